@@ -0,0 +1,72 @@
+"""
+Benchmark the single precision ray tracing mode against the double precision one: the same lens planes are traced with their pixels and the ray state (positions, deflections and jacobians) in double precision, in single precision, and in single precision with double precision accumulators (positions and jacobians); the timings and the convergence differences are reported
+
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from astropy.units import Mpc,deg
+from astropy.cosmology import WMAP9
+
+from lenstools.simulations.raytracing import RayTracer,PotentialPlane
+
+#Size of the lens planes, number of rays on a side and source redshift
+num_pixel_side = int(sys.argv[1]) if len(sys.argv)>1 else 2048
+num_rays_side = int(sys.argv[2]) if len(sys.argv)>2 else 1024
+source_redshift = 2.0
+side_length = 240.0 * Mpc
+map_angle = 3.0 * deg
+
+#Generate a smooth random potential on each plane (power spectrum ~ k^-6, the potential of a ~k^-2 density field)
+def randomPotential(seed):
+
+	np.random.seed(seed)
+	k = np.sqrt(np.add.outer(np.fft.fftfreq(num_pixel_side)**2,np.fft.rfftfreq(num_pixel_side)**2))
+	k[0,0] = 1.0
+
+	ft = (np.random.randn(*k.shape) + 1.0j*np.random.randn(*k.shape)) * k**-3
+	ft[0,0] = 0.0
+	potential = np.fft.irfft2(ft,s=(num_pixel_side,num_pixel_side))
+
+	return potential / potential.std()
+
+redshifts = np.arange(0.1,source_redshift+0.1,0.1)
+planes64 = list()
+planes32 = list()
+
+for n,z in enumerate(redshifts):
+
+	#Normalize the potential so that the convergence rms is ~0.01 per lens
+	plane = PotentialPlane(randomPotential(n),angle=side_length,redshift=z,cosmology=WMAP9)
+	plane.data *= 0.01 / np.abs(plane.density().data).std()
+
+	planes64.append(plane)
+	planes32.append(PotentialPlane(plane.data.astype(np.float32),angle=side_length,redshift=z,cosmology=WMAP9))
+
+#Ray tracing
+b = np.linspace(0.0,map_angle.value,num_rays_side)
+pos = np.array(np.meshgrid(b,b)) * map_angle.unit
+
+results = dict()
+for name,planes,dtype,accumulator_dtype in [("float64",planes64,np.float64,None),("float32",planes32,np.float32,None),("float32 (float64 accumulators)",planes32,np.float32,np.float64)]:
+
+	tracer = RayTracer(dtype=dtype,accumulator_dtype=accumulator_dtype)
+	for plane in planes:
+		tracer.addLens(plane)
+
+	start = time.time()
+	jacobian = tracer.shoot(pos,z=source_redshift-0.05,kind="jacobians")
+	elapsed = time.time() - start
+
+	results[name] = 1.0 - 0.5*(jacobian[0]+jacobian[3])
+	plane_memory = sum([ plane.data.nbytes for plane in planes ]) / 1024.**2
+	print("{0}: {1}x{1} rays through {2} lenses of {3}x{3} pixels in {4:.3f}s, lens planes take {5:.1f} Mbyte".format(name,num_rays_side,len(planes),num_pixel_side,elapsed,plane_memory))
+
+#Errors with respect to the double precision result
+print("Convergence rms: {0:.3e}".format(results["float64"].std()))
+for name in ["float32","float32 (float64 accumulators)"]:
+	difference = results[name] - results["float64"]
+	print("{0} error: max {1:.3e}, rms {2:.3e} (relative to the convergence rms: {3:.3e})".format(name,np.abs(difference).max(),difference.std(),difference.std()/results["float64"].std()))
@@ -7,4 +7,5 @@ except ImportError:
 
 from . import _gadget2
 from . import _nbody
-from . import _pixelize
\ No newline at end of file
+from . import _pixelize
+from . import _raytracing
\ No newline at end of file
@@ -19,8 +19,11 @@ static struct module_state _state;
 
 //Python module docstrings
 static char module_docstring[] = "This module provides a python interface for operations on Nbody simulation snapshots";
-static char grid3d_docstring[] = "Put the snapshot particles on a regularly spaced grid";
+static char grid3d_docstring[] = "Put the snapshot particles on a regularly spaced grid (point particles are assigned with the nearest grid point, cloud in cell or triangular shaped cloud scheme, optionally wrapping the clouds around the periodic axes)";
 static char grid3d_nfw_docstring[] = "Put the snapshot particles on a regularly spaced grid, but give each particle a NFW profile";
+static char project_slabs_docstring[] = "Project the snapshot particles on several slabs in a single pass over the particles, accumulating straight into the 2d planes with the nearest grid point, cloud in cell or triangular shaped cloud scheme";
+static char set_threads_docstring[] = "Set the number of threads used in the gridding procedures (0 means the OpenMP default)";
+static char get_threads_docstring[] = "Number of threads used in the gridding procedures (always 1 if the module was built without OpenMP)";
 static char adaptive_docstring[] = "Put the snapshot particles on a regularly spaced grid using adaptive smoothing";
 
 //Useful
@@ -30,14 +33,20 @@ static PyObject *_apply_kernel3d(PyObject *args,double(*kernel)(double,double,do
 //Method declarations
 static PyObject * _nbody_grid3d(PyObject *self,PyObject *args);
 static PyObject *_nbody_grid3d_nfw(PyObject *self,PyObject *args);
+static PyObject *_nbody_project_slabs(PyObject *self,PyObject *args);
 static PyObject * _nbody_adaptive(PyObject *self,PyObject *args);
+static PyObject *_nbody_set_threads(PyObject *self,PyObject *args);
+static PyObject *_nbody_get_threads(PyObject *self,PyObject *args);
 
 //_nbody method definitions
 static PyMethodDef module_methods[] = {
 
 	{"grid3d",_nbody_grid3d,METH_VARARGS,grid3d_docstring},
 	{"grid3d_nfw",_nbody_grid3d_nfw,METH_VARARGS,grid3d_nfw_docstring},
+	{"project_slabs",_nbody_project_slabs,METH_VARARGS,project_slabs_docstring},
 	{"adaptive",_nbody_adaptive,METH_VARARGS,adaptive_docstring},
+	{"set_threads",_nbody_set_threads,METH_VARARGS,set_threads_docstring},
+	{"get_threads",_nbody_get_threads,METH_VARARGS,get_threads_docstring},
 	{NULL,NULL,0,NULL}
 
 } ;
@@ -214,7 +223,11 @@ static PyObject *_apply_kernel2d(PyObject *args,double(*kernel)(double,double,do
 	double *lensingPlane = (double *)PyArray_DATA(lensingPlane_array);
 
 	//Compute the adaptive smoothing using C backend
-	adaptiveSmoothing(NumPart,positions,weights,rp,concentration,binning0,binning1,center,direction0,direction1,normal,size0,size1,PyObject_IsTrue(projectAll),lensingPlane,kernel);
+	int project_all = PyObject_IsTrue(projectAll);
+
+	Py_BEGIN_ALLOW_THREADS
+	adaptiveSmoothing(NumPart,positions,weights,rp,concentration,binning0,binning1,center,direction0,direction1,normal,size0,size1,project_all,lensingPlane,kernel);
+	Py_END_ALLOW_THREADS
 
 	//Cleanup
 	Py_DECREF(positions_array);
@@ -237,9 +250,15 @@ static PyObject *_apply_kernel3d(PyObject *args,double(*kernel)(double,double,do
 	PyObject *positions_obj,*bins_obj,*weights_obj,*radius_obj,*concentration_obj;
 	float *weights;
 	double *radius,*concentration;
+	int assignment=ASSIGNMENT_NGP,periodic[3]={1,1,1};
 
-	//parse input tuple
-	if(!PyArg_ParseTuple(args,"OOOOO",&positions_obj,&bins_obj,&weights_obj,&radius_obj,&concentration_obj)){
+	//parse input tuple (the assignment scheme and the periodic axes are optional)
+	if(!PyArg_ParseTuple(args,"OOOOO|i(iii)",&positions_obj,&bins_obj,&weights_obj,&radius_obj,&concentration_obj,&assignment,periodic,periodic+1,periodic+2)){
+		return NULL;
+	}
+
+	if(assignment!=ASSIGNMENT_NGP && assignment!=ASSIGNMENT_CIC && assignment!=ASSIGNMENT_TSC){
+		PyErr_SetString(PyExc_ValueError,"assignment must be 0 (NGP), 1 (CIC) or 2 (TSC)");
 		return NULL;
 	}
 
@@ -374,7 +393,9 @@ static PyObject *_apply_kernel3d(PyObject *args,double(*kernel)(double,double,do
 	float *grid_data = (float *)PyArray_DATA(grid_array);
 
 	//Snap the particles on the grid
-	grid3d(positions_data,weights,radius,concentration,NumPart,binsX_data[0],binsY_data[0],binsZ_data[0],binsX_data[1] - binsX_data[0],binsY_data[1] - binsY_data[0],binsZ_data[1] - binsZ_data[0],nx,ny,nz,grid_data,kernel);
+	Py_BEGIN_ALLOW_THREADS
+	grid3d(positions_data,weights,radius,concentration,NumPart,binsX_data[0],binsY_data[0],binsZ_data[0],binsX_data[1] - binsX_data[0],binsY_data[1] - binsY_data[0],binsZ_data[1] - binsZ_data[0],nx,ny,nz,grid_data,kernel,assignment,periodic);
+	Py_END_ALLOW_THREADS
 
 	//return the grid
 	Py_DECREF(positions_array);
@@ -406,9 +427,187 @@ static PyObject *_nbody_grid3d_nfw(PyObject *self,PyObject *args){
 }
 
 
+//project_slabs() implementation
+static PyObject *_nbody_project_slabs(PyObject *self,PyObject *args){
+
+	PyObject *positions_obj,*weights_obj,*left_obj,*size_obj,*shape_obj,*normals_obj,*thickness_weights_obj;
+	int assignment,g,d0,d1,Nweights;
+	float *weights;
+
+	//parse input tuple
+	if(!PyArg_ParseTuple(args,"OOOOOOOi",&positions_obj,&weights_obj,&left_obj,&size_obj,&shape_obj,&normals_obj,&thickness_weights_obj,&assignment)){
+		return NULL;
+	}
+
+	if(assignment<ASSIGNMENT_NGP || assignment>ASSIGNMENT_TSC){
+		PyErr_SetString(PyExc_ValueError,"Unknown mass assignment scheme");
+		return NULL;
+	}
+
+	//interpret parameters as numpy arrays
+	PyObject *positions_array = PyArray_FROM_OTF(positions_obj,NPY_FLOAT32,NPY_IN_ARRAY);
+	PyObject *left_array = PyArray_FROM_OTF(left_obj,NPY_DOUBLE,NPY_IN_ARRAY);
+	PyObject *size_array = PyArray_FROM_OTF(size_obj,NPY_DOUBLE,NPY_IN_ARRAY);
+	PyObject *shape_array = PyArray_FROM_OTF(shape_obj,NPY_INT32,NPY_IN_ARRAY);
+	PyObject *normals_array = PyArray_FROM_OTF(normals_obj,NPY_INT32,NPY_IN_ARRAY);
+	PyObject *thickness_weights_array = PyArray_FROM_OTF(thickness_weights_obj,NPY_DOUBLE,NPY_IN_ARRAY);
+	PyObject *weights_array = NULL;
+
+	if(weights_obj!=Py_None) weights_array = PyArray_FROM_OTF(weights_obj,NPY_FLOAT32,NPY_IN_ARRAY);
+
+	//check if anything failed
+	if(positions_array==NULL || left_array==NULL || size_array==NULL || shape_array==NULL || normals_array==NULL || thickness_weights_array==NULL || (weights_obj!=Py_None && weights_array==NULL)){
+		
+		Py_XDECREF(positions_array);
+		Py_XDECREF(left_array);
+		Py_XDECREF(size_array);
+		Py_XDECREF(shape_array);
+		Py_XDECREF(normals_array);
+		Py_XDECREF(thickness_weights_array);
+		Py_XDECREF(weights_array);
+
+		return NULL;
+	}
+
+	//Get info about the number of slabs
+	int NumPart = (int)PyArray_DIM(positions_array,0);
+	int Nslabs = (int)PyArray_SIZE(normals_array);
+	int *shape_data = (int *)PyArray_DATA(shape_array);
+	int *normals_data = (int *)PyArray_DATA(normals_array);
+	weights = (weights_array==NULL) ? NULL : (float *)PyArray_DATA(weights_array);
+
+	//Check that the geometry of the slabs is consistent
+	for(Nweights=0,g=0;g<Nslabs;g++){
+		
+		if(normals_data[g]<0 || normals_data[g]>2) break;
+		Nweights += shape_data[3*g + normals_data[g]];
+	
+	}
+
+	if(g<Nslabs || PyArray_SIZE(left_array)!=3*Nslabs || PyArray_SIZE(size_array)!=3*Nslabs || PyArray_SIZE(shape_array)!=3*Nslabs || PyArray_SIZE(thickness_weights_array)!=Nweights){
+
+		Py_DECREF(positions_array);
+		Py_DECREF(left_array);
+		Py_DECREF(size_array);
+		Py_DECREF(shape_array);
+		Py_DECREF(normals_array);
+		Py_DECREF(thickness_weights_array);
+		Py_XDECREF(weights_array);
+
+		PyErr_SetString(PyExc_ValueError,"The slab geometry and the thickness weights are not consistent!");
+		return NULL;
+
+	}
+
+	//Allocate the planes
+	PyObject *plane_list = PyList_New(Nslabs);
+	float **planes = (float **)malloc(sizeof(float *)*(Nslabs>0 ? Nslabs : 1));
+
+	if(plane_list==NULL || planes==NULL){
+
+		Py_XDECREF(plane_list);
+		free(planes);
+		Py_DECREF(positions_array);
+		Py_DECREF(left_array);
+		Py_DECREF(size_array);
+		Py_DECREF(shape_array);
+		Py_DECREF(normals_array);
+		Py_DECREF(thickness_weights_array);
+		Py_XDECREF(weights_array);
+
+		return PyErr_NoMemory();
+
+	}
+
+	for(g=0;g<Nslabs;g++){
+
+		//Directions of the plane
+		d0 = (normals_data[g]==0) ? 1 : 0;
+		d1 = (normals_data[g]==2) ? 1 : 2;
+
+		npy_intp planeDims[] = {(npy_intp) shape_data[3*g + d0],(npy_intp) shape_data[3*g + d1]};
+		PyObject *plane_array = PyArray_ZEROS(2,planeDims,NPY_FLOAT32,0);
+
+		if(plane_array==NULL){
+
+			Py_DECREF(plane_list);
+			free(planes);
+			Py_DECREF(positions_array);
+			Py_DECREF(left_array);
+			Py_DECREF(size_array);
+			Py_DECREF(shape_array);
+			Py_DECREF(normals_array);
+			Py_DECREF(thickness_weights_array);
+			Py_XDECREF(weights_array);
+
+			return NULL;
+
+		}
+
+		//The list steals the reference
+		PyList_SET_ITEM(plane_list,g,plane_array);
+		planes[g] = (float *)PyArray_DATA(plane_array);
+
+	}
+
+	//Project the particles on all the slabs at once
+	int status;
+
+	Py_BEGIN_ALLOW_THREADS
+	status = projectSlabs((float *)PyArray_DATA(positions_array),weights,NumPart,Nslabs,(double *)PyArray_DATA(left_array),(double *)PyArray_DATA(size_array),shape_data,normals_data,(double *)PyArray_DATA(thickness_weights_array),planes,assignment);
+	Py_END_ALLOW_THREADS
+
+	if(status){
+		Py_DECREF(plane_list);
+		plane_list = PyErr_NoMemory();
+	}
+
+	//return the planes
+	free(planes);
+	Py_DECREF(positions_array);
+	Py_DECREF(left_array);
+	Py_DECREF(size_array);
+	Py_DECREF(shape_array);
+	Py_DECREF(normals_array);
+	Py_DECREF(thickness_weights_array);
+	Py_XDECREF(weights_array);
+
+	return plane_list;
+
+}
+
+
 //adaptive() implementation
 static PyObject * _nbody_adaptive(PyObject *self,PyObject *args){
 
 	return _apply_kernel2d(args,quadraticKernel);
 
-}
\ No newline at end of file
+}
+
+
+//set_threads() implementation
+static PyObject *_nbody_set_threads(PyObject *self,PyObject *args){
+
+	int nthreads;
+
+	//parse input tuple
+	if(!PyArg_ParseTuple(args,"i",&nthreads)){
+		return NULL;
+	}
+
+	if(nthreads<0){
+		PyErr_SetString(PyExc_ValueError,"The number of threads must be non negative!");
+		return NULL;
+	}
+
+	setGridThreads(nthreads);
+	Py_RETURN_NONE;
+
+}
+
+//get_threads() implementation
+static PyObject *_nbody_get_threads(PyObject *self,PyObject *args){
+
+	return Py_BuildValue("i",getGridThreads());
+
+}
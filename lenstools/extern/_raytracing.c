@@ -0,0 +1,408 @@
+/*Python wrapper module for the ray tracing kernels;
+the method used is the same as in
+http://dan.iel.fm/posts/python-c-extensions/
+
+The module is called _raytracing and it defines the methods below (see docstrings)
+*/
+
+#include <stdio.h>
+
+#include <Python.h>
+#include <numpy/arrayobject.h>
+
+#include "lenstoolsPy3.h"
+#include "jacobian.h"
+#include "deflection.h"
+#include "postborn.h"
+
+#ifndef IS_PY3K
+static struct module_state _state;
+#endif
+
+//Python module docstrings
+static char module_docstring[] = "This module provides a python interface for the ray tracing kernels";
+static char jacobianUpdate_docstring[] = "Gather the shear matrices at the ray positions and update the ray jacobians and their deflections in place, in a single pass over the rays (the field, the jacobians and their deflections can be in single or double precision; with a non zero interpolation order the ray positions are fractional pixel coordinates)";
+static char lensQuantities_docstring[] = "Gather the deflection angles, the shear matrices and the gradients of the laplacian of the lensing potential at the ray pixels, in a single pass over the rays, into a preallocated (7,Nrays) array (in pixel units)";
+static char deflectionUpdate_docstring[] = "Gather the deflection angles at the ray positions and update the ray deflections in place, in a single pass over the rays (the field and the deflections can be in single or double precision; with a non zero interpolation order the ray positions are fractional pixel coordinates)";
+
+//Method declarations
+static PyObject *_raytracing_jacobianUpdate(PyObject *self,PyObject *args);
+static PyObject *_raytracing_deflectionUpdate(PyObject *self,PyObject *args);
+static PyObject *_raytracing_lensQuantities(PyObject *self,PyObject *args);
+
+//_raytracing method definitions
+static PyMethodDef module_methods[] = {
+
+	{"jacobianUpdate",_raytracing_jacobianUpdate,METH_VARARGS,jacobianUpdate_docstring},
+	{"deflectionUpdate",_raytracing_deflectionUpdate,METH_VARARGS,deflectionUpdate_docstring},
+	{"lensQuantities",_raytracing_lensQuantities,METH_VARARGS,lensQuantities_docstring},
+	{NULL,NULL,0,NULL}
+
+} ;
+
+//_raytracing constructor
+
+#ifdef IS_PY3K
+
+static struct PyModuleDef moduledef = {
+
+	PyModuleDef_HEAD_INIT,
+	"_raytracing",
+	module_docstring,
+	sizeof(struct module_state),
+	module_methods,
+	NULL,
+	myextension_trasverse,
+	myextension_clear,
+	NULL
+
+};
+
+#define INITERROR return NULL
+
+PyMODINIT_FUNC
+PyInit__raytracing(void)
+
+#else
+
+#define INITERROR return
+
+void
+init_raytracing(void)
+#endif
+
+{
+#ifdef IS_PY3K
+	PyObject *m = PyModule_Create(&moduledef);
+#else
+	PyObject *m = Py_InitModule3("_raytracing",module_methods,module_docstring);
+#endif
+
+	if(m==NULL)
+		INITERROR;
+	struct module_state *st = GETSTATE(m);
+
+	st->error = PyErr_NewException("_raytracing.Error", NULL, NULL);
+    if (st->error == NULL) {
+        Py_DECREF(m);
+        INITERROR;
+    }
+
+	/*Load numpy functionality*/
+	import_array();
+
+	/*Return*/
+#ifdef IS_PY3K
+	return m;
+#endif
+
+}
+
+//////////////////////////////////////////////
+//////////////////////////////////////////////
+//////////////////////////////////////////////
+
+//Check that a (Ncomponents,Nrays) array of floats or doubles can be updated in place: the rows must be contiguous, but they can be strided (i.e. a chunk of a larger array); the precision of the array is stored in single_precision
+static int check_inplace(PyObject *obj,int Ncomponents,const char *name,int *single_precision){
+
+	PyArrayObject *array = (PyArrayObject *)obj;
+	size_t itemsize;
+
+	if(!PyArray_Check(obj) || (PyArray_TYPE(array)!=NPY_DOUBLE && PyArray_TYPE(array)!=NPY_FLOAT)){
+		PyErr_Format(PyExc_TypeError,"%s must be an array of floats or doubles",name);
+		return 0;
+	}
+
+	*single_precision = (PyArray_TYPE(array)==NPY_FLOAT);
+	itemsize = (*single_precision) ? sizeof(float) : sizeof(double);
+
+	if(PyArray_NDIM(array)!=2 || PyArray_DIM(array,0)!=Ncomponents || PyArray_STRIDE(array,1)!=(npy_intp)itemsize || PyArray_STRIDE(array,0)%itemsize || !PyArray_ISWRITEABLE(array)){
+		PyErr_Format(PyExc_TypeError,"%s must be a writeable (%d,Nrays) array with contiguous rows",name,Ncomponents);
+		return 0;
+	}
+
+	return 1;
+
+}
+
+//jacobianUpdate() implementation
+static PyObject *_raytracing_jacobianUpdate(PyObject *self,PyObject *args){
+
+	PyObject *field_obj,*x_obj,*y_obj,*jacobian_obj,*jacobian_deflection_obj,*weight_obj;
+	PyObject *x_array=NULL,*y_array=NULL,*weight_array=NULL;
+	double scale,Ak,Ck,weight_scale;
+	int *x_data=NULL,*y_data=NULL,Ncomponents,order=0,single_precision_jacobian,single_precision_deflection;
+	double *x_coords=NULL,*y_coords=NULL,*weight_data=NULL;
+	long map_size,Nrays;
+
+	//parse input tuple (the interpolation order is optional)
+	if(!PyArg_ParseTuple(args,"OOOdOOddOd|i",&field_obj,&x_obj,&y_obj,&scale,&jacobian_obj,&jacobian_deflection_obj,&Ak,&Ck,&weight_obj,&weight_scale,&order)) return NULL;
+
+	//the jacobians are updated in place
+	if(!check_inplace(jacobian_obj,4,"jacobian",&single_precision_jacobian) || !check_inplace(jacobian_deflection_obj,4,"jacobian_deflection",&single_precision_deflection)) return NULL;
+
+	Nrays = (long)PyArray_DIM((PyArrayObject *)jacobian_obj,1);
+	if(PyArray_DIM((PyArrayObject *)jacobian_deflection_obj,1)!=Nrays){
+		PyErr_SetString(PyExc_ValueError,"jacobian and jacobian_deflection must have the same size");
+		return NULL;
+	}
+
+	//interpret the field array (single precision fields are not converted)
+	int single_precision = (PyArray_Check(field_obj) && PyArray_TYPE((PyArrayObject *)field_obj)==NPY_FLOAT);
+	PyObject *field_array = PyArray_FROM_OTF(field_obj,(single_precision ? NPY_FLOAT : NPY_DOUBLE),NPY_IN_ARRAY);
+	if(field_array==NULL) return NULL;
+
+	//interpret the pixel indices (or the fractional pixel coordinates if interpolating) and the weights, if provided
+	if(x_obj!=Py_None && y_obj!=Py_None){
+		x_array = PyArray_FROM_OTF(x_obj,(order ? NPY_DOUBLE : NPY_INT32),NPY_IN_ARRAY);
+		y_array = PyArray_FROM_OTF(y_obj,(order ? NPY_DOUBLE : NPY_INT32),NPY_IN_ARRAY);
+	}
+
+	if(weight_obj!=Py_None){
+		weight_array = PyArray_FROM_OTF(weight_obj,NPY_DOUBLE,NPY_IN_ARRAY);
+	}
+
+	//check if anything failed
+	if((x_obj!=Py_None && y_obj!=Py_None && (x_array==NULL || y_array==NULL)) || (weight_obj!=Py_None && weight_array==NULL)){
+
+		Py_DECREF(field_array);
+		Py_XDECREF(x_array);
+		Py_XDECREF(y_array);
+		Py_XDECREF(weight_array);
+
+		return NULL;
+	}
+
+	//check the shapes
+	if(x_array!=NULL){
+
+		Ncomponents = (PyArray_NDIM((PyArrayObject *)field_array)==2) ? 1 : (int)PyArray_DIM((PyArrayObject *)field_array,0);
+		map_size = (long)PyArray_DIM((PyArrayObject *)field_array,PyArray_NDIM((PyArrayObject *)field_array)-1);
+
+		if((Ncomponents!=1 && Ncomponents!=3) || PyArray_SIZE((PyArrayObject *)x_array)!=Nrays || PyArray_SIZE((PyArrayObject *)y_array)!=Nrays){
+			PyErr_SetString(PyExc_ValueError,"field must have shape (N,N) or (3,N,N), and there must be one pixel position per ray");
+			goto fail;
+		}
+
+		if(order){
+			x_coords = (double *)PyArray_DATA((PyArrayObject *)x_array);
+			y_coords = (double *)PyArray_DATA((PyArrayObject *)y_array);
+		} else{
+			x_data = (int *)PyArray_DATA((PyArrayObject *)x_array);
+			y_data = (int *)PyArray_DATA((PyArrayObject *)y_array);
+		}
+
+	} else{
+
+		Ncomponents = 3;
+		map_size = 0;
+
+		if(PyArray_SIZE((PyArrayObject *)field_array)!=3*Nrays){
+			PyErr_SetString(PyExc_ValueError,"without pixel indices, field must have shape (3,Nrays)");
+			goto fail;
+		}
+	}
+
+	if(weight_array!=NULL){
+
+		if(PyArray_SIZE((PyArrayObject *)weight_array)!=Nrays){
+			PyErr_SetString(PyExc_ValueError,"there must be one weight per ray");
+			goto fail;
+		}
+
+		weight_data = (double *)PyArray_DATA((PyArrayObject *)weight_array);
+	}
+
+	//get the data pointers
+	void *field = PyArray_DATA((PyArrayObject *)field_array);
+	void *jacobian = PyArray_DATA((PyArrayObject *)jacobian_obj);
+	void *jacobian_deflection = PyArray_DATA((PyArrayObject *)jacobian_deflection_obj);
+	long jacobian_stride = (long)(PyArray_STRIDE((PyArrayObject *)jacobian_obj,0)/PyArray_ITEMSIZE((PyArrayObject *)jacobian_obj));
+	long deflection_stride = (long)(PyArray_STRIDE((PyArrayObject *)jacobian_deflection_obj,0)/PyArray_ITEMSIZE((PyArrayObject *)jacobian_deflection_obj));
+
+	//call the C backend, the interpreter is not needed while the rays are processed
+	Py_BEGIN_ALLOW_THREADS
+	jacobian_update(field,single_precision,map_size,Ncomponents,scale,Nrays,x_data,y_data,x_coords,y_coords,order,jacobian,single_precision_jacobian,jacobian_stride,jacobian_deflection,single_precision_deflection,deflection_stride,Ak,Ck,weight_data,weight_scale);
+	Py_END_ALLOW_THREADS
+
+	//cleanup
+	Py_DECREF(field_array);
+	Py_XDECREF(x_array);
+	Py_XDECREF(y_array);
+	Py_XDECREF(weight_array);
+
+	//return None
+	Py_RETURN_NONE;
+
+fail:
+
+	Py_DECREF(field_array);
+	Py_XDECREF(x_array);
+	Py_XDECREF(y_array);
+	Py_XDECREF(weight_array);
+
+	return NULL;
+
+}
+
+
+//deflectionUpdate() implementation
+static PyObject *_raytracing_deflectionUpdate(PyObject *self,PyObject *args){
+
+	PyObject *field_obj,*x_obj,*y_obj,*deflection_obj;
+	PyObject *x_array=NULL,*y_array=NULL;
+	double scale,Ak,Ck;
+	int *x_data=NULL,*y_data=NULL,Ncomponents,order=0,single_precision_deflection;
+	double *x_coords=NULL,*y_coords=NULL;
+	long map_size,Nrays;
+
+	//parse input tuple (the interpolation order is optional)
+	if(!PyArg_ParseTuple(args,"OOOdOdd|i",&field_obj,&x_obj,&y_obj,&scale,&deflection_obj,&Ak,&Ck,&order)) return NULL;
+
+	//the deflections are updated in place
+	if(!check_inplace(deflection_obj,2,"deflection",&single_precision_deflection)) return NULL;
+	Nrays = (long)PyArray_DIM((PyArrayObject *)deflection_obj,1);
+
+	//interpret the field array (single precision fields are not converted)
+	int single_precision = (PyArray_Check(field_obj) && PyArray_TYPE((PyArrayObject *)field_obj)==NPY_FLOAT);
+	PyObject *field_array = PyArray_FROM_OTF(field_obj,(single_precision ? NPY_FLOAT : NPY_DOUBLE),NPY_IN_ARRAY);
+	if(field_array==NULL) return NULL;
+
+	//interpret the pixel indices (or the fractional pixel coordinates if interpolating), if provided
+	if(x_obj!=Py_None && y_obj!=Py_None){
+		
+		x_array = PyArray_FROM_OTF(x_obj,(order ? NPY_DOUBLE : NPY_INT32),NPY_IN_ARRAY);
+		y_array = PyArray_FROM_OTF(y_obj,(order ? NPY_DOUBLE : NPY_INT32),NPY_IN_ARRAY);
+
+		if(x_array==NULL || y_array==NULL){
+			
+			Py_DECREF(field_array);
+			Py_XDECREF(x_array);
+			Py_XDECREF(y_array);
+			
+			return NULL;
+		}
+	}
+
+	//check the shapes
+	if(x_array!=NULL){
+
+		Ncomponents = (PyArray_NDIM((PyArrayObject *)field_array)==2) ? 1 : (int)PyArray_DIM((PyArrayObject *)field_array,0);
+		map_size = (long)PyArray_DIM((PyArrayObject *)field_array,PyArray_NDIM((PyArrayObject *)field_array)-1);
+
+		if((Ncomponents!=1 && Ncomponents!=2) || PyArray_SIZE((PyArrayObject *)x_array)!=Nrays || PyArray_SIZE((PyArrayObject *)y_array)!=Nrays){
+			PyErr_SetString(PyExc_ValueError,"field must have shape (N,N) or (2,N,N), and there must be one pixel position per ray");
+			goto fail;
+		}
+
+		if(order){
+			x_coords = (double *)PyArray_DATA((PyArrayObject *)x_array);
+			y_coords = (double *)PyArray_DATA((PyArrayObject *)y_array);
+		} else{
+			x_data = (int *)PyArray_DATA((PyArrayObject *)x_array);
+			y_data = (int *)PyArray_DATA((PyArrayObject *)y_array);
+		}
+
+	} else{
+
+		Ncomponents = 2;
+		map_size = 0;
+
+		if(PyArray_SIZE((PyArrayObject *)field_array)!=2*Nrays){
+			PyErr_SetString(PyExc_ValueError,"without pixel indices, field must have shape (2,Nrays)");
+			goto fail;
+		}
+	}
+
+	//get the data pointers
+	void *field = PyArray_DATA((PyArrayObject *)field_array);
+	void *deflection = PyArray_DATA((PyArrayObject *)deflection_obj);
+	long deflection_stride = (long)(PyArray_STRIDE((PyArrayObject *)deflection_obj,0)/PyArray_ITEMSIZE((PyArrayObject *)deflection_obj));
+
+	//call the C backend, the interpreter is not needed while the rays are processed
+	Py_BEGIN_ALLOW_THREADS
+	deflection_update(field,single_precision,map_size,Ncomponents,scale,Nrays,x_data,y_data,x_coords,y_coords,order,deflection,single_precision_deflection,deflection_stride,Ak,Ck);
+	Py_END_ALLOW_THREADS
+
+	//cleanup
+	Py_DECREF(field_array);
+	Py_XDECREF(x_array);
+	Py_XDECREF(y_array);
+
+	//return None
+	Py_RETURN_NONE;
+
+fail:
+
+	Py_DECREF(field_array);
+	Py_XDECREF(x_array);
+	Py_XDECREF(y_array);
+
+	return NULL;
+
+}
+
+
+//lensQuantities() implementation
+static PyObject *_raytracing_lensQuantities(PyObject *self,PyObject *args){
+
+	PyObject *field_obj,*x_obj,*y_obj,*quantities_obj;
+	long map_size,Nrays;
+	int single_precision_quantities;
+
+	//parse input tuple
+	if(!PyArg_ParseTuple(args,"OOOO",&field_obj,&x_obj,&y_obj,&quantities_obj)) return NULL;
+
+	//the quantities are written in place, in double precision
+	if(!check_inplace(quantities_obj,7,"quantities",&single_precision_quantities)) return NULL;
+	if(single_precision_quantities){
+		PyErr_SetString(PyExc_TypeError,"quantities must be an array of doubles");
+		return NULL;
+	}
+	Nrays = (long)PyArray_DIM((PyArrayObject *)quantities_obj,1);
+
+	//interpret the potential (single precision potentials are not converted) and the pixel indices
+	int single_precision = (PyArray_Check(field_obj) && PyArray_TYPE((PyArrayObject *)field_obj)==NPY_FLOAT);
+	PyObject *field_array = PyArray_FROM_OTF(field_obj,(single_precision ? NPY_FLOAT : NPY_DOUBLE),NPY_IN_ARRAY);
+	PyObject *x_array = PyArray_FROM_OTF(x_obj,NPY_INT32,NPY_IN_ARRAY);
+	PyObject *y_array = PyArray_FROM_OTF(y_obj,NPY_INT32,NPY_IN_ARRAY);
+
+	if(field_array==NULL || x_array==NULL || y_array==NULL) goto fail;
+
+	//check the shapes
+	if(PyArray_NDIM((PyArrayObject *)field_array)!=2 || PyArray_SIZE((PyArrayObject *)x_array)!=Nrays || PyArray_SIZE((PyArrayObject *)y_array)!=Nrays){
+		PyErr_SetString(PyExc_ValueError,"field must have shape (N,N), and there must be one pixel position per ray");
+		goto fail;
+	}
+
+	map_size = (long)PyArray_DIM((PyArrayObject *)field_array,1);
+
+	//get the data pointers
+	void *field = PyArray_DATA((PyArrayObject *)field_array);
+	int *x_data = (int *)PyArray_DATA((PyArrayObject *)x_array);
+	int *y_data = (int *)PyArray_DATA((PyArrayObject *)y_array);
+	double *quantities = (double *)PyArray_DATA((PyArrayObject *)quantities_obj);
+	long quantities_stride = (long)(PyArray_STRIDE((PyArrayObject *)quantities_obj,0)/sizeof(double));
+
+	//call the C backend, the interpreter is not needed while the rays are processed
+	Py_BEGIN_ALLOW_THREADS
+	lens_quantities(field,single_precision,map_size,Nrays,x_data,y_data,quantities,quantities_stride);
+	Py_END_ALLOW_THREADS
+
+	//cleanup
+	Py_DECREF(field_array);
+	Py_DECREF(x_array);
+	Py_DECREF(y_array);
+
+	//return None
+	Py_RETURN_NONE;
+
+fail:
+
+	Py_XDECREF(field_array);
+	Py_XDECREF(x_array);
+	Py_XDECREF(y_array);
+
+	return NULL;
+
+}
@@ -17,6 +17,7 @@ The module is called _topology and it defines the methods below (see docstrings)
 #include "differentials.h"
 #include "minkowski.h"
 #include "azimuth.h"
+#include "interpolation.h"
 
 #ifndef IS_PY3K
 static struct module_state _state;
@@ -34,6 +35,7 @@ static char minkowski_docstring[] = "Measure the three Minkowski functionals of
 static char rfft2_azimuthal_docstring[] = "Measure azimuthal average of Fourier transforms of 2D image";
 static char bispectrum_docstring[] = "Measure the bispectrum from the Fourier transform of a 2D image";
 static char rfft3_azimuthal_docstring[] = "Measure azimuthal average of Fourier transforms of 3D scalar field";
+static char interpolationStencil_docstring[] = "Compute the pixels and weights of the interpolation stencils of points on a periodic 2D map";
 
 //method declarations
 static PyObject *_topology_peakCount(PyObject *self,PyObject *args);
@@ -45,6 +47,7 @@ static PyObject *_topology_minkowski(PyObject *self,PyObject *args);
 static PyObject *_topology_rfft2_azimuthal(PyObject *self,PyObject *args);
 static PyObject *_topology_bispectrum(PyObject *self,PyObject *args);
 static PyObject *_topology_rfft3_azimuthal(PyObject *self,PyObject *args);
+static PyObject *_topology_interpolationStencil(PyObject *self,PyObject *args);
 
 
 //_topology method definitions
@@ -59,6 +62,7 @@ static PyMethodDef module_methods[] = {
 	{"rfft2_azimuthal",_topology_rfft2_azimuthal,METH_VARARGS,rfft2_azimuthal_docstring},
 	{"bispectrum",_topology_bispectrum,METH_VARARGS,bispectrum_docstring},
 	{"rfft3_azimuthal",_topology_rfft3_azimuthal,METH_VARARGS,rfft3_azimuthal_docstring},
+	{"interpolationStencil",_topology_interpolationStencil,METH_VARARGS,interpolationStencil_docstring},
 	{NULL,NULL,0,NULL}
 
 } ;
@@ -411,8 +415,9 @@ static PyObject *_topology_gradient(PyObject *self,PyObject *args){
 		return NULL;
 	}
 
-	/*Interpret the input as a numpy array*/
-	PyObject *map_array = PyArray_FROM_OTF(map_obj,NPY_DOUBLE,NPY_IN_ARRAY);
+	/*Interpret the input as a numpy array (single precision maps are not converted)*/
+	int single_precision = (PyArray_Check(map_obj) && PyArray_TYPE((PyArrayObject *)map_obj)==NPY_FLOAT);
+	PyObject *map_array = PyArray_FROM_OTF(map_obj,(single_precision ? NPY_FLOAT : NPY_DOUBLE),NPY_IN_ARRAY);
 	if(map_array==NULL){
 		return NULL;
 	}
@@ -479,8 +484,10 @@ static PyObject *_topology_gradient(PyObject *self,PyObject *args){
 		return NULL;
 	}
 
-	/*Call the underlying C function that computes the gradient*/
-	gradient_xy((double *)PyArray_DATA(map_array),(double *)PyArray_DATA(gradient_x_array),(double *)PyArray_DATA(gradient_y_array),Nside,Npoints,x_data,y_data);
+	/*Call the underlying C function that computes the gradient (the interpreter is not needed meanwhile)*/
+	Py_BEGIN_ALLOW_THREADS
+	gradient_xy(PyArray_DATA(map_array),single_precision,(double *)PyArray_DATA(gradient_x_array),(double *)PyArray_DATA(gradient_y_array),Nside,Npoints,x_data,y_data);
+	Py_END_ALLOW_THREADS
 
 	/*Prepare a tuple container for the output*/
 	PyObject *gradient_output = PyTuple_New(2);
@@ -536,8 +543,9 @@ static PyObject *_topology_hessian(PyObject *self,PyObject *args){
 		return NULL;
 	}
 
-	/*Interpret the input as a numpy array*/
-	PyObject *map_array = PyArray_FROM_OTF(map_obj,NPY_DOUBLE,NPY_IN_ARRAY);
+	/*Interpret the input as a numpy array (single precision maps are not converted)*/
+	int single_precision = (PyArray_Check(map_obj) && PyArray_TYPE((PyArrayObject *)map_obj)==NPY_FLOAT);
+	PyObject *map_array = PyArray_FROM_OTF(map_obj,(single_precision ? NPY_FLOAT : NPY_DOUBLE),NPY_IN_ARRAY);
 	if(map_array==NULL){
 		return NULL;
 	}
@@ -606,8 +614,10 @@ static PyObject *_topology_hessian(PyObject *self,PyObject *args){
 		return NULL;
 	}
 
-	/*Call the underlying C function that computes the hessian*/
-	hessian((double *)PyArray_DATA(map_array),(double *)PyArray_DATA(hessian_xx_array),(double *)PyArray_DATA(hessian_yy_array),(double *)PyArray_DATA(hessian_xy_array),Nside,Npoints,x_data,y_data);
+	/*Call the underlying C function that computes the hessian (the interpreter is not needed meanwhile)*/
+	Py_BEGIN_ALLOW_THREADS
+	hessian(PyArray_DATA(map_array),single_precision,(double *)PyArray_DATA(hessian_xx_array),(double *)PyArray_DATA(hessian_yy_array),(double *)PyArray_DATA(hessian_xy_array),Nside,Npoints,x_data,y_data);
+	Py_END_ALLOW_THREADS
 
 	/*Prepare a tuple container for the output*/
 	PyObject *hessian_output = PyTuple_New(3);
@@ -680,8 +690,9 @@ static PyObject *_topology_gradLaplacian(PyObject *self,PyObject *args){
 		return NULL;
 	}
 
-	/*Interpret the input as a numpy array*/
-	PyObject *map_array = PyArray_FROM_OTF(map_obj,NPY_DOUBLE,NPY_IN_ARRAY);
+	/*Interpret the input as a numpy array (single precision maps are not converted)*/
+	int single_precision = (PyArray_Check(map_obj) && PyArray_TYPE((PyArrayObject *)map_obj)==NPY_FLOAT);
+	PyObject *map_array = PyArray_FROM_OTF(map_obj,(single_precision ? NPY_FLOAT : NPY_DOUBLE),NPY_IN_ARRAY);
 	if(map_array==NULL){
 		return NULL;
 	}
@@ -749,7 +760,9 @@ static PyObject *_topology_gradLaplacian(PyObject *self,PyObject *args){
 	}
 
 	/*Call the underlying C function that computes the gradient*/
-	gradLaplacian((double *)PyArray_DATA(map_array),(double *)PyArray_DATA(gradient_x_array),(double *)PyArray_DATA(gradient_y_array),Nside,Npoints,x_data,y_data);
+	Py_BEGIN_ALLOW_THREADS
+	gradLaplacian(PyArray_DATA(map_array),single_precision,(double *)PyArray_DATA(gradient_x_array),(double *)PyArray_DATA(gradient_y_array),Nside,Npoints,x_data,y_data);
+	Py_END_ALLOW_THREADS
 
 	/*Prepare a tuple container for the output*/
 	PyObject *gradient_output = PyTuple_New(2);
@@ -1289,3 +1302,89 @@ static PyObject *_topology_rfft3_azimuthal(PyObject *self,PyObject *args){
 	return output;
 }
 
+
+//interpolationStencil() implementation
+static PyObject *_topology_interpolationStencil(PyObject *self,PyObject *args){
+
+	PyObject *x_obj,*y_obj;
+	long map_size,n,p,Npoints;
+	int order,k,Nstencil;
+	long x_stencil[INTERPOLATION_MAX_STENCIL],y_stencil[INTERPOLATION_MAX_STENCIL];
+	double weights[INTERPOLATION_MAX_STENCIL];
+
+	/*Parse the input: fractional pixel coordinates, map size and interpolation order*/
+	if(!PyArg_ParseTuple(args,"OOli",&x_obj,&y_obj,&map_size,&order)){ 
+		return NULL;
+	}
+
+	if(map_size<=0){
+		PyErr_SetString(PyExc_ValueError,"the map size must be positive");
+		return NULL;
+	}
+
+	/*Interpret the coordinates as numpy arrays*/
+	PyObject *x_array = PyArray_FROM_OTF(x_obj,NPY_DOUBLE,NPY_IN_ARRAY);
+	PyObject *y_array = PyArray_FROM_OTF(y_obj,NPY_DOUBLE,NPY_IN_ARRAY);
+
+	if(x_array==NULL || y_array==NULL){
+		Py_XDECREF(x_array);
+		Py_XDECREF(y_array);
+		return NULL;
+	}
+
+	Npoints = (long)PyArray_SIZE(x_array);
+	if((long)PyArray_SIZE(y_array)!=Npoints){
+		PyErr_SetString(PyExc_ValueError,"x and y must have the same size");
+		Py_DECREF(x_array);
+		Py_DECREF(y_array);
+		return NULL;
+	}
+
+	/*Prepare the (Nstencil,Npoints) output arrays*/
+	Nstencil = interpolation_stencil_size(order);
+	npy_intp dims[] = {(npy_intp) Nstencil, (npy_intp) Npoints};
+	PyObject *x_points_array = PyArray_SimpleNew(2,dims,NPY_INT32);
+	PyObject *y_points_array = PyArray_SimpleNew(2,dims,NPY_INT32);
+	PyObject *weights_array = PyArray_SimpleNew(2,dims,NPY_DOUBLE);
+
+	if(x_points_array==NULL || y_points_array==NULL || weights_array==NULL){
+		
+		Py_DECREF(x_array);
+		Py_DECREF(y_array);
+		Py_XDECREF(x_points_array);
+		Py_XDECREF(y_points_array);
+		Py_XDECREF(weights_array);
+		
+		return NULL;
+	}
+
+	/*Compute the stencils (the interpreter is not needed meanwhile)*/
+	double *x_data = (double *)PyArray_DATA(x_array);
+	double *y_data = (double *)PyArray_DATA(y_array);
+	int *x_points = (int *)PyArray_DATA(x_points_array);
+	int *y_points = (int *)PyArray_DATA(y_points_array);
+	double *weights_data = (double *)PyArray_DATA(weights_array);
+
+	Py_BEGIN_ALLOW_THREADS
+	for(p=0;p<Npoints;p++){
+
+		interpolation_stencil(x_data[p],y_data[p],order,map_size,x_stencil,y_stencil,weights);
+		
+		for(k=0;k<Nstencil;k++){
+			n = k*Npoints + p;
+			x_points[n] = (int)x_stencil[k];
+			y_points[n] = (int)y_stencil[k];
+			weights_data[n] = weights[k];
+		}
+
+	}
+	Py_END_ALLOW_THREADS
+
+	/*Clean up*/
+	Py_DECREF(x_array);
+	Py_DECREF(y_array);
+
+	/*Done, now return*/
+	return Py_BuildValue("NNN",x_points_array,y_points_array,weights_array);
+
+}
@@ -13,4 +13,14 @@ static inline long fourier_coordinate(long x,long y,long map_size){
 	return ((map_size/2+1)*x + y);
 }
 
+/*Value of the pixel c of a map stored either in single or in double precision*/
+static inline double pixel_value(void *map,int single_precision,long c){
+	return single_precision ? (double)((float *)map)[c] : ((double *)map)[c];
+}
+
+/*Set the pixel c of a map stored either in single or in double precision*/
+static inline void set_pixel_value(void *map,int single_precision,long c,double value){
+	if(single_precision) ((float *)map)[c] = (float)value; else ((double *)map)[c] = value;
+}
+
 #endif
\ No newline at end of file
@@ -0,0 +1,83 @@
+#include <stdio.h>
+#include <stdlib.h>
+
+#include "coordinates.h"
+#include "interpolation.h"
+#include "deflection.h"
+
+/*Per-lens update of the ray deflections: for each ray gather the deflection angle a on the lens, then apply the recurrence
+
+Dk+1 = (Ak-1)Dk + Ck*a
+
+in place. The deflection angle is gathered according to the layout of the field:
+
+Ncomponents==1: field is the (map_size,map_size) lensing potential, the deflection is its gradient (same finite difference stencil as in differentials.c) 
+Ncomponents==2: field holds the (2,map_size,map_size) deflection angles on the lens; if neither the pixel indices nor the pixel coordinates are provided the field holds the (2,Nrays) deflection angles already gathered at the ray positions
+
+The ray positions are given either as pixel indices (x_points,y_points), or as fractional pixel coordinates (x_coords,y_coords): in the latter case the deflection angles are interpolated with the stencils in interpolation.c, of the given order.
+
+The field can be stored in single or double precision (single_precision flag), the gathered values are always processed in double precision. The deflection angles are multiplied by scale; D is stored in single or double precision too (single_precision_deflection flag), with its 2 components deflection_stride values apart
+*/
+
+/*Deflection angle at the pixel (x,y)*/
+static inline void deflection_pixel(void *field,int single_precision,long map_size,int Ncomponents,long x,long y,double *ax,double *ay){
+
+	long c;
+
+	if(Ncomponents==1){
+
+		*ax = (pixel_value(field,single_precision,coordinate(x+1,y,map_size)) - pixel_value(field,single_precision,coordinate(x-1,y,map_size)))/2.0;
+		*ay = (pixel_value(field,single_precision,coordinate(x,y+1,map_size)) - pixel_value(field,single_precision,coordinate(x,y-1,map_size)))/2.0;
+
+	} else{
+
+		c = coordinate(x,y,map_size);
+
+		*ax = pixel_value(field,single_precision,c);
+		*ay = pixel_value(field,single_precision,map_size*map_size+c);
+
+	}
+
+}
+
+void deflection_update(void *field,int single_precision,long map_size,int Ncomponents,double scale,long Nrays,int *x_points,int *y_points,double *x_coords,double *y_coords,int order,void *deflection,int single_precision_deflection,long deflection_stride,double Ak,double Ck){
+
+	long r;
+	int k,Nstencil;
+	long x_stencil[INTERPOLATION_MAX_STENCIL],y_stencil[INTERPOLATION_MAX_STENCIL];
+	double weights[INTERPOLATION_MAX_STENCIL];
+	double ax,ay,sx,sy;
+
+	for(r=0;r<Nrays;r++){
+
+		/*Gather the deflection angle*/
+		if(x_coords!=NULL){
+
+			Nstencil = interpolation_stencil(x_coords[r],y_coords[r],order,map_size,x_stencil,y_stencil,weights);
+			ax = 0.0;
+			ay = 0.0;
+
+			for(k=0;k<Nstencil;k++){
+				deflection_pixel(field,single_precision,map_size,Ncomponents,x_stencil[k],y_stencil[k],&sx,&sy);
+				ax += weights[k]*sx;
+				ay += weights[k]*sy;
+			}
+
+		} else if(x_points!=NULL){
+
+			deflection_pixel(field,single_precision,map_size,Ncomponents,x_points[r],y_points[r],&ax,&ay);
+
+		} else{
+
+			ax = pixel_value(field,single_precision,r);
+			ay = pixel_value(field,single_precision,Nrays+r);
+
+		}
+
+		/*Update the deflection*/
+		set_pixel_value(deflection,single_precision_deflection,r,(Ak-1)*pixel_value(deflection,single_precision_deflection,r) + Ck*(scale*ax));
+		set_pixel_value(deflection,single_precision_deflection,deflection_stride+r,(Ak-1)*pixel_value(deflection,single_precision_deflection,deflection_stride+r) + Ck*(scale*ay));
+
+	}
+
+}
@@ -0,0 +1,6 @@
+#ifndef __DEFLECTION_H
+#define __DEFLECTION_H
+
+void deflection_update(void *field,int single_precision,long map_size,int Ncomponents,double scale,long Nrays,int *x_points,int *y_points,double *x_coords,double *y_coords,int order,void *deflection,int single_precision_deflection,long deflection_stride,double Ak,double Ck);
+
+#endif
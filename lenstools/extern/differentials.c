@@ -4,7 +4,7 @@
 
 #include "coordinates.h"
 
-void gradient_xy(double *map,double *grad_map_x,double *grad_map_y,long map_size,int Npoints,int *x_points,int *y_points){
+void gradient_xy(void *map,int single_precision,double *grad_map_x,double *grad_map_y,long map_size,int Npoints,int *x_points,int *y_points){
 	
 	long i,j;
 	double grad_x,grad_y;
@@ -15,8 +15,8 @@ void gradient_xy(double *map,double *grad_map_x,double *grad_map_y,long map_size
 			for(j=0;j<map_size;j++){
 			
 			
-				grad_x=(map[coordinate(i+1,j,map_size)]-map[coordinate(i-1,j,map_size)])/2.0;
-				grad_y=(map[coordinate(i,j+1,map_size)]-map[coordinate(i,j-1,map_size)])/2.0;
+				grad_x=(pixel_value(map,single_precision,coordinate(i+1,j,map_size))-pixel_value(map,single_precision,coordinate(i-1,j,map_size)))/2.0;
+				grad_y=(pixel_value(map,single_precision,coordinate(i,j+1,map_size))-pixel_value(map,single_precision,coordinate(i,j-1,map_size)))/2.0;
 			
 				grad_map_x[coordinate(i,j,map_size)]=grad_x;
 				grad_map_y[coordinate(i,j,map_size)]=grad_y;
@@ -30,8 +30,8 @@ void gradient_xy(double *map,double *grad_map_x,double *grad_map_y,long map_size
 
 		for(i=0;i<Npoints;i++){
 
-			grad_x=(map[coordinate(x_points[i]+1,y_points[i],map_size)]-map[coordinate(x_points[i]-1,y_points[i],map_size)])/2.0;
-			grad_y=(map[coordinate(x_points[i],y_points[i]+1,map_size)]-map[coordinate(x_points[i],y_points[i]-1,map_size)])/2.0;
+			grad_x=(pixel_value(map,single_precision,coordinate(x_points[i]+1,y_points[i],map_size))-pixel_value(map,single_precision,coordinate(x_points[i]-1,y_points[i],map_size)))/2.0;
+			grad_y=(pixel_value(map,single_precision,coordinate(x_points[i],y_points[i]+1,map_size))-pixel_value(map,single_precision,coordinate(x_points[i],y_points[i]-1,map_size)))/2.0;
 			
 			grad_map_x[i]=grad_x;
 			grad_map_y[i]=grad_y;
@@ -42,7 +42,7 @@ void gradient_xy(double *map,double *grad_map_x,double *grad_map_y,long map_size
 	}
 }
 
-void hessian(double *map,double *hess_xx_map,double *hess_yy_map,double *hess_xy_map,long map_size,int Npoints, int *x_points,int *y_points){
+void hessian(void *map,int single_precision,double *hess_xx_map,double *hess_yy_map,double *hess_xy_map,long map_size,int Npoints, int *x_points,int *y_points){
 	
 	long i,j;
 	double hessian_xx,hessian_yy,hessian_xy;
@@ -53,9 +53,9 @@ void hessian(double *map,double *hess_xx_map,double *hess_yy_map,double *hess_xy
 		for(i=0;i<map_size;i++){
 			for(j=0;j<map_size;j++){
 			
-				hessian_xx=(map[coordinate(i+2,j,map_size)]+map[coordinate(i-2,j,map_size)]-2*map[coordinate(i,j,map_size)])/4.0;
-				hessian_yy=(map[coordinate(i,j+2,map_size)]+map[coordinate(i,j-2,map_size)]-2*map[coordinate(i,j,map_size)])/4.0;
-				hessian_xy=(map[coordinate(i+1,j+1,map_size)]+map[coordinate(i-1,j-1,map_size)]-map[coordinate(i-1,j+1,map_size)]-map[coordinate(i+1,j-1,map_size)])/4.0;
+				hessian_xx=(pixel_value(map,single_precision,coordinate(i+2,j,map_size))+pixel_value(map,single_precision,coordinate(i-2,j,map_size))-2*pixel_value(map,single_precision,coordinate(i,j,map_size)))/4.0;
+				hessian_yy=(pixel_value(map,single_precision,coordinate(i,j+2,map_size))+pixel_value(map,single_precision,coordinate(i,j-2,map_size))-2*pixel_value(map,single_precision,coordinate(i,j,map_size)))/4.0;
+				hessian_xy=(pixel_value(map,single_precision,coordinate(i+1,j+1,map_size))+pixel_value(map,single_precision,coordinate(i-1,j-1,map_size))-pixel_value(map,single_precision,coordinate(i-1,j+1,map_size))-pixel_value(map,single_precision,coordinate(i+1,j-1,map_size)))/4.0;
 			
 				hess_xx_map[coordinate(i,j,map_size)]=hessian_xx;
 				hess_yy_map[coordinate(i,j,map_size)]=hessian_yy;
@@ -69,9 +69,9 @@ void hessian(double *map,double *hess_xx_map,double *hess_yy_map,double *hess_xy
 
 			for(i=0;i<Npoints;i++){
 				
-				hessian_xx=(map[coordinate(x_points[i]+2,y_points[i],map_size)]+map[coordinate(x_points[i]-2,y_points[i],map_size)]-2*map[coordinate(x_points[i],y_points[i],map_size)])/4.0;
-				hessian_yy=(map[coordinate(x_points[i],y_points[i]+2,map_size)]+map[coordinate(x_points[i],y_points[i]-2,map_size)]-2*map[coordinate(x_points[i],y_points[i],map_size)])/4.0;
-				hessian_xy=(map[coordinate(x_points[i]+1,y_points[i]+1,map_size)]+map[coordinate(x_points[i]-1,y_points[i]-1,map_size)]-map[coordinate(x_points[i]-1,y_points[i]+1,map_size)]-map[coordinate(x_points[i]+1,y_points[i]-1,map_size)])/4.0;
+				hessian_xx=(pixel_value(map,single_precision,coordinate(x_points[i]+2,y_points[i],map_size))+pixel_value(map,single_precision,coordinate(x_points[i]-2,y_points[i],map_size))-2*pixel_value(map,single_precision,coordinate(x_points[i],y_points[i],map_size)))/4.0;
+				hessian_yy=(pixel_value(map,single_precision,coordinate(x_points[i],y_points[i]+2,map_size))+pixel_value(map,single_precision,coordinate(x_points[i],y_points[i]-2,map_size))-2*pixel_value(map,single_precision,coordinate(x_points[i],y_points[i],map_size)))/4.0;
+				hessian_xy=(pixel_value(map,single_precision,coordinate(x_points[i]+1,y_points[i]+1,map_size))+pixel_value(map,single_precision,coordinate(x_points[i]-1,y_points[i]-1,map_size))-pixel_value(map,single_precision,coordinate(x_points[i]-1,y_points[i]+1,map_size))-pixel_value(map,single_precision,coordinate(x_points[i]+1,y_points[i]-1,map_size)))/4.0;
 			
 				hess_xx_map[i]=hessian_xx;
 				hess_yy_map[i]=hessian_yy;
@@ -85,7 +85,7 @@ void hessian(double *map,double *hess_xx_map,double *hess_yy_map,double *hess_xy
 }
 
 
-void gradLaplacian(double *map,double *grad_map_x,double *grad_map_y,long map_size,int Npoints,int *x_points,int *y_points){
+void gradLaplacian(void *map,int single_precision,double *grad_map_x,double *grad_map_y,long map_size,int Npoints,int *x_points,int *y_points){
 	
 	long i,j;
 	double grad_x,grad_y;
@@ -96,10 +96,10 @@ void gradLaplacian(double *map,double *grad_map_x,double *grad_map_y,long map_si
 			for(j=0;j<map_size;j++){
 			
 			
-				grad_x = (map[coordinate(i+3,j,map_size)] + map[coordinate(i-1,j,map_size)] + map[coordinate(i+1,j+2,map_size)] + map[coordinate(i+1,j-2,map_size)] - 4*map[coordinate(i+1,j,map_size)])/8.0;
-				grad_x -= (map[coordinate(i+1,j,map_size)] + map[coordinate(i-3,j,map_size)] + map[coordinate(i-1,j+2,map_size)] + map[coordinate(i-1,j-2,map_size)] - 4*map[coordinate(i-1,j,map_size)])/8.0;
-				grad_y = (map[coordinate(i+2,j+1,map_size)] + map[coordinate(i-2,j+1,map_size)] + map[coordinate(i,j+3,map_size)] + map[coordinate(i,j-1,map_size)] - 4*map[coordinate(i,j+1,map_size)])/8.0;
-				grad_y -= (map[coordinate(i+2,j-1,map_size)] + map[coordinate(i-2,j-1,map_size)] + map[coordinate(i,j+1,map_size)] + map[coordinate(i,j-3,map_size)] - 4*map[coordinate(i,j-1,map_size)])/8.0;
+				grad_x = (pixel_value(map,single_precision,coordinate(i+3,j,map_size)) + pixel_value(map,single_precision,coordinate(i-1,j,map_size)) + pixel_value(map,single_precision,coordinate(i+1,j+2,map_size)) + pixel_value(map,single_precision,coordinate(i+1,j-2,map_size)) - 4*pixel_value(map,single_precision,coordinate(i+1,j,map_size)))/8.0;
+				grad_x -= (pixel_value(map,single_precision,coordinate(i+1,j,map_size)) + pixel_value(map,single_precision,coordinate(i-3,j,map_size)) + pixel_value(map,single_precision,coordinate(i-1,j+2,map_size)) + pixel_value(map,single_precision,coordinate(i-1,j-2,map_size)) - 4*pixel_value(map,single_precision,coordinate(i-1,j,map_size)))/8.0;
+				grad_y = (pixel_value(map,single_precision,coordinate(i+2,j+1,map_size)) + pixel_value(map,single_precision,coordinate(i-2,j+1,map_size)) + pixel_value(map,single_precision,coordinate(i,j+3,map_size)) + pixel_value(map,single_precision,coordinate(i,j-1,map_size)) - 4*pixel_value(map,single_precision,coordinate(i,j+1,map_size)))/8.0;
+				grad_y -= (pixel_value(map,single_precision,coordinate(i+2,j-1,map_size)) + pixel_value(map,single_precision,coordinate(i-2,j-1,map_size)) + pixel_value(map,single_precision,coordinate(i,j+1,map_size)) + pixel_value(map,single_precision,coordinate(i,j-3,map_size)) - 4*pixel_value(map,single_precision,coordinate(i,j-1,map_size)))/8.0;
 			
 				grad_map_x[coordinate(i,j,map_size)]=grad_x;
 				grad_map_y[coordinate(i,j,map_size)]=grad_y;
@@ -113,10 +113,10 @@ void gradLaplacian(double *map,double *grad_map_x,double *grad_map_y,long map_si
 
 		for(i=0;i<Npoints;i++){
 
-			grad_x = (map[coordinate(x_points[i]+3,y_points[i],map_size)] + map[coordinate(x_points[i]-1,y_points[i],map_size)] + map[coordinate(x_points[i]+1,y_points[i]+2,map_size)] + map[coordinate(x_points[i]+1,y_points[i]-2,map_size)] - 4*map[coordinate(x_points[i]+1,y_points[i],map_size)])/8.0;
-			grad_x -= (map[coordinate(x_points[i]+1,y_points[i],map_size)] + map[coordinate(x_points[i]-3,y_points[i],map_size)] + map[coordinate(x_points[i]-1,y_points[i]+2,map_size)] + map[coordinate(x_points[i]-1,y_points[i]-2,map_size)] - 4*map[coordinate(x_points[i]-1,y_points[i],map_size)])/8.0;
-			grad_y = (map[coordinate(x_points[i]+2,y_points[i]+1,map_size)] + map[coordinate(x_points[i]-2,y_points[i]+1,map_size)] + map[coordinate(x_points[i],y_points[i]+3,map_size)] + map[coordinate(x_points[i],y_points[i]-1,map_size)] - 4*map[coordinate(x_points[i],y_points[i]+1,map_size)])/8.0;
-			grad_y -= (map[coordinate(x_points[i]+2,y_points[i]-1,map_size)] + map[coordinate(x_points[i]-2,y_points[i]-1,map_size)] + map[coordinate(x_points[i],y_points[i]+1,map_size)] + map[coordinate(x_points[i],y_points[i]-3,map_size)] - 4*map[coordinate(x_points[i],y_points[i]-1,map_size)])/8.0;
+			grad_x = (pixel_value(map,single_precision,coordinate(x_points[i]+3,y_points[i],map_size)) + pixel_value(map,single_precision,coordinate(x_points[i]-1,y_points[i],map_size)) + pixel_value(map,single_precision,coordinate(x_points[i]+1,y_points[i]+2,map_size)) + pixel_value(map,single_precision,coordinate(x_points[i]+1,y_points[i]-2,map_size)) - 4*pixel_value(map,single_precision,coordinate(x_points[i]+1,y_points[i],map_size)))/8.0;
+			grad_x -= (pixel_value(map,single_precision,coordinate(x_points[i]+1,y_points[i],map_size)) + pixel_value(map,single_precision,coordinate(x_points[i]-3,y_points[i],map_size)) + pixel_value(map,single_precision,coordinate(x_points[i]-1,y_points[i]+2,map_size)) + pixel_value(map,single_precision,coordinate(x_points[i]-1,y_points[i]-2,map_size)) - 4*pixel_value(map,single_precision,coordinate(x_points[i]-1,y_points[i],map_size)))/8.0;
+			grad_y = (pixel_value(map,single_precision,coordinate(x_points[i]+2,y_points[i]+1,map_size)) + pixel_value(map,single_precision,coordinate(x_points[i]-2,y_points[i]+1,map_size)) + pixel_value(map,single_precision,coordinate(x_points[i],y_points[i]+3,map_size)) + pixel_value(map,single_precision,coordinate(x_points[i],y_points[i]-1,map_size)) - 4*pixel_value(map,single_precision,coordinate(x_points[i],y_points[i]+1,map_size)))/8.0;
+			grad_y -= (pixel_value(map,single_precision,coordinate(x_points[i]+2,y_points[i]-1,map_size)) + pixel_value(map,single_precision,coordinate(x_points[i]-2,y_points[i]-1,map_size)) + pixel_value(map,single_precision,coordinate(x_points[i],y_points[i]+1,map_size)) + pixel_value(map,single_precision,coordinate(x_points[i],y_points[i]-3,map_size)) - 4*pixel_value(map,single_precision,coordinate(x_points[i],y_points[i]-1,map_size)))/8.0;
 			
 			grad_map_x[i]=grad_x;
 			grad_map_y[i]=grad_y;
@@ -1,8 +1,8 @@
 #ifndef __DIFFERENTIALS_H
 #define __DIFFERENTIALS_H
 
-void gradient_xy(double *map,double *grad_map_x,double *grad_map_y,long map_size,int Npoints,int *x_points,int *y_points);
-void hessian(double *map,double *hess_xx_map,double *hess_yy_map,double *hess_xy_map,long map_size,int Npoints, int *x_points,int *y_points);
-void gradLaplacian(double *map,double *grad_map_x,double *grad_map_y,long map_size,int Npoints,int *x_points,int *y_points);
+void gradient_xy(void *map,int single_precision,double *grad_map_x,double *grad_map_y,long map_size,int Npoints,int *x_points,int *y_points);
+void hessian(void *map,int single_precision,double *hess_xx_map,double *hess_yy_map,double *hess_xy_map,long map_size,int Npoints, int *x_points,int *y_points);
+void gradLaplacian(void *map,int single_precision,double *grad_map_x,double *grad_map_y,long map_size,int Npoints,int *x_points,int *y_points);
 
 #endif
\ No newline at end of file
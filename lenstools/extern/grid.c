@@ -1,6 +1,13 @@
 #include <stdlib.h>
 #include <math.h>
 
+#ifdef _OPENMP
+#include <omp.h>
+#define THREAD_NUM omp_get_thread_num()
+#else
+#define THREAD_NUM 0
+#endif
+
 #include "coordinates.h"
 #include "grid.h"
 
@@ -8,6 +15,127 @@
 #define CONCENTRATION_DEFAULT 1.0
 #define NFW_CUT 0.1
 
+//Maximum number of cells in the private grid copies of the threads: beyond this the threads add to the shared grid atomically
+#define PRIVATE_BUFFER_MAX_CELLS 67108864
+
+//Number of threads used in the gridding procedures (0 means the OpenMP default)
+static int gridThreads = 0;
+
+void setGridThreads(int n){
+	gridThreads = (n>0) ? n : 0;
+}
+
+int getGridThreads(void){
+
+#ifdef _OPENMP
+	return (gridThreads>0) ? gridThreads : omp_get_max_threads();
+#else
+	return 1;
+#endif
+
+}
+
+//Accumulation of the particle contributions on a grid shared between threads: each thread but the first one gets a zeroed private copy of the grid, which is added back to the shared grid at the end; if the copies do not fit in the memory budget, the threads add to the shared grid atomically
+typedef struct {
+
+	void *grid;
+	void **buffers;
+	long size;
+	int single_precision;
+	int nthreads;
+	int atomic;
+
+} GridAccumulator;
+
+static void openAccumulator(GridAccumulator *acc,void *grid,long size,int single_precision,int nthreads,long max_cells){
+
+	int t;
+	size_t itemsize = single_precision ? sizeof(float) : sizeof(double);
+
+	acc->grid = grid;
+	acc->buffers = NULL;
+	acc->size = size;
+	acc->single_precision = single_precision;
+	acc->nthreads = nthreads;
+	acc->atomic = 0;
+
+	//One thread: no need to accumulate separately
+	if(nthreads<2) return;
+
+	if(size*(nthreads-1)>max_cells || (acc->buffers = (void **)calloc(nthreads,sizeof(void *)))==NULL){
+		acc->atomic = 1;
+		return;
+	}
+
+	acc->buffers[0] = grid;
+	for(t=1;t<nthreads;t++){
+
+		if((acc->buffers[t] = calloc(size,itemsize))==NULL){
+
+			//Not enough memory for the private copies: fall back to atomic additions
+			for(t--;t>0;t--) free(acc->buffers[t]);
+			free(acc->buffers);
+			acc->buffers = NULL;
+			acc->atomic = 1;
+			return;
+
+		}
+	}
+
+}
+
+//Grid on which the calling thread accumulates
+static inline void *threadGrid(GridAccumulator *acc){
+	return (acc->buffers==NULL) ? acc->grid : acc->buffers[THREAD_NUM];
+}
+
+static inline void addCell(float *grid,long p,float value,int atomic){
+
+	if(atomic){
+		#pragma omp atomic
+		grid[p] += value;
+	} else{
+		grid[p] += value;
+	}
+
+}
+
+static inline void addCellDouble(double *grid,long p,double value,int atomic){
+
+	if(atomic){
+		#pragma omp atomic
+		grid[p] += value;
+	} else{
+		grid[p] += value;
+	}
+
+}
+
+//Add the private copies back to the shared grid and release them
+static void closeAccumulator(GridAccumulator *acc){
+
+	long p;
+	int t;
+
+	if(acc->buffers==NULL) return;
+
+	#pragma omp parallel for private(t) num_threads(acc->nthreads) schedule(static)
+	for(p=0;p<acc->size;p++){
+		for(t=1;t<acc->nthreads;t++){
+			if(acc->single_precision){
+				((float *)acc->grid)[p] += ((float *)acc->buffers[t])[p];
+			} else{
+				((double *)acc->grid)[p] += ((double *)acc->buffers[t])[p];
+			}
+		}
+	}
+
+	for(t=1;t<acc->nthreads;t++) free(acc->buffers[t]);
+	free(acc->buffers);
+	acc->buffers = NULL;
+
+}
+
 
 //NFW density profile
 double nfwKernel(double dsquared,double w,double rv,double c){
@@ -69,102 +197,248 @@ int grid2d(double *x,double *y,double *s,double *map,int Nobjects,int Npixel,dou
 }
 
 
-//Snap particles on a 3d regularly spaced grid
-int grid3d(float *positions,float *weights,double *radius,double *concentration,int Npart,double leftX,double leftY,double leftZ,double sizeX,double sizeY,double sizeZ,int nx,int ny,int nz,float *grid,double(*kernel)(double,double,double,double)){
+//Cells covered by the cloud of a particle at position u (in cell units) along one axis, and the fraction of the particle assigned to each of them; cells outside a non periodic axis get a -1 index
+static inline int cloudCells(double u,int n,int assignment,int periodic,int *cells,double *fractions){
 
-	int n;
-	double i,j,k;
+	int c,first,Ncells;
+	double d;
 
-	//Cycle through the particles and for each one compute the position on the grid
-	if(radius==NULL || concentration==NULL || kernel==NULL){
-	
-		if(weights==NULL){
+	if(assignment==ASSIGNMENT_CIC){
 
-			for(n=0;n<Npart;n++){
+		//The two cells whose centers surround the particle
+		first = (int)floor(u-0.5);
+		d = u - 0.5 - first;
 
-				//Compute the position on the grid in the fastest way
-				i = (positions[3*n] - leftX)/sizeX;
-				j = (positions[3*n + 1] - leftY)/sizeY;
-				k = (positions[3*n + 2] - leftZ)/sizeZ;
+		fractions[0] = 1.0 - d;
+		fractions[1] = d;
+		Ncells = 2;
 
-				//If the particle lands on the grid, put it in the correct pixel
-				if(i>=0 && i<nx && j>=0 && j<ny && k>=0 && k<nz){
+	} else{
 
-					grid[((int)i)*ny*nz + ((int)j)*nz + (int)k] += 1.0;
+		//The cell that contains the particle and its two neighbors
+		first = (int)floor(u) - 1;
+		d = u - (first + 1.5);
 
-				}
-			
-			}
+		fractions[0] = 0.5*(0.5-d)*(0.5-d);
+		fractions[1] = 0.75 - d*d;
+		fractions[2] = 0.5*(0.5+d)*(0.5+d);
+		Ncells = 3;
 
+	}
+
+	for(c=0;c<Ncells;c++){
+		
+		if(periodic){
+			cells[c] = ((first+c) % n + n) % n;
 		} else{
+			cells[c] = (first+c>=0 && first+c<n) ? first+c : -1;
+		}
+	
+	}
+
+	return Ncells;
 
-			for(n=0;n<Npart;n++){
+}
 
-				//Compute the position on the grid in the fastest way
-				i = (positions[3*n] - leftX)/sizeX;
-				j = (positions[3*n + 1] - leftY)/sizeY;
-				k = (positions[3*n + 2] - leftZ)/sizeZ;
+//Assign a particle at position (i,j,k) (in cell units) to a 3d regularly spaced grid with the given scheme
+static inline void assignParticle(double i,double j,double k,double w,int nx,int ny,int nz,float *grid,int assignment,int *periodic,int atomic){
 
-				//If the particle lands on the grid, put it in the correct pixel
-				if(i>=0 && i<nx && j>=0 && j<ny && k>=0 && k<nz){
+	int a,b,c,Nx,Ny,Nz;
+	int cellsX[3],cellsY[3],cellsZ[3];
+	double fractionsX[3],fractionsY[3],fractionsZ[3];
 
-					grid[((int)i)*ny*nz + ((int)j)*nz + (int)k] += weights[n];
+	if(assignment==ASSIGNMENT_NGP){
 
-				}
-			
+		//If the particle lands on the grid, put it in the correct pixel
+		if(i>=0 && i<nx && j>=0 && j<ny && k>=0 && k<nz) addCell(grid,((long)i)*ny*nz + ((long)j)*nz + (long)k,(float)w,atomic);
+		return;
+
+	}
+
+	//Along the non periodic axes, the particles just outside the grid contribute with the part of their cloud that falls on it
+	if((!periodic[0] && (i<-2 || i>=nx+2)) || (!periodic[1] && (j<-2 || j>=ny+2)) || (!periodic[2] && (k<-2 || k>=nz+2))) return;
+
+	Nx = cloudCells(i,nx,assignment,periodic[0],cellsX,fractionsX);
+	Ny = cloudCells(j,ny,assignment,periodic[1],cellsY,fractionsY);
+	Nz = cloudCells(k,nz,assignment,periodic[2],cellsZ,fractionsZ);
+
+	//Spread the particle over the cells of its cloud
+	for(a=0;a<Nx;a++){
+		if(cellsX[a]<0) continue;
+		for(b=0;b<Ny;b++){
+			if(cellsY[b]<0) continue;
+			for(c=0;c<Nz;c++){
+				if(cellsZ[c]<0) continue;
+				addCell(grid,((long)cellsX[a])*ny*nz + ((long)cellsY[b])*nz + cellsZ[c],(float)(w*fractionsX[a]*fractionsY[b]*fractionsZ[c]),atomic);
 			}
+		}
+	}
+
+}
+
+//Assign a particle with a finite size profile to a 3d regularly spaced grid
+static inline void kernelParticle(float *position,double w,double radius,double concentration,double leftX,double leftY,double leftZ,double sizeX,double sizeY,double sizeZ,int nx,int ny,int nz,float *grid,double(*kernel)(double,double,double,double),int atomic){
+
+	int minI,maxI,minJ,maxJ,minK,maxK;
+	int ii,jj,kk;
+	double i,j,k,distanceSquared;
+
+	//Compute the position of the center on the grid in the fastest way
+	i = (position[0] - leftX)/sizeX;
+	j = (position[1] - leftY)/sizeY;
+	k = (position[2] - leftZ)/sizeZ;
+
+	//Compute the extremes of the cloud corresponding to the particle
+	minI = max_int((int)(i-radius/sizeX),0);
+	minI = min_int(minI,nx);
+	maxI = min_int((int)(i+radius/sizeX),nx);
+	maxI = max_int(maxI,0);
+
+	minJ = max_int((int)(j-radius/sizeY),0);
+	minJ = min_int(minJ,ny);
+	maxJ = min_int((int)(j+radius/sizeY),ny);
+	maxJ = max_int(maxJ,0);
 
+	minK = max_int((int)(k-radius/sizeZ),0);
+	minK = min_int(minK,nz);
+	maxK = min_int((int)(k+radius/sizeZ),nz);
+	maxK = max_int(maxK,0);
+
+	//Cycle over all the cloud pixels covered by the particle and assign the correct density
+	for(ii=minI;ii<maxI;ii++){
+		for(jj=minJ;jj<maxJ;jj++){
+			for(kk=minK;kk<maxK;kk++){
+
+				distanceSquared = pow(leftX + (ii+0.5)*sizeX - position[0],2) + pow(leftY + (jj+0.5)*sizeY - position[1],2) + pow(leftZ + (kk+0.5)*sizeZ - position[2],2);
+				if(distanceSquared<pow(radius,2)) addCell(grid,((long)ii)*ny*nz + ((long)jj)*nz + kk,(float)kernel(distanceSquared,w,radius,concentration),atomic); 
+
+			}
 		}
+	}
 
-	
+}
 
-	} else{
+//Project the particles on several slabs in a single pass over the particles, accumulating straight into the 2d planes without gridding the slab volumes; the geometry of the g-th slab is stored in left[3*g:3*g+3], size[3*g:3*g+3] and shape[3*g:3*g+3], normals[g] is the axis perpendicular to its plane and the bins along the normal are weighted with the next shape[3*g+normals[g]] entries of thickness_weights. The clouds are spread only on the plane, where they wrap around the periodic box; along the normal, which is not periodic, each particle goes in the bin it falls in
+int projectSlabs(float *positions,float *weights,int Npart,int Nslabs,double *left,double *size,int *shape,int *normals,double *thickness_weights,float **planes,int assignment){
 
-		int minI,maxI,minJ,maxJ,minK,maxK;
-		int ii,jj,kk;
-		double distanceSquared;
+	int n,g,nthreads = getGridThreads();
+	double **slab_weights;
+	GridAccumulator *accumulators;
+
+	//Locate the thickness weights of each slab
+	if((slab_weights = (double **)malloc(sizeof(double *)*(Nslabs>0 ? Nslabs : 1)))==NULL){
+		return 1;
+	}
+
+	if((accumulators = (GridAccumulator *)malloc(sizeof(GridAccumulator)*(Nslabs>0 ? Nslabs : 1)))==NULL){
+		free(slab_weights);
+		return 1;
+	}
+
+	for(g=0;g<Nslabs;g++){
+		slab_weights[g] = thickness_weights;
+		thickness_weights += shape[3*g + normals[g]];
+		openAccumulator(accumulators+g,planes[g],((long)shape[3*g + (normals[g]==0 ? 1 : 0)])*shape[3*g + (normals[g]==2 ? 1 : 2)],1,nthreads,PRIVATE_BUFFER_MAX_CELLS/(Nslabs>0 ? Nslabs : 1));
+	}
 
-		for(n=0;n<Npart;n++){
+	#pragma omp parallel for private(g) num_threads(nthreads) schedule(static)
+	for(n=0;n<Npart;n++){
 
-			//Compute the position of the center on the grid in the fastest way
-			i = (positions[3*n] - leftX)/sizeX;
-			j = (positions[3*n + 1] - leftY)/sizeY;
-			k = (positions[3*n + 2] - leftZ)/sizeZ;
+		int a,b,d0,d1,dn,n0,n1,nn,Na,Nb;
+		int cellsA[3],cellsB[3];
+		double fractionsA[3],fractionsB[3];
+		double u,v,t,wn;
+		float *plane;
 
-			//Compute the extremes of the cloud corresponding to the particle
-			minI = max_int((int)(i-radius[n]/sizeX),0);
-			minI = min_int(minI,nx);
-			maxI = min_int((int)(i+radius[n]/sizeX),nx);
-			maxI = max_int(maxI,0);
+		double w = (weights==NULL) ? WEIGHT_DEFAULT : (double)weights[n];
 
-			minJ = max_int((int)(j-radius[n]/sizeY),0);
-			minJ = min_int(minJ,ny);
-			maxJ = min_int((int)(j+radius[n]/sizeY),ny);
-			maxJ = max_int(maxJ,0);
+		//Deposit the particle on each slab it falls in
+		for(g=0;g<Nslabs;g++){
 
-			minK = max_int((int)(k-radius[n]/sizeZ),0);
-			minK = min_int(minK,nz);
-			maxK = min_int((int)(k+radius[n]/sizeZ),nz);
-			maxK = max_int(maxK,0);
+			plane = (float *)threadGrid(accumulators+g);
 
-			//Cycle over all the cloud pixels covered by the particle and assign the correct density
-			for(ii=minI;ii<maxI;ii++){
-				for(jj=minJ;jj<maxJ;jj++){
-					for(kk=minK;kk<maxK;kk++){
+			//Directions of the plane
+			dn = normals[g];
+			d0 = (dn==0) ? 1 : 0;
+			d1 = (dn==2) ? 1 : 2;
 
-						distanceSquared = pow(leftX + (ii+0.5)*sizeX - positions[3*n],2) + pow(leftY + (jj+0.5)*sizeY - positions[3*n+1],2) + pow(leftZ + (kk+0.5)*sizeZ - positions[3*n+2],2);
-						if(distanceSquared<pow(radius[n],2)) grid[ii*ny*nz + jj*nz + kk] += (float)kernel(distanceSquared,(double)weights[n],radius[n],concentration[n]); 
+			n0 = shape[3*g + d0];
+			n1 = shape[3*g + d1];
+			nn = shape[3*g + dn];
 
-					}
+			//Compute the position on the grid in the fastest way
+			u = (positions[3*n + d0] - left[3*g + d0])/size[3*g + d0];
+			v = (positions[3*n + d1] - left[3*g + d1])/size[3*g + d1];
+			t = (positions[3*n + dn] - left[3*g + dn])/size[3*g + dn];
+
+			//Along the normal the particle goes in the slab bin it falls in
+			if(t<0 || t>=nn) continue;
+			
+			wn = slab_weights[g][(int)t];
+			if(wn==0.0) continue;
+
+			if(assignment==ASSIGNMENT_NGP){
+
+				//If the particle lands on the plane, put it in the correct pixel
+				if(u>=0 && u<n0 && v>=0 && v<n1) addCell(plane,((long)u)*n1 + (long)v,(float)(w*wn),accumulators[g].atomic);
+				continue;
+
+			}
+
+			Na = cloudCells(u,n0,assignment,1,cellsA,fractionsA);
+			Nb = cloudCells(v,n1,assignment,1,cellsB,fractionsB);
+
+			//Spread the particle over the pixels of its cloud
+			for(a=0;a<Na;a++){
+				for(b=0;b<Nb;b++){
+					addCell(plane,((long)cellsA[a])*n1 + cellsB[b],(float)(w*wn*fractionsA[a]*fractionsB[b]),accumulators[g].atomic);
 				}
 			}
 
+		}
+
+	}
+
+	//Collect the contributions of all the threads
+	for(g=0;g<Nslabs;g++) closeAccumulator(accumulators+g);
+
+	free(accumulators);
+	free(slab_weights);
+	return 0;
+
+}
 
+//Snap particles on a 3d regularly spaced grid; point particles are assigned with the given scheme (periodic[d] tells if the clouds wrap around the grid along the d-th axis)
+int grid3d(float *positions,float *weights,double *radius,double *concentration,int Npart,double leftX,double leftY,double leftZ,double sizeX,double sizeY,double sizeZ,int nx,int ny,int nz,float *grid,double(*kernel)(double,double,double,double),int assignment,int *periodic){
+
+	int n,nthreads = getGridThreads();
+	int pointParticles = (radius==NULL || concentration==NULL || kernel==NULL);
+	GridAccumulator acc;
+
+	openAccumulator(&acc,grid,((long)nx)*ny*nz,1,nthreads,PRIVATE_BUFFER_MAX_CELLS);
+
+	//Cycle through the particles and for each one compute the position on the grid
+	#pragma omp parallel for num_threads(nthreads) schedule(dynamic,4096)
+	for(n=0;n<Npart;n++){
+
+		float *threadgrid = (float *)threadGrid(&acc);
+
+		if(pointParticles){
+
+			//Compute the position on the grid in the fastest way
+			assignParticle((positions[3*n] - leftX)/sizeX,(positions[3*n + 1] - leftY)/sizeY,(positions[3*n + 2] - leftZ)/sizeZ,(weights==NULL) ? WEIGHT_DEFAULT : (double)weights[n],nx,ny,nz,threadgrid,assignment,periodic,acc.atomic);
+
+		} else{
+
+			kernelParticle(positions+3*n,(double)weights[n],radius[n],concentration[n],leftX,leftY,leftZ,sizeX,sizeY,sizeZ,nx,ny,nz,threadgrid,kernel,acc.atomic);
 
 		}
 
 	}
 
+	//Collect the contributions of all the threads
+	closeAccumulator(&acc);
+
 	return 0;
 
 
@@ -174,14 +448,21 @@ int grid3d(float *positions,float *weights,double *radius,double *concentration,
 //adaptive smoothing
 int adaptiveSmoothing(int NumPart,float *positions,float *weights,double *rp,double *concentration,double *binning0, double *binning1,double center,int direction0,int direction1,int normal,int size0,int size1,int projectAll,double *lensingPlane,double(*kernel)(double,double,double,double)){
 
-	int i,j,p;
-	float posNormal,posTransverse0,posTransverse1;
-	double catchmentRadius,distanceSquared,w,c;
-	int catchmentRadiusPixel,pos0Pixel,pos1Pixel,pixelLeft0,pixelRight0,pixelLeft1,pixelRight1;
+	int p,nthreads = getGridThreads();
+	GridAccumulator acc;
+
+	openAccumulator(&acc,lensingPlane,((long)size0)*size1,0,nthreads,PRIVATE_BUFFER_MAX_CELLS/2);
 
 	//Loop over particles
+	#pragma omp parallel for num_threads(nthreads) schedule(dynamic,1024)
 	for(p=0;p<NumPart;p++){
 
+		int i,j;
+		float posNormal,posTransverse0,posTransverse1;
+		double catchmentRadius,distanceSquared,w,c;
+		int catchmentRadiusPixel,pos0Pixel,pos1Pixel,pixelLeft0,pixelRight0,pixelLeft1,pixelRight1;
+		double *plane = (double *)threadGrid(&acc);
+
 		//Set particle weight
 		if(weights){
 			w = (double)(weights[p]);
@@ -239,7 +520,7 @@ int adaptiveSmoothing(int NumPart,float *positions,float *weights,double *rp,dou
 				}
 
 				//Add the corresponding contribution to the density
-				if(distanceSquared<pow(rp[p],2)) lensingPlane[i*size0 + j] += kernel(distanceSquared,w,rp[p],c); 
+				if(distanceSquared<pow(rp[p],2)) addCellDouble(plane,(long)i*size0 + j,kernel(distanceSquared,w,rp[p],c),acc.atomic); 
 
 			}
 		}
@@ -247,6 +528,9 @@ int adaptiveSmoothing(int NumPart,float *positions,float *weights,double *rp,dou
 
 	}
 
+	//Collect the contributions of all the threads
+	closeAccumulator(&acc);
+
 	return 0;
 
-}
\ No newline at end of file
+}
@@ -3,8 +3,18 @@
 
 #include <math.h>
 
+/*Mass assignment schemes of point particles: nearest grid point, cloud in cell, triangular shaped cloud*/
+#define ASSIGNMENT_NGP 0
+#define ASSIGNMENT_CIC 1
+#define ASSIGNMENT_TSC 2
+
+/*Number of threads used in the gridding procedures (0 means the OpenMP default)*/
+void setGridThreads(int n);
+int getGridThreads(void);
+
 int grid2d(double *x,double *y,double *s,double *map,int Nobjects,int Npixel,double map_size);
-int grid3d(float *positions,float *weights,double *radius,double *concentration,int Npart,double leftX,double leftY,double leftZ,double sizeX,double sizeY,double sizeZ,int nx,int ny,int nz,float *grid,double(*kernel)(double,double,double,double));
+int grid3d(float *positions,float *weights,double *radius,double *concentration,int Npart,double leftX,double leftY,double leftZ,double sizeX,double sizeY,double sizeZ,int nx,int ny,int nz,float *grid,double(*kernel)(double,double,double,double),int assignment,int *periodic);
+int projectSlabs(float *positions,float *weights,int Npart,int Nslabs,double *left,double *size,int *shape,int *normals,double *thickness_weights,float **planes,int assignment);
 int adaptiveSmoothing(int NumPart,float *positions,float *weights,double *rp,double *concentration,double *binning0, double *binning1,double center,int direction0,int direction1,int normal,int size0,int size1,int projectAll,double *lensingPlane,double(*kernel)(double,double,double,double));
 
 static inline double quadraticKernel(double dsquared,double w,double rv,double c){
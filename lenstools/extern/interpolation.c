@@ -0,0 +1,107 @@
+#include <math.h>
+#include <stdio.h>
+#include <stdlib.h>
+
+#include "interpolation.h"
+
+/*Interpolation stencils on periodic maps: (x,y) are fractional pixel coordinates, measured from the center of the first pixel (the center of the pixel (i,j) is at x=j, y=i). The value of a map at (x,y) is the weighted sum of the pixel values in the stencil
+
+nearest: the pixel that contains (x,y) (1 pixel)
+bilinear: the 2x2 pixels around (x,y), with linear weights (4 pixels)
+bicubic: the 4x4 pixels around (x,y), with the cubic convolution weights of Keys (1981), a=-0.5 (16 pixels)
+
+The stencil pixel indices are wrapped in [0,map_size) with periodic boundary conditions, the weights always sum to 1
+*/
+
+int interpolation_stencil_size(int order){
+
+	switch(order){
+
+		case INTERPOLATION_BILINEAR:
+			return 4;
+		case INTERPOLATION_BICUBIC:
+			return 16;
+		default:
+			return 1;
+
+	}
+
+}
+
+/*1D weights of the stencil pixels, for a point at a fraction t in [0,1) of the way between two pixel centers*/
+static int interpolation_weights(double t,int order,double *w){
+
+	switch(order){
+
+		case INTERPOLATION_BILINEAR:
+
+			w[0] = 1.0 - t;
+			w[1] = t;
+			return 2;
+
+		case INTERPOLATION_BICUBIC:
+
+			w[0] = ((-0.5*t + 1.0)*t - 0.5)*t;
+			w[1] = (1.5*t - 2.5)*t*t + 1.0;
+			w[2] = ((-1.5*t + 2.0)*t + 0.5)*t;
+			w[3] = (0.5*t - 0.5)*t*t;
+			return 4;
+
+		default:
+
+			w[0] = 1.0;
+			return 1;
+
+	}
+
+}
+
+/*Fill the stencil of (x,y): pixel indices and weights; returns the number of pixels in the stencil*/
+int interpolation_stencil(double x,double y,int order,long map_size,long *x_stencil,long *y_stencil,double *weights){
+
+	int a,b,width,n;
+	long x0,y0;
+	double wx[4],wy[4];
+
+	/*First pixel in the stencil along each direction*/
+	if(order==INTERPOLATION_BILINEAR || order==INTERPOLATION_BICUBIC){
+		
+		x0 = (long)floor(x);
+		y0 = (long)floor(y);
+		width = interpolation_weights(x-x0,order,wx);
+		interpolation_weights(y-y0,order,wy);
+
+		if(order==INTERPOLATION_BICUBIC){
+			x0--;
+			y0--;
+		}
+
+	} else{
+
+		x0 = (long)floor(x+0.5);
+		y0 = (long)floor(y+0.5);
+		width = interpolation_weights(0.0,order,wx);
+		interpolation_weights(0.0,order,wy);
+
+	}
+
+	/*Periodic boundary conditions*/
+	x0 = ((x0 % map_size) + map_size) % map_size;
+	y0 = ((y0 % map_size) + map_size) % map_size;
+
+	/*Stencil pixels and weights*/
+	n = 0;
+	for(b=0;b<width;b++){
+		for(a=0;a<width;a++){
+
+			x_stencil[n] = (x0 + a) % map_size;
+			y_stencil[n] = (y0 + b) % map_size;
+			weights[n] = wx[a]*wy[b];
+			n++;
+
+		}
+	}
+
+	return n;
+
+}
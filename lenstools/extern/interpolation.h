@@ -0,0 +1,15 @@
+#ifndef __INTERPOLATION_H
+#define __INTERPOLATION_H
+
+/*Interpolation orders: nearest pixel, bilinear, bicubic*/
+#define INTERPOLATION_NEAREST 0
+#define INTERPOLATION_BILINEAR 1
+#define INTERPOLATION_BICUBIC 3
+
+/*Maximum number of pixels in an interpolation stencil*/
+#define INTERPOLATION_MAX_STENCIL 16
+
+int interpolation_stencil_size(int order);
+int interpolation_stencil(double x,double y,int order,long map_size,long *x_stencil,long *y_stencil,double *weights);
+
+#endif
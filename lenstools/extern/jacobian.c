@@ -0,0 +1,121 @@
+#include <stdio.h>
+#include <stdlib.h>
+
+#include "coordinates.h"
+#include "interpolation.h"
+#include "jacobian.h"
+
+/*Fused per-lens update of the ray tracing jacobians: for each ray gather the shear matrix S on the lens, then apply the recurrence
+
+Dk+1 = (Ak-1)Dk + Ck*(S.Jk)
+Jk+1 = Jk + w*Dk+1
+
+in place, with J=[xx,xy,yx,yy], D its deflection and S=[xx,yy,xy] the symmetric shear matrix. 
+
+The shear matrix is gathered according to the layout of the field:
+
+Ncomponents==1: field is the (map_size,map_size) lensing potential, the shear matrix is its hessian (same finite difference stencil as in differentials.c) 
+Ncomponents==3: field holds the (3,map_size,map_size) shear matrices on the lens; if neither the pixel indices nor the pixel coordinates are provided the field holds the (3,Nrays) shear matrices already gathered at the ray positions
+
+The ray positions are given either as pixel indices (x_points,y_points), or as fractional pixel coordinates (x_coords,y_coords): in the latter case the shear matrices are interpolated with the stencils in interpolation.c, of the given order.
+
+The field can be stored in single or double precision (single_precision flag), the gathered values are always processed in double precision. The shear matrices are multiplied by scale; the weights w are weight_scale*weight[r] (or weight_scale if weight is NULL). The jacobian and its deflection are stored in single or double precision (single_precision_jacobian and single_precision_deflection flags), and their 4 components are stored jacobian_stride (deflection_stride) values apart, so that chunks of larger ray bundles can be updated in place; the updates are always computed in double precision
+*/
+
+/*Shear matrix at the pixel (x,y)*/
+static inline void shear_pixel(void *field,int single_precision,long map_size,int Ncomponents,long x,long y,double *sxx,double *syy,double *sxy){
+
+	long c,npixel;
+	double center;
+
+	if(Ncomponents==1){
+
+		center = 2*pixel_value(field,single_precision,coordinate(x,y,map_size));
+
+		*sxx = (pixel_value(field,single_precision,coordinate(x+2,y,map_size)) + pixel_value(field,single_precision,coordinate(x-2,y,map_size)) - center)/4.0;
+		*syy = (pixel_value(field,single_precision,coordinate(x,y+2,map_size)) + pixel_value(field,single_precision,coordinate(x,y-2,map_size)) - center)/4.0;
+		*sxy = (pixel_value(field,single_precision,coordinate(x+1,y+1,map_size)) + pixel_value(field,single_precision,coordinate(x-1,y-1,map_size)) - pixel_value(field,single_precision,coordinate(x-1,y+1,map_size)) - pixel_value(field,single_precision,coordinate(x+1,y-1,map_size)))/4.0;
+
+	} else{
+
+		c = coordinate(x,y,map_size);
+		npixel = map_size*map_size;
+
+		*sxx = pixel_value(field,single_precision,c);
+		*syy = pixel_value(field,single_precision,npixel+c);
+		*sxy = pixel_value(field,single_precision,2*npixel+c);
+
+	}
+
+}
+
+void jacobian_update(void *field,int single_precision,long map_size,int Ncomponents,double scale,long Nrays,int *x_points,int *y_points,double *x_coords,double *y_coords,int order,void *jacobian,int single_precision_jacobian,long jacobian_stride,void *jacobian_deflection,int single_precision_deflection,long deflection_stride,double Ak,double Ck,double *weight,double weight_scale){
+
+	long r;
+	int k,Nstencil;
+	long x_stencil[INTERPOLATION_MAX_STENCIL],y_stencil[INTERPOLATION_MAX_STENCIL];
+	double weights[INTERPOLATION_MAX_STENCIL];
+	double sxx,syy,sxy,txx,tyy,txy,w;
+	double j0,j1,j2,j3,d0,d1,d2,d3;
+
+	for(r=0;r<Nrays;r++){
+
+		/*Gather the shear matrix*/
+		if(x_coords!=NULL){
+
+			Nstencil = interpolation_stencil(x_coords[r],y_coords[r],order,map_size,x_stencil,y_stencil,weights);
+			sxx = 0.0;
+			syy = 0.0;
+			sxy = 0.0;
+
+			for(k=0;k<Nstencil;k++){
+				shear_pixel(field,single_precision,map_size,Ncomponents,x_stencil[k],y_stencil[k],&txx,&tyy,&txy);
+				sxx += weights[k]*txx;
+				syy += weights[k]*tyy;
+				sxy += weights[k]*txy;
+			}
+
+		} else if(x_points!=NULL){
+
+			shear_pixel(field,single_precision,map_size,Ncomponents,x_points[r],y_points[r],&sxx,&syy,&sxy);
+
+		} else{
+
+			sxx = pixel_value(field,single_precision,r);
+			syy = pixel_value(field,single_precision,Nrays+r);
+			sxy = pixel_value(field,single_precision,2*Nrays+r);
+
+		}
+
+		sxx *= scale;
+		syy *= scale;
+		sxy *= scale;
+
+		/*Current jacobian*/
+		j0 = pixel_value(jacobian,single_precision_jacobian,r);
+		j1 = pixel_value(jacobian,single_precision_jacobian,jacobian_stride+r);
+		j2 = pixel_value(jacobian,single_precision_jacobian,2*jacobian_stride+r);
+		j3 = pixel_value(jacobian,single_precision_jacobian,3*jacobian_stride+r);
+
+		/*Update the jacobian deflection*/
+		d0 = (Ak-1)*pixel_value(jacobian_deflection,single_precision_deflection,r) + Ck*(sxx*j0 + sxy*j2);
+		d1 = (Ak-1)*pixel_value(jacobian_deflection,single_precision_deflection,deflection_stride+r) + Ck*(sxx*j1 + sxy*j3);
+		d2 = (Ak-1)*pixel_value(jacobian_deflection,single_precision_deflection,2*deflection_stride+r) + Ck*(sxy*j0 + syy*j2);
+		d3 = (Ak-1)*pixel_value(jacobian_deflection,single_precision_deflection,3*deflection_stride+r) + Ck*(sxy*j1 + syy*j3);
+
+		set_pixel_value(jacobian_deflection,single_precision_deflection,r,d0);
+		set_pixel_value(jacobian_deflection,single_precision_deflection,deflection_stride+r,d1);
+		set_pixel_value(jacobian_deflection,single_precision_deflection,2*deflection_stride+r,d2);
+		set_pixel_value(jacobian_deflection,single_precision_deflection,3*deflection_stride+r,d3);
+
+		/*Update the jacobian*/
+		w = (weight==NULL) ? weight_scale : weight_scale*weight[r];
+
+		set_pixel_value(jacobian,single_precision_jacobian,r,j0 + w*d0);
+		set_pixel_value(jacobian,single_precision_jacobian,jacobian_stride+r,j1 + w*d1);
+		set_pixel_value(jacobian,single_precision_jacobian,2*jacobian_stride+r,j2 + w*d2);
+		set_pixel_value(jacobian,single_precision_jacobian,3*jacobian_stride+r,j3 + w*d3);
+
+	}
+
+}
@@ -0,0 +1,6 @@
+#ifndef __JACOBIAN_H
+#define __JACOBIAN_H
+
+void jacobian_update(void *field,int single_precision,long map_size,int Ncomponents,double scale,long Nrays,int *x_points,int *y_points,double *x_coords,double *y_coords,int order,void *jacobian,int single_precision_jacobian,long jacobian_stride,void *jacobian_deflection,int single_precision_deflection,long deflection_stride,double Ak,double Ck,double *weight,double weight_scale);
+
+#endif
@@ -0,0 +1,50 @@
+#include <stdio.h>
+#include <stdlib.h>
+
+#include "coordinates.h"
+#include "postborn.h"
+
+/*Gather, in a single pass over the rays, all the lens quantities that the second order post-Born convergence needs at the pixels (x_points,y_points) of the (map_size,map_size) lensing potential:
+
+quantities[0..1]: deflection angle (gradient of the potential)
+quantities[2..4]: shear matrix [xx,yy,xy] (hessian of the potential)
+quantities[5..6]: gradient of the laplacian of the potential
+
+The finite difference stencils are the same as in differentials.c, the quantities are in pixel units and the 7 quantities of each ray are stored quantities_stride doubles apart. The potential can be stored in single or double precision (single_precision flag)
+*/
+
+#define P(dx,dy) pixel_value(field,single_precision,coordinate(x+(dx),y+(dy),map_size))
+
+void lens_quantities(void *field,int single_precision,long map_size,long Nrays,int *x_points,int *y_points,double *quantities,long quantities_stride){
+
+	long r,x,y;
+	double grad_x,grad_y;
+
+	for(r=0;r<Nrays;r++){
+
+		x = x_points[r];
+		y = y_points[r];
+
+		/*Deflection angle*/
+		quantities[r] = (P(1,0) - P(-1,0))/2.0;
+		quantities[quantities_stride+r] = (P(0,1) - P(0,-1))/2.0;
+
+		/*Shear matrix*/
+		quantities[2*quantities_stride+r] = (P(2,0) + P(-2,0) - 2*P(0,0))/4.0;
+		quantities[3*quantities_stride+r] = (P(0,2) + P(0,-2) - 2*P(0,0))/4.0;
+		quantities[4*quantities_stride+r] = (P(1,1) + P(-1,-1) - P(-1,1) - P(1,-1))/4.0;
+
+		/*Gradient of the laplacian*/
+		grad_x = (P(3,0) + P(-1,0) + P(1,2) + P(1,-2) - 4*P(1,0))/8.0;
+		grad_x -= (P(1,0) + P(-3,0) + P(-1,2) + P(-1,-2) - 4*P(-1,0))/8.0;
+		grad_y = (P(2,1) + P(-2,1) + P(0,3) + P(0,-1) - 4*P(0,1))/8.0;
+		grad_y -= (P(2,-1) + P(-2,-1) + P(0,1) + P(0,-3) - 4*P(0,-1))/8.0;
+
+		quantities[5*quantities_stride+r] = grad_x;
+		quantities[6*quantities_stride+r] = grad_y;
+
+	}
+
+}
+
+#undef P
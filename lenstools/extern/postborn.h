@@ -0,0 +1,6 @@
+#ifndef __POSTBORN_H
+#define __POSTBORN_H
+
+void lens_quantities(void *field,int single_precision,long map_size,long Nrays,int *x_points,int *y_points,double *quantities,long quantities_stride);
+
+#endif
@@ -49,12 +49,34 @@ except ImportError:
 	matplotlib = False
 
 
+#Interpolation orders understood by the C backend
+_interpolation_order = {"nearest":0,"bilinear":1,"bicubic":3}
+
+#Pixel indices and weights of the interpolation stencils of the fractional pixel coordinates (row,col) on a periodic map, with shape (Nstencil,)+row.shape
+def _interpolationStencil(row,col,map_size,interpolation):
+
+	if interpolation not in _interpolation_order:
+		raise ValueError("interpolation must be one in {0}".format(list(_interpolation_order.keys())))
+
+	#Call the C backend
+	j,i,weights = _topology.interpolationStencil(col,row,map_size,_interpolation_order[interpolation])
+	shape = weights.shape[:1] + np.shape(col)
+
+	return i.reshape(shape),j.reshape(shape),weights.reshape(shape)
+
+#Weighted sum of values gathered on interpolation stencils of shape (Nstencil,...)
+def _stencilSum(values,weights):
+	return (values.reshape(weights.shape)*weights).sum(0)
+
 ################################################
 ########Spin0 class#############################
 ################################################
 
 class Spin0(object):
 
+	#Types of the pixel values that are kept as they are, the others are converted to double precision for calculation accuracy
+	_native_dtypes = (np.float64,np.complex128)
+
 	def __init__(self,data,angle,masked=False,**kwargs):
 
 		#Sanity check
@@ -64,7 +86,7 @@ class Spin0(object):
 			assert data.shape[0]==data.shape[1],"The map must be a square!!"
 
 		#Convert to double precision for calculation accuracy
-		if data.dtype in (np.float,np.complex):
+		if data.dtype in self._native_dtypes:
 			self.data = data
 		else:
 			self.data = data.astype(np.float)
@@ -251,7 +273,7 @@ class Spin0(object):
 			return self.data[self._full_mask].std()
 
 
-	def getValues(self,x,y):
+	def getValues(self,x,y,interpolation="nearest"):
 
 		"""
 		Extract the map values at the requested (x,y) positions; this is implemented using the numpy fast indexing routines, so the formats of x and y must follow the numpy advanced indexing rules. Periodic boundary conditions are enforced
@@ -262,6 +284,9 @@ class Spin0(object):
 		:param y: y coordinates at which to extract the map values (if unitless these are interpreted as radians)
 		:type y: numpy array or quantity 
 
+		:param interpolation: how to interpolate the map between the pixel centers, must be one in [nearest,bilinear,bicubic]
+		:type interpolation: str.
+
 		:returns: numpy array with the map values at the specified positions, with the same shape as x and y
 
 		:raises: IndexError if the formats of x and y are not the proper ones
@@ -270,6 +295,23 @@ class Spin0(object):
 
 		assert isinstance(x,np.ndarray) and isinstance(y,np.ndarray)
 
+		#Return the map values at the specified coordinates
+		if interpolation=="nearest":
+			i,j = self._pixelIndices(x,y)
+			return self.data[i,j]
+
+		#Interpolate between the pixels in the stencils
+		assert x.shape==y.shape,"x and y must have the same shape!"
+		i,j,weights = self._interpolationStencil(x,y,interpolation)
+		return _stencilSum(self.data[i,j],weights)
+
+	def _pixelIndices(self,x,y):
+
+		"""
+		Computes the (row,column) indices of the pixels that contain the (x,y) positions, enforcing periodic boundary conditions
+
+		"""
+
 		#x coordinates
 		if type(x)==u.quantity.Quantity:
 			
@@ -290,8 +332,47 @@ class Spin0(object):
 
 			i = np.mod((y / self.resolution.to(u.rad).value).astype(np.int32),self.data.shape[0])
 
-		#Return the map values at the specified coordinates
-		return self.data[i,j]
+		return i,j
+
+	def _pixelCoordinates(self,x,y):
+
+		"""
+		Computes the fractional (row,column) coordinates of the (x,y) positions in pixel units, measured from the center of the first pixel
+
+		"""
+
+		#x coordinates
+		if type(x)==u.quantity.Quantity:
+			
+			assert x.unit.physical_type==self.side_angle.unit.physical_type
+			col = (x / self.resolution).decompose().value - 0.5
+
+		else:
+
+			col = x / self.resolution.to(u.rad).value - 0.5
+
+		#y coordinates
+		if type(y)==u.quantity.Quantity:
+			
+			assert y.unit.physical_type==self.side_angle.unit.physical_type
+			row = (y / self.resolution).decompose().value - 0.5
+
+		else:
+
+			row = y / self.resolution.to(u.rad).value - 0.5
+
+		return row,col
+
+	def _interpolationStencil(self,x,y,interpolation):
+
+		"""
+		Computes the (row,column) indices and the weights of the pixels in the interpolation stencils of the (x,y) positions, enforcing periodic boundary conditions; the returned arrays have shape (Nstencil,)+x.shape
+
+		"""
+
+		assert self.data.shape[0]==self.data.shape[1],"Interpolation is implemented for square maps only!"
+		row,col = self._pixelCoordinates(x,y)
+		return _interpolationStencil(row,col,self.data.shape[0],interpolation)
 
 
 	def cutRegion(self,extent):
@@ -504,7 +585,7 @@ class Spin0(object):
 		return self._hessian_boundary
 			
 
-	def gradient(self,x=None,y=None,save=True):
+	def gradient(self,x=None,y=None,save=True,interpolation="nearest"):
 		
 		"""
 		Computes the gradient of the map and sets the gradient_x,gradient_y attributes accordingly
@@ -518,6 +599,9 @@ class Spin0(object):
 		:param save: if True saves the gradient as attrubutes
 		:type save: bool.
 
+		:param interpolation: how to interpolate the gradient between the pixel centers when x and y are specified, must be one in [nearest,bilinear,bicubic]
+		:type interpolation: str.
+
 		:returns: tuple -- (gradient_x,gradient_y)
 
 		>>> test_map = ConvergenceMap.load("map.fit")
@@ -528,26 +612,12 @@ class Spin0(object):
 		if (x is not None) and (y is not None):
 
 			assert x.shape==y.shape,"x and y must have the same shape!"
-
-			#x coordinates
-			if type(x)==u.quantity.Quantity:
 			
-				assert x.unit.physical_type==self.side_angle.unit.physical_type
-				j = np.mod(((x / self.resolution).decompose().value).astype(np.int32),self.data.shape[1])
-
+			#Evaluate on the pixels of the interpolation stencils
+			if interpolation=="nearest":
+				i,j = self._pixelIndices(x,y)
 			else:
-
-				j = np.mod((x / self.resolution.to(u.rad).value).astype(np.int32),self.data.shape[1])	
-
-			#y coordinates
-			if type(y)==u.quantity.Quantity:
-			
-				assert y.unit.physical_type==self.side_angle.unit.physical_type
-				i = np.mod(((y / self.resolution).decompose().value).astype(np.int32),self.data.shape[0])
-
-			else:
-
-				i = np.mod((y / self.resolution.to(u.rad).value).astype(np.int32),self.data.shape[0])
+				i,j,weights = self._interpolationStencil(x,y,interpolation)
 
 		else:
 			i = None
@@ -559,6 +629,9 @@ class Spin0(object):
 		#Return the gradients
 		if (x is not None) and (y is not None):
 
+			if interpolation!="nearest":
+				return _stencilSum(gradient_x,weights),_stencilSum(gradient_y,weights)
+
 			return gradient_x.reshape(x.shape),gradient_y.reshape(x.shape)
 
 		else:
@@ -569,7 +642,7 @@ class Spin0(object):
 		
 			return gradient_x,gradient_y
 
-	def hessian(self,x=None,y=None,save=True):
+	def hessian(self,x=None,y=None,save=True,interpolation="nearest"):
 		
 		"""
 		Computes the hessian of the map and sets the hessian_xx,hessian_yy,hessian_xy attributes accordingly
@@ -583,6 +656,9 @@ class Spin0(object):
 		:param save: if True saves the gradient as attrubutes
 		:type save: bool.
 
+		:param interpolation: how to interpolate the hessian between the pixel centers when x and y are specified, must be one in [nearest,bilinear,bicubic]
+		:type interpolation: str.
+
 		:returns: tuple -- (hessian_xx,hessian_yy,hessian_xy)
 
 		>>> test_map = ConvergenceMap.load("map.fit")
@@ -593,26 +669,12 @@ class Spin0(object):
 		if (x is not None) and (y is not None):
 
 			assert x.shape==y.shape,"x and y must have the same shape!"
-
-			#x coordinates
-			if type(x)==u.quantity.Quantity:
 			
-				assert x.unit.physical_type==self.side_angle.unit.physical_type
-				j = np.mod(((x / self.resolution).decompose().value).astype(np.int32),self.data.shape[1])
-
+			#Evaluate on the pixels of the interpolation stencils
+			if interpolation=="nearest":
+				i,j = self._pixelIndices(x,y)
 			else:
-
-				j = np.mod((x / self.resolution.to(u.rad).value).astype(np.int32),self.data.shape[1])	
-
-			#y coordinates
-			if type(y)==u.quantity.Quantity:
-			
-				assert y.unit.physical_type==self.side_angle.unit.physical_type
-				i = np.mod(((y / self.resolution).decompose().value).astype(np.int32),self.data.shape[0])
-
-			else:
-
-				i = np.mod((y / self.resolution.to(u.rad).value).astype(np.int32),self.data.shape[0])
+				i,j,weights = self._interpolationStencil(x,y,interpolation)
 
 		else:
 			i = None
@@ -624,6 +686,9 @@ class Spin0(object):
 		#Return the hessian
 		if (x is not None) and (y is not None):
 
+			if interpolation!="nearest":
+				return _stencilSum(hessian_xx,weights),_stencilSum(hessian_yy,weights),_stencilSum(hessian_xy,weights)
+
 			return hessian_xx.reshape(x.shape),hessian_yy.reshape(x.shape),hessian_xy.reshape(x.shape)
 
 		else:
@@ -635,7 +700,7 @@ class Spin0(object):
 
 			return hessian_xx,hessian_yy,hessian_xy
 
-	def gradLaplacian(self,x=None,y=None):
+	def gradLaplacian(self,x=None,y=None,interpolation="nearest"):
 
 		"""
 		"""
@@ -643,26 +708,12 @@ class Spin0(object):
 		if (x is not None) and (y is not None):
 
 			assert x.shape==y.shape,"x and y must have the same shape!"
-
-			#x coordinates
-			if type(x)==u.quantity.Quantity:
 			
-				assert x.unit.physical_type==self.side_angle.unit.physical_type
-				j = np.mod(((x / self.resolution).decompose().value).astype(np.int32),self.data.shape[1])
-
+			#Evaluate on the pixels of the interpolation stencils
+			if interpolation=="nearest":
+				i,j = self._pixelIndices(x,y)
 			else:
-
-				j = np.mod((x / self.resolution.to(u.rad).value).astype(np.int32),self.data.shape[1])	
-
-			#y coordinates
-			if type(y)==u.quantity.Quantity:
-			
-				assert y.unit.physical_type==self.side_angle.unit.physical_type
-				i = np.mod(((y / self.resolution).decompose().value).astype(np.int32),self.data.shape[0])
-
-			else:
-
-				i = np.mod((y / self.resolution.to(u.rad).value).astype(np.int32),self.data.shape[0])
+				i,j,weights = self._interpolationStencil(x,y,interpolation)
 
 		else:
 			i = None
@@ -673,6 +724,10 @@ class Spin0(object):
 		
 		#Return the gradient of the laplacian
 		if (x is not None) and (y is not None):
+			
+			if interpolation!="nearest":
+				return _stencilSum(gl_x,weights),_stencilSum(gl_y,weights)
+			
 			return gl_x.reshape(x.shape),gl_y.reshape(x.shape)
 		else:
 			return gl_x,gl_y
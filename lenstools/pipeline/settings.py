@@ -161,6 +161,8 @@ class PlaneSettings(LTSettings):
 		self.thickness_resolution = 1
 		self.smooth = 1
 		self.kind = "potential"
+		self.assignment = "ngp"
+		self.chunk_size = None
 
 		#Allow for kwargs override
 		for key in kwargs:
@@ -238,6 +240,16 @@ class PlaneSettings(LTSettings):
 		except NoOptionError:
 			pass
 
+		try:
+			settings.assignment = options.get(section,"assignment")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.chunk_size = options.getint(section,"chunk_size")
+		except NoOptionError:
+			pass
+
 		#Return to user
 		return settings
 
@@ -278,6 +290,8 @@ class PlaneLightConeSettings(LTSettings):
 		self.thickness_resolution = 1
 		self.smooth = 1
 		self.kind = "potential"
+		self.assignment = "ngp"
+		self.chunk_size = None
 
 		#On the fly raytracing
 		self.do_lensing = False
@@ -348,6 +362,16 @@ class PlaneLightConeSettings(LTSettings):
 		except NoOptionError:
 			pass
 
+		try:
+			settings.assignment = options.get(section,"assignment")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.chunk_size = options.getint(section,"chunk_size")
+		except NoOptionError:
+			pass
+
 		#Return to user
 		return settings
 
@@ -391,6 +415,27 @@ class MapSettings(LTSettings):
 		self.plane_name_format = "snap{0}_potentialPlane{1}_normal{2}.{3}"
 		self.lens_type = "PotentialPlane"
 
+		#Memory budget (in Gbyte) for the lens planes cached between realizations (0 disables the cache)
+		self.plane_cache_size = 0.0
+
+		#Number of lens planes read ahead in the background during ray tracing (0 disables prefetching)
+		self.plane_prefetch = 0
+
+		#Number of rays processed at once against each lens plane (0 processes all the rays at once)
+		self.ray_chunk_size = 0
+
+		#Number of threads that process the chunks of rays in parallel
+		self.ray_threads = 1
+
+		#Keep the lens planes and the ray deflections in single precision during ray tracing (the ray positions and jacobians are accumulated in double precision)
+		self.single_precision_planes = False
+
+		#Interpolation of the lens quantities between the pixel centers of the planes (nearest, bilinear or bicubic)
+		self.plane_interpolation = "nearest"
+
+		#Save the state of the rays at most every checkpoint_interval seconds, so that interrupted realizations can be resumed and completed ones are skipped when the job is resubmitted (0 disables checkpoints)
+		self.checkpoint_interval = 0.0
+
 		self.map_resolution = 128
 		self.map_angle = 1.6 * u.deg
 		self.angle_unit = u.deg
@@ -468,6 +513,41 @@ class MapSettings(LTSettings):
 			self.lens_type = options.get(section,"lens_type")
 		except NoOptionError:
 			pass
+
+		try:
+			self.plane_cache_size = options.getfloat(section,"plane_cache_size")
+		except NoOptionError:
+			pass
+
+		try:
+			self.plane_prefetch = options.getint(section,"plane_prefetch")
+		except NoOptionError:
+			pass
+
+		try:
+			self.ray_chunk_size = options.getint(section,"ray_chunk_size")
+		except NoOptionError:
+			pass
+
+		try:
+			self.ray_threads = options.getint(section,"ray_threads")
+		except NoOptionError:
+			pass
+
+		try:
+			self.single_precision_planes = options.getboolean(section,"single_precision_planes")
+		except NoOptionError:
+			pass
+
+		try:
+			self.plane_interpolation = options.get(section,"plane_interpolation")
+		except NoOptionError:
+			pass
+
+		try:
+			self.checkpoint_interval = options.getfloat(section,"checkpoint_interval")
+		except NoOptionError:
+			pass
 		
 		self.map_resolution = options.getint(section,"map_resolution")
 		
@@ -626,6 +706,27 @@ class CatalogSettings(LTSettings):
 		self.plane_format = "fits"
 		self.plane_name_format = "snap{0}_potentialPlane{1}_normal{2}.{3}"
 
+		#Memory budget (in Gbyte) for the lens planes cached between realizations (0 disables the cache)
+		self.plane_cache_size = 0.0
+
+		#Number of lens planes read ahead in the background during ray tracing (0 disables prefetching)
+		self.plane_prefetch = 0
+
+		#Number of rays processed at once against each lens plane (0 processes all the rays at once)
+		self.ray_chunk_size = 0
+
+		#Number of threads that process the chunks of rays in parallel
+		self.ray_threads = 1
+
+		#Keep the lens planes and the ray deflections in single precision during ray tracing (the ray positions and jacobians are accumulated in double precision)
+		self.single_precision_planes = False
+
+		#Interpolation of the lens quantities between the pixel centers of the planes (nearest, bilinear or bicubic)
+		self.plane_interpolation = "nearest"
+
+		#Save the state of the rays at most every checkpoint_interval seconds, so that interrupted realizations can be resumed and completed ones are skipped when the job is resubmitted (0 disables checkpoints)
+		self.checkpoint_interval = 0.0
+
 		#Random seed used to generate multiple catalog realizations
 		self.seed = 0
 
@@ -679,6 +780,41 @@ class CatalogSettings(LTSettings):
 		except NoOptionError:
 			pass
 
+		try:
+			settings.plane_cache_size = options.getfloat(section,"plane_cache_size")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.plane_prefetch = options.getint(section,"plane_prefetch")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.ray_chunk_size = options.getint(section,"ray_chunk_size")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.ray_threads = options.getint(section,"ray_threads")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.single_precision_planes = options.getboolean(section,"single_precision_planes")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.plane_interpolation = options.get(section,"plane_interpolation")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.checkpoint_interval = options.getfloat(section,"checkpoint_interval")
+		except NoOptionError:
+			pass
+
 		#Set of lens planes to be used during ray tracing
 		settings.seed = options.getint(section,"seed")
 
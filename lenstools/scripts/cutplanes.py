@@ -15,7 +15,7 @@ from lenstools.pipeline.settings import PlaneSettings,PlaneLightConeSettings
 import lenstools.simulations
 import lenstools.simulations.nbody 
 
-from lenstools.simulations import DensityPlane,PotentialPlane
+from lenstools.simulations import DensityPlane,PotentialPlane,LensPackPlane
 from lenstools.image.convergence import ConvergenceMap,OmegaMap
 
 from lenstools.simulations.raytracing import RayTracer
@@ -148,7 +148,9 @@ def cnstTime(pool,batch,settings,batch_id,override):
 	"plane_resolution" : plane_resolution,
 	"thickness_resolution" : thickness_resolution,
 	"smooth" : smooth,
-	"kind" : kind,
+	"assignment" : getattr(settings,"assignment","ngp"),
+	"chunk_size" : getattr(settings,"chunk_size",None),
+	"kind" : "potential" if kind=="pack" else kind,
 	"density_placeholder" : density_projected,
 	"l_squared" : l_squared
 
@@ -185,35 +187,47 @@ def cnstTime(pool,batch,settings,batch_id,override):
 		if pool is not None:
 			logdriver.debug("Task {0} read nbody snapshot from {1}".format(pool.comm.rank,snapshot_filename))
 
-		#Get the positions of the particles
-		if not hasattr(snap,"positions"):
-			snap.getPositions(first=snap._first,last=snap._last)
+		#Get the positions of the particles, unless they are read in chunks while cutting the planes
+		if kwargs["chunk_size"] is None:
+			
+			if not hasattr(snap,"positions"):
+				snap.getPositions(first=snap._first,last=snap._last)
 
-		#Log memory usage
-		if (pool is None) or (pool.is_master()):
-			logstderr.debug("Read particle positions: peak memory usage {0:.3f} (task)".format(peakMemory()))
+			#Log memory usage
+			if (pool is None) or (pool.is_master()):
+				logstderr.debug("Read particle positions: peak memory usage {0:.3f} (task)".format(peakMemory()))
 
-		#Close the snapshot file
-		snap.close()
+			#Close the snapshot file
+			snap.close()
 
 		#Update the summary info file
 		if (pool is None) or (pool.is_master()):
 			infofile.write("s={0},d={1},z={2}\n".format(n,snap.header["comoving_distance"],snap.header["redshift"]))
 
-		#Cut the lens planes
+		#All the slabs to cut from this snapshot
+		slabs = [ (pos,thickness,normal) for pos in cut_points for normal in normals ]
+
+		if pool is None or pool.is_master():
+			for pos,thickness,normal in slabs:
+				logdriver.info("Cutting {0} plane at {1} with normal {2},thickness {3}, of size {4} x {4}".format(kind,pos,normal,thickness,snap.header["box_size"]))
+
+		############################
+		#####Do the cutting#########
+		############################
+
+		#Cut all the lens planes in a single pass over the particles
+		cut_planes = snap.cutPlanes(slabs,left_corner=np.zeros(3)*snap.Mpc_over_h,**kwargs)
+
+		#Close the snapshot file if the particles were read in chunks
+		if kwargs["chunk_size"] is not None:
+			snap.close()
+
+		#######################################################################################################################################
+
 		for cut,pos in enumerate(cut_points):
 			for normal in normals:
 
-				if pool is None or pool.is_master():
-					logdriver.info("Cutting {0} plane at {1} with normal {2},thickness {3}, of size {4} x {4}".format(kind,pos,normal,thickness,snap.header["box_size"]))
-
-				############################
-				#####Do the cutting#########
-				############################
-				
-				plane,resolution,NumPart = snap.cutPlaneGaussianGrid(normal=normal,center=pos,thickness=thickness,left_corner=np.zeros(3)*snap.Mpc_over_h,**kwargs)
-				
-				#######################################################################################################################################
+				plane,resolution,NumPart = cut_planes.pop(0)
 
 				#Save the plane
 				plane_file = batch.syshandler.map(os.path.join(save_path,settings.name_format.format(n,kind,cut,normal,settings.format)))
@@ -225,6 +239,8 @@ def cnstTime(pool,batch,settings,batch_id,override):
 						plane_wrap = PotentialPlane(plane.value,angle=snap.header["box_size"],redshift=snap.header["redshift"],comoving_distance=snap.header["comoving_distance"],cosmology=snap.cosmology,num_particles=NumPart,unit=plane.unit)
 					elif kind=="density":
 						plane_wrap = DensityPlane(plane,angle=snap.header["box_size"],redshift=snap.header["redshift"],comoving_distance=snap.header["comoving_distance"],cosmology=snap.cosmology,num_particles=NumPart)
+					elif kind=="pack":
+						plane_wrap = PotentialPlane(plane.value,angle=snap.header["box_size"],redshift=snap.header["redshift"],comoving_distance=snap.header["comoving_distance"],cosmology=snap.cosmology,num_particles=NumPart,unit=plane.unit).lensPack()
 					else:
 						raise NotImplementedError("Plane of kind '{0}' not implemented!".format(kind))
 
@@ -397,6 +413,8 @@ def lightCone(pool,batch,settings,batch_id,override):
 	"plane_resolution" : plane_resolution,
 	"thickness_resolution" : thickness_resolution,
 	"smooth" : smooth,
+	"assignment" : getattr(settings,"assignment","ngp"),
+	"chunk_size" : getattr(settings,"chunk_size",None),
 	"density_placeholder" : density_projected,
 	"l_squared" : l_squared
 
@@ -424,16 +442,18 @@ def lightCone(pool,batch,settings,batch_id,override):
 	if pool is not None:
 		logdriver.debug("Task {0} read nbody snapshot from {1}, particles {2}-{3}".format(pool.comm.rank,snapshot_filename,snap._first,snap._last-1))
 
-	#Get the positions of the particles
-	if not hasattr(snap,"positions"):
-		snap.getPositions(first=snap._first,last=snap._last)
+	#Get the positions of the particles, unless they are read in chunks while cutting the planes
+	if kwargs["chunk_size"] is None:
 
-	#Log memory usage
-	if (pool is None) or (pool.is_master()):
-		logstderr.debug("Read particle positions: peak memory usage {0:.3f} (task)".format(peakMemory()))
+		if not hasattr(snap,"positions"):
+			snap.getPositions(first=snap._first,last=snap._last)
 
-	#Close the snapshot file
-	snap.close()
+		#Log memory usage
+		if (pool is None) or (pool.is_master()):
+			logstderr.debug("Read particle positions: peak memory usage {0:.3f} (task)".format(peakMemory()))
+
+		#Close the snapshot file
+		snap.close()
 
 	#############################
 	#Check weak lensing settings#
@@ -522,6 +542,10 @@ def lightCone(pool,batch,settings,batch_id,override):
 				if pool is not None:
 					pool.comm.Barrier()
 
+	#Close the snapshot file if the particles were read in chunks
+	if kwargs["chunk_size"] is not None:
+		snap.close()
+
 	#Safety barrier sync
 	if pool is not None:
 		pool.comm.Barrier()
@@ -10,14 +10,14 @@ import gc
 from operator import add
 from functools import reduce
 
-from lenstools.simulations.logs import logdriver,logstderr,peakMemory,peakMemoryAll
+from lenstools.simulations.logs import logdriver,logstderr,peakMemory,peakMemoryAll,recordEvent
 
 from lenstools.utils.mpi import MPIWhirlPool
 
 from lenstools import ConvergenceMap,OmegaMap,ShearMap
 from lenstools.catalog import Catalog,ShearCatalog
 
-from lenstools.simulations.raytracing import RayTracer,DensityPlane
+from lenstools.simulations.raytracing import RayTracer,DensityPlane,LensPackPlane,plane_cache
 from lenstools.pipeline.simulation import SimulationBatch
 from lenstools.pipeline.settings import MapSettings,TelescopicMapSettings,CatalogSettings
 
@@ -44,14 +44,40 @@ def _subdirectories(num_realizations,realizations_in_subdir):
 	return s
 
 #####################################################################################
-#######Callback to call during raytracing to save the convergence at every step######
+#######Files produced by a realization (used to skip the complete ones)##############
 #####################################################################################
 
-def convergence_callback(jacobian,tracer,k,realization,angle,map_batch,settings):
-	convMap = ConvergenceMap(data=1.0-0.5*(jacobian[0]+jacobian[3]),angle=angle)
-	savename = os.path.join(map_batch.storage_subdir,"WLconv_z{0:.2f}_{1:04d}r.{2}".format(tracer.redshift[k],realization+1,settings.format))
-	logdriver.debug("Saving convergence map to {0}".format(savename)) 
-	convMap.save(savename)
+def _mapOutputs(batch,settings,save_path,redshifts,realization):
+
+	if settings.tomographic_convergence:
+		roots = ["WLconv"]
+	else:
+		roots = [ root for root,option in [("WLconv","convergence"),("WLshear","shear"),("WLconv-ks","convergence_ks"),("WLredshear","reduced_shear"),("WLredconv","reduced_shear_convergence"),("WLomega","omega")] if getattr(settings,option) ]
+
+	return [ batch.syshandler.map(os.path.join(save_path,"{0}_z{1:.2f}_{2:04d}r.{3}".format(root,z,realization+1,settings.format))) for root in roots for z in redshifts ]
+
+def _catalogOutputs(batch,settings,catalog_save_path,catalog_subdirectory,realizations_in_subdir,realization):
+
+	#Build savename
+	if settings.reduced_shear:
+		shear_root = "WLredshear_"
+	else:
+		shear_root = "WLshear_"
+
+	if len(catalog_subdirectory):
+		save_path = os.path.join(catalog_save_path,catalog_subdirectory[realization//realizations_in_subdir])
+	else:
+		save_path = catalog_save_path
+
+	return [ batch.syshandler.map(os.path.join(save_path,shear_root+os.path.basename(galaxy_position_file.split(".")[0])+"_{0:04d}r.{1}".format(realization+1,settings.format))) for galaxy_position_file in settings.input_files ]
+
+###########################################################################################################
+#######Callback to call during raytracing to save the tomographic convergence as soon as it is computed######
+###########################################################################################################
+
+def tomographic_callback(outputs,tracer,n,savenames,angle):
+	logdriver.debug("Saving convergence map to {0}".format(savenames[n])) 
+	ConvergenceMap(data=outputs["convergence"],angle=angle).save(savenames[n])
 
 ################################################
 #######Single redshift ray tracing##############
@@ -208,14 +234,27 @@ def singleRedshift(pool,batch,settings,batch_id):
 	if (pool is None) or (pool.is_master()):
 		logstderr.info("Initial memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
 
+	#Lens planes that are drawn multiple times are shared between realizations through the plane cache
+	plane_cache.setBudget(getattr(settings,"plane_cache_size",0.0)*(1024**3))
+	if (pool is None) or (pool.is_master()):
+		logdriver.info("Plane cache memory budget: {0:.3f} Gbyte (task)".format(plane_cache.max_bytes/1024.**3))
+
 	#We need one of these for cycles for each map random realization
 	for rloc,r in enumerate(range(first_map_realization,last_map_realization)):
 
 		#Set random seed to generate the realizations
 		np.random.seed(settings.seed + r)
 
-		#Instantiate the RayTracer
-		tracer = RayTracer()
+		#Instantiate the RayTracer (lens planes can be kept in single precision, and interpolated between the pixels)
+		plane_dtype = np.float32 if getattr(settings,"single_precision_planes",False) else np.float64
+		plane_interpolation = getattr(settings,"plane_interpolation","nearest")
+		lens_type = getattr(settings,"lens_type","PotentialPlane")
+		if lens_type=="PotentialPlane":
+			tracer = RayTracer(dtype=plane_dtype,accumulator_dtype=np.float64,interpolation=plane_interpolation)
+		elif lens_type=="LensPackPlane":
+			tracer = RayTracer(lens_type=LensPackPlane,dtype=plane_dtype,accumulator_dtype=np.float64,interpolation=plane_interpolation)
+		else:
+			raise ValueError("Lens type {0} not recognized!".format(lens_type))
 
 		#Force garbage collection
 		gc.collect()
@@ -286,6 +325,25 @@ def singleRedshift(pool,batch,settings,batch_id):
 		logdriver.info("Reordering completed in {0:.3f}s".format(now-last_timestamp))
 		last_timestamp = now
 
+		#If the job can be resubmitted, skip the realizations whose maps are all saved already, and resume the interrupted ones from their checkpoints
+		checkpoint_interval = getattr(settings,"checkpoint_interval",0.0)
+		if checkpoint_interval>0:
+
+			if settings.tomographic_convergence:
+				map_redshifts = tracer.redshift[:(source_redshift>np.array(tracer.redshift)).argmin()]
+			else:
+				map_redshifts = [source_redshift]
+
+			if all([ os.path.exists(savename) for savename in _mapOutputs(batch,settings,save_path,map_redshifts,r) ]):
+				logdriver.info("All the maps of realization {0} are saved already, skipping it".format(r+1))
+				continue
+
+			checkpoint = batch.syshandler.map(os.path.join(save_path,"checkpoint_{0:04d}r.npz".format(r+1)))
+			logdriver.info("Ray state will be saved to {0} every {1:.1f}s".format(checkpoint,checkpoint_interval))
+		
+		else:
+			checkpoint = None
+
 		#Start a bucket of light rays from a regular grid of initial positions
 		b = np.linspace(0.0,map_angle.value,resolution)
 		xx,yy = np.meshgrid(b,b)
@@ -293,13 +351,19 @@ def singleRedshift(pool,batch,settings,batch_id):
 
 		if settings.tomographic_convergence:
 
-			#Trace the ray deflections and save the convergence at every step
-			tracer.shoot(pos,z=source_redshift,kind="jacobians",callback=convergence_callback,realization=r,angle=map_angle,map_batch=map_batch,settings=settings)
+			#Trace the ray deflections once, computing the convergence after every lens: each map is labeled with the redshift of the lens just crossed (the sources are on the next lens), the last one is at the source redshift. Each map is saved as soon as it is computed, so only one of them is in memory at a time
+			last_lens = (source_redshift>np.array(tracer.redshift)).argmin() - 1
+			savenames = _mapOutputs(batch,settings,save_path,tracer.redshift[:last_lens+1],r)
+			tracer.shoot(pos,z=tracer.redshift[1:last_lens+1]+[source_redshift],outputs=set(["convergence"]),output_callback=tomographic_callback,savenames=savenames,angle=map_angle,prefetch=getattr(settings,"plane_prefetch",0),chunk_size=getattr(settings,"ray_chunk_size",0) or None,n_threads=getattr(settings,"ray_threads",1),checkpoint=checkpoint,checkpoint_interval=checkpoint_interval)
+
+			now = time.time()
+			logdriver.info("Tomographic convergence ray tracing for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
+			last_timestamp = now
 
 		else:
 
 			#Trace the ray deflections
-			jacobian = tracer.shoot(pos,z=source_redshift,kind="jacobians")
+			jacobian = tracer.shoot(pos,z=source_redshift,kind="jacobians",prefetch=getattr(settings,"plane_prefetch",0),chunk_size=getattr(settings,"ray_chunk_size",0) or None,n_threads=getattr(settings,"ray_threads",1),checkpoint=checkpoint,checkpoint_interval=checkpoint_interval)
 
 			now = time.time()
 			logdriver.info("Jacobian ray tracing for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
@@ -358,11 +422,13 @@ def singleRedshift(pool,batch,settings,batch_id):
 				omegaMap.save(savename)
 
 		now = time.time()
+		recordEvent("save",now-last_timestamp)
 		
 		#Log peak memory usage to stdout
 		peak_memory_task,peak_memory_all = peakMemory(),peakMemoryAll(pool)
 		logdriver.info("Weak lensing calculations for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
 		logdriver.info("Peak memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
+		logdriver.info("Plane cache: {0} hits, {1} misses, {2} evictions, {3} planes ({4:.3f} Gbyte) in memory".format(plane_cache.hits,plane_cache.misses,plane_cache.evictions,len(plane_cache),plane_cache.nbytes/1024.**3))
 
 		#Log progress and peak memory usage to stderr
 		if (pool is None) or (pool.is_master()):
@@ -548,17 +614,26 @@ def losIntegrate(pool,batch,settings,batch_id):
 	if (pool is None) or (pool.is_master()):
 		logstderr.info("Initial memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
 
+	#Lens planes that are drawn multiple times are shared between realizations through the plane cache
+	plane_cache.setBudget(getattr(settings,"plane_cache_size",0.0)*(1024**3))
+	if (pool is None) or (pool.is_master()):
+		logdriver.info("Plane cache memory budget: {0:.3f} Gbyte (task)".format(plane_cache.max_bytes/1024.**3))
+
 	#We need one of these for cycles for each map random realization
 	for rloc,r in enumerate(range(first_map_realization,last_map_realization)):
 
 		#Set random seed to generate the realizations
 		np.random.seed(settings.seed + r)
 
-		#Instantiate the RayTracer
+		#Instantiate the RayTracer (lens planes can be kept in single precision, and interpolated between the pixels)
+		plane_dtype = np.float32 if getattr(settings,"single_precision_planes",False) else np.float64
+		plane_interpolation = getattr(settings,"plane_interpolation","nearest")
 		if settings.lens_type=="PotentialPlane":
-			tracer = RayTracer()
+			tracer = RayTracer(dtype=plane_dtype,accumulator_dtype=np.float64,interpolation=plane_interpolation)
 		elif settings.lens_type=="DensityPlane":
-			tracer = RayTracer(lens_type=DensityPlane)
+			tracer = RayTracer(lens_type=DensityPlane,dtype=plane_dtype,accumulator_dtype=np.float64,interpolation=plane_interpolation)
+		elif settings.lens_type=="LensPackPlane":
+			tracer = RayTracer(lens_type=LensPackPlane,dtype=plane_dtype,accumulator_dtype=np.float64,interpolation=plane_interpolation)
 		else:
 			raise ValueError("Lens type {0} not recognized!".format(settings.lens_type))
 
@@ -644,35 +719,35 @@ def losIntegrate(pool,batch,settings,batch_id):
 
 		#Perform the line of sight integration (choose integration type)
 		if settings.integration_type=="born":
-			image = tracer.convergenceBorn(pos,z=source_redshift,save_intermediate=False)
+			image = tracer.convergenceBorn(pos,z=source_redshift,save_intermediate=False,chunk_size=getattr(settings,"ray_chunk_size",0) or None,n_threads=getattr(settings,"ray_threads",1))
 			img_type = ConvergenceMap
 
 		elif settings.integration_type=="born-rt":
-			image = tracer.convergenceBorn(pos,z=source_redshift,real_trajectory=True,save_intermediate=False)
+			image = tracer.convergenceBorn(pos,z=source_redshift,real_trajectory=True,save_intermediate=False,chunk_size=getattr(settings,"ray_chunk_size",0) or None,n_threads=getattr(settings,"ray_threads",1))
 			img_type = ConvergenceMap
 
 		elif settings.integration_type=="postBorn2":
-			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=False,transpose_up_to=settings.transpose_up_to,callback=callback,map_batch=map_batch,map_angle=map_angle,realization=r+1)
+			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=False,transpose_up_to=settings.transpose_up_to,callback=callback,map_batch=map_batch,map_angle=map_angle,realization=r+1,chunk_size=getattr(settings,"ray_chunk_size",0) or None,n_threads=getattr(settings,"ray_threads",1))
 			img_type = ConvergenceMap
 
 		elif settings.integration_type=="postBorn2-ll":
-			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=False,include_gp=False,transpose_up_to=settings.transpose_up_to,callback=callback,map_batch=map_batch,map_angle=map_angle,realization=r+1)
+			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=False,include_gp=False,transpose_up_to=settings.transpose_up_to,callback=callback,map_batch=map_batch,map_angle=map_angle,realization=r+1,chunk_size=getattr(settings,"ray_chunk_size",0) or None,n_threads=getattr(settings,"ray_threads",1))
 			img_type = ConvergenceMap
 
 		elif settings.integration_type=="postBorn2-gp":
-			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=False,include_ll=False,transpose_up_to=settings.transpose_up_to,callback=callback,map_batch=map_batch,map_angle=map_angle,realization=r+1)
+			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=False,include_ll=False,transpose_up_to=settings.transpose_up_to,callback=callback,map_batch=map_batch,map_angle=map_angle,realization=r+1,chunk_size=getattr(settings,"ray_chunk_size",0) or None,n_threads=getattr(settings,"ray_threads",1))
 			img_type = ConvergenceMap
 
 		elif settings.integration_type=="postBorn1+2":
-			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=True,callback=callback,transpose_up_to=settings.transpose_up_to,map_batch=map_batch,map_angle=map_angle,realization=r+1)
+			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=True,callback=callback,transpose_up_to=settings.transpose_up_to,map_batch=map_batch,map_angle=map_angle,realization=r+1,chunk_size=getattr(settings,"ray_chunk_size",0) or None,n_threads=getattr(settings,"ray_threads",1))
 			img_type = ConvergenceMap
 
 		elif settings.integration_type=="postBorn1+2-gp":
-			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=True,include_ll=False,transpose_up_to=settings.transpose_up_to,callback=callback,map_batch=map_batch,map_angle=map_angle,realization=r+1)
+			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=True,include_ll=False,transpose_up_to=settings.transpose_up_to,callback=callback,map_batch=map_batch,map_angle=map_angle,realization=r+1,chunk_size=getattr(settings,"ray_chunk_size",0) or None,n_threads=getattr(settings,"ray_threads",1))
 			img_type = ConvergenceMap
 
 		elif settings.integration_type=="postBorn1+2-ll":
-			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=True,include_gp=False,transpose_up_to=settings.transpose_up_to,callback=callback,map_batch=map_batch,map_angle=map_angle,realization=r+1)
+			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=True,include_gp=False,transpose_up_to=settings.transpose_up_to,callback=callback,map_batch=map_batch,map_angle=map_angle,realization=r+1,chunk_size=getattr(settings,"ray_chunk_size",0) or None,n_threads=getattr(settings,"ray_threads",1))
 			img_type = ConvergenceMap			
 
 		elif settings.integration_type=="omega2":
@@ -697,11 +772,13 @@ def losIntegrate(pool,batch,settings,batch_id):
 		logdriver.debug("Saving {0} map to {1}".format(settings.integration_type,savename)) 
 
 		now = time.time()
+		recordEvent("save",now-last_timestamp)
 		
 		#Log peak memory usage to stdout
 		peak_memory_task,peak_memory_all = peakMemory(),peakMemoryAll(pool)
 		logdriver.info("Weak lensing calculations for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
 		logdriver.info("Peak memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
+		logdriver.info("Plane cache: {0} hits, {1} misses, {2} evictions, {3} planes ({4:.3f} Gbyte) in memory".format(plane_cache.hits,plane_cache.misses,plane_cache.evictions,len(plane_cache),plane_cache.nbytes/1024.**3))
 
 		#Log progress and peak memory usage to stderr
 		if (pool is None) or (pool.is_master()):
@@ -873,14 +950,27 @@ def simulatedCatalog(pool,batch,settings,batch_id):
 	if (pool is None) or (pool.is_master()):
 		logstderr.info("Initial memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
 
+	#Lens planes that are drawn multiple times are shared between realizations through the plane cache
+	plane_cache.setBudget(getattr(settings,"plane_cache_size",0.0)*(1024**3))
+	if (pool is None) or (pool.is_master()):
+		logdriver.info("Plane cache memory budget: {0:.3f} Gbyte (task)".format(plane_cache.max_bytes/1024.**3))
+
 	#We need one of these for cycles for each map random realization
 	for rloc,r in enumerate(range(first_realization,last_realization)):
 
 		#Set random seed to generate the realizations
 		np.random.seed(settings.seed + r)
 
-		#Instantiate the RayTracer
-		tracer = RayTracer()
+		#Instantiate the RayTracer (lens planes can be kept in single precision, and interpolated between the pixels)
+		plane_dtype = np.float32 if getattr(settings,"single_precision_planes",False) else np.float64
+		plane_interpolation = getattr(settings,"plane_interpolation","nearest")
+		lens_type = getattr(settings,"lens_type","PotentialPlane")
+		if lens_type=="PotentialPlane":
+			tracer = RayTracer(dtype=plane_dtype,accumulator_dtype=np.float64,interpolation=plane_interpolation)
+		elif lens_type=="LensPackPlane":
+			tracer = RayTracer(lens_type=LensPackPlane,dtype=plane_dtype,accumulator_dtype=np.float64,interpolation=plane_interpolation)
+		else:
+			raise ValueError("Lens type {0} not recognized!".format(lens_type))
 
 		#Force garbage collection
 		gc.collect()
@@ -946,8 +1036,24 @@ def simulatedCatalog(pool,batch,settings,batch_id):
 		logdriver.info("Reordering completed in {0:.3f}s".format(now-last_timestamp))
 		last_timestamp = now
 
+		#If the job can be resubmitted, skip the realizations whose catalogs are all saved already, and resume the interrupted ones from their checkpoints
+		shear_catalog_savenames = _catalogOutputs(batch,settings,catalog_save_path,catalog_subdirectory,realizations_in_subdir,r)
+		checkpoint_interval = getattr(settings,"checkpoint_interval",0.0)
+		
+		if checkpoint_interval>0:
+
+			if all([ os.path.exists(savename) for savename in shear_catalog_savenames ]):
+				logdriver.info("All the catalogs of realization {0} are saved already, skipping it".format(r+1))
+				continue
+
+			checkpoint = batch.syshandler.map(os.path.join(catalog_save_path,"checkpoint_{0:04d}r.npz".format(r+1)))
+			logdriver.info("Ray state will be saved to {0} every {1:.1f}s".format(checkpoint,checkpoint_interval))
+
+		else:
+			checkpoint = None
+
 		#Trace the ray deflections through the lenses
-		jacobian = tracer.shoot(initial_positions,z=galaxy_redshift,kind="jacobians")
+		jacobian = tracer.shoot(initial_positions,z=galaxy_redshift,kind="jacobians",prefetch=getattr(settings,"plane_prefetch",0),chunk_size=getattr(settings,"ray_chunk_size",0) or None,n_threads=getattr(settings,"ray_threads",1),checkpoint=checkpoint,checkpoint_interval=checkpoint_interval)
 
 		now = time.time()
 		logdriver.info("Jacobian ray tracing for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
@@ -966,16 +1072,7 @@ def simulatedCatalog(pool,batch,settings,batch_id):
 			except TypeError:
 				galaxies_before = 0
 		
-			#Build savename
-			if settings.reduced_shear:
-				shear_root = "WLredshear_"
-			else:
-				shear_root = "WLshear_"
-
-			if len(catalog_subdirectory):
-				shear_catalog_savename = batch.syshandler.map(os.path.join(catalog_save_path,catalog_subdirectory[r//realizations_in_subdir],shear_root+os.path.basename(galaxy_position_file.split(".")[0])+"_{0:04d}r.{1}".format(r+1,settings.format)))
-			else:
-				shear_catalog_savename = batch.syshandler.map(os.path.join(catalog_save_path,shear_root+os.path.basename(galaxy_position_file.split(".")[0])+"_{0:04d}r.{1}".format(r+1,settings.format)))
+			shear_catalog_savename = shear_catalog_savenames[n]
 			
 			if settings.reduced_shear:
 				logdriver.info("Saving simulated reduced shear catalog to {0}".format(shear_catalog_savename))
@@ -985,11 +1082,13 @@ def simulatedCatalog(pool,batch,settings,batch_id):
 			shear_catalog[galaxies_before:galaxies_before+galaxies_in_catalog[n]].write(shear_catalog_savename,overwrite=True)
 
 		now = time.time()
+		recordEvent("save",now-last_timestamp)
 
 		#Log peak memory usage to stdout
 		peak_memory_task,peak_memory_all = peakMemory(),peakMemoryAll(pool)
 		logdriver.info("Weak lensing calculations for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
 		logdriver.info("Peak memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
+		logdriver.info("Plane cache: {0} hits, {1} misses, {2} evictions, {3} planes ({4:.3f} Gbyte) in memory".format(plane_cache.hits,plane_cache.misses,plane_cache.evictions,len(plane_cache),plane_cache.nbytes/1024.**3))
 
 		#Log progress and peak memory usage to stderr
 		if (pool is None) or (pool.is_master()):
@@ -13,7 +13,7 @@
 from .design import Design
 from .igs1 import IGS1
 from .cfhtemu1 import CFHTemu1,CFHTcov
-from .raytracing import Plane,DensityPlane,PotentialPlane,RayTracer
+from .raytracing import Plane,DensityPlane,PotentialPlane,LensPackPlane,RayTracer
 from .nicaea import NicaeaSettings,Nicaea
 
 from .gadget2 import Gadget2Snapshot,Gadget2SnapshotDE,Gadget2SnapshotNu,Gadget2SnapshotPipe
@@ -1,5 +1,6 @@
 from __future__ import division
 import re
+import itertools
 
 from .nbody import NbodySnapshot
 
@@ -82,21 +83,18 @@ class AmigaHalos(NbodySnapshot):
 
 	def getPositions(self,first=None,last=None,save=True):
 
-		#Matter density today
-		rhoM = self.cosmology.critical_density0 * self.cosmology.Om0
-
 		if first is None:
 			first = 0
 
+		#Read the catalog from the beginning (the file might have been iterated over already)
+		self.fp.seek(0)
+
 		if last is None:
-			m,x,y,z,rv,c = np.loadtxt(self.fp,usecols=(3,5,6,7,11,42))[first:].T
+			halos = np.loadtxt(self.fp,usecols=self._halo_columns)[first:]
 		else:
-			m,x,y,z,rv,c = np.loadtxt(self.fp,usecols=(3,5,6,7,11,42))[first:last].T
+			halos = np.loadtxt(self.fp,usecols=self._halo_columns)[first:last]
 		
-		positions = np.array((x,y,z)).astype(np.float32).T * self.kpc_over_h
-		self.virial_radius = rv * self.kpc_over_h 
-		self.concentration = c
-		self.weights = ((1./(4*np.pi)) * (c**3/(np.log(1.+c)-c/(1.+c))) * m*(u.Msun/self.header["h"]) / (rhoM*(self.virial_radius**3))).decompose().value
+		positions = self._haloPositions(halos)
 
 		if save:
 			self.positions = positions
@@ -104,6 +102,51 @@ class AmigaHalos(NbodySnapshot):
 
 		return positions
 
+	def iterPositions(self,chunk_size=1048576):
+
+		"""
+		Iterates over the halo positions in chunks, reading chunk_size lines of the catalog at a time: at each iteration the weights, virial_radius and concentration attributes refer to the halos in the current chunk
+
+		:param chunk_size: maximum number of halos in each chunk
+		:type chunk_size: int.
+
+		:returns: generator of arrays with the halo positions (with units)
+
+		"""
+
+		assert chunk_size>0,"The chunk size must be positive!"
+
+		#Read the catalog from the beginning
+		self.fp.seek(0)
+
+		while True:
+
+			lines = list(itertools.islice(self.fp,chunk_size))
+			if not len(lines):
+				break
+
+			#Skip the chunks that contain only comments
+			halos = np.loadtxt(lines,usecols=self._halo_columns,ndmin=2)
+			if len(halos):
+				yield self._haloPositions(halos)
+
+	#Columns of the AHF catalog with mass, position, virial radius and concentration
+	_halo_columns = (3,5,6,7,11,42)
+
+	def _haloPositions(self,halos):
+
+		#Matter density today
+		rhoM = self.cosmology.critical_density0 * self.cosmology.Om0
+
+		m,x,y,z,rv,c = halos.T
+		
+		positions = np.array((x,y,z)).astype(np.float32).T * self.kpc_over_h
+		self.virial_radius = rv * self.kpc_over_h 
+		self.concentration = c
+		self.weights = ((1./(4*np.pi)) * (c**3/(np.log(1.+c)-c/(1.+c))) * m*(u.Msun/self.header["h"]) / (rhoM*(self.virial_radius**3))).decompose().value
+
+		return positions
+
 
 	############################################
 	###########These are not necessary##########
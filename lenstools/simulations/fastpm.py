@@ -114,6 +114,9 @@ class FastPMSnapshot(NbodySnapshot):
 			positions[:,n][positions[:,n]<0] += self.header["box_size"]
 			positions[:,n][positions[:,n]>self.header["box_size"]] -= self.header["box_size"]
 
+		#Subclasses may use the emission scale factor of the particles just read
+		positions = self._transformPositions(positions,aemit)
+
 		#Maybe save
 		if save:
 			self.positions = positions
@@ -127,6 +130,9 @@ class FastPMSnapshot(NbodySnapshot):
 		#Return
 		return positions 
 
+	def _transformPositions(self,positions,aemit):
+		return positions
+
 	###########################################################################################
 
 	def getVelocities(self,first=None,last=None,save=True):
@@ -150,9 +156,8 @@ class FastPMSnapshotStretchZ(FastPMSnapshot):
 
 	"""
 
-	def getPositions(self,first=None,last=None,save=True):
-		super(FastPMSnapshotStretchZ,self).getPositions(first,last,True)
+	def _transformPositions(self,positions,aemit):
 
 		#Replace z with comoving distances
-		self.positions[:,2] = self.cosmology.comoving_distance(1./self.aemit-1.).to(self.positions.unit).astype(np.float32)
-		return self.positions
+		positions[:,2] = self.cosmology.comoving_distance(1./aemit-1.).to(positions.unit).astype(np.float32)
+		return positions
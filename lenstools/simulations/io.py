@@ -1,6 +1,8 @@
 from __future__ import division
 
 import re
+import json
+from collections import OrderedDict
 
 import numpy as np
 import astropy.units as u
@@ -17,30 +19,39 @@ except ImportError:
 	fitsio = None
 
 ####################################################################
-#######################FITS format##################################
+#######################Plane header#################################
 ####################################################################
 
-#Header
-def readFITSHeader(filename):
-	with fits.open(filename) as fp:
-		return fp[0].header
+#Header cards that describe a plane, shared by all the formats
+def planeHeader(self):
 
-#Read
-def readFITS(cls,filename,init_cosmology=True):
+	#A cosmology instance should be available in order to generate the header
+	assert self.cosmology is not None
 
-	#Read the FITS file with the plane information (if there are two HDU's the second one is the imaginary part)
-	if fitsio is not None:
-		hdu = fitsio(filename)
-	else:
-		hdu = fits.open(filename)
-			
-	if len(hdu)>2:
-		raise ValueError("There are more than 2 HDUs, file format unknown")
+	header = OrderedDict()
+	
+	header["H0"] = (self.cosmology.H0.to(u.km/(u.s*u.Mpc)).value,"Hubble constant in km/s*Mpc")
+	header["h"] = (self.cosmology.h,"Dimensionless Hubble constant")
+	header["OMEGA_M"] = (self.cosmology.Om0,"Dark Matter density")
+	header["OMEGA_L"] = (self.cosmology.Ode0,"Dark Energy density")
+	header["W0"] = (self.cosmology.w0,"Dark Energy equation of state")
+	header["WA"] = (self.cosmology.wa,"Dark Energy running equation of state")
 
-	if fitsio is not None:
-		header = hdu[0].read_header()
-	else:
-		header = hdu[0].header
+	header["Z"] = (self.redshift,"Redshift of the lens plane")
+	header["CHI"] = (self.cosmology.h * self.comoving_distance.to(u.Mpc).value,"Comoving distance in Mpc/h")
+
+	if self.side_angle.unit.physical_type=="angle":
+		header["ANGLE"] = (self.side_angle.to(u.deg).value,"Side angle in degrees")
+	elif self.side_angle.unit.physical_type=="length":
+		header["SIDE"] = (self.side_angle.to(u.Mpc).value*self.cosmology.h,"Side length in Mpc/h")
+
+	header["NPART"] = (float(self.num_particles),"Number of particles on the plane")
+	header["UNIT"] = (self.unit.to_string(),"Pixel value unit")
+
+	return header
+
+#Instantiate a plane from its pixel values and the header cards; if dtype is not None, real pixel values are kept in that precision
+def planeFromHeader(cls,data,header,filename=None,init_cosmology=True,dtype=None):
 
 	#Retrieve the info from the header (handle old FITS header format too)
 	try:
@@ -94,26 +105,77 @@ def readFITS(cls,filename,init_cosmology=True):
 	except (ValueError,KeyError):
 		unit = u.rad**2
 
+	#Real pixel values are converted (if needed) before the plane is built, the plane constructors keep them in their precision
+	if (dtype is not None) and not(np.iscomplexobj(data)):
+		data = data.astype(dtype,copy=False)
+
+	return cls(data,angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
+
+####################################################################
+#######################FITS format##################################
+####################################################################
+
+#Header
+def readFITSHeader(filename):
+	with fits.open(filename) as fp:
+		return fp[0].header
+
+#Read
+def readFITS(cls,filename,init_cosmology=True,dtype=np.float64):
+
+	#Keep the pixel values in the precision on disk: they are memory mapped instead of read
+	if dtype is None:
+		return mapFITS(cls,filename,init_cosmology=init_cosmology)
+
+	#Read the FITS file with the plane information (if there are two HDU's the second one is the imaginary part)
+	if fitsio is not None:
+		hdu = fitsio(filename)
+	else:
+		hdu = fits.open(filename)
+			
+	if len(hdu)>2:
+		raise ValueError("There are more than 2 HDUs, file format unknown")
+
+	if fitsio is not None:
+		header = hdu[0].read_header()
+	else:
+		header = hdu[0].header
+
 	#Instantiate the new PotentialPlane instance
 	if fitsio is not None:
 
 		if len(hdu)==1:
-			new_plane = cls(hdu[0].read(),angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
+			new_plane = planeFromHeader(cls,hdu[0].read(),header,filename=filename,init_cosmology=init_cosmology,dtype=dtype)
 		else:
-			new_plane = cls(hdu[1].read() + 1.0j*hdu[1].read(),angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
+			new_plane = planeFromHeader(cls,hdu[1].read() + 1.0j*hdu[1].read(),header,filename=filename,init_cosmology=init_cosmology)
 
 	else:
 			
 		if len(hdu)==1:
-			new_plane = cls(hdu[0].data.astype(np.float64),angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
+			new_plane = planeFromHeader(cls,hdu[0].data.astype(dtype),header,filename=filename,init_cosmology=init_cosmology,dtype=dtype)
 		else:
-			new_plane = cls((hdu[0].data + 1.0j*hdu[1].data).astype(np.complex128),angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
+			new_plane = planeFromHeader(cls,(hdu[0].data + 1.0j*hdu[1].data).astype(np.complex128),header,filename=filename,init_cosmology=init_cosmology)
 
 	#Close the FITS file and return
 	hdu.close()
 	return new_plane
 
 
+#Map: the pixel values are memory mapped (in the byte order on disk), so they are read from disk only when accessed; this is possible only if they are stored as unscaled floating point values in a single HDU
+def mapFITS(cls,filename,init_cosmology=True):
+
+	hdu = fits.open(filename,memmap=True)
+	header = hdu[0].header
+
+	if len(hdu)>1 or header["BITPIX"]>0 or header.get("BSCALE",1.0)!=1.0 or header.get("BZERO",0.0)!=0.0:
+		hdu.close()
+		raise ValueError("The pixel values in {0} are not stored as unscaled floating point values in a single HDU, so they cannot be memory mapped: save the plane in raw format instead".format(filename))
+
+	#The mapped pixel values stay valid after the file is closed
+	data = hdu[0].data
+	hdu.close()
+
+	return planeFromHeader(cls,data,header,filename=filename,init_cosmology=init_cosmology)
 
 #Write
 def saveFITS(self,filename,double_precision):
@@ -139,23 +201,8 @@ def saveFITS(self,filename,double_precision):
 
 
 	#Generate a header
-	hdu.header["H0"] = (self.cosmology.H0.to(u.km/(u.s*u.Mpc)).value,"Hubble constant in km/s*Mpc")
-	hdu.header["h"] = (self.cosmology.h,"Dimensionless Hubble constant")
-	hdu.header["OMEGA_M"] = (self.cosmology.Om0,"Dark Matter density")
-	hdu.header["OMEGA_L"] = (self.cosmology.Ode0,"Dark Energy density")
-	hdu.header["W0"] = (self.cosmology.w0,"Dark Energy equation of state")
-	hdu.header["WA"] = (self.cosmology.wa,"Dark Energy running equation of state")
-
-	hdu.header["Z"] = (self.redshift,"Redshift of the lens plane")
-	hdu.header["CHI"] = (hdu.header["h"] * self.comoving_distance.to(u.Mpc).value,"Comoving distance in Mpc/h")
-
-	if self.side_angle.unit.physical_type=="angle":
-		hdu.header["ANGLE"] = (self.side_angle.to(u.deg).value,"Side angle in degrees")
-	elif self.side_angle.unit.physical_type=="length":
-		hdu.header["SIDE"] = (self.side_angle.to(u.Mpc).value*self.cosmology.h,"Side length in Mpc/h")
-
-	hdu.header["NPART"] = (float(self.num_particles),"Number of particles on the plane")
-	hdu.header["UNIT"] = (self.unit.to_string(),"Pixel value unit") 
+	for key,card in planeHeader(self).items():
+		hdu.header[key] = card
 
 	#Save the plane
 	if self.space=="real":
@@ -165,4 +212,52 @@ def saveFITS(self,filename,double_precision):
 
 	hdulist.writeto(filename,overwrite=True)
 
-########################################################################################################################################
\ No newline at end of file
+########################################################################################################################################
+
+
+####################################################################
+#######################Raw format###################################
+####################################################################
+
+#The pixel values are stored as a raw little endian array, the header cards (FITS conventions) in a JSON sidecar file
+def rawHeaderFilename(filename):
+	return filename + ".json"
+
+#Header
+def readRawHeader(filename):
+	with open(rawHeaderFilename(filename),"r") as fp:
+		return json.load(fp,object_pairs_hook=OrderedDict)
+
+#Read: the pixel values are memory mapped, so they are read from disk (and shared between processes through the page cache) only when accessed; if they are requested in a different precision than the one on disk, they are converted in memory instead (dtype=None keeps the precision on disk)
+def readRaw(cls,filename,init_cosmology=True,dtype=np.float64):
+
+	header = readRawHeader(filename)
+	shape = tuple( header["NAXIS{0}".format(n)] for n in range(header["NAXIS"],0,-1) )
+
+	#Copy on write: the pixel values can be modified in memory, but the changes never reach the file
+	data = np.memmap(filename,dtype=np.dtype(header["DTYPE"]),mode="c",shape=shape)
+	
+	return planeFromHeader(cls,data,header,filename=filename,init_cosmology=init_cosmology,dtype=dtype)
+
+#Write: the pixel values are saved in double or single precision, which is recorded in the header
+def saveRaw(self,filename,double_precision=True):
+
+	if self.space!="real":
+		raise ValueError("Only real space planes can be saved in raw format!")
+
+	#Pixel values
+	data = np.ascontiguousarray(self.data,dtype=("<f8" if double_precision else "<f4"))
+	data.tofile(filename)
+
+	#Header
+	header = OrderedDict()
+	header["DTYPE"] = data.dtype.str
+	header["NAXIS"] = data.ndim
+	for n in range(data.ndim):
+		header["NAXIS{0}".format(n+1)] = data.shape[data.ndim-n-1]
+
+	for key,(value,comment) in planeHeader(self).items():
+		header[key] = value
+
+	with open(rawHeaderFilename(filename),"w") as fp:
+		json.dump(header,fp,indent=1,default=lambda value:value.item())
@@ -1,4 +1,7 @@
 import sys,platform
+import time
+import threading
+import json,csv
 import resource
 import logging
 
@@ -58,3 +61,148 @@ def peakMemoryAll(pool):
 	pool.comm.Reduce(memory_task_raw,memory_task_all)
 
 	return memory_task_all[0]*unit,pool.size+1
+
+##################################################
+#Per lens timing and memory usage instrumentation#
+##################################################
+
+class PerformanceRecorder(object):
+
+	"""
+	Collects structured timing and memory usage events (one per lens and per phase, e.g. load, roll, gradient, update, callback, save) during the ray tracing operations. The events are recorded only while the recorder is active, i.e. within a with statement or between start() and stop(), and they can be saved to a JSON or CSV file (one per task)
+
+	:param task: identifier of the task that records the events (e.g. the MPI rank)
+	:type task: int.
+
+	>>> with PerformanceRecorder(task=0) as recorder:
+	>>> 	tracer.shoot(pos,z=2.0)
+	>>> recorder.save("profile.json")
+
+	"""
+
+	#Columns of the saved events
+	fields = ["task","phase","lens","file","redshift","start","wall_time","bytes","peak_memory"]
+
+	#Recorder that is currently collecting the events (None if the instrumentation is off)
+	active = None
+
+	def __init__(self,task=0):
+		self.task = task
+		self.events = list()
+		self._lock = threading.Lock()
+		self._previous = None
+		self._start = time.time()
+
+	def __repr__(self):
+		return "<PerformanceRecorder: task={0}, {1} events>".format(self.task,len(self.events))
+
+	def start(self):
+
+		"""
+		Start collecting the events
+
+		"""
+
+		self._previous = PerformanceRecorder.active
+		PerformanceRecorder.active = self
+
+	def stop(self):
+
+		"""
+		Stop collecting the events (the recorder that was active before, if any, is restored)
+
+		"""
+
+		if PerformanceRecorder.active is self:
+			PerformanceRecorder.active = self._previous
+		self._previous = None
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self,exc_type,exc_value,traceback):
+		self.stop()
+		return False
+
+	def record(self,phase,wall_time,lens=None,redshift=None,nbytes=0,file=None):
+
+		"""
+		Record an event that just completed
+
+		:param phase: name of the phase (load, roll, gradient, update, callback, save...)
+		:type phase: str.
+
+		:param wall_time: duration of the event in seconds
+		:type wall_time: float.
+
+		:param lens: index of the lens the event refers to, if any
+		:type lens: int.
+
+		:param redshift: redshift of the lens, if any
+		:type redshift: float.
+
+		:param nbytes: number of bytes read from disk during the event
+		:type nbytes: int.
+
+		:param file: file the lens was read from, if any
+		:type file: str.
+
+		"""
+
+		event = {"task":self.task,"phase":phase,"lens":lens,"file":file,"redshift":(None if redshift is None else float(redshift)),"start":time.time()-wall_time-self._start,"wall_time":wall_time,"bytes":int(nbytes),"peak_memory":peakMemory().value}
+
+		with self._lock:
+			self.events.append(event)
+
+	def totals(self):
+
+		"""
+		Total wall time spent in each phase
+
+		:returns: dict phase -> seconds
+		:rtype: dict.
+
+		"""
+
+		totals = dict()
+		for event in self.events:
+			totals[event["phase"]] = totals.get(event["phase"],0.0) + event["wall_time"]
+
+		return totals
+
+	def save(self,filename,format=None):
+
+		"""
+		Save the recorded events to a file
+
+		:param filename: name of the file
+		:type filename: str.
+
+		:param format: one between json and csv; if None it is inferred from the file extension (json is the default)
+		:type format: str.
+
+		"""
+
+		if format is None:
+			format = "csv" if filename.endswith(".csv") else "json"
+
+		with self._lock:
+			events = list(self.events)
+
+		if format=="json":
+			with open(filename,"w") as fp:
+				json.dump(events,fp,indent=1)
+		elif format=="csv":
+			with open(filename,"w") as fp:
+				writer = csv.DictWriter(fp,fieldnames=self.fields)
+				writer.writeheader()
+				writer.writerows(events)
+		else:
+			raise ValueError("Format {0} not supported, must be one between json and csv".format(format))
+
+#Record an event on the active recorder, if any
+def recordEvent(phase,wall_time,lens=None,redshift=None,nbytes=0,file=None):
+	recorder = PerformanceRecorder.active
+	if recorder is not None:
+		recorder.record(phase,wall_time,lens=lens,redshift=redshift,nbytes=nbytes,file=file)
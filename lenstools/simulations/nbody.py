@@ -43,6 +43,34 @@ except ImportError:
 	rpy2 = False
 
 
+#Mass assignment schemes of the gridding backend (the mass assignment window is a sinc to the power of scheme index + 1)
+_assignment_schemes = {"ngp":0,"cic":1,"tsc":2}
+
+#########################################################################
+#################Chunks of the positions read from disk##################
+#########################################################################
+
+class _PositionChunks(object):
+
+	"""
+	Re-iterable sequence of chunks of the particle positions in a snapshot: each iteration reads them from disk again with iterPositions, converting them to the length unit of the snapshot
+
+	"""
+
+	def __init__(self,snapshot,chunk_size):
+		self.snapshot = snapshot
+		self.chunk_size = chunk_size
+		self.unit = snapshot.header["box_size"].unit
+
+	def __iter__(self):
+		
+		for positions in self.snapshot.iterPositions(chunk_size=self.chunk_size):
+			
+			if positions.unit!=self.unit:
+				positions = positions.to(self.unit)
+			
+			yield positions
+
 ###################################################################
 #################NbodySnapshot abstract class######################
 ###################################################################
@@ -400,11 +428,74 @@ class NbodySnapshot(object):
 
 		self.velocities = velocities
 
+	############################################################################################################################
+
+	def iterPositions(self,chunk_size=1048576):
+
+		"""
+		Iterates over the particle positions handled by this instance in chunks, reading one chunk at a time from disk: this allows to grid snapshots that do not fit in memory. At each iteration the weights, virial_radius and concentration attributes refer to the particles in the current chunk
+
+		:param chunk_size: maximum number of particles in each chunk
+		:type chunk_size: int.
+
+		:returns: generator of arrays with the particle positions (with units)
 
-	def massDensity(self,resolution=0.5*Mpc,smooth=None,left_corner=None,save=False,density_placeholder=None):
+		"""
+
+		assert chunk_size>0,"The chunk size must be positive!"
+
+		#Range of particles handled by this instance
+		first = getattr(self,"_first",None)
+		last = getattr(self,"_last",None)
+
+		if first is None:
+			first = 0
+		if last is None:
+			last = int(self._header["num_particles_file"])
+
+		#Read one chunk at a time
+		for chunk_first in range(first,last,chunk_size):
+			yield self.getPositions(first=chunk_first,last=min(chunk_first+chunk_size,last),save=False)
+
+	def _positionChunks(self,chunk_size):
 
 		"""
-		Uses a C backend gridding function to compute the matter mass density fluctutation for the current snapshot: the density is evaluated using a nearest neighbor search
+		Particle positions to grid: the positions in memory if available, otherwise the ones read from disk all at once (chunk_size=None) or in chunks of chunk_size particles
+
+		:returns: re-iterable sequence of arrays with the particle positions
+
+		"""
+
+		if hasattr(self,"positions"):
+			return [self.positions]
+		elif chunk_size is None:
+			return [self.getPositions(first=getattr(self,"_first",None),last=getattr(self,"_last",None),save=False)]
+		else:
+			return _PositionChunks(self,chunk_size)
+
+	@staticmethod
+	def _chunksUnit(chunks):
+
+		#Units of the positions (the chunks read from disk are in the length unit of the snapshot, nothing is read here)
+		if isinstance(chunks,_PositionChunks):
+			return chunks.unit
+		else:
+			return chunks[0].unit
+
+	@staticmethod
+	def _chunksLeftCorner(chunks,unit):
+
+		#Default lower left corner of the grid: the minimum of the (x,y,z) of the particles in memory; the positions read from disk in chunks span the periodic box, whose origin is taken instead of making an additional pass over the snapshot
+		if isinstance(chunks,_PositionChunks):
+			return np.zeros(3) * unit
+		else:
+			return chunks[0].min(axis=0).to(unit)
+
+
+	def massDensity(self,resolution=0.5*Mpc,smooth=None,left_corner=None,save=False,density_placeholder=None,assignment="ngp",chunk_size=None):
+
+		"""
+		Uses a C backend gridding function to compute the matter mass density fluctutation for the current snapshot: the particles are assigned to the grid cells with a nearest grid point (ngp), cloud in cell (cic) or triangular shaped cloud (tsc) scheme, the clouds wrap around the periodic box
 
 		:param resolution: resolution below which particles are grouped together; if an int is passed, this is the size of the grid
 		:type resolution: float with units or int.
@@ -412,7 +503,7 @@ class NbodySnapshot(object):
 		:param smooth: if not None, performs a smoothing of the density (or potential) with a gaussian kernel of scale "smooth x the pixel resolution"
 		:type smooth: int. or None
 
-		:param left_corner: specify the position of the lower left corner of the box; if None, the minimum of the (x,y,z) of the contained particles is assumed
+		:param left_corner: specify the position of the lower left corner of the box; if None, the minimum of the (x,y,z) of the contained particles is assumed (the origin of the box if the particles are read from disk in chunks)
 		:type left_corner: tuple of quantities or None
 
 		:param save: if True saves the density histogram and resolution as instance attributes
@@ -421,29 +512,30 @@ class NbodySnapshot(object):
 		:param density placeholder: if not None, it is used as a fixed memory chunk for MPI communications of the density
 		:type density_placeholder: array
 
+		:param assignment: mass assignment scheme of the point particles, must be one in [ngp,cic,tsc]; particles with virial radius and concentration are spread with their NFW profile, and only ngp is accepted for them
+		:type assignment: str.
+
+		:param chunk_size: if not None and the positions are not in memory, the particles are read from disk and gridded chunk_size at a time (see iterPositions)
+		:type chunk_size: int. or None
+
 		:returns: tuple(numpy 3D array with the (unsmoothed) matter density fluctuation on a grid,bin resolution along the axes)  
 
 		"""
 
 		#Sanity checks
 		assert type(resolution) in [np.int,quantity.Quantity]
+		assert assignment in _assignment_schemes,"assignment must be one in {0}".format(sorted(_assignment_schemes))
 		
 		if type(resolution)==quantity.Quantity:	
 			assert resolution.unit.physical_type=="length"
 
-		#Check if positions are already available, otherwise retrieve them
-		if hasattr(self,"positions"):
-			positions = self.positions
-		else:
-			positions = self.getPositions(save=False)
-
-		assert hasattr(self,"weights")
-		assert hasattr(self,"virial_radius")
-		assert hasattr(self,"concentration")
+		#Check if positions are already available, otherwise retrieve them (possibly in chunks)
+		chunks = self._positionChunks(chunk_size)
+		unit = self._chunksUnit(chunks)
 
 		#Bin extremes (we start from the leftmost position up to the box size)
 		if left_corner is None:
-			xmin,ymin,zmin = positions.min(axis=0)
+			xmin,ymin,zmin = self._chunksLeftCorner(chunks,unit)
 		else:
 			xmin,ymin,zmin = left_corner
 
@@ -451,33 +543,50 @@ class NbodySnapshot(object):
 		if type(resolution)==quantity.Quantity:
 
 			#Scale to appropriate units
-			resolution = resolution.to(positions.unit)
-			xi = np.arange(xmin.to(positions.unit).value,(xmin + self._header["box_size"]).to(positions.unit).value,resolution.value)
-			yi = np.arange(ymin.to(positions.unit).value,(ymin + self._header["box_size"]).to(positions.unit).value,resolution.value)
-			zi = np.arange(zmin.to(positions.unit).value,(zmin + self._header["box_size"]).to(positions.unit).value,resolution.value)
+			resolution = resolution.to(unit)
+			xi = np.arange(xmin.to(unit).value,(xmin + self._header["box_size"]).to(unit).value,resolution.value)
+			yi = np.arange(ymin.to(unit).value,(ymin + self._header["box_size"]).to(unit).value,resolution.value)
+			zi = np.arange(zmin.to(unit).value,(zmin + self._header["box_size"]).to(unit).value,resolution.value)
 
 		else:
 
-			xi = np.linspace(xmin.to(positions.unit).value,(xmin + self._header["box_size"]).to(positions.unit).value,resolution+1)
-			yi = np.linspace(ymin.to(positions.unit).value,(ymin + self._header["box_size"]).to(positions.unit).value,resolution+1)
-			zi = np.linspace(zmin.to(positions.unit).value,(zmin + self._header["box_size"]).to(positions.unit).value,resolution+1)
+			xi = np.linspace(xmin.to(unit).value,(xmin + self._header["box_size"]).to(unit).value,resolution+1)
+			yi = np.linspace(ymin.to(unit).value,(ymin + self._header["box_size"]).to(unit).value,resolution+1)
+			zi = np.linspace(zmin.to(unit).value,(zmin + self._header["box_size"]).to(unit).value,resolution+1)
 
 
-		#Compute the number count histogram
-		assert positions.value.dtype==np.float32
+		#Compute the number count histogram, one chunk at a time
+		density = None
+		for positions in chunks:
 
-		#Weights
-		if self.weights is not None:
-			weights = (self.weights * self._header["num_particles_total"] / ((len(xi) - 1) * (len(yi) - 1) * (len(zi) - 1))).astype(np.float32)
-		else:
-			weights = None
+			assert positions.unit==unit
+			assert positions.value.dtype==np.float32
 
-		if self.virial_radius is not None:
-			rv = self.virial_radius.to(positions.unit).value
-		else:
-			rv = None
+			#The particle attributes refer to the positions just read
+			assert hasattr(self,"weights")
+			assert hasattr(self,"virial_radius")
+			assert hasattr(self,"concentration")
+
+			#Weights
+			if self.weights is not None:
+				weights = (self.weights * self._header["num_particles_total"] / ((len(xi) - 1) * (len(yi) - 1) * (len(zi) - 1))).astype(np.float32)
+			else:
+				weights = None
+
+			if self.virial_radius is not None:
+				self._checkNFWAssignment(assignment)
+				rv = self.virial_radius.to(unit).value
+			else:
+				rv = None
+
+			density_chunk = ext._nbody.grid3d(positions.value,(xi,yi,zi),weights,rv,self.concentration,_assignment_schemes[assignment])
+			
+			if density is None:
+				density = density_chunk
+			else:
+				density += density_chunk
 
-		density = ext._nbody.grid3d(positions.value,(xi,yi,zi),weights,rv,self.concentration) * (len(xi)-1) * (len(yi)-1) * (len(zi)-1) / self._header["num_particles_total"]
+		density = density * (len(xi)-1) * (len(yi)-1) * (len(zi)-1) / self._header["num_particles_total"]
 
 		#Accumulate from the other processors
 		if self.pool is not None:
@@ -495,7 +604,7 @@ class NbodySnapshot(object):
 				self.pool.closeWindow()
 
 		#Recompute resolution to make sure it represents the bin size correctly
-		bin_resolution = ((xi[1:]-xi[:-1]).mean() * positions.unit,(yi[1:]-yi[:-1]).mean() * positions.unit,(zi[1:]-zi[:-1]).mean() * positions.unit)
+		bin_resolution = ((xi[1:]-xi[:-1]).mean() * unit,(yi[1:]-yi[:-1]).mean() * unit,(zi[1:]-zi[:-1]).mean() * unit)
 
 		#Perform smoothing if prompted
 		if smooth is not None:
@@ -513,13 +622,13 @@ class NbodySnapshot(object):
 
 		#Return the density histogram, along with the bin resolution along each axis
 		if save:
-			self.density,self.resolution = density,bin_resolution
+			self.density,self.resolution,self.density_assignment = density,bin_resolution,assignment
 
 		return density,bin_resolution
 
 	###################################################################################################################################################
 
-	def cutPlaneGaussianGrid(self,normal=2,thickness=0.5*Mpc,center=7.0*Mpc,plane_resolution=4096,left_corner=None,thickness_resolution=1,smooth=1,kind="density",**kwargs):
+	def cutPlaneGaussianGrid(self,normal=2,thickness=0.5*Mpc,center=7.0*Mpc,plane_resolution=4096,left_corner=None,thickness_resolution=1,smooth=1,kind="density",assignment="ngp",thickness_weights=None,chunk_size=None,**kwargs):
 
 		"""
 		Cuts a density (or lensing potential) plane out of the snapshot by computing the particle number density on a slab and performing Gaussian smoothing; the plane coordinates are cartesian comoving
@@ -536,7 +645,7 @@ class NbodySnapshot(object):
 		:param plane_resolution: plane resolution (perpendicular to the normal)
 		:type plane_resolution: float. with units (or int.)
 
-		:param left_corner: specify the position of the lower left corner of the box; if None, the minimum of the (x,y,z) of the contained particles is assumed
+		:param left_corner: specify the position of the lower left corner of the box; if None, the minimum of the (x,y,z) of the contained particles is assumed (the origin of the box if the particles are read from disk in chunks)
 		:type left_corner: tuple of quantities or None
 
 		:param thickness_resolution: plane resolution (along the normal)
@@ -548,6 +657,15 @@ class NbodySnapshot(object):
 		:param kind: decide if computing a density or gravitational potential plane (this is computed solving the poisson equation)
 		:type kind: str. ("density" or "potential")
 
+		:param assignment: mass assignment scheme of the point particles, must be one in [ngp,cic,tsc]; the clouds are spread only on the plane, where they wrap around the periodic box, while along the normal each particle goes in the bin it falls in. Particles with virial radius and concentration are spread with their NFW profile, and only ngp is accepted for them
+		:type assignment: str.
+
+		:param thickness_weights: if not None, the bins along the normal are weighted with these numbers when projecting the slab on the plane (one for each bin); the default is a plain sum over the slab thickness
+		:type thickness_weights: array
+
+		:param chunk_size: if not None and the positions are not in memory, the particles are read from disk and gridded chunk_size at a time (see iterPositions)
+		:type chunk_size: int. or None
+
 		:param kwargs: accepted keyword are: 'density_placeholder', a pre-allocated numpy array, with a RMA window opened on it; this facilitates the communication with different processors by using a single RMA window during the execution. 'l_squared' a pre-computed meshgrid of squared multipoles used for smoothing
 		:type kwargs: dict.
 
@@ -560,30 +678,270 @@ class NbodySnapshot(object):
 		assert kind in ["density","potential"],"Specify density or potential plane!"
 		assert type(thickness)==quantity.Quantity and thickness.unit.physical_type=="length"
 		assert type(center)==quantity.Quantity and center.unit.physical_type=="length"
+		assert assignment in _assignment_schemes,"assignment must be one in {0}".format(sorted(_assignment_schemes))
 
 		#Redshift must be bigger than 0 or we cannot proceed
 		if ("redshift" in self.header) and (self.header["redshift"]<=0.0):
 			raise ValueError("The snapshot redshift must be >0 for the lensing density to be defined!")
 
-		#Cosmological normalization factor
-		cosmo_normalization = 1.5 * self.header["H0"]**2 * self.header["Om0"] / c**2
+		#Get the particle positions if not available get (possibly in chunks)
+		chunks = self._positionChunks(chunk_size)
+		unit = self._chunksUnit(chunks)
 
-		#Direction of the plane
-		plane_directions = [ d for d in range(3) if d!=normal ]
+		#Lower left corner of the plane
+		if left_corner is None:
+			left_corner = self._chunksLeftCorner(chunks,unit)
 
-		#Get the particle positions if not available get
-		if hasattr(self,"positions"):
-			positions = self.positions
+		#Create a list that holds the bins
+		center = center.to(unit)
+		binning = self._slabBinning(normal,thickness,center,plane_resolution,left_corner,thickness_resolution,unit)
+
+		#Log
+		if self.pool is not None:
+			logplanes.debug("Task {0} began gridding procedure".format(self.pool.rank))
 		else:
-			positions = self.getPositions(first=self._first,last=self._last,save=False)
+			logplanes.debug("Began gridding procedure")
 
-		assert hasattr(self,"weights")
-		assert hasattr(self,"virial_radius")
-		assert hasattr(self,"concentration")
+		##########
+		#Gridding#
+		##########
+
+		density = None
+		for positions in chunks:
+
+			#Now use gridding to compute the density along the slab
+			assert positions.unit==unit
+			assert positions.value.dtype==np.float32
+
+			#The particle attributes refer to the positions just read
+			assert hasattr(self,"weights")
+			assert hasattr(self,"virial_radius")
+			assert hasattr(self,"concentration")
+
+			#Weights
+			if self.weights is not None:
+				weights = self.weights.astype(np.float32)
+			else:
+				weights = None
+
+			if self.virial_radius is not None:
+				
+				#The particle profiles are gridded on the slab volume, then projected along the normal
+				density_chunk = self._projectNFW(positions.value,weights,binning,normal,thickness_weights,assignment,unit)
+
+			else:
+				
+				#Point particles are projected straight on the plane
+				density_chunk = self._projectSlabs(positions.value,weights,[binning],[normal],thickness_weights,assignment)[0]
+
+			if density is None:
+				density = density_chunk
+			else:
+				density += density_chunk
+
+		###################################################################################################################################
+
+		#Log
+		if self.pool is not None:
+			logplanes.debug("Task {0} done with gridding procedure".format(self.pool.rank))
+		else:
+			logplanes.debug("Done with gridding procedure")
+
+		if (self.pool is None) or (self.pool.is_master()):
+			logstderr.debug("Done with gridding procedure: peak memory usage {0:.3f} (task)".format(peakMemory()))
+
+		#Project the slab and compute the plane
+		return self._projectSlab(density,binning,normal,center,unit,smooth,kind,**kwargs)
+
+
+	def cutPlanes(self,planes,plane_resolution=4096,left_corner=None,thickness_resolution=1,smooth=1,kind="density",assignment="ngp",thickness_weights=None,chunk_size=None,**kwargs):
+
+		"""
+		Cut several density (lensing potential) planes out of the snapshot in a single pass over the particles: each particle is deposited in all the slabs it falls in, then each slab is projected along its normal as in cutPlaneGaussianGrid
+
+		:param planes: slabs to cut, each one specified by a tuple (center,thickness,normal)
+		:type planes: list of tuples
+
+		:param plane_resolution: plane resolution (perpendicular to the normal)
+		:type plane_resolution: float. with units (or int.)
+
+		:param left_corner: specify the position of the lower left corner of the box; if None, the minimum of the (x,y,z) of the contained particles is assumed (the origin of the box if the particles are read from disk in chunks)
+		:type left_corner: tuple of quantities or None
+
+		:param thickness_resolution: plane resolution (along the normal)
+		:type thickness_resolution: float. with units (or int.)
+
+		:param smooth: if not None, performs a smoothing of the density (or potential) with a gaussian kernel of scale "smooth x the pixel resolution"
+		:type smooth: int. or None
+
+		:param kind: decide if computing a density or gravitational potential plane (this is computed solving the poisson equation)
+		:type kind: str. ("density" or "potential")
+
+		:param assignment: mass assignment scheme of the point particles, must be one in [ngp,cic,tsc] (see cutPlaneGaussianGrid)
+		:type assignment: str.
+
+		:param thickness_weights: if not None, the bins along the normal are weighted with these numbers when projecting the slab on the plane (one for each bin); the default is a plain sum over the slab thickness
+		:type thickness_weights: array
+
+		:param chunk_size: if not None and the positions are not in memory, the particles are read from disk and gridded chunk_size at a time (see iterPositions)
+		:type chunk_size: int. or None
+
+		:param kwargs: same as cutPlaneGaussianGrid; the 'density_placeholder' is reused for each of the planes
+		:type kwargs: dict.
+
+		:returns: list of tuple(numpy 2D array with the density (or lensing potential),bin resolution along the axes, number of particles on the plane), one for each slab in the same order as planes
+
+		"""
+
+		#Sanity checks
+		assert kind in ["density","potential"],"Specify density or potential plane!"
+		assert assignment in _assignment_schemes,"assignment must be one in {0}".format(sorted(_assignment_schemes))
+
+		for center,thickness,normal in planes:
+			assert normal in range(3),"There are only 3 dimensions!"
+			assert type(thickness)==quantity.Quantity and thickness.unit.physical_type=="length"
+			assert type(center)==quantity.Quantity and center.unit.physical_type=="length"
+
+		#Redshift must be bigger than 0 or we cannot proceed
+		if ("redshift" in self.header) and (self.header["redshift"]<=0.0):
+			raise ValueError("The snapshot redshift must be >0 for the lensing density to be defined!")
+
+		#Get the particle positions if not available get (possibly in chunks)
+		chunks = self._positionChunks(chunk_size)
+		unit = self._chunksUnit(chunks)
 
 		#Lower left corner of the plane
 		if left_corner is None:
-			left_corner = positions.min(axis=0)
+			left_corner = self._chunksLeftCorner(chunks,unit)
+
+		#Binning of each slab
+		centers = [ center.to(unit) for center,thickness,normal in planes ]
+		binnings = [ self._slabBinning(normal,thickness,centers[n],plane_resolution,left_corner,thickness_resolution,unit) for n,(center,thickness,normal) in enumerate(planes) ]
+
+		#Log
+		if self.pool is not None:
+			logplanes.debug("Task {0} began gridding procedure on {1} slabs".format(self.pool.rank,len(planes)))
+		else:
+			logplanes.debug("Began gridding procedure on {0} slabs".format(len(planes)))
+
+		##########
+		#Gridding#
+		##########
+
+		densities = None
+		for positions in chunks:
+
+			#Now use gridding to compute the density along the slabs
+			assert positions.unit==unit
+			assert positions.value.dtype==np.float32
+
+			#The particle attributes refer to the positions just read
+			assert hasattr(self,"weights")
+			assert hasattr(self,"virial_radius")
+			assert hasattr(self,"concentration")
+
+			#Weights
+			if self.weights is not None:
+				weights = self.weights.astype(np.float32)
+			else:
+				weights = None
+
+			#The NFW profiles of the particles depend on the slab binning: they are gridded on one slab at a time
+			if self.virial_radius is not None:
+				densities_chunk = [ self._projectNFW(positions.value,weights,binnings[n],normal,thickness_weights,assignment,unit) for n,(center,thickness,normal) in enumerate(planes) ]
+			else:
+				densities_chunk = self._projectSlabs(positions.value,weights,binnings,[ normal for center,thickness,normal in planes ],thickness_weights,assignment)
+
+			if densities is None:
+				densities = densities_chunk
+			else:
+				for n,density_chunk in enumerate(densities_chunk):
+					densities[n] += density_chunk
+
+		###################################################################################################################################
+
+		#Log
+		if self.pool is not None:
+			logplanes.debug("Task {0} done with gridding procedure".format(self.pool.rank))
+		else:
+			logplanes.debug("Done with gridding procedure")
+
+		if (self.pool is None) or (self.pool.is_master()):
+			logstderr.debug("Done with gridding procedure: peak memory usage {0:.3f} (task)".format(peakMemory()))
+
+		#Project each slab and compute the planes
+		cut_planes = list()
+		for n,(center,thickness,normal) in enumerate(planes):
+			cut_planes.append(self._projectSlab(densities[n],binnings[n],normal,centers[n],unit,smooth,kind,**kwargs))
+			densities[n] = None
+
+		return cut_planes
+
+
+	def _projectSlabs(self,positions,weights,binnings,normals,thickness_weights,assignment):
+
+		"""
+		Project the point particles on a list of slabs in a single pass, accumulating straight into the 2D planes (the slab volumes are never gridded)
+
+		:returns: list of 2D arrays with the projected particle counts, one for each slab
+
+		"""
+
+		#Geometry of the slabs
+		slab_left = np.array([ [ b[0] for b in binning ] for binning in binnings ],dtype=np.float64)
+		slab_size = np.array([ [ b[1] - b[0] for b in binning ] for binning in binnings ],dtype=np.float64)
+		slab_shape = np.array([ [ len(b) - 1 for b in binning ] for binning in binnings ],dtype=np.int32)
+
+		#Weights of the bins along the normal
+		if thickness_weights is None:
+			slab_weights = np.ones(sum([ slab_shape[n,normal] for n,normal in enumerate(normals) ]))
+		else:
+			assert all([ len(thickness_weights)==slab_shape[n,normal] for n,normal in enumerate(normals) ]),"There must be one thickness weight for each bin along the normal!"
+			slab_weights = np.concatenate([ np.array(thickness_weights,dtype=np.float64) for normal in normals ])
+
+		return ext._nbody.project_slabs(positions,weights,slab_left,slab_size,slab_shape,np.array(normals,dtype=np.int32),slab_weights,_assignment_schemes[assignment])
+
+
+	@staticmethod
+	def _checkNFWAssignment(assignment):
+
+		#The particles with an NFW profile are spread according to the profile, a mass assignment scheme cannot be applied to them
+		if assignment!="ngp":
+			raise ValueError("The {0} mass assignment scheme applies to point particles only, the particles with virial radius and concentration are spread with their NFW profile!".format(assignment))
+
+	def _projectNFW(self,positions,weights,binning,normal,thickness_weights,assignment,unit):
+
+		"""
+		Project the NFW profiles of the particles (with virial radius and concentration) on a slab: the profiles are gridded on the slab volume, then summed along the normal
+
+		:returns: 2D array with the projected profiles
+
+		"""
+
+		assert weights is not None,"Particles have virial radiuses, you should specify their weight!"
+		self._checkNFWAssignment(assignment)
+		weights  = (weights * self._header["num_particles_total"] / ((len(binning[0]) - 1) * (len(binning[1]) - 1) * (len(binning[2]) - 1))).astype(np.float32)
+		rv = self.virial_radius.to(unit).value
+
+		density = ext._nbody.grid3d_nfw(positions,tuple(binning),weights,rv,self.concentration,_assignment_schemes[assignment],tuple([ int(d!=normal) for d in range(3) ]))
+		if thickness_weights is None:
+			return density.sum(normal)
+		else:
+			assert len(thickness_weights)==density.shape[normal],"There must be one thickness weight for each bin along the normal!"
+			return np.tensordot(density,np.array(thickness_weights,dtype=np.float64),axes=([normal],[0])).astype(np.float32)
+
+
+	def _slabBinning(self,normal,thickness,center,plane_resolution,left_corner,thickness_resolution,unit):
+
+		"""
+		Compute the bin edges of the grid that covers a slab of the snapshot
+
+		:returns: list with the bin edges along each of the 3 axes
+
+		"""
+
+		#Direction of the plane
+		plane_directions = [ d for d in range(3) if d!=normal ]
 
 		#Create a list that holds the bins
 		binning = [None,None,None]
@@ -594,47 +952,48 @@ class NbodySnapshot(object):
 		if type(plane_resolution)==quantity.Quantity:
 			
 			assert plane_resolution.unit.physical_type=="length"
-			plane_resolution = plane_resolution.to(positions.unit)
-			binning[plane_directions[0]] = np.arange(left_corner[plane_directions[0]].to(positions.unit).value,(left_corner[plane_directions[0]] + self._header["box_size"]).to(positions.unit).value,plane_resolution.value)
-			binning[plane_directions[1]] = np.arange(left_corner[plane_directions[1]].to(positions.unit).value,(left_corner[plane_directions[1]] + self._header["box_size"]).to(positions.unit).value,plane_resolution.value)
+			plane_resolution = plane_resolution.to(unit)
+			binning[plane_directions[0]] = np.arange(left_corner[plane_directions[0]].to(unit).value,(left_corner[plane_directions[0]] + self._header["box_size"]).to(unit).value,plane_resolution.value)
+			binning[plane_directions[1]] = np.arange(left_corner[plane_directions[1]].to(unit).value,(left_corner[plane_directions[1]] + self._header["box_size"]).to(unit).value,plane_resolution.value)
 
 		else:
 
-			binning[plane_directions[0]] = np.linspace(left_corner[plane_directions[0]].to(positions.unit).value,(left_corner[plane_directions[0]] + self._header["box_size"]).to(positions.unit).value,plane_resolution+1)
-			binning[plane_directions[1]] = np.linspace(left_corner[plane_directions[1]].to(positions.unit).value,(left_corner[plane_directions[1]] + self._header["box_size"]).to(positions.unit).value,plane_resolution+1)
+			binning[plane_directions[0]] = np.linspace(left_corner[plane_directions[0]].to(unit).value,(left_corner[plane_directions[0]] + self._header["box_size"]).to(unit).value,plane_resolution+1)
+			binning[plane_directions[1]] = np.linspace(left_corner[plane_directions[1]].to(unit).value,(left_corner[plane_directions[1]] + self._header["box_size"]).to(unit).value,plane_resolution+1)
 
 		
 		#Binning in the normal direction		
 		assert type(thickness_resolution) in [np.int,quantity.Quantity]
-		center = center.to(positions.unit)
-		thickness  = thickness.to(positions.unit)
+		center = center.to(unit)
+		thickness  = thickness.to(unit)
 		
 		if type(thickness_resolution)==quantity.Quantity:
 			
 			assert thickness_resolution.unit.physical_type=="length"
-			thickness_resolution = thickness_resolution.to(positions.unit)
-			binning[normal] = np.arange((center - thickness/2).to(positions.unit).value,(center + thickness/2).to(positions.unit).value,thickness_resolution.value)
+			thickness_resolution = thickness_resolution.to(unit)
+			binning[normal] = np.arange((center - thickness/2).to(unit).value,(center + thickness/2).to(unit).value,thickness_resolution.value)
 
 		else:
 
-			binning[normal] = np.linspace((center - thickness/2).to(positions.unit).value,(center + thickness/2).to(positions.unit).value,thickness_resolution+1)
+			binning[normal] = np.linspace((center - thickness/2).to(unit).value,(center + thickness/2).to(unit).value,thickness_resolution+1)
 
-		#Weights
-		if self.weights is not None:
-			weights = self.weights.astype(np.float32)
-		else:
-			weights = None
+		return binning
 
-		#Virial radius
-		if self.virial_radius is not None:
-			assert weights is not None,"Particles have virial radiuses, you should specify their weight!"
-			weights  = (weights * self._header["num_particles_total"] / ((len(binning[0]) - 1) * (len(binning[1]) - 1) * (len(binning[2]) - 1))).astype(np.float32)
-			rv = self.virial_radius.to(positions.unit).value
-		else:
-			rv = None
+
+	def _projectSlab(self,density,binning,normal,center,unit,smooth,kind,**kwargs):
+
+		"""
+		Collect the projected density of a slab from all the tasks and normalize the result to a density (or lensing potential) plane
+
+		:returns: tuple(numpy 2D array with the density (or lensing potential),bin resolution along the axes, number of particles on the plane)
+
+		"""
+
+		#Cosmological normalization factor
+		cosmo_normalization = 1.5 * self.header["H0"]**2 * self.header["Om0"] / c**2
 
 		#Recompute resolution to make sure it represents the bin size correctly
-		bin_resolution = [ (binning[n][1:]-binning[n][:-1]).mean() * positions.unit for n in (0,1,2) ]
+		bin_resolution = [ (binning[n][1:]-binning[n][:-1]).mean() * unit for n in (0,1,2) ]
 
 		############################################################################################################
 		#################################Longitudinal normalization factor##########################################
@@ -652,41 +1011,15 @@ class NbodySnapshot(object):
 			zlens = z_at_value(self.cosmology.comoving_distance,center)
 			density_normalization = bin_resolution[normal] * center * (1.+zlens)
 
-		#Now use gridding to compute the density along the slab
-		assert positions.value.dtype==np.float32
-
-		#Log
-		if self.pool is not None:
-			logplanes.debug("Task {0} began gridding procedure".format(self.pool.rank))
-		else:
-			logplanes.debug("Began gridding procedure")
-
-		##########
-		#Gridding#
-		##########
-
-		density = ext._nbody.grid3d_nfw(positions.value,tuple(binning),weights,rv,self.concentration)
-
-		###################################################################################################################################
-
-		#Log
-		if self.pool is not None:
-			logplanes.debug("Task {0} done with gridding procedure".format(self.pool.rank))
-		else:
-			logplanes.debug("Done with gridding procedure")
-
-		if (self.pool is None) or (self.pool.is_master()):
-			logstderr.debug("Done with gridding procedure: peak memory usage {0:.3f} (task)".format(peakMemory()))
-
 		#Accumulate the density from the other processors
 		if "density_placeholder" in kwargs.keys():
 
 			density_projected = kwargs["density_placeholder"]
 
 			#Safety assert
-			assert density_projected.shape==(density.shape[plane_directions[0]],density.shape[plane_directions[1]])
+			assert density_projected.shape==density.shape
 
-			density_projected[:] = density.sum(normal)
+			density_projected[:] = density
 			NumPartTask = density_projected.sum()
 
 			if self.pool is not None:
@@ -709,8 +1042,8 @@ class NbodySnapshot(object):
 		
 		else:
 
-			#Project along the normal direction
-			density_projected = density.sum(normal)
+			#The density is already projected along the normal direction
+			density_projected = density
 			NumPartTask = density_projected.sum()
 			
 			if self.pool is not None:
@@ -1277,7 +1610,7 @@ class NbodySnapshot(object):
 	#############################################################################################################################################
 
 
-	def powerSpectrum(self,k_edges,resolution=None,return_num_modes=False,density_placeholder=None):
+	def powerSpectrum(self,k_edges,resolution=None,return_num_modes=False,density_placeholder=None,assignment="ngp",chunk_size=None):
 
 		"""
 		Computes the power spectrum of the relative density fluctuations in the snapshot at the wavenumbers specified by k_edges; a discrete particle number density is computed before hand to prepare the FFT grid
@@ -1294,6 +1627,12 @@ class NbodySnapshot(object):
 		:param density placeholder: if not None, it is used as a fixed memory chunk for MPI communications in the density calculations
 		:type density_placeholder: array
 
+		:param assignment: mass assignment scheme used to grid the particles, to be passed to the massDensity method (if the density is already an attribute of this instance, the scheme it was computed with is used); the cic and tsc windows are deconvolved from the density, the ngp one is not, for backwards compatibility
+		:type assignment: str.
+
+		:param chunk_size: if not None and the positions are not in memory, the particles are read from disk and gridded chunk_size at a time; to be passed to the massDensity method
+		:type chunk_size: int. or None
+
 		:returns: tuple(k_values(bin centers),power spectrum at the specified k_values)
 
 		"""
@@ -1310,10 +1649,11 @@ class NbodySnapshot(object):
 
 		#Compute the gridded number density
 		if not hasattr(self,"density"):
-			density,bin_resolution = self.massDensity(resolution=resolution,density_placeholder=density_placeholder) 
+			density,bin_resolution = self.massDensity(resolution=resolution,density_placeholder=density_placeholder,assignment=assignment,chunk_size=chunk_size) 
 		else:
 			assert resolution is None,"The spatial resolution is already specified in the attributes of this instance! Call massDensity() to modify!"
 			density,bin_resolution = self.density,self.resolution
+			assignment = getattr(self,"density_assignment","ngp")
 		
 		#Decide pixel sizes in Fourier spaces
 		kpixX = (2.0*np.pi/self._header["box_size"]).to(k_edges.unit)
@@ -1331,6 +1671,11 @@ class NbodySnapshot(object):
 		#Perform the FFT
 		density_ft = fftengine.rfftn(density)
 
+		#Deconvolve the mass assignment window, which is a product of sincs along the axes
+		if assignment!="ngp":
+			window = np.sinc(fftengine.fftfreq(density.shape[0]))[:,None,None] * np.sinc(fftengine.fftfreq(density.shape[1]))[None,:,None] * np.sinc(fftengine.rfftfreq(density.shape[2]))[None,None,:]
+			density_ft /= window**(_assignment_schemes[assignment]+1)
+
 		#Compute the azimuthal averages
 		hits,power_spectrum = ext._topology.rfft3_azimuthal(density_ft,density_ft,kpixX.value,kpixY.value,kpixZ.value,k_edges.value)
 
@@ -1,11 +1,22 @@
-from ..image.convergence import Spin0,ConvergenceMap,OmegaMap
+from ..image.convergence import Spin0,ConvergenceMap,OmegaMap,_interpolation_order,_interpolationStencil,_stencilSum
 from ..image.shear import Spin1,Spin2,ShearMap
 
-import sys
+import sys,os
 import time
 import gc
+import copy
+import threading
 
-from .logs import logplanes,logray,logstderr,peakMemory
+from multiprocessing.pool import ThreadPool
+
+if sys.version_info.major>=3:
+	import queue
+else:
+	import Queue as queue
+
+from collections import OrderedDict
+
+from .logs import logplanes,logray,logstderr,peakMemory,recordEvent
 
 from operator import mul
 from functools import reduce
@@ -25,9 +36,11 @@ fftengine = NUMPYFFTPack()
 
 from astropy.units import km,s,Mpc,rad,deg,dimensionless_unscaled,quantity
 
-from .io import readFITSHeader,readFITS,saveFITS
+from .io import readFITSHeader,readFITS,saveFITS,readRawHeader,readRaw,saveRaw
 from .camb import TransferFunction
 
+from ..extern import _raytracing
+
 #Enable garbage collection if not active already
 if not gc.isenabled():
 	gc.enable()
@@ -39,6 +52,8 @@ if not gc.isenabled():
 
 class Plane(Spin0):
 
+	#Single precision pixel values are kept too (see the dtype option of load), as well as the big endian pixel values of memory mapped FITS planes
+	_native_dtypes = (np.float64,np.float32,np.complex128,np.dtype(">f8"),np.dtype(">f4"))
 
 	def __init__(self,data,angle,redshift=2.0,cosmology=None,comoving_distance=None,unit=rad**2,num_particles=None,masked=False,filename=None):
 
@@ -59,13 +74,16 @@ class Plane(Spin0):
 		else:
 			self.comoving_distance = cosmology.comoving_distance(redshift)
 
-		if data.dtype in [np.float,np.float32]:
+		if data.dtype.newbyteorder("=") in [np.float,np.float32]:
 			self.space = "real"
 		elif data.dtype==np.complex:
 			self.space = "fourier"
 		else:
 			raise TypeError("data type not supported!")
 
+		#Periodic (row,column) shift of the plane pixels, applied when indexing
+		self.roll_offset = (0,0)
+
 	@staticmethod
 	def readHeader(filename,format=None):
 
@@ -75,7 +93,7 @@ class Plane(Spin0):
 		:param filename: name of the file
 		:type filename: str.
 
-		:param format: format of the file, only FITS implemented so far; if None, it's detected automatically from the filename
+		:param format: format of the file, "fits" or "raw" (raw little endian pixel values, with the header in a JSON sidecar file; they are memory mapped when loaded); if None, it's detected automatically from the filename
 		:type format: str.
 
 		:returns: header object
@@ -87,12 +105,16 @@ class Plane(Spin0):
 			extension = filename.split(".")[-1]
 			if extension in ["fit","fits"]:
 				format="fits"
+			elif extension=="raw":
+				format="raw"
 			else:
 				raise IOError("File format not recognized from extension '{0}', please specify it manually".format(extension))
 
 
 		if format=="fits":
 			return readFITSHeader(filename)
+		elif format=="raw":
+			return readRawHeader(filename)
 		else:
 			raise ValueError("Format {0} not implemented yet!!".format(format))
 
@@ -126,12 +148,12 @@ class Plane(Spin0):
 	def save(self,filename,format=None,double_precision=False):
 
 		"""
-		Saves the Plane to an external file, of which the format can be specified (only fits implemented so far)
+		Saves the Plane to an external file, of which the format can be specified (fits or raw)
 
 		:param filename: name of the file on which to save the plane
 		:type filename: str.
 
-		:param format: format of the file, only FITS implemented so far; if None, it's detected automatically from the filename
+		:param format: format of the file, "fits" or "raw" (raw little endian pixel values, with the header in a JSON sidecar file; they are memory mapped when loaded); if None, it's detected automatically from the filename
 		:type format: str.
 
 		:param double_precision: if True saves the Plane in double precision
@@ -144,30 +166,45 @@ class Plane(Spin0):
 			extension = filename.split(".")[-1]
 			if extension in ["fit","fits"]:
 				format="fits"
+			elif extension=="raw":
+				format="raw"
 			else:
 				raise IOError("File format not recognized from extension '{0}', please specify it manually".format(extension))
 
+		#If the plane has been rolled, save the shifted pixels
+		if self.roll_offset!=(0,0):
+			plane = copy.copy(self)
+			plane.data = self.rolledData()
+			plane.roll_offset = (0,0)
+		else:
+			plane = self
+
 		if format=="fits":
-			saveFITS(self,filename=filename,double_precision=double_precision)
+			saveFITS(plane,filename=filename,double_precision=double_precision)
+		elif format=="raw":
+			saveRaw(plane,filename=filename,double_precision=double_precision)
 		else:
 			raise ValueError("Format {0} not implemented yet!!".format(format))
 
 
 	@classmethod
-	def load(cls,filename,format=None,init_cosmology=True):
+	def load(cls,filename,format=None,init_cosmology=True,dtype=np.float64):
 
 		"""
-		Loads the Plane from an external file, of which the format can be specified (only fits implemented so far)
+		Loads the Plane from an external file, of which the format can be specified (fits or raw)
 
 		:param filename: name of the file from which to load the plane
 		:type filename: str.
 
-		:param format: format of the file, only FITS implemented so far; if None, it's detected automatically from the filename
+		:param format: format of the file, "fits" or "raw" (raw little endian pixel values, with the header in a JSON sidecar file; they are memory mapped when loaded); if None, it's detected automatically from the filename
 		:type format: str.
 
 		:param init_cosmology: if True, instantiates the cosmology attribute of the PotentialPlane
 		:type init_cosmology: bool.
 
+		:param dtype: precision in which the (real) pixel values are kept in memory; np.float32 halves the memory taken by the plane (and the memory traffic when the plane is used for ray tracing). If None, the pixel values are kept as they are on disk and memory mapped, so that only the pixels that are accessed are read (FITS planes can be mapped only if their pixel values are stored unscaled, otherwise ValueError is raised)
+		:type dtype: data-type
+
 		:returns: PotentialPlane instance that wraps the data contained in the file
 
 		"""
@@ -177,12 +214,16 @@ class Plane(Spin0):
 			extension = filename.split(".")[-1]
 			if extension in ["fit","fits"]:
 				format="fits"
+			elif extension=="raw":
+				format="raw"
 			else:
 				raise IOError("File format not recognized from extension '{0}', please specify it manually".format(extension))
 
 
 		if format=="fits":
-			return readFITS(cls,filename=filename,init_cosmology=init_cosmology)
+			return readFITS(cls,filename=filename,init_cosmology=init_cosmology,dtype=dtype)
+		elif format=="raw":
+			return readRaw(cls,filename=filename,init_cosmology=init_cosmology,dtype=dtype)
 		else:
 			raise ValueError("Format {0} not implemented yet!!".format(format))
 
@@ -190,51 +231,116 @@ class Plane(Spin0):
 	def randomRoll(self,seed=None,lmesh=None):
 
 		"""
-		Randomly shifts the plane along its axes, enforcing periodic boundary conditions
+		Randomly shifts the plane along its axes, enforcing periodic boundary conditions; the shift is stored in the roll_offset attribute and applied when the pixels are indexed, so the plane data is not touched
 
 		:param seed: random seed with which to initialize the generator
 		:type seed: int.
 
-		:param lmesh: the FFT frequency meshgrid (lx,ly) necessary for the calculations in fourier space; if None, a new one is computed from scratch (must have the appropriate dimensions)
+		:param lmesh: not used, kept for backwards compatibility (the shift is the same in real and Fourier space)
 		:type lmesh: array
 
 		"""
 
-		now = time.time()
-		last_timestamp = now
-
 		if seed is not None:
 			np.random.seed(seed)
 
 		if self.space=="real":
+			shift = (np.random.randint(0,self.data.shape[0]),np.random.randint(0,self.data.shape[1]))
+		elif self.space=="fourier":
+			
+			#Same shift as the multiplication by the exp(2*pi*i*l*s) phases
+			sx,sy = np.random.randint(0,self.data.shape[0],size=2)
+			shift = (-sy,-sx)
+		
+		else:
+			raise ValueError("space must be either real or fourier!")
+
+		#Update the offsets
+		npixel = self.data.shape[0]
+		self.roll_offset = ((self.roll_offset[0]+shift[0])%npixel,(self.roll_offset[1]+shift[1])%npixel)
+		logplanes.debug("Plane rolled by {0} pixels".format(self.roll_offset))
+
+
+	def rolledData(self):
+
+		"""
+		Materializes the pixel values of the plane in real space, with the random shift applied
+
+		:returns: array with the shifted pixel values
+
+		"""
+
+		assert self.space=="real","The plane must be in real space!"
+		return self._roll(self.data)
+
+
+	def _roll(self,array):
 
-			#Roll in real space
-			self.data = np.roll(np.roll(self.data,np.random.randint(0,self.data.shape[0]),axis=0),np.random.randint(0,self.data.shape[1]),axis=1)	
+		#Apply the random shift to a full plane computed from the unshifted pixels
+		if self.roll_offset==(0,0):
+			return array
 		
-		elif self.space=="fourier":
+		return np.roll(array,self.roll_offset,axis=(-2,-1))
 
-			#Rolling in Fourier space is just multiplying by phases
-			if lmesh is None:
-				l = np.array(np.meshgrid(fftengine.rfftfreq(self.data.shape[0]),fftengine.fftfreq(self.data.shape[0])))
-			else:
-				l = lmesh
 
-			#Timestamp
-			now = time.time()
-			logplanes.debug("l meshgrid initialized in {0:.3f}s".format(now-last_timestamp))
-			last_timestamp = now 
+	#Angular size of a pixel (in radians) as seen by the observer
+	def _pixelAngle(self):
 
-			random_shift = np.random.randint(0,self.data.shape[0],size=2)
-			self.data *= np.exp(2.0j*np.pi*np.tensordot(random_shift,l,axes=(0,0)))
+		if self.side_angle.unit.physical_type=="length":
+			return (self.resolution / self.comoving_distance).decompose().value
+		else:
+			return self.resolution.to(rad).value
 
-			#Timestamp
-			now = time.time()
-			logplanes.debug("Phase multiplication completed in {0:.3f}s".format(now-last_timestamp))
-			last_timestamp = now 
 
+	def _pixelIndices(self,x,y,pixel_angle=None):
+
+		#Unitless positions are angles in radians, the pixel size can be passed to skip the unit conversions
+		if type(x)!=quantity.Quantity:
+			
+			if pixel_angle is None:
+				pixel_angle = self._pixelAngle()
+
+			npixel = self.data.shape[0]
+			i = np.mod((y / pixel_angle).astype(np.int32) - self.roll_offset[0],npixel)
+			j = np.mod((x / pixel_angle).astype(np.int32) - self.roll_offset[1],npixel)
+
+			return i,j
+
+		#Pixel indices in the shifted plane correspond to offset indices in the data
+		i,j = super(Plane,self)._pixelIndices(x,y)
+
+		if self.roll_offset!=(0,0):
+			i = np.mod(i-self.roll_offset[0],self.data.shape[0])
+			j = np.mod(j-self.roll_offset[1],self.data.shape[0])
+
+		return i,j
+
+
+	def _pixelCoordinates(self,x,y,pixel_angle=None):
+
+		#Unitless positions are angles in radians, the pixel size can be passed to skip the unit conversions
+		if type(x)!=quantity.Quantity:
+
+			if pixel_angle is None:
+				pixel_angle = self._pixelAngle()
+
+			row = y / pixel_angle - 0.5
+			col = x / pixel_angle - 0.5
 
 		else:
-			raise ValueError("space must be either real or fourier!")
+			row,col = super(Plane,self)._pixelCoordinates(x,y)
+
+		#Coordinates in the shifted plane correspond to offset coordinates in the data (periodic boundary conditions are enforced by the interpolation stencils)
+		return row-self.roll_offset[0],col-self.roll_offset[1]
+
+
+	#Pixel positions of the rays (x,y in radians) for the ray tracing kernels: pixel indices, or fractional pixel coordinates when interpolating
+	def _rayPixels(self,x,y,pixel_angle,order):
+
+		if order:
+			return self._pixelCoordinates(x,y,pixel_angle=pixel_angle)
+		else:
+			return self._pixelIndices(x,y,pixel_angle=pixel_angle)
 
 
 	def toReal(self):
@@ -261,7 +367,7 @@ class Plane(Spin0):
 		self.space="fourier"
 
 
-	def getValues(self,x,y):
+	def getValues(self,x,y,interpolation="nearest"):
 
 		"""
 		Extract the map values at the requested (x,y) positions; this is implemented using the numpy fast indexing routines, so the formats of x and y must follow the numpy advanced indexing rules. Periodic boundary conditions are enforced
@@ -272,6 +378,9 @@ class Plane(Spin0):
 		:param y: y coordinates at which to extract the map values (if unitless these are interpreted as radians)
 		:type y: numpy array or quantity 
 
+		:param interpolation: how to interpolate the map between the pixel centers, must be one in [nearest,bilinear,bicubic]
+		:type interpolation: str.
+
 		:returns: numpy array with the map values at the specified positions, with the same shape as x and y
 
 		:raises: IndexError if the formats of x and y are not the proper ones
@@ -280,40 +389,26 @@ class Plane(Spin0):
 
 		assert isinstance(x,np.ndarray) and isinstance(y,np.ndarray)
 
-		#x coordinates
-		if type(x)==quantity.Quantity:
-			
-			assert x.unit.physical_type=="angle"
-
-			#Check if the resolution units are length units
-			if self.resolution.unit.physical_type=="length":
-				x = x.to(rad).value*self.comoving_distance 
+		#Check if the resolution units are length units
+		if self.resolution.unit.physical_type=="length":
 
-			j = np.mod(((x / self.resolution).decompose().value).astype(np.int32),self.data.shape[1])
+			if type(x)==quantity.Quantity:
+				assert x.unit.physical_type=="angle"
+				x = x.to(rad).value*self.comoving_distance
 
-		else:
-
-			j = np.mod((x / self.resolution.to(rad).value).astype(np.int32),self.data.shape[1])	
-
-		#y coordinates
-		if type(y)==quantity.Quantity:
-			
-			assert y.unit.physical_type=="angle"
-
-			#Check if the resolution units are length units
-			if self.resolution.unit.physical_type=="length":
+			if type(y)==quantity.Quantity:
+				assert y.unit.physical_type=="angle"
 				y = y.to(rad).value*self.comoving_distance
 
-			i = np.mod(((y / self.resolution).decompose().value).astype(np.int32),self.data.shape[0])
-
-		else:
-
-			i = np.mod((y / self.resolution.to(rad).value).astype(np.int32),self.data.shape[0])
-
 		#Return the map values at the specified coordinates
-		return self.data[i,j]
+		if interpolation=="nearest":
+			i,j = self._pixelIndices(x,y)
+			return self.data[i,j]
+
+		i,j,weights = self._interpolationStencil(x,y,interpolation)
+		return _stencilSum(self.data[i,j],weights)
 
-	def _grad(self,x=None,y=None,lmesh=None):
+	def _grad(self,x=None,y=None,lmesh=None,interpolation="nearest"):
 
 		now = time.time()
 		last_timestamp = now
@@ -326,7 +421,7 @@ class Plane(Spin0):
 				y = y.to(rad).value * self.comoving_distance
 			
 			#Compute the gradient of the potential map
-			deflection_x,deflection_y = self.gradient(x,y)
+			deflection_x,deflection_y = self.gradient(x,y,interpolation=interpolation)
 			deflection = np.array([deflection_x,deflection_y])
 		
 		elif self.space=="fourier":
@@ -363,6 +458,10 @@ class Plane(Spin0):
 		else:
 			raise ValueError("space must be either real or fourier!")
 
+		#Shift the full plane if it has been rolled
+		if (x is None) or (y is None):
+			deflection = self._roll(deflection)
+
 		#Scale to units
 		deflection = deflection * self.unit
 		deflection /= self.resolution
@@ -416,7 +515,7 @@ class Plane(Spin0):
 			if z0t==z1t:
 				raise ValueError("The transfer function binning in z is too coarse! No scaling can be performed!")
 
-			self.data *= t1[0]/t0[0]
+			self.data = self.data * (t1[0]/t0[0])
 		
 		elif scaling_method=="FFT":
 
@@ -432,13 +531,13 @@ class Plane(Spin0):
 			ft_plane /= tfr(z0,kmesh)
 
 			#Invert the transfer function to get the scaled plane in real space
-			self.data[:] = fftengine.irfft2(ft_plane)
+			self.data = fftengine.irfft2(ft_plane)
 
 		else:
 			raise ValueError("Scaling method {0} not recognized".format(scaling_method))
 
 		if with_scale_factor:
-			self.data *= (1+z1)/(1+z0)
+			self.data = self.data * ((1+z1)/(1+z0))
 
 		#Log
 		logplanes.debug("Scaled fluctuations on lens at redshift {0:.6f} to redshift {1:.6f} with method {2}".format(z0,z1,scaling_method))
@@ -492,6 +591,10 @@ class DensityPlane(Plane):
 
 	"""
 
+	#Density values on the grid of pixels with rows i and columns j
+	def _gridDensity(self,i,j):
+		return self.data.take(i,axis=0).take(j,axis=1)
+
 	def potential(self,lmesh=None):
 
 		"""
@@ -530,8 +633,11 @@ class DensityPlane(Plane):
 		density_ft *= -2.0*((self.resolution.to(rad).value)**2) / (l_squared * ((2.0*np.pi)**2))
 		density_ft[0,0] = 0.0
 
-		#Instantiate the new PotentialPlane
-		return PotentialPlane(data=fftengine.irfft2(density_ft),angle=self.side_angle,redshift=self.redshift,comoving_distance=self.comoving_distance,cosmology=self.cosmology,num_particles=self.num_particles,unit=rad**2)
+		#Instantiate the new PotentialPlane (the Poisson equation commutes with the random shift)
+		potential_plane = PotentialPlane(data=fftengine.irfft2(density_ft),angle=self.side_angle,redshift=self.redshift,comoving_distance=self.comoving_distance,cosmology=self.cosmology,num_particles=self.num_particles,unit=rad**2)
+		potential_plane.roll_offset = self.roll_offset
+		
+		return potential_plane
 
 	def densityGradient(self,x=None,y=None,lmesh=None):
 
@@ -569,7 +675,7 @@ class PotentialPlane(Plane):
 	"""
 
 	
-	def deflectionAngles(self,x=None,y=None,lmesh=None):
+	def deflectionAngles(self,x=None,y=None,lmesh=None,interpolation="nearest"):
 
 		"""
 		Computes the deflection angles for the given lensing potential by taking the gradient of the potential map; it is also possible to proceed with FFTs
@@ -583,11 +689,14 @@ class PotentialPlane(Plane):
 		:param lmesh: the FFT frequency meshgrid (lx,ly) necessary for the calculations in fourier space; if None, a new one is computed from scratch (must have the appropriate dimensions)
 		:type lmesh: array
 
+		:param interpolation: how to interpolate the deflection angles between the pixel centers when x and y are specified, must be one in [nearest,bilinear,bicubic]
+		:type interpolation: str.
+
 		:returns: DeflectionPlane instance, or array with deflections of rays hitting the lens at (x,y)
 
 		"""
 
-		deflection = self._grad(x,y,lmesh)
+		deflection = self._grad(x,y,lmesh,interpolation=interpolation)
 
 		assert deflection.unit.physical_type=="angle"
 		deflection = deflection.to(rad)
@@ -604,7 +713,7 @@ class PotentialPlane(Plane):
 
 	#########################################################################################################################################
 
-	def shearMatrix(self,x=None,y=None,lmesh=None):
+	def shearMatrix(self,x=None,y=None,lmesh=None,interpolation="nearest"):
 
 		"""
 		Computes the shear matrix for the given lensing potential; it is also possible to proceed with FFTs
@@ -618,6 +727,9 @@ class PotentialPlane(Plane):
 		:param lmesh: the FFT frequency meshgrid (lx,ly) necessary for the calculations in fourier space; if None, a new one is computed from scratch (must have the appropriate dimensions)
 		:type lmesh: array
 
+		:param interpolation: how to interpolate the shear matrix between the pixel centers when x and y are specified, must be one in [nearest,bilinear,bicubic]
+		:type interpolation: str.
+
 		:returns: ShearTensorPlane instance, or array with deflections of rays hitting the lens at (x,y)
 
 		"""
@@ -633,7 +745,7 @@ class PotentialPlane(Plane):
 				y = y.to(rad).value * self.comoving_distance
 			
 			#Compute the second derivatives
-			tensor = np.array(self.hessian(x,y))
+			tensor = np.array(self.hessian(x,y,interpolation=interpolation))
 
 		elif self.space=="fourier":
 
@@ -661,6 +773,10 @@ class PotentialPlane(Plane):
 		else:
 			raise ValueError("space must be either real or fourier!")
 
+		#Shift the full plane if it has been rolled
+		if (x is None) or (y is None):
+			tensor = self._roll(tensor)
+
 
 		#Scale units
 		tensor = tensor * self.unit
@@ -681,9 +797,64 @@ class PotentialPlane(Plane):
 		else:
 			return ShearTensorPlane(tensor,angle=self.side_angle,redshift=self.redshift,comoving_distance=self.comoving_distance,cosmology=self.cosmology,unit=dimensionless_unscaled)
 
+	#Field and scale factor (to radians) from which the deflection update kernel computes the deflection angles
+	def _deflectionField(self):
+
+		assert self.space=="real","The deflection angles can be gathered at the ray positions only in real space!"
+
+		#Same unit conversions as in deflectionAngles
+		scale = self.unit / self.resolution
+		if self.side_angle.unit.physical_type=="length":
+			scale *= self.comoving_distance / rad
+
+		return self.data,scale.to(rad).value
+
+	#Field and scale factor from which the jacobian update kernel computes the shear matrices
+	def _shearField(self):
+
+		assert self.space=="real","The shear matrices can be gathered at the ray positions only in real space!"
+
+		#Same unit conversions as in shearMatrix
+		scale = self.unit / self.resolution**2
+		if self.side_angle.unit.physical_type=="length":
+			scale *= self.comoving_distance**2 / rad**2
+
+		assert scale.unit.physical_type=="dimensionless"
+		return self.data,scale.decompose().value
+
+	#Field and scale factor (to 1/radians) from which the density gradient is computed, with the same unit conversions as in densityGradient
+	def _densityGradientField(self):
+
+		assert self.space=="real","The density gradient can be gathered at the ray positions only in real space!"
+
+		scale = self.unit / self.resolution**3
+		if self.side_angle.unit.physical_type=="length":
+			scale *= self.comoving_distance**3 / rad**3
+
+		return self.data,0.5*scale.to(1/rad).value
+
+	#Density on the grid of pixels with rows i and columns j, with the same finite difference stencil as in hessian
+	def _gridDensity(self,i,j):
+
+		field,scale = self._shearField()
+		npixel = field.shape[0]
+
+		#Gathering whole rows first, then the columns, is faster than gathering single pixels
+		rows = field.take(i,axis=0)
+		center = 2*rows.take(j,axis=1)
+
+		hessian_xx = (rows.take((j+2)%npixel,axis=1) + rows.take((j-2)%npixel,axis=1) - center) / 4.0
+		hessian_yy = (field.take((i+2)%npixel,axis=0).take(j,axis=1) + field.take((i-2)%npixel,axis=0).take(j,axis=1) - center) / 4.0
+
+		#The density is half the trace of the hessian
+		hessian_xx += hessian_yy
+		hessian_xx *= 0.5*scale
+		
+		return hessian_xx
+
 	#########################################################################################################################################
 
-	def density(self,x=None,y=None):
+	def density(self,x=None,y=None,interpolation="nearest"):
 
 		"""
 		Computes the projected density fluctuation by taking the laplacian of the potential; useful to check if the potential is reasonable
@@ -694,6 +865,9 @@ class PotentialPlane(Plane):
 		:param y: optional; if not None, compute the density only for rays hitting the lens at the particular y positions (mainly for speedup in case there are less light rays than the plane resolution allows; must proceed in real space to allow speedup)
 		:type y: array with units
 
+		:param interpolation: how to interpolate the density between the pixel centers when x and y are specified, must be one in [nearest,bilinear,bicubic]
+		:type interpolation: str.
+
 		:returns: DensityPlane instance with the density fluctuation data (if x and y are None), or numpy array with the same shape as x and y 
 
 		"""
@@ -707,7 +881,7 @@ class PotentialPlane(Plane):
 				y = y.to(rad).value * self.comoving_distance			
 			
 			logplanes.debug("Computing hessian...")
-			hessian_xx,hessian_yy,hessian_xy = self.hessian(x,y)
+			hessian_xx,hessian_yy,hessian_xy = self.hessian(x,y,interpolation=interpolation)
 			
 			logplanes.debug("Computing laplacian...")
 			laplacian = hessian_xx + hessian_yy
@@ -723,6 +897,10 @@ class PotentialPlane(Plane):
 		else:
 			raise ValueError("space must be either real or fourier!")
 
+		#Shift the full plane if it has been rolled
+		if (x is None) or (y is None):
+			laplacian = self._roll(laplacian)
+
 		#Scale the units
 		laplacian = laplacian * self.unit
 		laplacian /= (self.resolution**2)
@@ -781,6 +959,10 @@ class PotentialPlane(Plane):
 		else:
 			raise ValueError("space must be either real or fourier!")
 
+		#Shift the full plane if it has been rolled
+		if (x is None) or (y is None):
+			grad = self._roll(grad)
+
 		#Scale to units
 		grad = grad * self.unit
 		grad /= (self.resolution**3)
@@ -821,8 +1003,12 @@ class PotentialPlane(Plane):
 		px,py = self.gradient(x,y)
 		dx,dy = self.gradLaplacian(x,y)
 
-		#Dot product
-		gp2 = (px*dx + py*dy) * (self.unit**2) / (self.resolution**4)
+		#Dot product (shift the full plane if it has been rolled)
+		gp2 = px*dx + py*dy
+		if (x is None) or (y is None):
+			gp2 = self._roll(gp2)
+		
+		gp2 = gp2 * (self.unit**2) / (self.resolution**4)
 
 		if self.side_angle.unit.physical_type=="length":
 			gp2 *= (self.comoving_distance**4)
@@ -837,6 +1023,23 @@ class PotentialPlane(Plane):
 			return Plane(gp2.decompose().value,angle=self.side_angle,comoving_distance=self.comoving_distance,cosmology=self.cosmology,unit=dimensionless_unscaled)
 
 
+	#########################################################################################################################################
+
+	def lensPack(self,lmesh=None):
+
+		"""
+		Precomputes the deflection angles and the shear matrix on the whole plane, packing them in a LensPackPlane that can be ray traced without computing finite differences
+
+		:param lmesh: the FFT frequency meshgrid (lx,ly) necessary for the calculations in fourier space; if None, a new one is computed from scratch (must have the appropriate dimensions)
+		:type lmesh: array
+
+		:returns: LensPackPlane instance
+
+		"""
+
+		return LensPackPlane.fromPotential(self,lmesh=lmesh)
+
+
 #############################################################
 ################DeflectionPlane class########################
 #############################################################
@@ -968,368 +1171,1846 @@ class ShearTensorPlane(Spin2):
 			self.comoving_distance = cosmology.comoving_distance(redshift)
 
 
-#######################################################
-###############RayTracer class#########################
-#######################################################
+#############################################################
+################LensPackPlane class##########################
+#############################################################
 
-class RayTracer(object):
+class LensPackPlane(Spin1):
 
 	"""
-	Class handler of ray tracing operations: it mainly computes the path corrections of light rays that travel through a set of gravitational lenses
+	Class handler of a lens plane with precomputed deflection angles and shear matrix; it holds, for each pixel, the 5 values (alpha_x,alpha_y,psi_11,psi_22,psi_12) so that ray tracing through the plane is a pure gather of the pixel values, without finite differences
 
 	"""
 
-	def __init__(self,lens_mesh_size=None,lens_type=PotentialPlane):
+	def __init__(self,data,angle,redshift=2.0,cosmology=None,comoving_distance=None,unit=rad,num_particles=None,filename=None):
 
-		self.Nlenses = 0
-		self.lens = list()
-		self.distance = list()
-		self.redshift = list()
-		self.lens_type = lens_type
+		#Sanity check
+		assert (cosmology is not None) or (comoving_distance is not None),"cosmology and comoving_distance cannot be both None!!"
+		assert data.shape[0]==5,"A lens pack has 5 components (alpha_x,alpha_y,psi_11,psi_22,psi_12)!!"
 
-		#If we know the size of the lens planes already we can compute, once and for all, the FFT meshgrid
-		if lens_mesh_size is not None:
-			self.lmesh = np.array(np.meshgrid(fftengine.rfftfreq(lens_mesh_size),fftengine.fftfreq(lens_mesh_size)))
+		super(LensPackPlane,self).__init__(data,angle,redshift=redshift,cosmology=cosmology,unit=unit,filename=filename)
+		self.space = "real"
+
+		if num_particles is None:
+			self.num_particles = -1
 		else:
-			self.lmesh = None
+			self.num_particles = num_particles
 
+		#If a comoving distance is provided, use that; otherwise it needs to be computed from the astropy cosmology instance
+		if comoving_distance is not None:		
+			
+			assert comoving_distance.unit.physical_type=="length"
+			self.comoving_distance = comoving_distance
+		
+		else:
+			self.comoving_distance = cosmology.comoving_distance(redshift)
 
-	def addLens(self,lens_specification):
+		#Periodic (row,column) shift of the plane pixels, applied when indexing
+		self.roll_offset = (0,0)
 
-		"""
-		Adds a gravitational lens to the ray tracer, either by putting in a lens plane, or by specifying the name of a file which contains the lens specifications
+	#The lens packs are read, saved and loaded like the other planes (the 5 components are the leading axis of the pixel values)
+	readHeader = staticmethod(Plane.readHeader)
+	save = Plane.save
+	load = classmethod(Plane.load.__func__)
 
-		:param lens_specification: specifications of the lens to add, either in tuple(filename,distance,redshift) or as a PotentialPlane instance
-		:type lens specification: tuple or PotentialPlane instance
+	@classmethod
+	def fromPotential(cls,potential,lmesh=None):
 
 		"""
+		Builds a lens pack computing the deflection angles and the shear matrix of a lensing potential plane
 
-		#Sanity check
-		assert type(lens_specification) in [tuple,self.lens_type]
-
-		#If specification is in tuple form, parse it
-		if type(lens_specification)==tuple:
-
-			filename,distance,redshift = lens_specification
-
-			assert type(filename)==str
-			assert distance.unit.physical_type=="length"
-			assert type(redshift)==float
-			
-			self.lens.append(filename)
-			self.distance.append(distance)
-			self.redshift.append(redshift)
-			self.Nlenses += 1
-
-		else:
-
-			#Otherwise get the info from the PotentialPlane class
-			self.lens.append(lens_specification)
-			self.distance.append(lens_specification.comoving_distance)
-			self.redshift.append(lens_specification.redshift)
-			self.Nlenses += 1
+		:param potential: lensing potential plane
+		:type potential: :py:class:`PotentialPlane`
 
-		#If completed correctly, log info to the user
-		logray.debug("Added lens at redshift {0:.3f}(comoving distance {1:.3f})".format(self.redshift[-1],self.distance[-1]))
+		:param lmesh: the FFT frequency meshgrid (lx,ly) necessary for the calculations in fourier space, if the potential plane is in fourier space
+		:type lmesh: array
 
-	#Load the lens
-	def loadLens(self,lens):
+		:returns: LensPackPlane instance
 
-		if type(lens)==self.lens_type:
-			return lens
+		"""
 
-		elif type(lens)==str:
-				
-			logray.info("Reading plane from {0}...".format(lens))
-			current_lens = self.lens_type.load(lens)
-			logray.info("Read plane from {0}...".format(lens))
-			logstderr.debug("Read plane: peak memory usage {0:.3f} (task)".format(peakMemory()))
-			
-			logray.info("Randomly rolling lens at z={0:.3f} along its axes...".format(current_lens.redshift))
-			current_lens.randomRoll()
-			logray.info("Rolled lens at z={0:.3f} along its axes...".format(current_lens.redshift))
-			logstderr.debug("Rolled lens: peak memory usage {0:.3f} (task)".format(peakMemory()))
+		assert isinstance(potential,PotentialPlane)
 
-			return current_lens
+		#Compute deflections and shear matrices on the full plane
+		deflection = potential.deflectionAngles(lmesh=lmesh)
+		tensor = potential.shearMatrix(lmesh=lmesh)
 
-		else:
-			raise TypeError("Lens format not recognized!")
+		#Pack
+		data = np.concatenate((deflection.data.to(rad).value,tensor.data))
+		return cls(data,angle=potential.side_angle,redshift=potential.redshift,cosmology=potential.cosmology,comoving_distance=potential.comoving_distance,num_particles=potential.num_particles)
 
 
-	def randomRoll(self,seed=None):
+	def randomRoll(self,seed=None,lmesh=None):
 
 		"""
-		Randomly rolls all the lenses in the system along both axes
+		Randomly shifts the plane along its axes, enforcing periodic boundary conditions; the shift is stored in the roll_offset attribute and applied when the pixels are indexed
 
 		:param seed: random seed with which to initialize the generator
 		:type seed: int.
 
+		:param lmesh: not used, kept for compatibility with the Plane API
+		:type lmesh: array
+
 		"""
 
 		if seed is not None:
 			np.random.seed(seed)
 
-		for lens in self.lens:
-			lens.randomRoll(seed=None,lmesh=self.lmesh)
+		npixel = self.data.shape[1]
+		shift = (np.random.randint(0,npixel),np.random.randint(0,npixel))
+		self.roll_offset = ((self.roll_offset[0]+shift[0])%npixel,(self.roll_offset[1]+shift[1])%npixel)
+		logplanes.debug("Lens pack rolled by {0} pixels".format(self.roll_offset))
 
 
-	def reorderLenses(self):
+	def rolledData(self):
 
 		"""
-		Reorders the lenses in the ray tracer according to their comoving distance from the observer
+		Materializes the pixel values of the lens pack, with the random shift applied
+
+		:returns: array with the shifted pixel values
 
 		"""
 
-		self.lens = [ lens for (redshift,lens) in sorted(zip(self.redshift,self.lens)) ]
-		self.redshift.sort()
-		self.distance.sort()
+		if self.roll_offset==(0,0):
+			return self.data
 
+		return np.roll(self.data,self.roll_offset,axis=(-2,-1))
 
-	##################################################################################################################################
-	#####################This method solves the nonlinear lensing ODE#################################################################
-	#############################(backward ray tracing)###############################################################################
-	##################################################################################################################################
 
-	def shoot(self,initial_positions,z=2.0,initial_deflection=None,kind="positions",save_intermediate=False,compute_all_deflections=False,callback=None,transfer=None,**kwargs):
+	#Angular size of a pixel (in radians) as seen by the observer
+	def _pixelAngle(self):
 
-		"""
-		Shots a bucket of light rays from the observer to the sources at redshift z (backward ray tracing), through the system of gravitational lenses, and computes the deflection statistics
+		if self.side_angle.unit.physical_type=="length":
+			return (self.resolution / self.comoving_distance).decompose().value
+		else:
+			return self.resolution.to(rad).value
 
-		:param initial_positions: initial angular positions of the light ray bucket, according to the observer; if unitless, the positions are assumed to be in radians. initial_positions[0] is x, initial_positions[1] is y
-		:type initial_positions: numpy array or quantity
 
-		:param z: redshift of the sources; if an array is passed, a redshift must be specified for each ray, i.e. z.shape==initial_positions.shape[1:]
-		:type z: float. or array
+	def _pixelIndices(self,x,y,pixel_angle=None):
 
-		:param initial_deflection: if not None, this is the initial deflection light rays undergo with respect to the line of sight (equivalent to specifying the first derivative IC on the lensing ODE); must have the same shape as initial_positions
-		:type initial_deflection: numpy array or quantity
+		#Unitless positions are angles in radians, the pixel size can be passed to skip the unit conversions
+		if type(x)!=quantity.Quantity:
 
-		:param kind: what deflection statistics to compute; "positions" will calculate the ray deflections after they crossed the last lens, "jacobian" will compute the lensing jacobian matrix after the last lens, "shear" and "convergence" will compute the omonimous weak lensing statistics  
-		:type kind: str.
+			if pixel_angle is None:
+				pixel_angle = self._pixelAngle()
 
-		:param save_intermediate: save the intermediate positions of the rays too
-		:type save_intermediate: bool.
+			j = (x / pixel_angle).astype(np.int32)
+			i = (y / pixel_angle).astype(np.int32)
 
-		:param compute_all_deflections: if True, computes the gradients of the lensing potential at every pixel on the lens(might be overkill if Nrays<<Npixels); must be True if the computation is done with FFTs
-		:type compute_all_deflections: bool.
+		else:
 
-		:param callback: if not None, this callback function is called on the current ray positions array at each step in the ray tracing; the current raytracing instance and the step number are passed as additional arguments, hence callback must match this signature
-		:type callback: callable
+			#Scale x and y to lengths in case this is a physical plane
+			if self.side_angle.unit.physical_type=="length":
+				x = x.to(rad).value * self.comoving_distance
+				y = y.to(rad).value * self.comoving_distance
 
-		:param transfer: if not None, scales the fluctuations on each lens plane to a different redshift (before computing the ray defections) using a provided transfer function 
-		:type transfer: :py:class:`TransferSpecs`
+			j = ((x / self.resolution).decompose().value).astype(np.int32)
+			i = ((y / self.resolution).decompose().value).astype(np.int32)
 
-		:param kwargs: the keyword arguments are passed to the callback if not None
-		:type kwargs: dict.
+		#Periodic boundary conditions
+		npixel = self.data.shape[1]
+		return np.mod(i-self.roll_offset[0],npixel),np.mod(j-self.roll_offset[1],npixel)
 
-		:returns: angular positions (or jacobians) of the light rays after the last lens crossing
 
-		"""
+	def _pixelCoordinates(self,x,y,pixel_angle=None):
 
-		#Sanity check
-		assert self.lens_type==PotentialPlane, "Lens type must be PotentialPlane"
-		assert initial_positions.ndim>=2 and initial_positions.shape[0]==2,"initial positions shape must be (2,...)!"
-		assert type(initial_positions)==quantity.Quantity and initial_positions.unit.physical_type=="angle"
-		assert kind in ["positions","jacobians","shear","convergence"],"kind must be one in [positions,jacobians,shear,convergence]!"
-		assert transfer is None or isinstance(transfer,TransferSpecs)
+		#Unitless positions are angles in radians, the pixel size can be passed to skip the unit conversions
+		if type(x)!=quantity.Quantity:
 
-		#Allocate arrays for the intermediate light ray positions and deflections
+			if pixel_angle is None:
+				pixel_angle = self._pixelAngle()
 
-		if initial_deflection is None:
-			current_positions = initial_positions.copy()
-			current_deflection = np.zeros(initial_positions.shape) * initial_positions.unit
-		else:
-			assert initial_deflection.shape==initial_positions.shape
-			current_deflection = initial_deflection.copy()
-			current_positions = initial_positions + initial_deflection
+			row = y / pixel_angle - 0.5
+			col = x / pixel_angle - 0.5
 
-		#If we want to trace jacobians, allocate also space for the jacobians
-		if kind in ["jacobians","shear","convergence"]:
+		else:
 
-			#Initial condition for the jacobian is the identity
-			current_jacobian = np.outer(np.array([1.0,0.0,0.0,1.0]),np.ones(initial_positions.shape[1:])).reshape((4,)+initial_positions.shape[1:])
-			current_jacobian_deflection = np.zeros(current_jacobian.shape)
+			#Scale x and y to lengths in case this is a physical plane
+			if self.side_angle.unit.physical_type=="length":
+				x = x.to(rad).value * self.comoving_distance
+				y = y.to(rad).value * self.comoving_distance
+
+			row = (y / self.resolution).decompose().value - 0.5
+			col = (x / self.resolution).decompose().value - 0.5
+
+		#Periodic boundary conditions are enforced by the interpolation stencils
+		return row-self.roll_offset[0],col-self.roll_offset[1]
+
+
+	#Pixel positions of the rays (x,y in radians) for the ray tracing kernels: pixel indices, or fractional pixel coordinates when interpolating
+	def _rayPixels(self,x,y,pixel_angle,order):
+
+		if order:
+			return self._pixelCoordinates(x,y,pixel_angle=pixel_angle)
+		else:
+			return self._pixelIndices(x,y,pixel_angle=pixel_angle)
+
+
+	def _gather(self,components,x,y,interpolation):
+
+		#Values of the selected components at the pixels that contain (x,y)
+		if interpolation=="nearest":
+			i,j = self._pixelIndices(x,y)
+			return self.data[components,i,j]
+
+		#Weighted sum of the values in the interpolation stencils
+		row,col = self._pixelCoordinates(x,y)
+		i,j,weights = _interpolationStencil(row,col,self.data.shape[1],interpolation)
+		return (self.data[components,i,j]*weights).sum(1)
+
+
+	def getValues(self,x,y,interpolation="nearest"):
+
+		"""
+		Extract the lens pack values at the requested (x,y) positions; periodic boundary conditions are enforced
+
+		:param x: x coordinates at which to extract the values (if unitless these are interpreted as radians)
+		:type x: numpy array or quantity 
+
+		:param y: y coordinates at which to extract the values (if unitless these are interpreted as radians)
+		:type y: numpy array or quantity 
+
+		:param interpolation: how to interpolate the values between the pixel centers, must be one in [nearest,bilinear,bicubic]
+		:type interpolation: str.
+
+		:returns: numpy array with the (alpha_x,alpha_y,psi_11,psi_22,psi_12) values at the specified positions, with shape (5,shape x)
+
+		"""
+
+		assert isinstance(x,np.ndarray) and isinstance(y,np.ndarray)
+		return self._gather(slice(None),x,y,interpolation)
+
+
+	def deflectionAngles(self,x=None,y=None,lmesh=None,interpolation="nearest"):
+
+		"""
+		Gathers the precomputed deflection angles at the ray positions
+
+		:param x: optional; if not None, return the deflection angles only for rays hitting the lens at the particular x positions
+		:type x: array with units
+
+		:param y: optional; if not None, return the deflection angles only for rays hitting the lens at the particular y positions
+		:type y: array with units
+
+		:param lmesh: not used, kept for compatibility with the PotentialPlane API
+		:type lmesh: array
+
+		:param interpolation: how to interpolate the deflection angles between the pixel centers when x and y are specified, must be one in [nearest,bilinear,bicubic]
+		:type interpolation: str.
+
+		:returns: DeflectionPlane instance, or array with deflections of rays hitting the lens at (x,y)
+
+		"""
+
+		if (x is not None) and (y is not None):
+			return self._gather(slice(0,2),x,y,interpolation) * rad
+		else:
+			return DeflectionPlane(self.rolledData()[:2]*rad,angle=self.side_angle,redshift=self.redshift,comoving_distance=self.comoving_distance,cosmology=self.cosmology,unit=rad)
+
+
+	def shearMatrix(self,x=None,y=None,lmesh=None,interpolation="nearest"):
+
+		"""
+		Gathers the precomputed shear matrices at the ray positions
+
+		:param x: optional; if not None, return the shear matrix only for rays hitting the lens at the particular x positions
+		:type x: array with units
+
+		:param y: optional; if not None, return the shear matrix only for rays hitting the lens at the particular y positions
+		:type y: array with units
+
+		:param lmesh: not used, kept for compatibility with the PotentialPlane API
+		:type lmesh: array
+
+		:param interpolation: how to interpolate the shear matrix between the pixel centers when x and y are specified, must be one in [nearest,bilinear,bicubic]
+		:type interpolation: str.
+
+		:returns: ShearTensorPlane instance, or array with the (psi_11,psi_22,psi_12) values of rays hitting the lens at (x,y)
+
+		"""
+
+		if (x is not None) and (y is not None):
+			return self._gather(slice(2,5),x,y,interpolation)
+		else:
+			return ShearTensorPlane(self.rolledData()[2:],angle=self.side_angle,redshift=self.redshift,comoving_distance=self.comoving_distance,cosmology=self.cosmology,unit=dimensionless_unscaled)
+
+	#Field and scale factor (to radians) from which the deflection update kernel gathers the deflection angles
+	def _deflectionField(self):
+		return self.data[:2],1.0
+
+	#Field and scale factor from which the jacobian update kernel gathers the shear matrices
+	def _shearField(self):
+		return self.data[2:],1.0
+
+	#Density on the grid of pixels with rows i and columns j
+	def _gridDensity(self,i,j):
+		rows = self.data[2:4].take(i,axis=1)
+		return 0.5*(rows[0].take(j,axis=1) + rows[1].take(j,axis=1))
+
+
+	def density(self,x=None,y=None,interpolation="nearest"):
+
+		"""
+		Computes the projected density fluctuation as half the trace of the shear matrix
+
+		:param x: optional; if not None, compute the density only for rays hitting the lens at the particular x positions
+		:type x: array with units
+
+		:param y: optional; if not None, compute the density only for rays hitting the lens at the particular y positions
+		:type y: array with units
+
+		:param interpolation: how to interpolate the density between the pixel centers when x and y are specified, must be one in [nearest,bilinear,bicubic]
+		:type interpolation: str.
+
+		:returns: DensityPlane instance with the density fluctuation data (if x and y are None), or numpy array with the same shape as x and y 
+
+		"""
+
+		if (x is not None) and (y is not None):
+			return 0.5*self._gather(slice(2,4),x,y,interpolation).sum(0)
+		else:
+			data = self.rolledData()
+			return DensityPlane(0.5*(data[2]+data[3]),angle=self.side_angle,cosmology=self.cosmology,redshift=self.redshift,comoving_distance=self.comoving_distance,num_particles=self.num_particles,unit=dimensionless_unscaled)
+
+
+#######################################################
+###############PlaneCache class########################
+#######################################################
+
+class PlaneCache(object):
+
+	"""
+	Process-wide LRU cache of the lens planes read from disk, keyed by filename; the total size of the cached pixel data is kept below a memory budget, and the least recently used planes are evicted first
+
+	"""
+
+	def __init__(self,max_bytes=0):
+
+		self.max_bytes = int(max_bytes)
+		self.nbytes = 0
+		self._planes = OrderedDict()
+		self._lock = threading.RLock()
+		self.resetStats()
+
+	def __len__(self):
+		return len(self._planes)
+
+	def __contains__(self,filename):
+		return filename in self._planes
+
+	def __repr__(self):
+		return "<PlaneCache: {0} planes, {1:.3f}/{2:.3f} Gbyte used, hits={3}, misses={4}, evictions={5}>".format(len(self),self.nbytes/1024.**3,self.max_bytes/1024.**3,self.hits,self.misses,self.evictions)
+
+	def resetStats(self):
+
+		"""
+		Resets the hit/miss/eviction counters
+
+		"""
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def setBudget(self,max_bytes):
+
+		"""
+		Sets the memory budget of the cache, evicting planes if necessary
+
+		:param max_bytes: maximum size of the cached pixel data, in bytes (0 disables caching)
+		:type max_bytes: int.
+
+		"""
+
+		with self._lock:
+			self.max_bytes = int(max_bytes)
+			self._evict()
+
+	def clear(self):
+
+		"""
+		Removes all the planes from the cache
+
+		"""
+
+		with self._lock:
+			self._planes.clear()
+			self.nbytes = 0
+
+	def load(self,filename,cls,dtype=np.float64):
+
+		"""
+		Loads a plane from a file, reading it from disk only if it is not in the cache already
+
+		:param filename: name of the file from which to load the plane
+		:type filename: str.
+
+		:param cls: Plane sub-class used to read the file
+		:type cls: class
+
+		:param dtype: precision of the pixel values (a cached plane with a different precision is read again)
+		:type dtype: data-type
+
+		:returns: cls instance; its pixel data is shared with the cached plane and must not be modified in place
+
+		"""
+
+		#The cache is shared with the prefetching threads, the bookkeeping is done under the lock
+		with self._lock:
+			
+			plane = self._planes.pop(filename,None)
+
+			if (plane is not None) and isinstance(plane,cls) and (plane.data.dtype==dtype):
+				self.hits += 1
+				self._planes[filename] = plane
+				logray.debug("Plane cache hit: {0}".format(filename))
+				return copy.copy(plane)
+
+			self.misses += 1
+			logray.debug("Plane cache miss: {0}".format(filename))
+			
+			if plane is not None:
+				self.nbytes -= plane.data.nbytes
+
+		#Read from disk outside of the lock, so that other threads can keep using the cache
+		plane = cls.load(filename,dtype=dtype)
+
+		#Planes that do not fit in the budget are not cached
+		with self._lock:
+			if (plane.data.nbytes<=self.max_bytes) and not(filename in self._planes):
+				plane.data.flags.writeable = False
+				self._planes[filename] = plane
+				self.nbytes += plane.data.nbytes
+				self._evict()
+
+		#Return a shallow copy, so that the attributes of the cached plane are left untouched
+		return copy.copy(plane)
+
+	def _evict(self):
+
+		while self.nbytes>self.max_bytes and len(self._planes):
+			filename,plane = self._planes.popitem(last=False)
+			self.nbytes -= plane.data.nbytes
+			self.evictions += 1
+			logray.debug("Plane cache eviction: {0}".format(filename))
+
+#Cache instance shared by all the RayTracer instances in the process
+plane_cache = PlaneCache()
+
+
+#######################################################
+###############PlanePrefetcher class###################
+#######################################################
+
+class PlanePrefetcher(object):
+
+	"""
+	Reads lens planes from disk in a background thread, ahead of the ray tracing loop; at most depth planes are kept waiting in memory at any given time
+
+	:param tracer: ray tracer that owns the lenses
+	:type tracer: :py:class:`RayTracer`
+
+	:param lenses: lenses to read, in crossing order
+	:type lenses: list.
+
+	:param depth: maximum number of planes read ahead
+	:type depth: int.
+
+	:param first: index of the first lens in the list of lenses of the tracer
+	:type first: int.
+
+	"""
+
+	def __init__(self,tracer,lenses,depth=1,first=0):
+
+		assert depth>0,"Prefetch depth must be positive!"
+
+		self.tracer = tracer
+		self.lenses = lenses
+		self.depth = depth
+		self.first = first
+
+		#Each plane read ahead takes a slot, which is given back when the plane is handed to the tracer
+		self._slots = threading.Semaphore(depth)
+		self._queue = queue.Queue()
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._read,name="PlanePrefetcher")
+		self._thread.daemon = True
+
+	def __enter__(self):
+		self._thread.start()
+		return self
+
+	def __exit__(self,exc_type,exc_value,traceback):
+		self.close()
+
+	def _read(self):
+
+		for n,lens in enumerate(self.lenses,self.first):
+
+			self._slots.acquire()
+			if self._stop.is_set():
+				return
+
+			try:
+				self._queue.put((self.tracer.readLens(lens,index=n),None))
+			except Exception as e:
+				self._queue.put((None,e))
+				return
+
+	def next(self):
+
+		"""
+		Returns the next lens plane, blocking until it has been read from disk
+
+		"""
+
+		plane,error = self._queue.get()
+		self._slots.release()
+
+		if error is not None:
+			raise error
+
+		return plane
+
+	def close(self):
+
+		"""
+		Stops the background thread, discarding the planes that were read but not used
+
+		"""
+
+		self._stop.set()
+		self._slots.release()
+		self._thread.join()
+
+
+#######################################################
+###############PlaneStripe class#######################
+#######################################################
+
+class PlaneStripe(object):
+
+	"""
+	Band of consecutive pixel rows of a lens plane (PotentialPlane or LensPackPlane), padded on both sides with a halo of rows (periodic boundary conditions) wide enough for the finite difference and interpolation stencils: in distributed ray tracing each task keeps one stripe of every lens, and computes the lens quantities for the rays that fall in its rows
+
+	:param plane: lens plane to cut (memory mapped planes are never read whole, only the stripe rows are accessed)
+	:type plane: :py:class:`PotentialPlane` or :py:class:`LensPackPlane`
+
+	:param first_row: first pixel row of the band (in the unshifted plane pixels)
+	:type first_row: int.
+
+	:param last_row: last pixel row of the band (excluded)
+	:type last_row: int.
+
+	:param interpolation: interpolation of the lens quantities between the pixel centers ("nearest","bilinear" or "bicubic")
+	:type interpolation: str.
+
+	:param with_shear: if False, only the fields needed for the deflection angles are kept
+	:type with_shear: bool.
+
+	:param dtype: precision in which the stripe rows are kept (only the rows are converted); if None, the precision of the plane
+	:type dtype: data-type
+
+	"""
+
+	def __init__(self,plane,first_row,last_row,interpolation="nearest",with_shear=True,dtype=None):
+
+		assert plane.space=="real","Only real space planes can be cut in stripes!"
+		assert interpolation in _interpolation_order,"interpolation must be one in {0}".format(list(_interpolation_order.keys()))
+
+		deflection_field,self.deflection_scale = plane._deflectionField()
+		shear_field,self.shear_scale = plane._shearField()
+
+		#The finite differences of the potential reach 2 pixels away, the interpolation stencils up to 2 more
+		self.potential = (deflection_field.ndim==2)
+		self.interpolation = interpolation
+		self.halo = 2*self.potential + {0:0,1:1,3:2}[_interpolation_order[interpolation]]
+
+		self.npixel = deflection_field.shape[-1]
+		self.first_row = first_row
+		self.last_row = last_row
+		self.redshift = plane.redshift
+		self.roll_offset = plane.roll_offset
+		self.pixel_angle = plane._pixelAngle()
+
+		#Cut the rows in the band and in the halo
+		rows = np.arange(first_row-self.halo,last_row+self.halo) % self.npixel
+		self.deflection_field = np.asarray(deflection_field[...,rows,:],dtype=dtype)
+
+		if not with_shear:
+			self.shear_field = None
+		elif shear_field is deflection_field:
+			self.shear_field = self.deflection_field
+		else:
+			self.shear_field = np.asarray(shear_field[...,rows,:],dtype=dtype)
+
+	@property
+	def nbytes(self):
+		return self.deflection_field.nbytes + (self.shear_field.nbytes if (self.shear_field is not None) and (self.shear_field is not self.deflection_field) else 0)
+
+	def rows(self,x,y):
+
+		"""
+		Computes the pixel rows (in the unshifted plane pixels) that own the rays at (x,y): the stencils of each ray fit in the band of the stripe that owns its row
+
+		:param x: ray x positions in radians
+		:type x: array
+
+		:param y: ray y positions in radians
+		:type y: array
+
+		:returns: array of rows
+
+		"""
+
+		#Same rows as in Plane._pixelIndices (nearest) and Plane._pixelCoordinates (interpolation)
+		if self.interpolation=="nearest":
+			return np.mod((y / self.pixel_angle).astype(np.int32) - self.roll_offset[0],self.npixel)
+		else:
+			return np.mod(np.floor(y / self.pixel_angle - 0.5).astype(np.int64) - self.roll_offset[0],self.npixel)
+
+	#Stencil pixels (local rows, columns) and weights of the rays at (x,y), the weights are None for nearest pixels
+	def _stencil(self,x,y):
+
+		rows = self.rows(x,y)
+		if self.interpolation=="nearest":
+			i = rows[None]
+			j = np.mod((x / self.pixel_angle).astype(np.int32) - self.roll_offset[1],self.npixel)[None]
+			weights = None
+		else:
+			i,j,weights = _interpolationStencil(y/self.pixel_angle - 0.5 - self.roll_offset[0],x/self.pixel_angle - 0.5 - self.roll_offset[1],self.npixel,self.interpolation)
+
+		#Rows relative to the stripe: the stencils are at most a few rows away from the row that owns the ray, which must be in the band
+		local = np.mod(rows - self.first_row,self.npixel)
+		assert (local<self.last_row-self.first_row).all(),"Some rays fall outside the stripe rows {0}-{1}!".format(self.first_row,self.last_row)
+		i = local + self.halo + np.mod(i - rows + self.npixel//2,self.npixel) - self.npixel//2
+
+		return i,j,weights
+
+	#Sum the values gathered on the stencils
+	@staticmethod
+	def _stencilSum(values,weights):
+		
+		if weights is None:
+			return values[...,0,:]
+
+		return (values*weights).sum(-2)
+
+	def deflections(self,x,y):
+
+		"""
+		Gathers the deflection angles at the ray positions, with the same stencils as the ray tracing kernels; the values must be multiplied by deflection_scale to get radians
+
+		:param x: ray x positions in radians
+		:type x: array
+
+		:param y: ray y positions in radians
+		:type y: array
+
+		:returns: (2,Nrays) array
+
+		"""
+
+		i,j,weights = self._stencil(x,y)
+		field = self.deflection_field
+		n = self.npixel
+
+		if self.potential:
+			values = np.array([ (field[i,(j+1)%n].astype(np.float64) - field[i,(j-1)%n]) / 2.0 , (field[i+1,j].astype(np.float64) - field[i-1,j]) / 2.0 ])
+		else:
+			values = field[:,i,j].astype(np.float64)
+
+		return self._stencilSum(values,weights)
+
+	def shearMatrices(self,x,y):
+
+		"""
+		Gathers the shear matrices [xx,yy,xy] at the ray positions, with the same stencils as the ray tracing kernels; the values must be multiplied by shear_scale
+
+		:param x: ray x positions in radians
+		:type x: array
+
+		:param y: ray y positions in radians
+		:type y: array
+
+		:returns: (3,Nrays) array
+
+		"""
+
+		assert self.shear_field is not None,"The stripe was cut without the shear fields!"
+
+		i,j,weights = self._stencil(x,y)
+		field = self.shear_field
+		n = self.npixel
+
+		if self.potential:
+			center = 2*field[i,j].astype(np.float64)
+			values = np.array([ 
+				(field[i,(j+2)%n].astype(np.float64) + field[i,(j-2)%n] - center) / 4.0,
+				(field[i+2,j].astype(np.float64) + field[i-2,j] - center) / 4.0,
+				(field[i+1,(j+1)%n].astype(np.float64) + field[i-1,(j-1)%n] - field[i+1,(j-1)%n] - field[i-1,(j+1)%n]) / 4.0
+				])
+		else:
+			values = field[:,i,j].astype(np.float64)
+
+		return self._stencilSum(values,weights)
+
+
+#Check if an array of indices is the identity permutation
+def _isIdentity(indices):
+	return (indices==np.arange(len(indices))).all()
+
+#######################################################
+###############RayTracer class#########################
+#######################################################
+
+class RayTracer(object):
+
+	"""
+	Class handler of ray tracing operations: it mainly computes the path corrections of light rays that travel through a set of gravitational lenses
+
+	"""
+
+	def __init__(self,lens_mesh_size=None,lens_type=PotentialPlane,cache=plane_cache,dtype=np.float64,accumulator_dtype=None,interpolation="nearest"):
+
+		self.Nlenses = 0
+		self.lens = list()
+		self.distance = list()
+		self.redshift = list()
+		self.lens_type = lens_type
+
+		#Precision of the lens planes read from disk and of the ray state (positions, deflections and jacobians) that shoot traces through them
+		self.dtype = dtype
+
+		#The ray positions and jacobians accumulate the deflections over all the lenses: they can be kept in a higher precision than the rest of the ray state
+		self.accumulator_dtype = dtype if (accumulator_dtype is None) else accumulator_dtype
+
+		#How the lens quantities are interpolated between the pixel centers of the planes
+		if interpolation not in _interpolation_order:
+			raise ValueError("interpolation must be one in {0}".format(list(_interpolation_order.keys())))
+		self.interpolation = interpolation
+
+		#Lens planes specified by filename are read through this cache
+		self.cache = cache
+
+		#Pool of threads that process the chunks of rays, created when needed
+		self._pool = None
+		self._pool_size = 0
+
+		#If we know the size of the lens planes already we can compute, once and for all, the FFT meshgrid
+		if lens_mesh_size is not None:
+			self.lmesh = np.array(np.meshgrid(fftengine.rfftfreq(lens_mesh_size),fftengine.fftfreq(lens_mesh_size)))
+		else:
+			self.lmesh = None
+
+
+	def addLens(self,lens_specification):
+
+		"""
+		Adds a gravitational lens to the ray tracer, either by putting in a lens plane, or by specifying the name of a file which contains the lens specifications
+
+		:param lens_specification: specifications of the lens to add, either in tuple(filename,distance,redshift) or as a PotentialPlane instance
+		:type lens specification: tuple or PotentialPlane instance
+
+		"""
+
+		#Sanity check
+		assert type(lens_specification) in [tuple,self.lens_type]
+
+		#If specification is in tuple form, parse it
+		if type(lens_specification)==tuple:
+
+			filename,distance,redshift = lens_specification
+
+			assert type(filename)==str
+			assert distance.unit.physical_type=="length"
+			assert type(redshift)==float
+			
+			self.lens.append(filename)
+			self.distance.append(distance)
+			self.redshift.append(redshift)
+			self.Nlenses += 1
+
+		else:
+
+			#Otherwise get the info from the PotentialPlane class
+			self.lens.append(lens_specification)
+			self.distance.append(lens_specification.comoving_distance)
+			self.redshift.append(lens_specification.redshift)
+			self.Nlenses += 1
+
+		#If completed correctly, log info to the user
+		logray.debug("Added lens at redshift {0:.3f}(comoving distance {1:.3f})".format(self.redshift[-1],self.distance[-1]))
+
+	#Number of bytes read from disk when loading a lens plane: the memory mapped pixel values are read only when they are accessed, not during the load
+	@staticmethod
+	def _bytesRead(plane,filename):
+
+		if isinstance(plane.data,np.memmap):
+			return 0
+		else:
+			return os.path.getsize(filename)
+
+	#Read the lens from disk (index is the position of the lens in the crossing order, which is recorded in the performance events)
+	def readLens(self,lens,index=None):
+
+		if type(lens)==self.lens_type:
+			return lens
+
+		elif type(lens)==str:
+				
+			logray.info("Reading plane from {0}...".format(lens))
+			start = time.time()
+			if self.cache is not None:
+				misses = self.cache.misses
+				current_lens = self.cache.load(lens,self.lens_type,dtype=self.dtype)
+				from_disk = self.cache.misses>misses
+			else:
+				current_lens = self.lens_type.load(lens,dtype=self.dtype)
+				from_disk = True
+			logray.info("Read plane from {0}...".format(lens))
+			logstderr.debug("Read plane: peak memory usage {0:.3f} (task)".format(peakMemory()))
+			recordEvent("load",time.time()-start,lens=index,file=lens,redshift=current_lens.redshift,nbytes=(self._bytesRead(current_lens,lens) if from_disk else 0))
+
+			return current_lens
+
+		else:
+			raise TypeError("Lens format not recognized!")
+
+	#Roll a lens that was read from disk
+	def rollLens(self,lens,current_lens,index=None):
+
+		if type(lens)==str:
+			logray.info("Randomly rolling lens at z={0:.3f} along its axes...".format(current_lens.redshift))
+			start = time.time()
+			current_lens.randomRoll()
+			logray.info("Rolled lens at z={0:.3f} along its axes...".format(current_lens.redshift))
+			logstderr.debug("Rolled lens: peak memory usage {0:.3f} (task)".format(peakMemory()))
+			recordEvent("roll",time.time()-start,lens=index,file=lens,redshift=current_lens.redshift)
+
+		return current_lens
+
+	#Load the lens
+	def loadLens(self,lens,index=None):
+		return self.rollLens(lens,self.readLens(lens,index=index),index=index)
+
+	#Load the lenses in crossing order (the first one has index first), optionally reading them ahead in a background thread; yields the time spent waiting for each of them
+	def loadLenses(self,lenses,prefetch=0,first=0):
+
+		if not prefetch:
+			
+			for n,lens in enumerate(lenses,first):
+				start = time.time()
+				current_lens = self.loadLens(lens,index=n)
+				yield current_lens,time.time()-start
+
+		else:
+
+			#The random rolls are drawn in this thread, so the results do not depend on the prefetch depth
+			with PlanePrefetcher(self,lenses,depth=prefetch,first=first) as prefetcher:
+				for n,lens in enumerate(lenses,first):
+					start = time.time()
+					current_lens = self.rollLens(lens,prefetcher.next(),index=n)
+					yield current_lens,time.time()-start
+
+
+	#Memory (in bytes) taken by the temporary arrays that a chunk allocates for each of its rays while crossing a lens, at the precision they are allocated in:
+	#the lens pixels of the rays (int32 indices, or float64 interpolation coordinates) with the float64 quotients they are computed from, the given number of float64 values computed at the rays and, if values are gathered
+	#on the interpolation stencils in python (getValues, density), the pixel indices and weight of each stencil pixel with the gathered values and their weighted products (two of which can be alive at the same time, while a stencil sum is reduced)
+	#The ray state of the whole bundle (positions, deflections, jacobians) is allocated once before the lenses are crossed, and does not depend on the chunk size
+	def _chunkBytesPerRay(self,values,indices=2,gathered=0,interpolation=None):
+
+		order = _interpolation_order[interpolation or self.interpolation]
+		pixel_bytes = indices*(4 if order==0 else 8) + (16 if indices else 0)
+		stencil_bytes = (order+1)**2 * (2*4 + 8 + (gathered+2)*8) if (gathered and order) else 0
+
+		return pixel_bytes + values*8 + stencil_bytes
+
+	#Split a bundle of rays in chunks; the temporary arrays of the chunks processed at the same time (one per thread) take at most max_memory Gbyte 
+	def _rayChunks(self,num_rays,chunk_size=None,max_memory=None,n_threads=1,bytes_per_ray=None):
+
+		if chunk_size is None:
+			
+			if max_memory is not None:
+				if bytes_per_ray is None:
+					bytes_per_ray = self._chunkBytesPerRay(0)
+				chunk_size = max(int(max_memory*(1024**3)/(bytes_per_ray*n_threads)),1)
+			elif n_threads>1:
+				#A few chunks per thread balance the load
+				chunk_size = max(-(-num_rays//(4*n_threads)),1)
+			else:
+				chunk_size = num_rays
+
+		chunks = [ slice(first,min(first+chunk_size,num_rays)) for first in range(0,num_rays,chunk_size) ]
+		logray.debug("Ray bundle of {0} rays split in {1} chunks of (at most) {2} rays, processed by {3} threads".format(num_rays,len(chunks),chunk_size,n_threads))
+
+		return chunks
+
+	#Call function on each chunk of rays, using a pool of threads if n_threads>1; the function must only write to the rays in its chunk
+	def _mapChunks(self,function,chunks,n_threads=1):
+
+		if n_threads<=1 or len(chunks)<=1:
+			return [ function(rays) for rays in chunks ]
+
+		#The pool is kept between calls
+		if (self._pool is None) or (self._pool_size!=n_threads):
+			
+			if self._pool is not None:
+				self._pool.terminate()
+			
+			self._pool = ThreadPool(n_threads)
+			self._pool_size = n_threads
+
+		return self._pool.map(function,chunks)
+
+
+	#Save the ray state arrays, the index of the next lens to cross and the state of the random number generator (which rolls the lenses) to a checkpoint file; the file is replaced atomically, so an interruption never leaves a partial checkpoint
+	def _saveCheckpoint(self,filename,ray_state,next_lens):
+
+		start = time.time()
+		random_state = np.random.get_state()
+		
+		with open(filename+".tmp","wb") as fp:
+			np.savez(fp,next_lens=next_lens,redshift=np.array(self.redshift),random_keys=random_state[1],random_pos=random_state[2],random_has_gauss=random_state[3],random_cached_gaussian=random_state[4],**ray_state)
+		
+		os.rename(filename+".tmp",filename)
+		logray.debug("Ray state before lens {0} saved to checkpoint {1} in {2:.3f}s".format(next_lens,filename,time.time()-start))
+
+	#Restore the ray state arrays (in place) and the random number generator from a checkpoint file, returns the index of the next lens to cross
+	def _loadCheckpoint(self,filename,ray_state,last_lens):
+
+		with np.load(filename) as checkpoint:
+
+			#The checkpoint must come from the same run
+			next_lens = int(checkpoint["next_lens"])
+			if (set(ray_state.keys())-set(checkpoint.files)) or any(checkpoint[name].shape!=ray_state[name].shape for name in ray_state) or (checkpoint["redshift"].shape!=(len(self.redshift),)) or (next_lens>last_lens) or not np.allclose(checkpoint["redshift"],self.redshift):
+				raise ValueError("The checkpoint {0} does not match the rays or the lenses that are being traced!".format(filename))
+
+			for name in ray_state:
+				ray_state[name][:] = checkpoint[name]
+
+			np.random.set_state(("MT19937",checkpoint["random_keys"],int(checkpoint["random_pos"]),int(checkpoint["random_has_gauss"]),float(checkpoint["random_cached_gaussian"])))
+
+		logray.info("Resuming ray tracing from lens {0} with the ray state in checkpoint {1}".format(next_lens,filename))
+		return next_lens
+
+	#Write the outputs of the n-th source redshift for a chunk of rays: the rays took a full step past the last lens, of which the back_step fraction goes beyond the source and is taken back
+	def _emitOutputs(self,output_values,n,rays,back_step,positions,deflections,jacobians,jacobian_deflections):
+
+		if "positions" in output_values:
+			np.subtract(positions[:,rays],back_step*deflections[:,rays],out=output_values["positions"][n][:,rays])
+
+		if jacobians is None:
+			return
+
+		#Jacobians at the source redshift, from which the other statistics are derived
+		jacobian = jacobians[:,rays] - back_step*jacobian_deflections[:,rays]
+
+		if "jacobians" in output_values:
+			output_values["jacobians"][n][:,rays] = jacobian
+
+		if "convergence" in output_values:
+			output_values["convergence"][n][rays] = 1.0 - 0.5*(jacobian[0]+jacobian[3])
+
+		if "shear" in output_values:
+			output_values["shear"][n][0,rays] = 0.5*(jacobian[3]-jacobian[0])
+			output_values["shear"][n][1,rays] = -0.5*(jacobian[1]+jacobian[2])
+
+		if "omega" in output_values:
+			output_values["omega"][n][rays] = -0.5*(jacobian[2]-jacobian[1])
+
+	#Attach the units to the outputs and restore the shape of the ray bundle
+	@staticmethod
+	def _outputMaps(output_values,ray_shape,unit):
+
+		if "positions" in output_values:
+			output_values["positions"] = (output_values["positions"]*rad).to(unit)
+
+		for name in output_values:
+			output_values[name] = output_values[name].reshape(output_values[name].shape[:-1]+ray_shape)
+
+		return output_values
+
+	#If the rays sit on a grid (positions[0] depends on the column only, positions[1] on the row only) return the x and y axes of the grid in radians, otherwise None
+	def _rayGrid(self,positions):
+
+		if positions.ndim!=3:
+			return None
+
+		x = positions[0].to(rad).value
+		y = positions[1].to(rad).value
+
+		if (x==x[0]).all() and (y==y[:,0][:,None]).all():
+			return x[0],y[:,0]
+		else:
+			return None
+
+
+	def randomRoll(self,seed=None):
+
+		"""
+		Randomly rolls all the lenses in the system along both axes
+
+		:param seed: random seed with which to initialize the generator
+		:type seed: int.
+
+		"""
+
+		if seed is not None:
+			np.random.seed(seed)
+
+		for lens in self.lens:
+			lens.randomRoll(seed=None,lmesh=self.lmesh)
+
+
+	def reorderLenses(self):
+
+		"""
+		Reorders the lenses in the ray tracer according to their comoving distance from the observer
+
+		"""
+
+		self.lens = [ lens for (redshift,lens) in sorted(zip(self.redshift,self.lens)) ]
+		self.redshift.sort()
+		self.distance.sort()
+
+
+	##################################################################################################################################
+	#####################This method solves the nonlinear lensing ODE#################################################################
+	#############################(backward ray tracing)###############################################################################
+	##################################################################################################################################
+
+	def shoot(self,initial_positions,z=2.0,initial_deflection=None,kind="positions",save_intermediate=False,compute_all_deflections=False,callback=None,transfer=None,prefetch=0,chunk_size=None,max_memory=None,n_threads=1,checkpoint=None,checkpoint_interval=0.0,outputs=None,output_callback=None,**kwargs):
+
+		"""
+		Shots a bucket of light rays from the observer to the sources at redshift z (backward ray tracing), through the system of gravitational lenses, and computes the deflection statistics
+
+		:param initial_positions: initial angular positions of the light ray bucket, according to the observer; if unitless, the positions are assumed to be in radians. initial_positions[0] is x, initial_positions[1] is y
+		:type initial_positions: numpy array or quantity
+
+		:param z: redshift of the sources; if an array is passed, a redshift must be specified for each ray, i.e. z.shape==initial_positions.shape[1:]; if outputs is not None, this can be a list of source redshifts instead, which are shared by all the rays
+		:type z: float. or array or list
+
+		:param initial_deflection: if not None, this is the initial deflection light rays undergo with respect to the line of sight (equivalent to specifying the first derivative IC on the lensing ODE); must have the same shape as initial_positions
+		:type initial_deflection: numpy array or quantity
+
+		:param kind: what deflection statistics to compute; "positions" will calculate the ray deflections after they crossed the last lens, "jacobian" will compute the lensing jacobian matrix after the last lens, "shear" and "convergence" will compute the omonimous weak lensing statistics  
+		:type kind: str.
+
+		:param save_intermediate: save the intermediate positions of the rays too
+		:type save_intermediate: bool.
+
+		:param compute_all_deflections: if True, computes the gradients of the lensing potential at every pixel on the lens(might be overkill if Nrays<<Npixels); must be True if the computation is done with FFTs
+		:type compute_all_deflections: bool.
+
+		:param callback: if not None, this callback function is called on the current ray positions array at each step in the ray tracing; the current raytracing instance and the step number are passed as additional arguments, hence callback must match this signature
+		:type callback: callable
+
+		:param transfer: if not None, scales the fluctuations on each lens plane to a different redshift (before computing the ray defections) using a provided transfer function 
+		:type transfer: :py:class:`TransferSpecs`
+
+		:param prefetch: if larger than 0, this number of lens planes is read from disk in a background thread while the current lens is being crossed
+		:type prefetch: int.
+
+		:param chunk_size: if not None, the rays are processed in chunks of this size against each lens, to bound the memory taken by the temporary arrays
+		:type chunk_size: int.
+
+		:param max_memory: if not None (and chunk_size is None), the chunk size is chosen so that the temporary arrays of the chunks take at most this memory (in Gbyte)
+		:type max_memory: float.
+
+		:param n_threads: number of threads that process the chunks of rays in parallel
+		:type n_threads: int.
+
+		:param checkpoint: if not None, the state of the rays (and of the random number generator that rolls the planes) is saved to this file (numpy npz format) after the lenses are crossed, so that an interrupted run can be resumed: if the file exists when shoot is called, the ray tracing restarts from the first lens that was not crossed. The file is removed when the ray tracing completes
+		:type checkpoint: str.
+
+		:param checkpoint_interval: minimum time (in seconds) between two checkpoints
+		:type checkpoint_interval: float.
+
+		:param outputs: if not None, the set of statistics to compute in a single pass, among "positions","jacobians","convergence","shear" and "omega" (kind is ignored): each of them is computed at every source redshift in z, when the rays reach it, into a preallocated array 
+		:type outputs: set.
+
+		:param output_callback: if not None (and outputs is not None), this function is called with the outputs of each source redshift as soon as the rays reach it, i.e. output_callback(values,tracer,n,**kwargs) where values is a dictionary with an array for each output and n is the index of the source redshift in z; the outputs of a source redshift are not kept in memory after the call, and they are not returned
+		:type output_callback: callable
+
+		:param kwargs: the keyword arguments are passed to the callback (and to the output_callback) if not None
+		:type kwargs: dict.
+
+		:returns: angular positions (or jacobians) of the light rays after the last lens crossing; if outputs is not None, a dictionary with an array for each output (with a leading dimension for the source redshifts, if z is a list), or None if the outputs are handed to output_callback
+
+		"""
+
+		#Sanity check
+		assert self.lens_type in [PotentialPlane,LensPackPlane], "Lens type must be PotentialPlane or LensPackPlane"
+		assert initial_positions.ndim>=2 and initial_positions.shape[0]==2,"initial positions shape must be (2,...)!"
+		assert type(initial_positions)==quantity.Quantity and initial_positions.unit.physical_type=="angle"
+		assert kind in ["positions","jacobians","shear","convergence"],"kind must be one in [positions,jacobians,shear,convergence]!"
+		assert transfer is None or isinstance(transfer,TransferSpecs)
+		assert transfer is None or self.lens_type==PotentialPlane,"Transfer function scaling is implemented for PotentialPlane lenses only"
+
+		#With multiple outputs, the rays take full steps up to the farthest source redshift, and each output is corrected for the partial last step of its source redshift
+		if outputs is not None:
+			
+			outputs = set(outputs)
+			assert outputs and outputs<=set(["positions","jacobians","convergence","shear","omega"]),"outputs must be a subset of [positions,jacobians,convergence,shear,omega]!"
+			assert type(z)!=np.ndarray,"With multiple outputs the source redshifts must be a float or a list!"
+			assert not save_intermediate,"save_intermediate is not supported with multiple outputs!"
+			assert (output_callback is None) or callable(output_callback),"output_callback must be callable!"
+
+			scalar_redshift = (np.ndim(z)==0)
+			output_redshifts = np.atleast_1d(np.array(z,dtype=np.float64))
+			assert output_redshifts.ndim==1,"The source redshifts must be a float or a list!"
+			kind = "positions" if outputs==set(["positions"]) else "jacobians"
+			z = output_redshifts.max()
+
+		#Allocate arrays for the intermediate light ray positions and deflections; the rays are stored flat, in arrays of shape (2,Nrays)
+		ray_shape = initial_positions.shape[1:]
+		num_rays = reduce(mul,ray_shape)
+
+		#The lens loop works on bare arrays: positions and deflections are converted to radians once, and the units are attached again on return
+		#The deflections are kept in the precision of the tracer, the positions (which accumulate the deflections) in the precision of its accumulators
+		if initial_deflection is None:
+			position_values = initial_positions.to(rad).value.reshape((2,num_rays)).astype(self.accumulator_dtype)
+			deflection_values = np.zeros((2,num_rays),dtype=self.dtype)
+		else:
+			assert initial_deflection.shape==initial_positions.shape
+			deflection_values = initial_deflection.to(rad).value.reshape((2,num_rays)).astype(self.dtype)
+			position_values = (initial_positions + initial_deflection).to(rad).value.reshape((2,num_rays)).astype(self.accumulator_dtype)
+
+		#If we want to trace jacobians, allocate also space for the jacobians
+		if kind in ["jacobians","shear","convergence"]:
+
+			#Initial condition for the jacobian is the identity
+			current_jacobian = np.zeros((4,num_rays),dtype=self.accumulator_dtype)
+			current_jacobian[0] = 1.0
+			current_jacobian[3] = 1.0
+			current_jacobian_deflection = np.zeros((4,num_rays),dtype=self.dtype)
+
+		#Decide which is the last lens the light rays should cross
+		if type(z)==np.ndarray:
+			
+			#Check that shapes correspond
+			assert z.shape==initial_positions.shape[1:]
+
+			#Check that redshift is not too high given the current lenses
+			assert z.max()<self.redshift[-1],"Given the current lenses you can trace up to redshift {0:.2f}!".format(self.redshift[-1])
+
+			#Compute the number of lenses that each ray should cross
+			last_lens_ray = (z[None] > np.array(self.redshift).reshape((len(self.redshift),)+(1,)*len(z.shape))).argmin(0) - 1
+			last_lens = last_lens_ray.max()
+
+			z = z.reshape(num_rays)
+			last_lens_ray = last_lens_ray.reshape(num_rays)
+
+			#Sort the rays once by the number of lenses they cross: at each lens the rays that still need to be traced are a contiguous prefix, which shrinks as the sources are reached
+			ray_order = np.argsort(-last_lens_ray,kind="mergesort")
+			ray_inverse = np.argsort(ray_order)
+			
+			z = z[ray_order]
+			last_lens_ray = last_lens_ray[ray_order]
+			position_values = position_values[:,ray_order].copy()
+			deflection_values = deflection_values[:,ray_order].copy()
+
+			#Number of rays that cross each lens
+			rays_crossing = np.searchsorted(-last_lens_ray,-np.arange(last_lens+1),side="right")
+		
+		else:
+			
+			#Check that redshift is not too high given the current lenses
+			assert z<self.redshift[-1],"Given the current lenses you can trace up to redshift {0:.2f}!".format(self.redshift[-1])
+			last_lens = (z>np.array(self.redshift)).argmin() - 1
+			ray_inverse = None
+
+		#Rays are traced in sorted order, they are put back in the original order when they are returned
+		def unsorted(array):
+			if ray_inverse is None:
+				return array
+			return array[...,ray_inverse]
+		
+		if kind=="positions" and save_intermediate:
+			all_positions = np.zeros((last_lens+1,2,num_rays),dtype=self.accumulator_dtype)
+
+		#State of the rays that is saved in the checkpoints
+		ray_state = {"positions":position_values,"deflections":deflection_values}
+		if kind in ["jacobians","shear","convergence"]:
+			ray_state["jacobians"] = current_jacobian
+			ray_state["jacobian_deflections"] = current_jacobian_deflection
+		if kind=="positions" and save_intermediate:
+			ray_state["all_positions"] = all_positions
+
+		#Preallocate the outputs, with the lens after which each source redshift is reached and the weight of the partial last step
+		if outputs is not None:
+
+			output_shape = {"positions":(2,),"jacobians":(4,),"convergence":(),"shear":(2,),"omega":()}
+			output_lens = np.array([ (zs>np.array(self.redshift)).argmin() - 1 for zs in output_redshifts ])
+			output_weights = np.array([ (zs - ([0.0]+self.redshift)[n+1]) / (([0.0]+self.redshift)[n+2] - ([0.0]+self.redshift)[n+1]) for zs,n in zip(output_redshifts,output_lens) ])
+
+			#The outputs handed to the callback are allocated only while the rays cross the lens that emits them; the emitted ones are not part of the ray state
+			if output_callback is None:
+				
+				output_values = dict([ (name,np.zeros((len(output_redshifts),)+output_shape[name]+(num_rays,),dtype=self.accumulator_dtype)) for name in outputs ])
+				for name in outputs:
+					ray_state["output_"+name] = output_values[name]
+			
+			else:
+				output_values = dict([ (name,[None]*len(output_redshifts)) for name in outputs ])
+
+		#Resume an interrupted run from its checkpoint
+		if (checkpoint is not None) and os.path.exists(checkpoint):
+			first_lens = self._loadCheckpoint(checkpoint,ray_state,last_lens)
+		else:
+			first_lens = 0
+
+		last_checkpoint = time.time()
+
+		#Split the ray bundle in chunks, which are processed against each lens (possibly in parallel). Each ray of a chunk allocates its lens pixels, the weighted deflections added to its position (2 values) and, if the sources are at different redshifts, the weight of the deflections with its intermediate terms (3 values)
+		#The outputs emitted at a source redshift take back a fraction of the last deflections (2 values), and of the jacobians with their product (8 values)
+		#When the lenses are gathered on the whole planes the pixels are replaced by the positions in radians (2 values), the deflections before and after the unit conversion (4 values) and the shear matrix (3 values)
+		chunk_values = 2 + 3*(type(z)==np.ndarray)
+		if outputs is not None:
+			chunk_values += 2 if kind=="positions" else 8
+		if compute_all_deflections:
+			bytes_per_ray = self._chunkBytesPerRay(chunk_values+9,indices=0)
+		else:
+			bytes_per_ray = self._chunkBytesPerRay(chunk_values)
+
+		chunks = self._rayChunks(num_rays,chunk_size=chunk_size,max_memory=max_memory,n_threads=n_threads,bytes_per_ray=bytes_per_ray)
+
+		#Interpolation order of the lens quantities at the ray positions
+		order = _interpolation_order[self.interpolation]
+
+		#The light rays positions at the k+1 th step are computed according to Xk+1 = Xk + Dk, where Dk is the deflection
+		#To stabilize the solution numerically we compute the deflections as Dk+1 = (Ak-1)Dk + Ck*pk where pk is the deflection due to the potential gradient
+
+		#Ordered references to the lenses
+		distance = np.array([ d.to(Mpc).value for d in [0.0*Mpc] + self.distance ])
+		redshift = np.array([0.0] + self.redshift)
+		lens = self.lens
+		io_total = 0.0
+		compute_total = 0.0
+
+		#This is the main loop that goes through all the lenses (they are loaded in order, possibly ahead of time)
+		for k,(current_lens,io_time) in enumerate(self.loadLenses(lens[first_lens:last_lens+1],prefetch=prefetch,first=first_lens),first_lens):
+
+			#Check the lens
+			np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
+
+			#If transfer function is provided, scale to target redshift
+			if transfer is not None:
+				current_lens.scaleWithTransfer(transfer.cur2target[current_lens.redshift],tfr=transfer.tfr,with_scale_factor=transfer.with_scale_factor,kmesh=transfer.kmesh,scaling_method=transfer.scaling_method)
+
+			#Log
+			logray.debug("Crossing lens {0} at redshift z={1:.3f}".format(k,current_lens.redshift))
+			start = time.time()
+
+			#If the computations are done on the whole plane, they are done once for all the chunks
+			if compute_all_deflections:
+				
+				deflection_plane = current_lens.deflectionAngles(lmesh=self.lmesh)
+				if kind in ["jacobians","convergence","shear"]:
+					shear_plane = current_lens.shearMatrix(lmesh=self.lmesh)
+
+				logray.debug("Deflection angles and shear matrices computed on the whole lens in {0:.3f}s".format(time.time()-start))
+				logstderr.debug("Whole lens computations: peak memory usage {0:.3f} (task)".format(peakMemory()))
+
+			else:
+
+				#Unit conversions are done once per lens, the chunks index the lens pixels with bare arrays
+				last_timestamp = time.time()
+				pixel_angle = current_lens._pixelAngle()
+				deflection_field,deflection_scale = current_lens._deflectionField()
+				if kind in ["jacobians","convergence","shear"]:
+					shear_field,shear_scale = current_lens._shearField()
+
+				logray.debug("Lens unit conversions completed in {0:.6f}s (once for {1} chunks)".format(time.time()-last_timestamp,len(chunks)))
+
+			#Compute geometrical weight factors
+			Ak = (distance[k+1] / distance[k+2]) * (1.0 + (distance[k+2] - distance[k+1])/(distance[k+1] - distance[k]))
+			Ck = -1.0 * (distance[k+2] - distance[k+1]) / distance[k+2]
+
+			#Process a chunk of rays: this writes only to the rays in the chunk
+			def crossChunk(rays):
+
+				last_timestamp = time.time()
+
+				#Compute the deflection angles and the deflection on the next lens
+				if compute_all_deflections:
+					deflections = deflection_plane.getValues(position_values[0,rays]*rad,position_values[1,rays]*rad)
+					_raytracing.deflectionUpdate((deflections.to(rad).value if isinstance(deflections,quantity.Quantity) else deflections),None,None,1.0,deflection_values[:,rays],Ak,Ck)
+				else:
+					i,j = current_lens._rayPixels(position_values[0,rays],position_values[1,rays],pixel_angle,order)
+					_raytracing.deflectionUpdate(deflection_field,j,i,deflection_scale,deflection_values[:,rays],Ak,Ck,order)
+
+				#Weight of the deflections: rays that reach their source before the next lens only get a fraction of them
+				if type(z)==np.ndarray:
+					weight = (k<last_lens_ray[rays]) + (k==last_lens_ray[rays])*(z[rays] - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+					weight_scale = 1.0
+				else:
+					weight = None
+					weight_scale = 1.0 if (k<last_lens or outputs is not None) else (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+
+				now = time.time()
+				time_deflections = now-last_timestamp
+				last_timestamp = now
+
+				#If we are tracing jacobians we need to compute the matrix product with the shear matrix and add the distortions to the jacobians
+				if kind in ["jacobians","convergence","shear"]:
+
+					#Gather, matrix products and jacobian update happen in a single pass over the rays (in real space the shear matrices are gathered at the same pixels as the deflections)
+					if compute_all_deflections:
+						_raytracing.jacobianUpdate(shear_plane.getValues(position_values[0,rays]*rad,position_values[1,rays]*rad),None,None,1.0,current_jacobian[:,rays],current_jacobian_deflection[:,rays],Ak,Ck,weight,weight_scale)
+					else:
+						_raytracing.jacobianUpdate(shear_field,j,i,shear_scale,current_jacobian[:,rays],current_jacobian_deflection[:,rays],Ak,Ck,weight,weight_scale,order)
+				
+				now = time.time()
+				time_shear = now-last_timestamp
+				last_timestamp = now
+
+				#Add the deflections to the positions
+				if weight is not None:
+					position_values[:,rays] += deflection_values[:,rays] * weight
+				elif k<last_lens:
+					position_values[:,rays] += deflection_values[:,rays]
+				else:
+					position_values[:,rays] += deflection_values[:,rays] * weight_scale
+
+				#Emit the outputs of the source redshifts that are reached after this lens
+				if outputs is not None:
+					for n in np.where(output_lens==k)[0]:
+						self._emitOutputs(output_values,n,rays,1.0-output_weights[n],position_values,deflection_values,(current_jacobian if kind=="jacobians" else None),(current_jacobian_deflection if kind=="jacobians" else None))
+
+				return time_deflections,time_shear,time.time()-last_timestamp
+
+			#Outputs that are emitted after this lens, if they are handed to the callback
+			if (outputs is not None) and (output_callback is not None):
+				emitted = np.where(output_lens==k)[0]
+				for n in emitted:
+					for name in outputs:
+						output_values[name][n] = np.zeros(output_shape[name]+(num_rays,),dtype=self.accumulator_dtype)
+
+			#Rays whose source is in front of this lens are not traced anymore
+			if ray_inverse is not None:
+				lens_chunks = [ slice(rays.start,min(rays.stop,rays_crossing[k])) for rays in chunks if rays.start<rays_crossing[k] ]
+			else:
+				lens_chunks = chunks
+
+			#Time spent in the different steps, summed over the chunks
+			time_deflections,time_shear,time_addition = np.array(self._mapChunks(crossChunk,lens_chunks,n_threads=n_threads)).reshape((-1,3)).sum(0)
+
+			logray.debug("Retrieval of deflection angles from potential planes completed in {0:.3f}s".format(time_deflections))
+			if kind in ["jacobians","convergence","shear"]:
+				logray.debug("Shear matrix products computed in {0:.3f}s".format(time_shear))
+			logray.debug("Addition of deflections completed in {0:.3f}s".format(time_addition))
+			logstderr.debug("Deflections added on {0} chunks: peak memory usage {1:.3f} (task)".format(len(chunks),peakMemory()))
+			recordEvent("gradient",time_deflections,lens=k,redshift=current_lens.redshift)
+			recordEvent("update",time_shear+time_addition,lens=k,redshift=current_lens.redshift)
+
+			#Save the intermediate positions if option was specified
+			if kind=="positions" and save_intermediate:
+				all_positions[k] = unsorted(position_values)
+
+			#Optionally, call the callback function on the current positions
+			if callback is not None:
+				
+				last_timestamp = time.time()
+				if kind=="positions":
+					callback((unsorted(position_values)*rad).to(initial_positions.unit).reshape(initial_positions.shape),self,k,**kwargs)
+				elif kind=="jacobians":
+					callback(unsorted(current_jacobian).reshape((4,)+ray_shape),self,k,**kwargs)
+
+				recordEvent("callback",time.time()-last_timestamp,lens=k,redshift=current_lens.redshift)
+
+			#Hand the outputs of the source redshifts that were just reached to the output callback, then release them
+			if (outputs is not None) and (output_callback is not None) and len(emitted):
+
+				last_timestamp = time.time()
+				for n in emitted:
+					output_callback(self._outputMaps(dict([ (name,output_values[name][n]) for name in outputs ]),ray_shape,initial_positions.unit),self,n,**kwargs)
+					for name in outputs:
+						output_values[name][n] = None
+
+				recordEvent("callback",time.time()-last_timestamp,lens=k,redshift=current_lens.redshift)
+
+			#Log timestamp to cross lens
+			now = time.time()
+			logray.debug("Lens {0} at z={1:.3f} crossed in {2:.3f}s".format(k,current_lens.redshift,now-start))
+			logray.debug("Lens {0} at z={1:.3f}: I/O wait {2:.3f}s, compute {3:.3f}s".format(k,current_lens.redshift,io_time,now-start))
+			logstderr.debug("Lens {0} crossed: peak memory usage {1:.3f} (task)".format(k,peakMemory()))
+
+			io_total += io_time
+			compute_total += now-start
+
+			#Save the state of the rays every now and then
+			if (checkpoint is not None) and (k<last_lens) and (now-last_checkpoint>=checkpoint_interval):
+				self._saveCheckpoint(checkpoint,ray_state,k+1)
+				last_checkpoint = time.time()
+				recordEvent("save",last_checkpoint-now,lens=k,redshift=current_lens.redshift)
+
+		#Log the time budget
+		logray.info("Crossed {0} lenses: I/O wait {1:.3f}s, compute {2:.3f}s (prefetch depth {3})".format(last_lens+1-first_lens,io_total,compute_total,prefetch))
+		logray.info("Traced {0} rays in {1} chunks: peak memory usage {2:.3f} (task)".format(num_rays,len(chunks),peakMemory()))
+
+		#The run is complete, the checkpoint is not needed anymore
+		if (checkpoint is not None) and os.path.exists(checkpoint):
+			os.remove(checkpoint)
+
+		#Multiple outputs: attach the units and restore the shapes (unless they were handed to the callback)
+		if outputs is not None:
+
+			if output_callback is not None:
+				return None
+
+			output_values = self._outputMaps(output_values,ray_shape,initial_positions.unit)
+			if scalar_redshift:
+				for name in output_values:
+					output_values[name] = output_values[name][0]
+
+			return output_values
+
+		#Return the final positions of the light rays (or jacobians)
+		if kind=="positions":
+			
+			if save_intermediate:
+				return (all_positions*rad).to(initial_positions.unit).reshape((last_lens+1,)+initial_positions.shape)
+			else:
+				return (unsorted(position_values)*rad).to(initial_positions.unit).reshape(initial_positions.shape)
+
+		else:
+
+			current_jacobian = unsorted(current_jacobian)
+
+			#Different return types according to option (can compute convergence and shear directly, without full size temporaries)
+
+			if kind=="convergence":
+				convergence = np.add(current_jacobian[0],current_jacobian[3])
+				convergence *= -0.5
+				convergence += 1.0
+				return convergence.reshape(ray_shape)
+			
+			elif kind=="shear":
+				shear = np.empty((2,num_rays),dtype=current_jacobian.dtype)
+				np.subtract(current_jacobian[3],current_jacobian[0],out=shear[0])
+				np.add(current_jacobian[1],current_jacobian[2],out=shear[1])
+				shear[0] *= 0.5
+				shear[1] *= -0.5
+				return shear.reshape((2,)+ray_shape)
+
+			else:
+				return current_jacobian.reshape((4,)+ray_shape)
+
+	def shootDistributed(self,initial_positions,z=2.0,kind="positions",pool=None):
+
+		"""
+		Shoots a bucket of light rays from the observer to the sources at redshift z (backward ray tracing) like shoot does, with the lens planes split among the tasks of an MPI pool: each task reads only a stripe of pixel rows of every lens (plus a halo of rows for the finite difference and interpolation stencils) and, before each lens is crossed, the rays are sent to the task that owns the rows they fall in. This allows to trace through planes that do not fit in the memory of a single task: the plane files are memory mapped, so that no task reads them whole (raw planes, or FITS planes with unscaled floating point pixel values; the other formats raise ValueError). All the tasks must call this method with the same rays, and the random number generator must be in the same state on all of them, so that the planes are rolled consistently
+
+		:param initial_positions: initial angular positions of the light ray bucket, according to the observer; initial_positions[0] is x, initial_positions[1] is y
+		:type initial_positions: quantity
+
+		:param z: redshift of the sources
+		:type z: float.
+
+		:param kind: what deflection statistics to compute ("positions","jacobians","shear" or "convergence", see shoot)
+		:type kind: str.
+
+		:param pool: MPI pool among which the lens planes are split; if None the whole planes are traced in this task
+		:type pool: :py:class:`MPIWhirlPool`
+
+		:returns: angular positions (or jacobians) of the light rays after the last lens crossing, on the master task (None on the other tasks)
+
+		"""
+
+		#Sanity check
+		assert self.lens_type in [PotentialPlane,LensPackPlane], "Lens type must be PotentialPlane or LensPackPlane"
+		assert initial_positions.ndim>=2 and initial_positions.shape[0]==2,"initial positions shape must be (2,...)!"
+		assert type(initial_positions)==quantity.Quantity and initial_positions.unit.physical_type=="angle"
+		assert kind in ["positions","jacobians","shear","convergence"],"kind must be one in [positions,jacobians,shear,convergence]!"
+		assert z<self.redshift[-1],"Given the current lenses you can trace up to redshift {0:.2f}!".format(self.redshift[-1])
+
+		if pool is None:
+			rank,num_tasks = 0,1
+		else:
+			rank,num_tasks = pool.rank,pool.size+1
+
+		ray_shape = initial_positions.shape[1:]
+		num_rays = reduce(mul,ray_shape)
+		last_lens = (z>np.array(self.redshift)).argmin() - 1
+		with_jacobians = kind in ["jacobians","shear","convergence"]
+
+		#The state of the rays travels with them between the tasks: rows are the ray index, the positions and the deflections (and the jacobians and their deflections)
+		first,last = rank*num_rays//num_tasks,(rank+1)*num_rays//num_tasks
+		rays = np.zeros((13 if with_jacobians else 5,last-first))
+		rays[0] = np.arange(first,last)
+		rays[1:3] = initial_positions.to(rad).value.reshape((2,num_rays))[:,first:last]
+		if with_jacobians:
+			rays[5] = 1.0
+			rays[8] = 1.0
+
+		#Ordered references to the lenses
+		distance = np.array([ d.to(Mpc).value for d in [0.0*Mpc] + self.distance ])
+		redshift = np.array([0.0] + self.redshift)
+
+		for k,lens in enumerate(self.lens[:last_lens+1]):
+
+			start = time.time()
+
+			#Map the lens in memory (bypassing the cache, which would keep the whole planes) and read only the rows of this task, converting them to the tracer precision
+			if type(lens)==str:
+				logray.info("Mapping plane from {0}...".format(lens))
+				current_lens = self.lens_type.load(lens,dtype=None)
+				load_time = time.time()-start
+				current_lens = self.rollLens(lens,current_lens,index=k)
+			else:
+				current_lens = self.loadLens(lens,index=k)
+
+			np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
+
+			cut_start = time.time()
+			bounds = np.arange(num_tasks+1)*current_lens.data.shape[-1]//num_tasks
+			stripe = PlaneStripe(current_lens,bounds[rank],bounds[rank+1],interpolation=self.interpolation,with_shear=with_jacobians,dtype=self.dtype)
+
+			#The mapped planes are read from disk only in the stripe rows, when the stripe is cut
+			if type(lens)==str:
+				recordEvent("load",load_time+time.time()-cut_start,lens=k,file=lens,redshift=stripe.redshift,nbytes=stripe.nbytes)
+
+			del current_lens
+
+			now = time.time()
+			logray.debug("Stripe of rows {0}-{1} (halo {2}) of lens {3} read in {4:.3f}s ({5:.1f} Mbyte)".format(stripe.first_row,stripe.last_row,stripe.halo,k,now-start,stripe.nbytes/1024.**2))
+			logstderr.debug("Lens {0} stripe read: peak memory usage {1:.3f} (task)".format(k,peakMemory()))
+
+			#Send the rays to the tasks that own their rows
+			if num_tasks>1:
+				owner = np.searchsorted(bounds,stripe.rows(rays[1],rays[2]),side="right") - 1
+				rays = self._migrateRays(pool.comm,rays,owner,num_tasks)
+				logray.debug("Rays migrated in {0:.3f}s, {1} rays in this task".format(time.time()-now,rays.shape[1]))
+				recordEvent("migrate",time.time()-now,lens=k,redshift=stripe.redshift)
+
+			#Compute geometrical weight factors
+			Ak = (distance[k+1] / distance[k+2]) * (1.0 + (distance[k+2] - distance[k+1])/(distance[k+1] - distance[k]))
+			Ck = -1.0 * (distance[k+2] - distance[k+1]) / distance[k+2]
+			weight_scale = 1.0 if k<last_lens else (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+
+			#Same updates as in shoot, with the lens quantities gathered from the stripe
+			now = time.time()
+			if rays.shape[1]:
+				
+				deflections = rays[3:5]
+				_raytracing.deflectionUpdate(stripe.deflections(rays[1],rays[2]),None,None,stripe.deflection_scale,deflections,Ak,Ck)
+				
+				if with_jacobians:
+					jacobians = rays[5:9]
+					_raytracing.jacobianUpdate(stripe.shearMatrices(rays[1],rays[2]),None,None,stripe.shear_scale,jacobians,rays[9:13],Ak,Ck,None,weight_scale)
+
+				rays[1:3] += deflections * weight_scale
+
+			recordEvent("update",time.time()-now,lens=k,redshift=stripe.redshift)
+			logray.debug("Lens {0} at z={1:.3f} crossed in {2:.3f}s".format(k,stripe.redshift,time.time()-start))
+			logstderr.debug("Lens {0} crossed: peak memory usage {1:.3f} (task)".format(k,peakMemory()))
+
+		#Collect the rays on the master task, in their original order
+		if num_tasks>1:
+			rays = self._gatherRays(pool.comm,rays,num_tasks)
+			if not(pool.is_master()):
+				return None
+
+		rays = rays[:,np.argsort(rays[0],kind="mergesort")]
+		logray.info("Traced {0} rays through {1} lens stripes on {2} tasks: peak memory usage {3:.3f} (task)".format(num_rays,last_lens+1,num_tasks,peakMemory()))
+
+		if kind=="positions":
+			return (rays[1:3]*rad).to(initial_positions.unit).reshape(initial_positions.shape)
+		elif kind=="convergence":
+			return (1.0 - 0.5*(rays[5]+rays[8])).reshape(ray_shape)
+		elif kind=="shear":
+			return np.array([0.5*(rays[8]-rays[5]),-0.5*(rays[6]+rays[7])]).reshape((2,)+ray_shape)
+		else:
+			return rays[5:9].reshape((4,)+ray_shape)
+
+
+	#Send each ray (a column of the ray state) to the task that owns it: the rays are grouped by destination in a contiguous buffer, the counts are exchanged first and the rays are exchanged with a single Alltoallv (no pickling, so the buffers are not limited in size)
+	@staticmethod
+	def _migrateRays(comm,rays,owner,num_tasks):
+
+		num_rows = rays.shape[0]
+		send = np.ascontiguousarray(rays[:,np.argsort(owner,kind="mergesort")].T)
+		send_counts = np.bincount(owner,minlength=num_tasks).astype(np.int32)
+		recv_counts = np.zeros(num_tasks,dtype=np.int32)
+		comm.Alltoall(send_counts,recv_counts)
+
+		recv = np.empty((recv_counts.sum(),num_rows),dtype=rays.dtype)
+		send_counts *= num_rows
+		recv_counts *= num_rows
+		comm.Alltoallv([send,(send_counts,np.cumsum(send_counts)-send_counts)],[recv,(recv_counts,np.cumsum(recv_counts)-recv_counts)])
+
+		return np.ascontiguousarray(recv.T)
+
+	#Collect the rays of all the tasks on the master task (None on the other tasks), with a single Gatherv after the counts are gathered
+	@staticmethod
+	def _gatherRays(comm,rays,num_tasks):
+
+		num_rows = rays.shape[0]
+		counts = np.zeros(num_tasks,dtype=np.int32)
+		comm.Gather(np.array([rays.shape[1]],dtype=np.int32),counts,root=0)
+
+		if comm.Get_rank()==0:
+			recv = np.empty((counts.sum(),num_rows),dtype=rays.dtype)
+			counts *= num_rows
+			comm.Gatherv(np.ascontiguousarray(rays.T),[recv,(counts,np.cumsum(counts)-counts)],root=0)
+			return recv.T
+		else:
+			comm.Gatherv(np.ascontiguousarray(rays.T),None,root=0)
+			return None
+
+
+	##################################################################################################################################
+	#####################Backward ray tracing of many realizations of the lens system at once#########################################
+	##################################################################################################################################
+
+	def lensTable(self,num_realizations,candidates=None,seed=None):
+
+		"""
+		Draws the random realizations of the lens system that :py:meth:`shootMany` traces through: for each realization and each lens, a plane file is picked among the candidates and a random periodic shift is drawn
+
+		:param num_realizations: number of realizations of the lens system
+		:type num_realizations: int.
+
+		:param candidates: for each lens (in crossing order), list of the planes that can be drawn; if None, only the lenses added to the tracer are used, and the realizations differ only by the random shifts
+		:type candidates: list.
+
+		:param seed: random seed with which to initialize the generator
+		:type seed: int.
+
+		:returns: list with one row per realization; each row contains one (lens,roll_offset) tuple per lens
+
+		"""
+
+		if seed is not None:
+			np.random.seed(seed)
+
+		if candidates is None:
+			candidates = [ [lens] for lens in self.lens ]
+
+		assert len(candidates)==self.Nlenses,"You need to specify the plane candidates for each of the {0} lenses!".format(self.Nlenses)
+
+		#Number of pixels on a side of each candidate plane: the headers are read once per file
+		npixel = dict()
+		for lens_candidates in candidates:
+			for lens in lens_candidates:
+				if type(lens)==str:
+					if lens not in npixel:
+						npixel[lens] = Plane.readHeader(lens)["NAXIS1"]
+				else:
+					npixel[id(lens)] = lens.data.shape[-1]
+
+		#Draw the realizations
+		table = list()
+		for r in range(num_realizations):
+			
+			row = list()
+			for k in range(self.Nlenses):
+				lens = candidates[k][np.random.randint(0,len(candidates[k]))]
+				n = npixel[lens if type(lens)==str else id(lens)]
+				row.append((lens,(np.random.randint(0,n),np.random.randint(0,n))))
+
+			table.append(row)
+
+		return table
+
+
+	def shootMany(self,initial_positions,lens_table,z=2.0,kind="positions",chunk_size=None,max_memory=None,n_threads=1):
+
+		"""
+		Shots the same bucket of light rays through many realizations of the lens system at once (backward ray tracing). The realizations are crossed lens by lens: at each step, each distinct lens plane is read once and applied to all the realizations that use it, so the I/O cost is proportional to the number of distinct planes rather than to the number of realizations
+
+		:param initial_positions: initial angular positions of the light ray bucket, according to the observer; if unitless, the positions are assumed to be in radians. initial_positions[0] is x, initial_positions[1] is y
+		:type initial_positions: numpy array or quantity
+
+		:param lens_table: realizations of the lens system, one row per realization; each row contains one (lens,roll_offset) tuple for each lens in the tracer (in crossing order), where lens is a file name or a plane instance and roll_offset the periodic (row,column) shift of its pixels (None for no shift). The lens redshifts and distances are the ones of the tracer. See :py:meth:`lensTable`
+		:type lens_table: list.
+
+		:param z: redshift of the sources; if an array is passed, a redshift must be specified for each ray, i.e. z.shape==initial_positions.shape[1:]
+		:type z: float. or array
+
+		:param kind: what deflection statistics to compute; "positions" will calculate the ray deflections after they crossed the last lens, "jacobian" will compute the lensing jacobian matrix after the last lens, "shear" and "convergence" will compute the omonimous weak lensing statistics  
+		:type kind: str.
+
+		:param chunk_size: if not None, the rays are processed in chunks of this size against each lens, to bound the memory taken by the temporary arrays
+		:type chunk_size: int.
+
+		:param max_memory: if not None (and chunk_size is None), the chunk size is chosen so that the temporary arrays of the chunks take at most this memory (in Gbyte)
+		:type max_memory: float.
+
+		:param n_threads: number of threads that process the chunks of rays in parallel
+		:type n_threads: int.
+
+		:returns: angular positions (or jacobians) of the light rays after the last lens crossing, for each realization (the first axis of the returned array runs over the realizations)
+
+		"""
+
+		#Sanity check
+		assert self.lens_type in [PotentialPlane,LensPackPlane], "Lens type must be PotentialPlane or LensPackPlane"
+		assert initial_positions.ndim>=2 and initial_positions.shape[0]==2,"initial positions shape must be (2,...)!"
+		assert type(initial_positions)==quantity.Quantity and initial_positions.unit.physical_type=="angle"
+		assert kind in ["positions","jacobians","shear","convergence"],"kind must be one in [positions,jacobians,shear,convergence]!"
+		assert len(lens_table)>0,"The lens table must contain at least one realization!"
 
-			#Useful to compute the product of the jacobian (2x2 matrix) with the shear matrix (2x2 symmetric matrix)
-			dotter = np.zeros((4,3,4))
-			dotter[(0,0,1,1,2,2,3,3),(0,2,0,2,2,1,2,1),(0,2,1,3,0,2,1,3)] = 1
+		for row in lens_table:
+			assert len(row)==self.Nlenses,"Each realization in the lens table must specify all the {0} lenses!".format(self.Nlenses)
+
+		#Allocate arrays for the light ray positions and deflections of all the realizations, of shape (R,2,Nrays)
+		num_realizations = len(lens_table)
+		ray_shape = initial_positions.shape[1:]
+		num_rays = reduce(mul,ray_shape)
+
+		#The lens loop works on bare arrays: positions and deflections are in radians (in the same precisions as in shoot)
+		position_values = np.repeat(initial_positions.to(rad).value.reshape((1,2,num_rays)).astype(self.accumulator_dtype),num_realizations,axis=0)
+		deflection_values = np.zeros((num_realizations,2,num_rays),dtype=self.dtype)
+
+		#If we want to trace jacobians, allocate also space for the jacobians
+		if kind in ["jacobians","shear","convergence"]:
+
+			#Initial condition for the jacobian is the identity
+			current_jacobian = np.zeros((num_realizations,4,num_rays),dtype=self.accumulator_dtype)
+			current_jacobian[:,0] = 1.0
+			current_jacobian[:,3] = 1.0
+			current_jacobian_deflection = np.zeros((num_realizations,4,num_rays),dtype=self.dtype)
 
 		#Decide which is the last lens the light rays should cross
 		if type(z)==np.ndarray:
 			
-			#Check that shapes correspond
 			assert z.shape==initial_positions.shape[1:]
-
-			#Check that redshift is not too high given the current lenses
 			assert z.max()<self.redshift[-1],"Given the current lenses you can trace up to redshift {0:.2f}!".format(self.redshift[-1])
 
-			#Compute the number of lenses that each ray should cross
 			last_lens_ray = (z[None] > np.array(self.redshift).reshape((len(self.redshift),)+(1,)*len(z.shape))).argmin(0) - 1
 			last_lens = last_lens_ray.max()
+
+			z = z.reshape(num_rays)
+			last_lens_ray = last_lens_ray.reshape(num_rays)
 		
 		else:
 			
-			#Check that redshift is not too high given the current lenses
 			assert z<self.redshift[-1],"Given the current lenses you can trace up to redshift {0:.2f}!".format(self.redshift[-1])
 			last_lens = (z>np.array(self.redshift)).argmin() - 1
-		
-		if kind=="positions" and save_intermediate:
-			all_positions = np.zeros((last_lens+1,) + initial_positions.shape) * initial_positions.unit
 
-		#The light rays positions at the k+1 th step are computed according to Xk+1 = Xk + Dk, where Dk is the deflection
-		#To stabilize the solution numerically we compute the deflections as Dk+1 = (Ak-1)Dk + Ck*pk where pk is the deflection due to the potential gradient
+		#Split the ray bundle in chunks, which are processed against each lens (possibly in parallel); each ray of a chunk allocates the same temporaries as in shoot
+		chunks = self._rayChunks(num_rays,chunk_size=chunk_size,max_memory=max_memory,n_threads=n_threads,bytes_per_ray=self._chunkBytesPerRay(2 + 3*(type(z)==np.ndarray)))
+
+		#Interpolation order of the lens quantities at the ray positions
+		order = _interpolation_order[self.interpolation]
 
 		#Ordered references to the lenses
 		distance = np.array([ d.to(Mpc).value for d in [0.0*Mpc] + self.distance ])
 		redshift = np.array([0.0] + self.redshift)
-		lens = self.lens
+		io_total = 0.0
+		compute_total = 0.0
+		planes_read = 0
 
-		#This is the main loop that goes through all the lenses
+		#This is the main loop that goes through all the lenses; each realization is crossed with its own draw of the lens
 		for k in range(last_lens+1):
 
-			#Load in the lens
-			current_lens = self.loadLens(lens[k])
-			np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
-
-			#If transfer function is provided, scale to target redshift
-			if transfer is not None:
-				current_lens.scaleWithTransfer(transfer.cur2target[current_lens.redshift],tfr=transfer.tfr,with_scale_factor=transfer.with_scale_factor,kmesh=transfer.kmesh,scaling_method=transfer.scaling_method)
-
-			#Log
-			logray.debug("Crossing lens {0} at redshift z={1:.3f}".format(k,current_lens.redshift))
-			start = time.time()
-			last_timestamp = start
-
-			#Compute the deflection angles and log timestamp
-			if compute_all_deflections:
-				deflections = current_lens.deflectionAngles(lmesh=self.lmesh).getValues(current_positions[0],current_positions[1])
-			else:
-				deflections = current_lens.deflectionAngles(current_positions[0],current_positions[1])
-
-			now = time.time()
-			logray.debug("Retrieval of deflection angles from potential planes completed in {0:.3f}s".format(now-last_timestamp))
-			logstderr.debug("Retrieval of deflection angles: peak memory usage {0:.3f} (task)".format(peakMemory()))
-			last_timestamp = now
-
-			#If we are tracing jacobians we need to retrieve the shear matrices too
-			if kind in ["jacobians","convergence","shear"]:
-
-				if compute_all_deflections:
-					shear_tensors = current_lens.shearMatrix(lmesh=self.lmesh).getValues(current_positions[0],current_positions[1])
-				else:
-					shear_tensors = current_lens.shearMatrix(current_positions[0],current_positions[1])
+			#Group the realizations that use the same plane at this step
+			groups = OrderedDict()
+			for r,row in enumerate(lens_table):
+				groups.setdefault(row[k][0] if type(row[k][0])==str else id(row[k][0]),list()).append(r)
 
-				now = time.time()
-				logray.debug("Shear matrices retrieved in {0:.3f}s".format(now-last_timestamp))
-				logstderr.debug("Shear matrices retrieved: peak memory usage {0:.3f} (task)".format(peakMemory()))
-				last_timestamp = now
-			
-			#####################################################################################
+			logray.debug("Crossing lens {0} at redshift z={1:.3f}: {2} distinct planes for {3} realizations".format(k,self.redshift[k],len(groups),num_realizations))
 
 			#Compute geometrical weight factors
 			Ak = (distance[k+1] / distance[k+2]) * (1.0 + (distance[k+2] - distance[k+1])/(distance[k+1] - distance[k]))
 			Ck = -1.0 * (distance[k+2] - distance[k+1]) / distance[k+2]
 
-			#Compute the position on the next lens and log timestamp
-			current_deflection *= (Ak-1) 
-			now = time.time()
-			logray.debug("Geometrical weight factors calculations and deflection scaling completed in {0:.3f}s".format(now-last_timestamp))
-			last_timestamp = now
+			for realizations in groups.values():
 
-			#Add deflections and log timestamp
-			current_deflection += Ck * deflections 
-			now = time.time()
-			logray.debug("Deflection angles computed in {0:.3f}s".format(now-last_timestamp))
-			last_timestamp = now
+				#Each distinct plane is read once per step
+				start = time.time()
+				plane = self.readLens(lens_table[realizations[0]][k][0],index=k)
+				io_time = time.time()-start
+				start = time.time()
+				planes_read += 1
 
-			#If we are tracing jacobians we need to compute the matrix product with the shear matrix
-			if kind in ["jacobians","convergence","shear"]:
+				np.testing.assert_approx_equal(plane.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,plane.redshift,self.redshift[k]))
 
-				current_jacobian_deflection *= (Ak-1)
+				for r in realizations:
 
-				#This is the part in which the products with the shear matrix are computed
-				current_jacobian_deflection += Ck * (np.tensordot(dotter,current_jacobian,axes=([2],[0])) * shear_tensors).sum(1)
-				
-				now = time.time()
-				logray.debug("Shear matrix products computed in {0:.3f}s".format(now-last_timestamp))
-				logstderr.debug("Shear matrix products completed: peak memory usage {0:.3f} (task)".format(peakMemory()))
-				last_timestamp = now
+					#The realizations share the plane data, only the shift is different
+					current_lens = copy.copy(plane)
+					if lens_table[r][k][1] is not None:
+						current_lens.roll_offset = tuple(lens_table[r][k][1])
 
-			###########################################################################################
+					#Unit conversions are done once per lens
+					pixel_angle = current_lens._pixelAngle()
+					deflection_field,deflection_scale = current_lens._deflectionField()
+					if kind in ["jacobians","convergence","shear"]:
+						shear_field,shear_scale = current_lens._shearField()
 
-			if type(z)==np.ndarray:
-				
-				current_positions[:,k<last_lens_ray] += current_deflection[:,k<last_lens_ray]
-				current_positions[:,k==last_lens_ray] += current_deflection[:,k==last_lens_ray] * (z[None,k==last_lens_ray] - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+					#Process a chunk of rays: this writes only to the rays in the chunk
+					def crossChunk(rays):
 
-				#We need to add the distortions to the jacobians too
-				if kind in ["jacobians","convergence","shear"]:
-					current_jacobian[:,k<last_lens_ray] += current_jacobian_deflection[:,k<last_lens_ray]
-					current_jacobian[:,k==last_lens_ray] += current_jacobian_deflection[:,k==last_lens_ray] * (z[None,k==last_lens_ray] - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+						#Compute the deflection angles and the deflection on the next lens
+						i,j = current_lens._rayPixels(position_values[r,0,rays],position_values[r,1,rays],pixel_angle,order)
+						_raytracing.deflectionUpdate(deflection_field,j,i,deflection_scale,deflection_values[r,:,rays],Ak,Ck,order)
 
-			else:
-				
-				if k<last_lens:
-					current_positions += current_deflection
-				else:
-					current_positions += current_deflection * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+						#Weight of the deflections: rays that reach their source before the next lens only get a fraction of them
+						if type(z)==np.ndarray:
+							weight = (k<last_lens_ray[rays]) + (k==last_lens_ray[rays])*(z[rays] - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+							weight_scale = 1.0
+						else:
+							weight = None
+							weight_scale = 1.0 if k<last_lens else (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
 
-				#We need to add the distortions to the jacobians too
-				if kind in ["jacobians","convergence","shear"]:
+						#Update the jacobians
+						if kind in ["jacobians","convergence","shear"]:
+							_raytracing.jacobianUpdate(shear_field,j,i,shear_scale,current_jacobian[r,:,rays],current_jacobian_deflection[r,:,rays],Ak,Ck,weight,weight_scale,order)
 
-					if k<last_lens:
-						current_jacobian += current_jacobian_deflection
-					else:
-						current_jacobian += current_jacobian_deflection * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+						#Add the deflections to the positions
+						if weight is not None:
+							position_values[r,:,rays] += deflection_values[r,:,rays] * weight
+						elif k<last_lens:
+							position_values[r,:,rays] += deflection_values[r,:,rays]
+						else:
+							position_values[r,:,rays] += deflection_values[r,:,rays] * weight_scale
 
-			now = time.time()
-			logray.debug("Addition of deflections completed in {0:.3f}s".format(now-last_timestamp))
-			logstderr.debug("Addition of deflections completed: peak memory usage {0:.3f} (task)".format(peakMemory()))
-			last_timestamp = now
+					self._mapChunks(crossChunk,chunks,n_threads=n_threads)
 
-			#Save the intermediate positions if option was specified
-			if kind=="positions" and save_intermediate:
-				all_positions[k] = current_positions.copy()
+				#Log timestamp to cross the plane
+				now = time.time()
+				logray.debug("Lens {0} at z={1:.3f} crossed by {2} realizations: I/O wait {3:.3f}s, compute {4:.3f}s".format(k,self.redshift[k],len(realizations),io_time,now-start))
 
-			#Optionally, call the callback function on the current positions
-			if callback is not None:
-				if kind=="positions":
-					callback(current_positions,self,k,**kwargs)
-				elif kind=="jacobians":
-					callback(current_jacobian,self,k,**kwargs)
+				io_total += io_time
+				compute_total += now-start
 
-			#Log timestamp to cross lens
-			now = time.time()
-			logray.debug("Lens {0} at z={1:.3f} crossed in {2:.3f}s".format(k,current_lens.redshift,now-start))
 			logstderr.debug("Lens {0} crossed: peak memory usage {1:.3f} (task)".format(k,peakMemory()))
 
+		#Log the time budget
+		logray.info("Crossed {0} lenses in {1} realizations reading {2} planes: I/O wait {3:.3f}s, compute {4:.3f}s".format(last_lens+1,num_realizations,planes_read,io_total,compute_total))
+		logray.info("Traced {0}x{1} rays in {2} chunks: peak memory usage {3:.3f} (task)".format(num_realizations,num_rays,len(chunks),peakMemory()))
 
-		#Return the final positions of the light rays (or jacobians)
+		#Return the final positions of the light rays (or jacobians) for each realization
 		if kind=="positions":
-			
-			if save_intermediate:
-				return all_positions
-			else:
-				return current_positions
-
-		else:
-
-			#Different return types according to option (can compute convergence and shear directly)
+			return (position_values*rad).to(initial_positions.unit).reshape((num_realizations,)+initial_positions.shape)
 
-			if kind=="convergence":
-				return 1.0 - 0.5*(current_jacobian[0]+current_jacobian[3]) 
-			
-			elif kind=="shear":
-				return np.array([0.5*(current_jacobian[3] - current_jacobian[0]),-0.5*(current_jacobian[1]+current_jacobian[2])])
+		elif kind=="convergence":
+			convergence = np.add(current_jacobian[:,0],current_jacobian[:,3])
+			convergence *= -0.5
+			convergence += 1.0
+			return convergence.reshape((num_realizations,)+ray_shape)
+		
+		elif kind=="shear":
+			shear = np.empty((num_realizations,2,num_rays),dtype=current_jacobian.dtype)
+			np.subtract(current_jacobian[:,3],current_jacobian[:,0],out=shear[:,0])
+			np.add(current_jacobian[:,1],current_jacobian[:,2],out=shear[:,1])
+			shear[:,0] *= 0.5
+			shear[:,1] *= -0.5
+			return shear.reshape((num_realizations,2)+ray_shape)
 
-			else:
-				return current_jacobian
+		else:
+			return current_jacobian.reshape((num_realizations,4)+ray_shape)
 
 	##################################################################################
 	###########Direct calculation of the convergence with Born approximation##########
 	##################################################################################
 
-	def convergenceBorn(self,initial_positions,z=2.0,save_intermediate=False,real_trajectory=False):
+	def convergenceBorn(self,initial_positions,z=2.0,save_intermediate=False,real_trajectory=False,chunk_size=None,max_memory=None,n_threads=1):
 
 		"""
 		Computes the convergence directly integrating the lensing density along the line of sight (real or unperturbed)
@@ -1346,6 +3027,15 @@ class RayTracer(object):
 		:param real_trajectory: if True, integrate the density on the real light ray trajectory; if False the unperturbed trajectory is used
 		:type real_trajectory: bool.
 
+		:param chunk_size: if not None, the rays are processed in chunks of this size against each lens, to bound the memory taken by the temporary arrays
+		:type chunk_size: int.
+
+		:param max_memory: if not None (and chunk_size is None), the chunk size is chosen so that the temporary arrays of the chunks take at most this memory (in Gbyte)
+		:type max_memory: float.
+
+		:param n_threads: number of threads that process the chunks of rays in parallel
+		:type n_threads: int.
+
 		:returns: convergence values at each of the initial positions
 
 		"""
@@ -1358,8 +3048,24 @@ class RayTracer(object):
 		assert z<self.redshift[-1],"Given the current lenses you can trace up to redshift {0:.2f}!".format(self.redshift[-1])
 		last_lens = (z>np.array(self.redshift)).argmin() - 1
 
+		#The rays are stored flat and split in chunks, which are processed against each lens (possibly in parallel)
+		ray_shape = initial_positions.shape[1:]
+		num_rays = reduce(mul,ray_shape)
+
+		#Each ray of a chunk allocates the lens pixels where the density is gathered, the 3 components of the hessian of the potential, the density and its product with the lensing kernel (5 values), and the stencils on which the hessian is gathered when interpolating
+		#Along the real trajectories also the lens pixels of the deflections
+		if real_trajectory:
+			bytes_per_ray = self._chunkBytesPerRay(5,indices=4,gathered=3)
+		else:
+			bytes_per_ray = self._chunkBytesPerRay(5,gathered=3)
+
+		chunks = self._rayChunks(num_rays,chunk_size=chunk_size,max_memory=max_memory,n_threads=n_threads,bytes_per_ray=bytes_per_ray)
+
+		#Interpolation order of the lens quantities at the ray positions
+		order = _interpolation_order[self.interpolation]
+
 		if save_intermediate:
-			all_convergence = np.zeros((last_lens+1,) + initial_positions.shape[1:])
+			all_convergence = np.zeros((last_lens+1,num_rays))
 
 		#Ordered references to the lenses
 		distance = np.array([ d.to(Mpc).value for d in [0.0*Mpc] + self.distance ])
@@ -1367,24 +3073,39 @@ class RayTracer(object):
 		lens = self.lens
 
 		#Initial positions
-		current_positions = initial_positions.copy()
+		current_positions = initial_positions.reshape((2,num_rays)).copy()
+
+		#When the rays sit on a grid, the lens pixels they hit are determined by the grid rows and columns: the density is gathered on the whole grid at once, in blocks of rows
+		grid = None
+		if not(real_trajectory) and self.interpolation=="nearest":
+			grid = self._rayGrid(initial_positions)
+
+		if grid is not None:
+			rows_per_chunk = max(chunks[0].stop//ray_shape[1],1)
+			row_chunks = [ slice(first,min(first+rows_per_chunk,ray_shape[0])) for first in range(0,ray_shape[0],rows_per_chunk) ]
+			logray.debug("Rays on a {0}x{1} grid: density gathered in {2} blocks of (at most) {3} rows".format(ray_shape[0],ray_shape[1],len(row_chunks),rows_per_chunk))
 
 		if real_trajectory:
-			current_deflection = np.zeros(initial_positions.shape) * initial_positions.unit
+			current_deflection = np.zeros((2,num_rays)) * initial_positions.unit
+			position_values = current_positions.value
+			deflection_values = current_deflection.value
+			rad_to_unit = rad.to(initial_positions.unit)
+			unit_to_rad = initial_positions.unit.to(rad)
 
 		#Timestamp
 		now = time.time()
 		last_timestamp = now
 
 		#Loop that goes through the lenses
-		current_convergence = np.zeros(initial_positions.shape[1:])
+		current_convergence = np.zeros(num_rays)
+		source_distance = None
 		for k in range(last_lens+1):
 
 			#Start time for this lens
 			start = time.time()
 
 			#Load in the lens
-			current_lens = self.loadLens(lens[k])
+			current_lens = self.loadLens(lens[k],index=k)
 			np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
 
 			#Extract the density at the ray positions
@@ -1392,70 +3113,92 @@ class RayTracer(object):
 			logray.debug("Extracting density values from lens {0} at redshift {1:2f}".format(k,current_lens.redshift))
 			last_timestamp = now
 
-			#Compute full density plane
-			if self.lens_type==PotentialPlane:
-				density = current_lens.density(current_positions[0],current_positions[1])
-			elif self.lens_type==DensityPlane:
-				density = current_lens.getValues(current_positions[0],current_positions[1])
-			else:
-				raise TypeError("Lens format not recognized!")
+			#Lensing kernel and geometric factors (the distance to the sources is computed only once)
+			if source_distance is None:
+				source_distance = current_lens.cosmology.comoving_distance(z).to(Mpc).value
+			
+			kernel = 1. - (distance[k+1]/source_distance)
+			Ak = (distance[k+1] / distance[k+2]) * (1.0 + (distance[k+2] - distance[k+1])/(distance[k+1] - distance[k]))
+			Ck = -1.0 * (distance[k+2] - distance[k+1]) / distance[k+2]
 
-			#Timestamp
-			now = time.time()
-			logray.debug("Density values extracted in {0:.3f}s".format(now-last_timestamp))
-			last_timestamp = now
+			#Unit conversions for the deflections are done once per lens
+			if real_trajectory:
+				pixel_angle = current_lens._pixelAngle()
+				deflection_field,deflection_scale = current_lens._deflectionField()
 
-			#Cumulate on the convergence
-			if k<last_lens:
-				current_convergence += density * (1. - (distance[k+1]/current_lens.cosmology.comoving_distance(z).to(Mpc).value))
-			else:
-				current_convergence += density * (1. - (distance[k+1]/current_lens.cosmology.comoving_distance(z).to(Mpc).value)) * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+			#Process a chunk of rays: this writes only to the rays in the chunk
+			def crossChunk(rays):
 
-			#Compute ray deflections
-			if real_trajectory:
+				#Compute full density plane
+				if self.lens_type in [PotentialPlane,LensPackPlane]:
+					density = current_lens.density(current_positions[0,rays],current_positions[1,rays],interpolation=self.interpolation)
+				elif self.lens_type==DensityPlane:
+					density = current_lens.getValues(current_positions[0,rays],current_positions[1,rays],interpolation=self.interpolation)
+				else:
+					raise TypeError("Lens format not recognized!")
 
-				#Compute deflections due to current lens
-				deflections = current_lens.deflectionAngles(current_positions[0],current_positions[1])
+				#Cumulate on the convergence
+				if k<last_lens:
+					current_convergence[rays] += density * kernel
+				else:
+					current_convergence[rays] += density * kernel * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
 
-				#Geometric factors
-				Ak = (distance[k+1] / distance[k+2]) * (1.0 + (distance[k+2] - distance[k+1])/(distance[k+1] - distance[k]))
-				Ck = -1.0 * (distance[k+2] - distance[k+1]) / distance[k+2]
+				#Compute ray deflections due to current lens, and add them to the current positions
+				if real_trajectory:
+					i,j = current_lens._rayPixels(position_values[0,rays]*unit_to_rad,position_values[1,rays]*unit_to_rad,pixel_angle,order)
+					_raytracing.deflectionUpdate(deflection_field,j,i,deflection_scale*rad_to_unit,deflection_values[:,rays],Ak,Ck,order)
+					position_values[:,rays] += deflection_values[:,rays]
 
-				#Compute the position on the next lens and log timestamp
-				current_deflection *= (Ak-1) 
-				now = time.time()
-				logray.debug("Geometrical weight factors calculations and deflection scaling completed in {0:.3f}s".format(now-last_timestamp))
-				last_timestamp = now
+			#Process a block of rows of the ray grid: the density is computed once on each distinct lens pixel, and accumulated in place
+			def crossRows(rows):
 
-				#Add deflections and log timestamp
-				current_deflection += Ck * deflections 
-				now = time.time()
-				logray.debug("Deflection angles computed in {0:.3f}s".format(now-last_timestamp))
-				last_timestamp = now
+				lens_rows,row_inverse = np.unique(grid_rows[rows],return_inverse=True)
+				density = current_lens._gridDensity(lens_rows,lens_columns)
+				
+				#Back to the ray grid (unless the distinct pixels are already in the same order as the rays)
+				if not _isIdentity(row_inverse):
+					density = density.take(row_inverse,axis=0)
+				if not _isIdentity(column_inverse):
+					density = density.take(column_inverse,axis=1)
+
+				density *= kernel if k<last_lens else kernel * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+				convergence_grid[rows] += density
+
+			if grid is not None:
+				grid_rows,grid_columns = current_lens._pixelIndices(grid[0],grid[1],pixel_angle=current_lens._pixelAngle())
+				lens_columns,column_inverse = np.unique(grid_columns,return_inverse=True)
+				convergence_grid = current_convergence.reshape(ray_shape)
+				self._mapChunks(crossRows,row_chunks,n_threads=n_threads)
+			else:
+				self._mapChunks(crossChunk,chunks,n_threads=n_threads)
 
-				#Add deflection to current positions
-				current_positions += current_deflection
+			#Timestamp
+			now = time.time()
+			logray.debug("Density values extracted{0} in {1:.3f}s".format(" and rays deflected" if real_trajectory else "",now-last_timestamp))
+			recordEvent("gradient",now-last_timestamp,lens=k,redshift=current_lens.redshift)
+			last_timestamp = now
 
 			now = time.time()
 			logray.debug("Lens {0} crossed in {1:.3f}s".format(k,now-start))
+			logstderr.debug("Lens {0} crossed: peak memory usage {1:.3f} (task)".format(k,peakMemory()))
 			last_timestamp = now
 
 			#Save the intermediate convergence values if option is enabled
 			if save_intermediate:
-				all_convergence[k] = current_convergence.copy()
+				all_convergence[k] = current_convergence
 
 
 		#Return to the user
 		if save_intermediate:
-			return all_convergence
+			return all_convergence.reshape((last_lens+1,)+ray_shape)
 		else:
-			return current_convergence
+			return current_convergence.reshape(ray_shape)
 
 	##################################################################################
 	###########Calculation of the convergence at second post-Born order###############
 	##################################################################################
 
-	def convergencePostBorn2(self,initial_positions,z=2.0,save_intermediate=False,include_first_order=False,include_ll=True,include_gp=True,transpose_up_to=-1,callback=None,**kwargs):
+	def convergencePostBorn2(self,initial_positions,z=2.0,save_intermediate=False,include_first_order=False,include_ll=True,include_gp=True,transpose_up_to=-1,callback=None,chunk_size=None,max_memory=None,n_threads=1,**kwargs):
 
 		"""
 		Computes the convergence at second post-born order with a double line of sight integral
@@ -1484,6 +3227,15 @@ class RayTracer(object):
 		:param callback: function is called on each contribution to the convergence during the LOS integration. The signature of the callback is callback(array_ov_values,tracer,k,type,**kwargs)
 		:type callback: callable.
 
+		:param chunk_size: if not None, the rays are processed in chunks of this size against each lens, to bound the memory taken by the temporary arrays
+		:type chunk_size: int.
+
+		:param max_memory: if not None (and chunk_size is None), the chunk size is chosen so that the temporary arrays of the chunks take at most this memory (in Gbyte)
+		:type max_memory: float.
+
+		:param n_threads: number of threads that process the chunks of rays in parallel
+		:type n_threads: int.
+
 		:param kwargs: additional keyword arguments to be passed to the callback
 		:type kwargs: dict.
 
@@ -1500,50 +3252,88 @@ class RayTracer(object):
 		assert z<self.redshift[-1],"Given the current lenses you can trace up to redshift {0:.2f}!".format(self.redshift[-1])
 		last_lens = (z>np.array(self.redshift)).argmin() - 1
 
+		#The rays are stored flat and split in chunks, which are processed against each lens (possibly in parallel)
+		ray_shape = initial_positions.shape[1:]
+		num_rays = reduce(mul,ray_shape)
+
+		#The lens quantities and the terms are gathered in buffers allocated once for the whole bundle: each ray of a chunk allocates only its (nearest) lens pixel indices and one intermediate term
+		chunks = self._rayChunks(num_rays,chunk_size=chunk_size,max_memory=max_memory,n_threads=n_threads,bytes_per_ray=self._chunkBytesPerRay(1,interpolation="nearest"))
+
 		if save_intermediate:
-			all_convergence = np.zeros((last_lens+1,) + initial_positions.shape[1:])
+			all_convergence = np.zeros((last_lens+1,num_rays))
 
 		#Ordered references to the lenses
 		distance = np.array([ d.to(Mpc).value for d in [0.0*Mpc] + self.distance ])
 		redshift = np.array([0.0] + self.redshift)
 		lens = self.lens
 
-		#Initial positions
-		current_positions = initial_positions
+		#The rays do not leave their initial positions (in radians): the unit conversions are done once
+		current_positions = initial_positions.reshape((2,num_rays)).to(rad).value
 
 		#Timestamp
 		now = time.time()
 		last_timestamp = now
 
-		#Loop that goes through the lenses
-		current_convergence = np.zeros(initial_positions.shape[1:])
-		
-		current_deflections_0 = np.zeros(initial_positions.shape)*rad
-		current_deflections_1 = np.zeros(initial_positions.shape)*rad
-		current_deflections = np.zeros(initial_positions.shape)*rad
+		#Integrated quantities (bare numbers, the deflections are in radians)
+		current_convergence = np.zeros(num_rays)
 		
-		current_jacobians_0 = np.zeros((3,)+initial_positions.shape[1:])
-		current_jacobians_1 = np.zeros((3,)+initial_positions.shape[1:])
-		current_jacobians = np.zeros((3,)+initial_positions.shape[1:])
+		current_deflections_0 = np.zeros((2,num_rays))
+		current_deflections_1 = np.zeros((2,num_rays))
+		current_deflections = np.zeros((2,num_rays))
 		
+		current_jacobians_0 = np.zeros((3,num_rays))
+		current_jacobians_1 = np.zeros((3,num_rays))
+		current_jacobians = np.zeros((3,num_rays))
+
+		#Buffers allocated once: the lens quantities gathered at the rays [deflection(2),shear(3),density gradient(2)] and the work space of the terms
+		lens_quantities = np.empty((7,num_rays))
+		term = np.empty(num_rays)
+		product = np.empty(num_rays)
+
+		#Time spent on each term of the expansion, summed over the lenses and the chunks
+		term_names = ["gather","lens-lens","geodesic","born","accumulate"]
+		total_timings = np.zeros(len(term_names))
+
+		#Loop that goes through the lenses
+		source_distance = None
 		for k in range(last_lens+1):
 
 			#Start time for this lens
 			start = time.time()
 
 			#Load in the lens
-			current_lens = self.loadLens(lens[k])
+			current_lens = self.loadLens(lens[k],index=k)
 			np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
 
-			#Maybe transpose
+			#Maybe transpose (on a copy, the cached lens is left untouched); the transposed pixels are materialized once, so the gathers read contiguous memory
 			if k<=transpose_up_to:
 				logray.debug("Transposing pixel values for lens {0}".format(k))
-				current_lens.data = current_lens.data.T
+				current_lens = copy.copy(current_lens)
+				current_lens.data = np.ascontiguousarray(current_lens.data.T)
+				current_lens.roll_offset = current_lens.roll_offset[::-1]
 
-			#Distances, lensing kernel
+			#Distances, lensing kernel (the distance to the sources is computed only once)
 			chi_prev = distance[k]
 			chi = distance[k+1]
-			kernel = 1. - (chi/current_lens.cosmology.comoving_distance(z).to(Mpc).value)
+
+			if source_distance is None:
+				source_distance = current_lens.cosmology.comoving_distance(z).to(Mpc).value
+			
+			kernel = 1. - (chi/source_distance)
+
+			#The last lens contributes only up to the source redshift
+			if k<last_lens:
+				ll_coefficient = 0.5*kernel
+				gp_coefficient = kernel
+			else:
+				ll_coefficient = 0.5 * kernel * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+				gp_coefficient = kernel * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+
+			#Unit conversions are done once per lens
+			pixel_angle = current_lens._pixelAngle()
+			potential,deflection_scale = current_lens._deflectionField()
+			shear_scale = current_lens._shearField()[1]
+			gradient_scale = current_lens._densityGradientField()[1]
 
 			#################################################################################
 			##Compute lensing quantities (deflections, jacobian, density, density gradient)##
@@ -1554,86 +3344,148 @@ class RayTracer(object):
 			logray.debug("Extracting field values from lens {0} at redshift {1:2f}".format(k,current_lens.redshift))
 			last_timestamp = now
 
-			#Update local quantities
-			deflections_lcl = current_lens.deflectionAngles(current_positions[0],current_positions[1])
-			shear_tensors_lcl = current_lens.shearMatrix(current_positions[0],current_positions[1])
-			density_grad_lcl = current_lens.densityGradient(current_positions[0],current_positions[1])
-
-			#Save geodesic perturbation term
+			#The contributions passed to the callback are collected over the chunks
 			if callback is not None:
-				callback((deflections_lcl*density_grad_lcl).decompose().value.sum(0),self,k,"gpgd",**kwargs)
+				contributions = dict( (contribution_type,np.zeros(num_rays)) for contribution_type in ["gpgd","ll","gp","born"] )
 
-			if include_first_order:
-				density_lcl = 0.5*(shear_tensors_lcl[0]+shear_tensors_lcl[1])
+			#Process a chunk of rays: this writes only to the rays in the chunk (the chunks are slices, so all the arrays below are views)
+			def crossChunk(rays):
 
-			#Update integrated quantities
-			if k<last_lens:
-				
+				timings = np.zeros(len(term_names))
+				t = term[rays]
+				p = product[rays]
+
+				#Gather all the lens quantities with one pass over the potential
+				timestamp = time.time()
+				i,j = current_lens._pixelIndices(current_positions[0,rays],current_positions[1,rays],pixel_angle=pixel_angle)
+				quantities = lens_quantities[:,rays]
+				_raytracing.lensQuantities(potential,j,i,quantities)
+
+				deflections_lcl = quantities[:2]
+				shear_tensors_lcl = quantities[2:5]
+				density_grad_lcl = quantities[5:]
+
+				deflections_lcl *= deflection_scale
+				shear_tensors_lcl *= shear_scale
+				density_grad_lcl *= gradient_scale
+
+				#Save geodesic perturbation term
+				if callback is not None:
+					np.multiply(deflections_lcl[0],density_grad_lcl[0],out=t)
+					np.multiply(deflections_lcl[1],density_grad_lcl[1],out=p)
+					t += p
+					contributions["gpgd"][rays] = t
+
+				timings[0] = time.time() - timestamp
+
+				#Lens-lens coupling: shear matrix contracted with the integrated jacobian
 				if include_ll:
-					add_on = (0.5*kernel) * (shear_tensors_lcl*current_jacobians)[[0,1,2,2]].sum(0)
-					current_convergence += add_on
+
+					timestamp = time.time()
+					np.multiply(shear_tensors_lcl[0],current_jacobians[0,rays],out=t)
+					np.multiply(shear_tensors_lcl[1],current_jacobians[1,rays],out=p)
+					t += p
+					np.multiply(shear_tensors_lcl[2],current_jacobians[2,rays],out=p)
+					t += p
+					t += p
+					
+					t *= ll_coefficient
+					current_convergence[rays] += t
 					if callback is not None:
-						callback(add_on,self,k,"ll",**kwargs)
+						contributions["ll"][rays] = t
 
+					timings[1] = time.time() - timestamp
+
+				#Geodesic perturbation: density gradient contracted with the integrated deflection
 				if include_gp:
-					add_on = kernel * (density_grad_lcl*current_deflections).decompose().value.sum(0)
-					current_convergence += add_on
+
+					timestamp = time.time()
+					np.multiply(density_grad_lcl[0],current_deflections[0,rays],out=t)
+					np.multiply(density_grad_lcl[1],current_deflections[1,rays],out=p)
+					t += p
+					
+					t *= gp_coefficient
+					current_convergence[rays] += t
 					if callback is not None:
-						callback(add_on,self,k,"gp",**kwargs)
-				
+						contributions["gp"][rays] = t
+
+					timings[2] = time.time() - timestamp
+
+				#First order (Born) term
 				if include_first_order:
-					add_on = kernel * density_lcl
-					current_convergence += add_on
+
+					timestamp = time.time()
+					np.add(shear_tensors_lcl[0],shear_tensors_lcl[1],out=t)
+					t *= 0.5
+					t *= gp_coefficient
+					current_convergence[rays] += t
 					if callback is not None:
-						callback(add_on,self,k,"born",**kwargs)
+						contributions["born"][rays] = t
 
-				current_deflections_0 += deflections_lcl
-				current_deflections_1 += deflections_lcl*(0.5*(chi+chi_prev))
-				current_deflections = -current_deflections_0 + current_deflections_1/chi
+					timings[3] = time.time() - timestamp
 
-				current_jacobians_0 += shear_tensors_lcl
-				current_jacobians_1 += shear_tensors_lcl*(0.5*(chi+chi_prev))
-				current_jacobians = -current_jacobians_0 + current_jacobians_1/chi
+				#Update integrated quantities
+				if k<last_lens:
 
+					timestamp = time.time()
 
-			else:
+					for c in range(2):
+						current_deflections_0[c,rays] += deflections_lcl[c]
+						np.multiply(deflections_lcl[c],0.5*(chi+chi_prev),out=p)
+						current_deflections_1[c,rays] += p
+						np.divide(current_deflections_1[c,rays],chi,out=current_deflections[c,rays])
+						current_deflections[c,rays] -= current_deflections_0[c,rays]
 
-				if include_ll:
-					add_on = (0.5 * kernel * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])) * (shear_tensors_lcl*current_jacobians)[[0,1,2,2]].sum(0)
-					current_convergence += add_on
-					if callback is not None:
-						callback(add_on,self,k,"ll",**kwargs)
+					for c in range(3):
+						current_jacobians_0[c,rays] += shear_tensors_lcl[c]
+						np.multiply(shear_tensors_lcl[c],0.5*(chi+chi_prev),out=p)
+						current_jacobians_1[c,rays] += p
+						np.divide(current_jacobians_1[c,rays],chi,out=current_jacobians[c,rays])
+						current_jacobians[c,rays] -= current_jacobians_0[c,rays]
 
-				if include_gp:
-					add_on = (kernel * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])) * (density_grad_lcl*current_deflections).decompose().value.sum(0)
-					current_convergence += add_on
-					if callback is not None:
-						callback(add_on,self,k,"gp",**kwargs)
+					timings[4] = time.time() - timestamp
+
+				return timings
+
+			lens_timings = np.sum(self._mapChunks(crossChunk,chunks,n_threads=n_threads),axis=0)
+			total_timings += lens_timings
+
+			for name,timing in zip(term_names,lens_timings):
+				recordEvent(name,timing,lens=k,redshift=current_lens.redshift)
+
+			#Call the callback on the contributions of this lens, in the same order as they are computed
+			if callback is not None:
 				
-				if include_first_order:
-					add_on = kernel * density_lcl * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
-					current_convergence += add_on
-					if callback is not None:
-						callback(add_on,self,k,"born",**kwargs)
+				timestamp = time.time()
+				callback(contributions["gpgd"].reshape(ray_shape),self,k,"gpgd",**kwargs)
+				
+				for contribution_type,include in [("ll",include_ll),("gp",include_gp),("born",include_first_order)]:
+					if include:
+						callback(contributions[contribution_type].reshape(ray_shape),self,k,contribution_type,**kwargs)
+
+				recordEvent("callback",time.time()-timestamp,lens=k,redshift=current_lens.redshift)
 			
 			#Timestamp
 			now = time.time()
-			logray.debug("Field values extracted in {0:.3f}s".format(now-last_timestamp))
+			logray.debug("Field values extracted in {0:.3f}s ({1})".format(now-last_timestamp,", ".join([ "{0} {1:.3f}s".format(name,timing) for name,timing in zip(term_names,lens_timings) ])))
 			last_timestamp = now
 
 			now = time.time()
 			logray.debug("Lens {0} crossed in {1:.3f}s".format(k,now-start))
+			logstderr.debug("Lens {0} crossed: peak memory usage {1:.3f} (task)".format(k,peakMemory()))
 			last_timestamp = now
 
 			#Save the intermediate convergence values if option is enabled
 			if save_intermediate:
-				all_convergence[k] = current_convergence.copy()
+				all_convergence[k] = current_convergence
+
+		logray.info("Post-Born convergence through {0} lenses, time per term: {1}".format(last_lens+1,", ".join([ "{0} {1:.3f}s".format(name,timing) for name,timing in zip(term_names,total_timings) ])))
 
 		#Return to the user
 		if save_intermediate:
-			return all_convergence
+			return all_convergence.reshape((last_lens+1,)+ray_shape)
 		else:
-			return current_convergence
+			return current_convergence.reshape(ray_shape)
 
 	########################################################################
 	###########Calculation of omega at second post-Born order###############
@@ -1693,7 +3545,7 @@ class RayTracer(object):
 			start = time.time()
 
 			#Load in the lens
-			current_lens = self.loadLens(lens[k])
+			current_lens = self.loadLens(lens[k],index=k)
 			np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
 
 			#Distances, lensing kernel
@@ -1749,7 +3601,7 @@ class RayTracer(object):
 	def shootForward(self,source_positions,z=2.0,save_intermediate=False,grid_resolution=512,interpolation="nearest"):
 
 		"""
-		Shoots a bucket of light rays from the source at redshift z to the observer at redshift 0 (forward ray tracing) and computes the according deflections using backward ray tracing plus a suitable interpolation scheme (KD Tree based)
+		Shoots a bucket of light rays from the source at redshift z to the observer at redshift 0 (forward ray tracing) and computes the according deflections using backward ray tracing plus a suitable interpolation scheme (KD Tree based nearest neighbors, or linear interpolation on the triangulated grid)
 
 		:param source_positions: angular positions of the unlensed sources
 		:type source_positions: numpy array or quantity
@@ -1763,16 +3615,19 @@ class RayTracer(object):
 		:param grid_resolution: the number of points on a side of the interpolation grid (must be choosen big enough according to the number of sources to resolve)
 		:type grid_resolution: int. 
 
-		:param interpolation: only "nearest" implemented so far
+		:param interpolation: "nearest" picks the grid point whose ray lands closest to each source; "linear" splits each cell of the grid in two triangles, finds the traced triangle that contains each source and inverts the lens mapping with barycentric interpolation inside it (much coarser grids reach the same accuracy; the sources that are not contained in any traced triangle get NaN apparent positions)
 		:type interpolation: str.
 
 		:returns: apparent positions of the sources as seen from the observer
 
 		"""
 
-		#First allocate the regular grid to use (must be fine enough to resolve the single ray distortions, since we use nearest neighbors interpolation for now)
+		assert interpolation in ["nearest","linear"],"interpolation must be one in [nearest,linear]!"
+
+		#First allocate the regular grid to use (with nearest neighbors interpolation it must be fine enough to resolve the single ray distortions)
 		corner = source_positions.max(axis=tuple(range(1,len(source_positions.shape))))
-		initial_grid = np.array(np.meshgrid(np.linspace(0.0,corner[0].value,grid_resolution),np.linspace(0.0,corner[1].value,grid_resolution))) * corner.unit
+		grid_axes = np.linspace(0.0,corner[0].value,grid_resolution),np.linspace(0.0,corner[1].value,grid_resolution)
+		initial_grid = np.array(np.meshgrid(*grid_axes)) * corner.unit
 		initial_grid = initial_grid.reshape((2,)+(reduce(mul,initial_grid.shape[1:]),))
 
 		now = time.time()
@@ -1785,6 +3640,24 @@ class RayTracer(object):
 		logray.debug("Ray tracing in {0:.3f}s".format(now-last_timestamp))
 		last_timestamp = now
 
+		if interpolation=="linear":
+
+			#The regular grid is the spatial index: the walk for each source starts from the grid point closest to the source, and then from the one found after the previous lens
+			sources = source_positions.to(corner.unit).value.reshape((2,)+(reduce(mul,source_positions.shape[1:]),))
+			vertices = np.array([ np.clip(np.round(sources[c] / (grid_axes[c][1]-grid_axes[c][0])),0,grid_resolution-1).astype(np.int64) for c in (1,0) ])
+			traced_grids = final_grid if save_intermediate else final_grid[None]
+
+			apparent_positions = np.zeros((traced_grids.shape[0],)+sources.shape)
+			for n in range(traced_grids.shape[0]):
+				apparent_positions[n],vertices = self._invertLinear(traced_grids[n].to(corner.unit).value.reshape((2,grid_resolution,grid_resolution)),grid_axes,sources,vertices)
+
+			now = time.time()
+			logray.debug("Lens mapping inverted on {0} triangulated grids in {1:.3f}s".format(traced_grids.shape[0],now-last_timestamp))
+			last_timestamp = now
+
+			apparent_positions = (apparent_positions * corner.unit).reshape((traced_grids.shape[0],)+source_positions.shape)
+			return apparent_positions if save_intermediate else apparent_positions[0]
+
 		if save_intermediate:
 
 			#If this option is enabled the full evolution of the distortions (after each lens is crossed) is computed
@@ -1833,6 +3706,100 @@ class RayTracer(object):
 		return apparent_positions
 
 
+	#Invert the lens mapping of a (2,Ny,Nx) traced grid by linear interpolation: each grid cell is split in two triangles, the sources are located in the traced triangles around the closest traced vertex, which is found walking on the grid from the vertices in guess (row,column); returns the apparent positions (NaN for the sources that are not located in any traced triangle) and the closest vertices
+	def _invertLinear(self,traced,grid_axes,sources,guess):
+
+		ny,nx = traced.shape[1:]
+		row,col = guess[0].copy(),guess[1].copy()
+
+		#Walk towards the traced vertex closest to each source (the current vertex comes first among the candidates, so the walk stops on ties)
+		step_row = np.array([0,-1,-1,-1,0,0,1,1,1])
+		step_col = np.array([0,-1,0,1,-1,1,-1,0,1])
+		walking = np.arange(sources.shape[1])
+		
+		while len(walking):
+
+			candidate_row = np.clip(row[walking][None]+step_row[:,None],0,ny-1)
+			candidate_col = np.clip(col[walking][None]+step_col[:,None],0,nx-1)
+			distance = (traced[0][candidate_row,candidate_col]-sources[0,walking])**2 + (traced[1][candidate_row,candidate_col]-sources[1,walking])**2
+			best = distance.argmin(0)
+
+			row[walking] = candidate_row[best,np.arange(len(walking))]
+			col[walking] = candidate_col[best,np.arange(len(walking))]
+			walking = walking[best>0]
+
+		apparent = np.zeros(sources.shape) + np.nan
+		found = np.zeros(sources.shape[1],dtype=bool)
+
+		#Triangles of the cells that share the closest vertex
+		self._locateTriangles(traced,grid_axes,sources,row,col,[(-1,-1),(-1,0),(0,-1),(0,0)],apparent,found)
+
+		#The walk can stop on a local minimum of the distance, away from the triangle that contains the source (strong shear, folds of the lens mapping): the sources that are left are looked for in all the traced cells that are close enough to contain them,
+		#i.e. whose centroid is closer than the largest distance between a traced cell centroid and its vertices
+		if not found.all():
+
+			missing = np.where(~found)[0]
+			corners = np.array([traced[:,:-1,:-1],traced[:,:-1,1:],traced[:,1:,:-1],traced[:,1:,1:]])
+			centroids = corners.mean(0)
+			radius = np.sqrt(((corners-centroids)**2).sum(1)).max()
+			candidates = KDTree(centroids.reshape((2,(ny-1)*(nx-1))).transpose()).query_ball_point(sources[:,missing].transpose(),r=radius)
+
+			#Test each (source,cell) pair, a source in a fold of the mapping can be located in more than one cell
+			pair_source = np.repeat(missing,[ len(cells) for cells in candidates ])
+			pair_cell = np.array([ cell for cells in candidates for cell in cells ],dtype=np.int64)
+			pair_apparent = np.zeros((2,len(pair_source))) + np.nan
+			pair_found = np.zeros(len(pair_source),dtype=bool)
+			self._locateTriangles(traced,grid_axes,sources[:,pair_source],pair_cell//(nx-1),pair_cell%(nx-1),[(0,0)],pair_apparent,pair_found)
+
+			apparent[:,pair_source[pair_found]] = pair_apparent[:,pair_found]
+			found[pair_source[pair_found]] = True
+
+		#The sources that are still not located (for example beyond the edges of the traced grid) are not extrapolated
+		if not found.all():
+			logray.warning("{0} of {1} sources could not be located in the traced triangles (they might fall outside of the traced grid), their apparent positions are NaN".format((~found).sum(),len(found)))
+		else:
+			logray.debug("{0} sources located in the traced triangles".format(len(found)))
+
+		return apparent,np.array([row,col])
+
+	#Locate the sources that are not found yet in the two traced triangles of the cells whose corners are at the given (row,column) offsets from the vertices (row,col), and interpolate their apparent positions with the same barycentric combination of the grid points
+	@staticmethod
+	def _locateTriangles(traced,grid_axes,sources,row,col,cells,apparent,found):
+
+		ny,nx = traced.shape[1:]
+
+		for cell_row,cell_col in cells:
+			for triangle in [((0,0),(0,1),(1,1)),((0,0),(1,1),(1,0))]:
+
+				r0 = row + cell_row
+				c0 = col + cell_col
+				inside = (~found) & (r0>=0) & (r0<ny-1) & (c0>=0) & (c0<nx-1)
+				if not inside.any():
+					continue
+
+				#Barycentric coordinates of the sources in the traced triangle
+				vr = [ r0[inside]+dr for dr,dc in triangle ]
+				vc = [ c0[inside]+dc for dr,dc in triangle ]
+				p = [ traced[:,vr[v],vc[v]] for v in range(3) ]
+				
+				e1 = p[1] - p[0]
+				e2 = p[2] - p[0]
+				d = sources[:,inside] - p[0]
+				det = e1[0]*e2[1] - e1[1]*e2[0]
+				
+				with np.errstate(divide="ignore",invalid="ignore"):
+					l1 = (d[0]*e2[1] - d[1]*e2[0]) / det
+					l2 = (e1[0]*d[1] - e1[1]*d[0]) / det
+				
+				l0 = 1.0 - l1 - l2
+				contained = (l0>=-1.0e-10) & (l1>=-1.0e-10) & (l2>=-1.0e-10) & (det!=0)
+
+				selected = np.where(inside)[0][contained]
+				apparent[0,selected] = (l0*grid_axes[0][vc[0]] + l1*grid_axes[0][vc[1]] + l2*grid_axes[0][vc[2]])[contained]
+				apparent[1,selected] = (l0*grid_axes[1][vr[0]] + l1*grid_axes[1][vr[1]] + l2*grid_axes[1][vr[2]])[contained]
+				found[selected] = True
+
+
 
 	#########################################################
 	#######################Graphics##########################
@@ -4,6 +4,8 @@ from ..simulations import Gadget2SnapshotDE
 from ..pipeline.settings import Gadget2Settings
 
 from .. import dataExtern
+from .. import extern as ext
+from ..utils.configuration import configuration
 
 import numpy as np
 from astropy.units import Mpc,m,s
@@ -82,3 +84,228 @@ def test_paramfile():
 	a = 1.0 / (1 + z)
 	np.savetxt("outputs.txt",a)
 
+
+
+def test_mass_assignment():
+
+	def snapshot(x):
+		snap = Gadget2SnapshotDE()
+		snap.setPositions(x.astype(np.float32)*Mpc)
+		snap.setVelocities(np.zeros(x.shape)*m/s)
+		snap.setHeaderInfo(box_size=10.0*Mpc)
+		snap.weights,snap.virial_radius,snap.concentration = None,None,None
+		return snap
+
+	#A particle in the center of a corner cell: the triangular shaped cloud wraps around the box
+	density,resolution = snapshot(np.array([[0.3125,0.3125,0.3125]])).massDensity(resolution=16,left_corner=np.zeros(3)*Mpc,assignment="tsc")
+	density /= 16**3
+	assert np.isclose(density.sum(),1.0)
+	assert np.isclose(density[0,0,0],0.75**3)
+	assert np.isclose(density[-1,0,0],0.125*0.75**2) and np.isclose(density[1,0,0],0.125*0.75**2)
+
+	#A plane wave: once the mass assignment window is deconvolved, its power on a coarse grid matches the one on a fine grid
+	np.random.seed(0)
+	x = np.random.rand(400000,3)*10.0
+	x[:,0] = (x[:,0] + 0.02*np.sin(np.pi*x[:,0])) % 10.0
+	k_edges = np.array([2.9,3.4,5.0]) / Mpc
+
+	k,power_fine = snapshot(x).powerSpectrum(k_edges,resolution=64,assignment="tsc")
+	for assignment,tolerance in [("cic",0.02),("tsc",0.01)]:
+		k,power = snapshot(x).powerSpectrum(k_edges,resolution=16,assignment=assignment)
+		assert np.abs(power[0]/power_fine[0]-1.0)<tolerance
+
+	k,power = snapshot(x).powerSpectrum(k_edges,resolution=16)
+	assert np.abs(power[0]/power_fine[0]-1.0)>0.1
+
+def test_cut_planes():
+
+	np.random.seed(1)
+	snap = Gadget2SnapshotDE()
+	snap.setPositions((np.random.rand(50000,3)*10.0).astype(np.float32)*Mpc)
+	snap.setVelocities(np.zeros((50000,3))*m/s)
+	snap.setHeaderInfo(box_size=10.0*Mpc,redshift=1.0)
+	snap._header["comoving_distance"] = 3000.0*Mpc
+	snap.weights,snap.virial_radius,snap.concentration = None,None,None
+
+	#Cutting all the planes in a single pass gives the same result as cutting them one at a time
+	slabs = [ (center,thickness,normal) for center,thickness in [(2.5*Mpc,5.0*Mpc),(6.0*Mpc,2.0*Mpc)] for normal in range(3) ]
+	for assignment in ["ngp","tsc"]:
+		for kind,smooth in [("density",None),("potential",1)]:
+			planes = snap.cutPlanes(slabs,plane_resolution=32,left_corner=np.zeros(3)*Mpc,thickness_resolution=4,smooth=smooth,kind=kind,assignment=assignment)
+			for (center,thickness,normal),(plane,resolution,NumPart) in zip(slabs,planes):
+				plane_single,resolution_single,NumPart_single = snap.cutPlaneGaussianGrid(normal=normal,center=center,thickness=thickness,plane_resolution=32,left_corner=np.zeros(3)*Mpc,thickness_resolution=4,smooth=smooth,kind=kind,assignment=assignment)
+				assert np.allclose(plane,plane_single,rtol=1.0e-5,atol=0)
+				assert np.isclose(NumPart,NumPart_single)
+
+	#The slabs are projected straight on the plane, with the same result as summing the gridded slab volume along the normal
+	for normal in range(3):
+		binning = snap._slabBinning(normal,3.0*Mpc,4.0*Mpc,32,np.zeros(3)*Mpc,5,Mpc)
+		density = ext._nbody.grid3d(snap.positions.value,tuple(binning),None,None,None,0,tuple([ int(d!=normal) for d in range(3) ]))
+		assert np.allclose(snap._projectSlabs(snap.positions.value,None,[binning],[normal],None,"ngp")[0],density.sum(normal),rtol=0,atol=1.0e-4)
+
+	#The clouds are spread only on the plane: along the normal each particle goes in the slab bin it falls in, so the slab holds exactly the particles inside it
+	positions = snap.positions.value
+	for assignment,scheme in [("cic",1),("tsc",2)]:
+		for normal in range(3):
+			binning = snap._slabBinning(normal,3.0*Mpc,4.0*Mpc,32,np.zeros(3)*Mpc,5,Mpc)
+			inside = (positions[:,normal]>=binning[normal][0]) & (positions[:,normal]<binning[normal][-1])
+			plane = snap._projectSlabs(positions,None,[binning],[normal],None,assignment)[0]
+			assert np.isclose(plane.sum(),inside.sum(),rtol=1.0e-5)
+
+			#Same as gridding the particles inside the slab on a single bin along the normal
+			binning[normal] = binning[normal][[0,-1]]
+			density = ext._nbody.grid3d(positions[inside],tuple(binning),None,None,None,scheme,(1,1,1))
+			assert np.allclose(plane,density.sum(normal),rtol=0,atol=1.0e-4)
+
+	#Thickness weighting: dropping the second half of the slab is the same as cutting a thinner slab
+	plane_half,resolution,NumPart_half = snap.cutPlaneGaussianGrid(normal=2,center=2.0*Mpc,thickness=2.0*Mpc,plane_resolution=32,left_corner=np.zeros(3)*Mpc,thickness_resolution=2,smooth=None)
+	plane,resolution,NumPart = snap.cutPlaneGaussianGrid(normal=2,center=3.0*Mpc,thickness=4.0*Mpc,plane_resolution=32,left_corner=np.zeros(3)*Mpc,thickness_resolution=4,smooth=None,thickness_weights=[1.,1.,0.,0.])
+	assert NumPart==NumPart_half
+	assert np.allclose(plane,plane_half)
+
+def test_gridding_threads():
+
+	np.random.seed(2)
+	x = (np.random.rand(200000,3)*10.0).astype(np.float32)
+	w = np.random.rand(200000).astype(np.float32)
+	rv = np.random.rand(200000)*0.5
+	binning = tuple([ np.linspace(0.0,10.0,33) ]*3)
+
+	#The gridding gives the same result regardless of the number of threads
+	results = dict()
+	for threads in [1,4]:
+		configuration.gridding_threads = threads
+		results[threads] = [ ext._nbody.grid3d(x,binning,w,None,None,scheme,(1,1,0)) for scheme in range(3) ]
+		results[threads].append(ext._nbody.grid3d_nfw(x,binning,w,rv,np.ones(200000),0,(0,0,0)))
+		results[threads] += ext._nbody.project_slabs(x,None,np.zeros((2,3)),np.ones((2,3))*10.0/32,np.array([[32,32,4],[4,32,32]],dtype=np.int32),np.array([2,0],dtype=np.int32),np.ones(8),2)
+
+	configuration.gridding_threads = 0
+	for single,multi in zip(results[1],results[4]):
+		assert np.allclose(single,multi,rtol=1.0e-5,atol=1.0e-3)
+
+def test_chunked_gridding():
+
+	#Write a snapshot to disk
+	np.random.seed(4)
+	positions = np.random.rand(20000,3)*10.0
+	positions[0] = 0.0
+	snap = Gadget2SnapshotDE()
+	snap.setPositions(positions*Mpc)
+	snap.setVelocities(np.zeros((20000,3))*m/s)
+	snap.setHeaderInfo(box_size=10.0*Mpc/0.72,redshift=1.0)
+	snap.write("gadget_chunks")
+
+	with Gadget2SnapshotDE.open("gadget_chunks") as snap:
+
+		#The chunks cover all the particles in order
+		positions = snap.getPositions(save=False)
+		chunks = list(snap.iterPositions(chunk_size=3000))
+		assert len(chunks)==7
+		assert np.all(np.concatenate([ chunk.value for chunk in chunks ])==positions.value)
+
+		#Gridding chunk by chunk gives the same result as gridding all the particles at once (the particles read in chunks are gridded from the origin of the box by default)
+		origin = np.zeros(3)*snap.Mpc_over_h
+		density,resolution = snap.massDensity(resolution=16,left_corner=origin,assignment="cic")
+		density_chunks,resolution = snap.massDensity(resolution=16,assignment="cic",chunk_size=3000)
+		assert np.allclose(density,density_chunks,rtol=1.0e-5,atol=1.0e-5)
+
+		slabs = [ (3.0*snap.Mpc_over_h,2.0*snap.Mpc_over_h,normal) for normal in range(3) ]
+		planes = snap.cutPlanes(slabs,plane_resolution=32,left_corner=origin,thickness_resolution=2,smooth=None)
+		planes_chunks = snap.cutPlanes(slabs,plane_resolution=32,thickness_resolution=2,smooth=None,chunk_size=3000)
+		for (plane,resolution,NumPart),(plane_chunks,resolution,NumPart_chunks) in zip(planes,planes_chunks):
+			assert NumPart==NumPart_chunks
+			assert np.allclose(plane,plane_chunks,rtol=1.0e-5,atol=1.0e-6)
+
+		plane,resolution,NumPart = snap.cutPlaneGaussianGrid(normal=1,center=3.0*snap.Mpc_over_h,thickness=2.0*snap.Mpc_over_h,plane_resolution=32,left_corner=origin,thickness_resolution=2,smooth=None,assignment="tsc")
+		plane_chunks,resolution,NumPart_chunks = snap.cutPlaneGaussianGrid(normal=1,center=3.0*snap.Mpc_over_h,thickness=2.0*snap.Mpc_over_h,plane_resolution=32,thickness_resolution=2,smooth=None,assignment="tsc",chunk_size=3000)
+		assert np.isclose(NumPart,NumPart_chunks)
+		assert np.allclose(plane,plane_chunks,rtol=1.0e-5,atol=1.0e-6)
+
+		#One particle sits at the origin of the box, so the default grids of the two power spectra coincide
+		k_edges = np.linspace(0.5,5.0,8)/snap.Mpc_over_h
+		k,power = snap.powerSpectrum(k_edges,resolution=16)
+		k,power_chunks = snap.powerSpectrum(k_edges,resolution=16,chunk_size=3000)
+		assert np.allclose(power.value,power_chunks.value,rtol=1.0e-4)
+
+
+def test_amiga_chunks():
+
+	from ..simulations.amiga import AmigaHalos
+
+	#Write a small AHF halo catalog, with the log file that holds the cosmological parameters
+	np.random.seed(6)
+	with open("halos.00.log","w") as fp:
+		fp.write("simu.omega0 : 0.26\nsimu.lambda0 : 0.74\nsimu.boxsize : 10.0\n")
+
+	halos = np.random.rand(50,43)
+	halos[:,3] = 1.0e12*(1.0 + halos[:,3])
+	halos[:,5:8] *= 1.0e4
+	halos[:,11] = 200.0*(1.0 + halos[:,11])
+	halos[:,42] = 5.0*(1.0 + halos[:,42])
+	np.savetxt("halos.0000.z1.000.AHF_halos",halos,header="AHF halo catalog")
+
+	with AmigaHalos.open("halos.0000.z1.000.AHF_halos") as snap:
+
+		#The chunks cover all the halos in order
+		positions = snap.getPositions(save=False)
+		chunks = list(snap.iterPositions(chunk_size=7))
+		assert sum([ len(chunk) for chunk in chunks ])==50
+		assert np.all(np.concatenate([ chunk.value for chunk in chunks ])==positions.value)
+
+		#The halo profiles gridded one chunk at a time (in the length unit of the snapshot) are the same as the ones gridded all at once
+		origin = np.zeros(3)*snap.Mpc_over_h
+		density,resolution = snap.massDensity(resolution=8,left_corner=origin)
+		density_chunks,resolution = snap.massDensity(resolution=8,chunk_size=7)
+		assert np.allclose(density,density_chunks,rtol=1.0e-4,atol=1.0e-6)
+
+		slabs = [ (5.0*snap.Mpc_over_h,4.0*snap.Mpc_over_h,normal) for normal in range(2) ]
+		planes = snap.cutPlanes(slabs,plane_resolution=16,left_corner=origin,smooth=None)
+		planes_chunks = snap.cutPlanes(slabs,plane_resolution=16,smooth=None,chunk_size=7)
+		for (plane,resolution,NumPart),(plane_chunks,resolution,NumPart_chunks) in zip(planes,planes_chunks):
+			assert np.allclose(plane,plane_chunks,rtol=1.0e-4,atol=1.0e-6)
+
+		#The halos are spread with their NFW profile, a cloud mass assignment cannot be applied to them
+		for assignment in ["cic","tsc"]:
+			try:
+				snap.cutPlanes(slabs,plane_resolution=16,left_corner=origin,smooth=None,assignment=assignment)
+			except ValueError:
+				pass
+			else:
+				raise AssertionError("The {0} assignment should not be accepted for halos with NFW profiles!".format(assignment))
+
+
+def test_fastpm_chunks():
+
+	try:
+		import bigfile
+		from ..simulations.fastpm import FastPMSnapshotStretchZ
+	except ImportError:
+		return
+
+	#Write a small FastPM light cone snapshot
+	np.random.seed(7)
+	with bigfile.BigFile("fastpm_chunks",create=True) as bf:
+		bf.create_from_array("Position",(np.random.rand(4096,3)*10.0).astype(np.float32))
+		bf.create_from_array("Aemit",np.random.uniform(0.5,0.9,4096).astype(np.float32))
+		with bf.create(".") as header:
+			header.attrs["NC"] = [16]
+			header.attrs["OmegaM"] = [0.26]
+			header.attrs["BoxSize"] = [10.0]
+			header.attrs["M0"] = [1.0]
+
+	snap = FastPMSnapshotStretchZ.open("fastpm_chunks")
+
+	#The z coordinates of the chunks are stretched with the emission scale factor of the same particles
+	positions = snap.getPositions(save=False)
+	chunks = list(snap.iterPositions(chunk_size=1000))
+	assert len(chunks)==5
+	assert np.all(np.concatenate([ chunk.value for chunk in chunks ])==positions.value)
+
+	#Cutting the planes one chunk at a time gives the same result as cutting them all at once
+	origin = np.zeros(3)*snap.Mpc_over_h
+	slabs = [ (5.0*snap.Mpc_over_h,2.0*snap.Mpc_over_h,normal) for normal in range(2) ]
+	planes = snap.cutPlanes(slabs,plane_resolution=16,left_corner=origin,smooth=None)
+	planes_chunks = snap.cutPlanes(slabs,plane_resolution=16,smooth=None,chunk_size=1000)
+	for (plane,resolution,NumPart),(plane_chunks,resolution,NumPart_chunks) in zip(planes,planes_chunks):
+		assert NumPart==NumPart_chunks
+		assert np.allclose(plane,plane_chunks,rtol=1.0e-5,atol=1.0e-6)
@@ -29,4 +29,902 @@ def test_nfw():
 	#Build a PotentialPlane
 	pln = PotentialPlane(p/p.max(),snap.header["box_size"],comoving_distance=snap.header["comoving_distance"],unit=None,num_particles=n)
 	pln.visualize(colorbar=True)
-	pln.savefig("nfw.png")
\ No newline at end of file
+	pln.savefig("nfw.png")
+
+def test_plane_cache():
+
+	from ..simulations.raytracing import PlaneCache
+	from astropy.cosmology import w0waCDM
+
+	#Save a couple of small planes to disk
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	for n in range(2):
+		PotentialPlane(np.random.randn(64,64),angle=1.0*u.deg,redshift=1.0,cosmology=cosmo).save("cache_test{0}.fits".format(n))
+
+	#The budget fits only one plane
+	cache = PlaneCache(max_bytes=64*64*8)
+	p0 = cache.load("cache_test0.fits",PotentialPlane)
+	p0_again = cache.load("cache_test0.fits",PotentialPlane)
+	assert (cache.hits,cache.misses,cache.evictions)==(1,1,0)
+	assert np.shares_memory(p0.data,p0_again.data)
+	
+	#Loading the second plane evicts the first
+	p1 = cache.load("cache_test1.fits",PotentialPlane)
+	assert (cache.hits,cache.misses,cache.evictions)==(1,2,1)
+	assert "cache_test1.fits" in cache and not("cache_test0.fits" in cache)
+
+	#Rolling a cached plane leaves the cached data untouched
+	data = cache.load("cache_test1.fits",PotentialPlane).data.copy()
+	p1.randomRoll()
+	assert (cache.load("cache_test1.fits",PotentialPlane).data==data).all()
+
+
+def test_roll_offset():
+
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	data = np.random.randn(64,64)
+
+	#Rolling only stores the offset, the data is not touched
+	pln = PotentialPlane(data,angle=1.0*u.deg,redshift=1.0,cosmology=cosmo)
+	pln.randomRoll(seed=5)
+	assert pln.data is data
+
+	#Compare with the explicitly rolled plane
+	np.random.seed(5)
+	rolled = np.roll(np.roll(data,np.random.randint(0,64),axis=0),np.random.randint(0,64),axis=1)
+	ref = PotentialPlane(rolled,angle=1.0*u.deg,redshift=1.0,cosmology=cosmo)
+
+	x,y = np.random.rand(2,1000)*1.5*u.deg
+	assert (pln.getValues(x,y)==ref.getValues(x,y)).all()
+	assert (pln.deflectionAngles(x,y)==ref.deflectionAngles(x,y)).all()
+	assert (pln.shearMatrix(x,y)==ref.shearMatrix(x,y)).all()
+	assert (pln.shearMatrix().data==ref.shearMatrix().data).all()
+	assert (pln.rolledData()==rolled).all()
+
+
+def test_lens_pack():
+
+	from ..simulations.raytracing import LensPackPlane
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	pot = PotentialPlane(np.random.randn(64,64)*1.0e-3,angle=1.0*u.deg,redshift=1.0,cosmology=cosmo)
+	pot.randomRoll(seed=3)
+
+	#The pack carries the same deflections and shear matrices as the potential
+	pack = pot.lensPack()
+	x,y = np.random.rand(2,1000)*u.deg
+	assert np.allclose(pack.deflectionAngles(x,y).value,pot.deflectionAngles(x,y).value)
+	assert np.allclose(pack.shearMatrix(x,y),pot.shearMatrix(x,y))
+
+	#Save/load round trip
+	pack.save("pack_test.fits",double_precision=True)
+	pack_loaded = LensPackPlane.load("pack_test.fits")
+	assert pack_loaded.data.shape==(5,64,64)
+	assert np.allclose(pack_loaded.shearMatrix(x,y),pot.shearMatrix(x,y))
+
+
+def test_prefetch():
+
+	from ..simulations.raytracing import RayTracer,PlaneCache
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	tracer = RayTracer(cache=PlaneCache())
+	for n,z in enumerate([0.2,0.4,0.6,0.8]):
+		PotentialPlane(np.random.randn(64,64)*1.0e-7,angle=200.0*u.Mpc,redshift=z,cosmology=cosmo).save("prefetch_test{0}.fits".format(n))
+		tracer.addLens(("prefetch_test{0}.fits".format(n),cosmo.comoving_distance(z),z))
+
+	#Reading the planes ahead does not change the results
+	pos = np.random.rand(2,100)*u.deg
+	jacobians = dict()
+	for prefetch in [0,2]:
+		np.random.seed(1)
+		jacobians[prefetch] = tracer.shoot(pos,z=0.7,kind="jacobians",prefetch=prefetch)
+
+	assert (jacobians[0]==jacobians[2]).all()
+
+
+def test_jacobian_update():
+
+	from ..extern import _raytracing
+
+	#Random jacobians and shear matrices
+	jacobian = np.random.randn(4,1000)
+	jacobian_deflection = np.random.randn(4,1000)
+	shear = np.random.randn(3,1000)
+	weight = np.random.rand(1000)
+	Ak,Ck = 1.1,-0.3
+
+	#Reference: explicit 2x2 matrix products
+	J = jacobian.reshape(2,2,1000)
+	S = np.array([[shear[0],shear[2]],[shear[2],shear[1]]])
+	deflection_ref = (Ak-1)*jacobian_deflection + Ck*np.einsum("ikr,kjr->ijr",S,J).reshape(4,1000)
+	jacobian_ref = jacobian + 0.5*weight*deflection_ref
+
+	#Fused kernel
+	_raytracing.jacobianUpdate(shear,None,None,1.0,jacobian,jacobian_deflection,Ak,Ck,weight,0.5)
+	assert np.allclose(jacobian_deflection,deflection_ref)
+	assert np.allclose(jacobian,jacobian_ref)
+
+
+def test_chunked_shoot():
+
+	from ..simulations.raytracing import RayTracer
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	tracer = RayTracer()
+	for z in [0.2,0.4,0.6,0.8]:
+		tracer.addLens(PotentialPlane(np.random.randn(64,64)*1.0e-7,angle=200.0*u.Mpc,redshift=z,cosmology=cosmo))
+
+	#Processing the rays in chunks does not change the results
+	pos = np.random.rand(2,32,32)*u.deg
+	z = np.random.uniform(0.3,0.7,size=(32,32))
+	for kind in ["positions","jacobians"]:
+		full = tracer.shoot(pos,z=z,kind=kind)
+		chunked = tracer.shoot(pos,z=z,kind=kind,chunk_size=100)
+		assert full.shape==chunked.shape
+		assert (full==chunked).all()
+
+	#A memory budget is converted into chunks according to the temporaries allocated by each ray (2 pixel indices with their quotients, 2 weighted deflections, 3 terms of the weights)
+	bytes_per_ray = tracer._chunkBytesPerRay(5)
+	assert bytes_per_ray==2*4 + 2*8 + 5*8
+	chunks = tracer._rayChunks(1024,max_memory=100*bytes_per_ray/(1024.**3),bytes_per_ray=bytes_per_ray)
+	assert len(chunks)==11 and chunks[0]==slice(0,100)
+	assert (tracer.shoot(pos,z=z,kind="jacobians",max_memory=100*bytes_per_ray/(1024.**3))==tracer.shoot(pos,z=z,kind="jacobians")).all()
+
+
+def test_chunk_memory():
+
+	import tracemalloc
+	from ..simulations.raytracing import RayTracer
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	planes = [ PotentialPlane(np.random.randn(128,128)*1.0e-7,angle=200.0*u.Mpc,redshift=z,cosmology=cosmo) for z in [0.2,0.4,0.6,0.8] ]
+	pos = np.random.rand(2,40000)*u.deg
+	z = np.random.uniform(0.3,0.7,size=40000)
+	max_memory = 1.0/1024
+
+	#The temporaries allocated while the chunks cross a lens never exceed the memory budget, and the budget is not far from being used
+	calls = [
+	lambda tracer:tracer.shoot(pos,z=0.7,kind="jacobians",max_memory=max_memory),
+	lambda tracer:tracer.shoot(pos,z=z,kind="jacobians",max_memory=max_memory),
+	lambda tracer:tracer.shoot(pos,z=[0.5,0.7],outputs=["positions","convergence","shear"],max_memory=max_memory),
+	lambda tracer:tracer.shoot(pos,z=0.7,kind="jacobians",compute_all_deflections=True,max_memory=max_memory),
+	lambda tracer:tracer.shootMany(pos,tracer.lensTable(2,seed=1),z=0.7,kind="jacobians",max_memory=max_memory),
+	lambda tracer:tracer.convergenceBorn(pos,z=0.7,max_memory=max_memory),
+	lambda tracer:tracer.convergenceBorn(pos,z=0.7,real_trajectory=True,max_memory=max_memory),
+	lambda tracer:tracer.convergencePostBorn2(pos,z=0.7,max_memory=max_memory)
+	]
+
+	for interpolation in ["nearest","bilinear","bicubic"]:
+		for dtype in [np.float64,np.float32]:
+
+			tracer = RayTracer(dtype=dtype,interpolation=interpolation)
+			for plane in planes:
+				tracer.addLens(plane)
+
+			#Peak memory allocated while the chunks cross each lens
+			peaks = list()
+			map_chunks = tracer._mapChunks
+			def measured(function,chunks,n_threads=1):
+				tracemalloc.start()
+				try:
+					return map_chunks(function,chunks,n_threads=n_threads)
+				finally:
+					peaks.append(tracemalloc.get_traced_memory()[1])
+					tracemalloc.stop()
+
+			tracer._mapChunks = measured
+
+			for call in calls:
+				peaks = list()
+				call(tracer)
+				assert max(peaks) <= max_memory*1024**3
+				if dtype==np.float64:
+					assert max(peaks) > 0.4*max_memory*1024**3
+
+
+def test_threaded_raytracing():
+
+	from ..simulations.raytracing import RayTracer
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	tracer = RayTracer()
+	for z in [0.2,0.4,0.6,0.8]:
+		tracer.addLens(PotentialPlane(np.random.randn(64,64)*1.0e-7,angle=200.0*u.Mpc,redshift=z,cosmology=cosmo))
+
+	#Processing the chunks in parallel does not change the results
+	pos = np.random.rand(2,32,32)*u.deg
+	assert (tracer.shoot(pos,z=0.7,kind="jacobians")==tracer.shoot(pos,z=0.7,kind="jacobians",chunk_size=100,n_threads=2)).all()
+	assert (tracer.convergenceBorn(pos,z=0.7,real_trajectory=True)==tracer.convergenceBorn(pos,z=0.7,real_trajectory=True,chunk_size=100,n_threads=2)).all()
+	assert (tracer.convergencePostBorn2(pos,z=0.7)==tracer.convergencePostBorn2(pos,z=0.7,chunk_size=100,n_threads=2)).all()
+
+
+def test_gil_release():
+
+	import threading
+	import time
+	from ..extern import _topology
+
+	field = np.random.randn(2048,2048)
+	i,j = np.random.randint(0,2048,size=(2,3000000)).astype(np.int32)
+	row,col = np.random.rand(2,1000000)*2048
+
+	#The finite difference and interpolation kernels release the interpreter while they run: a python thread keeps counting meanwhile
+	def count(done,counter):
+		while not done.is_set():
+			counter[0] += 1
+
+	def progress(function):
+		done = threading.Event()
+		counter = [0]
+		thread = threading.Thread(target=count,args=(done,counter))
+		thread.start()
+		time.sleep(0.01)
+		start = time.time()
+		first = counter[0]
+		function()
+		increments = counter[0] - first
+		elapsed = time.time() - start
+		done.set()
+		thread.join()
+		return increments,elapsed
+
+	#Counting rate while the interpreter is free
+	reference,elapsed = progress(lambda:time.sleep(0.2))
+	rate = reference/elapsed
+
+	for function in [lambda:_topology.hessian(field,None,None),lambda:_topology.gradient(field,j,i),lambda:_topology.hessian(field,j,i),lambda:_topology.interpolationStencil(col,row,2048,3)]:
+		increments,elapsed = progress(function)
+		assert increments > 0.25*rate*elapsed
+
+	#Calls from different threads run concurrently: with more than one core the throughput grows with the number of threads
+	num_threads = min(os.cpu_count() or 1,4)
+	start = time.time()
+	for n in range(num_threads):
+		_topology.hessian(field,None,None)
+	serial = time.time() - start
+
+	threads = [ threading.Thread(target=_topology.hessian,args=(field,None,None)) for n in range(num_threads) ]
+	start = time.time()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	parallel = time.time() - start
+
+	if num_threads>1:
+		assert parallel < 0.8*serial
+
+
+def test_shoot_many():
+
+	import copy
+	from ..simulations.raytracing import RayTracer
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	tracer = RayTracer()
+	candidates = list()
+	for z in [0.2,0.4,0.6,0.8]:
+		candidates.append([ PotentialPlane(np.random.randn(64,64)*1.0e-7,angle=200.0*u.Mpc,redshift=z,cosmology=cosmo) for n in range(2) ])
+		tracer.addLens(candidates[-1][0])
+
+	#Tracing the realizations together gives the same results as tracing them one at a time
+	table = tracer.lensTable(3,candidates=candidates,seed=1)
+	pos = np.random.rand(2,32,32)*u.deg
+	z = np.random.uniform(0.3,0.7,size=(32,32))
+	jacobians = tracer.shootMany(pos,table,z=z,kind="jacobians",chunk_size=100)
+	assert jacobians.shape==(3,4,32,32)
+
+	for r,row in enumerate(table):
+		
+		single = RayTracer()
+		for lens,roll_offset in row:
+			lens = copy.copy(lens)
+			lens.roll_offset = roll_offset
+			single.addLens(lens)
+
+		assert np.allclose(single.shoot(pos,z=z,kind="jacobians"),jacobians[r],rtol=0.0,atol=1.0e-14)
+		assert np.allclose(single.shoot(pos,z=0.7).value,tracer.shootMany(pos,table[r:r+1],z=0.7)[0].value,rtol=0.0,atol=1.0e-14)
+
+
+def test_sorted_redshifts():
+
+	from ..simulations.raytracing import RayTracer
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	tracer = RayTracer()
+	for z in [0.2,0.4,0.6,0.8]:
+		tracer.addLens(PotentialPlane(np.random.randn(64,64)*1.0e-7,angle=200.0*u.Mpc,redshift=z,cosmology=cosmo))
+
+	#Rays are traced sorted by redshift, but they are returned in the original order
+	pos = np.random.rand(2,32,32)*u.deg
+	z = np.random.choice([0.3,0.5,0.7],size=(32,32))
+	jacobians = tracer.shoot(pos,z=z,kind="jacobians",chunk_size=100)
+	
+	for zs in [0.3,0.5,0.7]:
+		assert (jacobians[:,z==zs]==tracer.shoot(pos,z=zs,kind="jacobians")[:,z==zs]).all()
+
+
+def test_ray_units():
+
+	from ..simulations.raytracing import RayTracer
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	tracer = RayTracer()
+	for z in [0.2,0.4,0.6]:
+		tracer.addLens(PotentialPlane(np.random.randn(64,64)*1.0e-7,angle=200.0*u.Mpc,redshift=z,cosmology=cosmo))
+
+	#Rays are traced in radians whatever the unit of the initial positions, which is restored on return
+	pos = np.random.rand(2,32,32)*u.deg
+	final_deg = tracer.shoot(pos,z=0.5)
+	final_arcmin = tracer.shoot(pos.to(u.arcmin),z=0.5)
+
+	assert final_deg.unit==u.deg and final_arcmin.unit==u.arcmin
+	assert np.allclose(final_deg.value,final_arcmin.to(u.deg).value,rtol=0.0,atol=1.0e-12)
+	assert np.allclose(tracer.convergenceBorn(pos,z=0.5,real_trajectory=True),tracer.convergenceBorn(pos.to(u.arcmin),z=0.5,real_trajectory=True))
+
+
+def test_interpolation():
+
+	from ..simulations.raytracing import RayTracer
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+
+	#Bilinear and bicubic interpolations reproduce linear functions exactly
+	row,col = np.indices((64,64))
+	plane = PotentialPlane(0.5*col + 0.25*row,angle=1.0*u.deg,redshift=1.0,cosmology=cosmo)
+	x,y = np.random.uniform(2.0,60.0,size=(2,1000))*plane.resolution
+	for interpolation in ["bilinear","bicubic"]:
+		assert np.allclose(plane.getValues(x,y,interpolation=interpolation),0.5*(x/plane.resolution).decompose().value + 0.25*(y/plane.resolution).decompose().value - 0.375)
+	
+	#At the pixel centers the interpolation returns the pixel values
+	x,y = (np.random.randint(0,64,size=(2,1000))+0.5)*plane.resolution
+	assert np.allclose(plane.getValues(x,y,interpolation="bicubic"),plane.getValues(x,y))
+
+	#Potentials and lens packs agree on the interpolated deflections, also on rolled planes
+	pot = PotentialPlane(np.random.randn(64,64)*1.0e-3,angle=1.0*u.deg,redshift=1.0,cosmology=cosmo)
+	pot.randomRoll(seed=3)
+	pack = pot.lensPack()
+	x,y = np.random.rand(2,1000)*u.deg
+	for interpolation in ["bilinear","bicubic"]:
+		assert np.allclose(pack.deflectionAngles(x,y,interpolation=interpolation).value,pot.deflectionAngles(x,y,interpolation=interpolation).value)
+		assert np.allclose(pack.shearMatrix(x,y,interpolation=interpolation),pot.shearMatrix(x,y,interpolation=interpolation))
+
+	#The ray tracing kernels interpolate the deflections in the same way
+	tracer = RayTracer(interpolation="bilinear")
+	tracer.addLens(PotentialPlane(np.random.randn(64,64)*1.0e-7,angle=200.0*u.Mpc,redshift=0.5,cosmology=cosmo))
+	tracer.addLens(PotentialPlane(np.zeros((64,64)),angle=200.0*u.Mpc,redshift=1.0,cosmology=cosmo))
+	pos = np.random.rand(2,1000)*u.deg
+
+	deflection = (tracer.shoot(pos,z=0.9) - pos).to(u.rad).value
+	alpha = tracer.lens[0].deflectionAngles(pos[0],pos[1],interpolation="bilinear").to(u.rad).value
+	assert np.allclose(deflection,alpha*(deflection*alpha).sum()/(alpha**2).sum())
+
+
+def test_born_grid():
+
+	from ..simulations.raytracing import RayTracer,LensPackPlane
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	planes = list()
+	for n,z in enumerate([0.2,0.4,0.6,0.8]):
+		planes.append(PotentialPlane(np.random.randn(64,64)*1.0e-3,angle=200.0*u.Mpc,redshift=z,cosmology=cosmo))
+		planes[-1].randomRoll(seed=n)
+
+	#Rays on a grid gather the density by rows and columns: the results are the same as with the generic gather
+	b = np.linspace(0.0,5.0,50)
+	pos = np.array(np.meshgrid(b,b))*u.deg
+	
+	for lens_type,lenses in [(PotentialPlane,planes),(LensPackPlane,[ p.lensPack() for p in planes ])]:
+		
+		tracer = RayTracer(lens_type=lens_type)
+		for lens in lenses:
+			tracer.addLens(lens)
+
+		convergence = tracer.convergenceBorn(pos,z=0.7)
+		assert np.allclose(convergence,tracer.convergenceBorn(pos.reshape((2,2500)),z=0.7).reshape((50,50)))
+		assert (convergence==tracer.convergenceBorn(pos,z=0.7,chunk_size=300,n_threads=2)).all()
+
+
+def test_raw_format():
+
+	from ..simulations.raytracing import Plane,LensPackPlane
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	plane = PotentialPlane(np.random.randn(64,64)*1.0e-7,angle=200.0*u.Mpc,redshift=0.5,cosmology=cosmo,num_particles=100)
+	plane.save("raw_test.raw",double_precision=True)
+
+	#Raw planes are memory mapped, and carry the same information as the FITS ones
+	loaded = PotentialPlane.load("raw_test.raw")
+	assert isinstance(loaded.data,np.memmap)
+	assert (loaded.data==plane.data).all()
+	assert loaded.side_angle==plane.side_angle and loaded.redshift==plane.redshift and loaded.unit==plane.unit
+	assert np.isclose(loaded.comoving_distance.value,plane.comoving_distance.value)
+	assert Plane.readHeader("raw_test.raw")["NAXIS1"]==64
+
+	#Modifying a loaded plane does not modify the file
+	loaded.data[0,0] += 1.0
+	assert PotentialPlane.load("raw_test.raw").data[0,0]==plane.data[0,0]
+
+	#Single precision planes are memory mapped as they are when they are loaded in single precision
+	plane.save("raw_test_single.raw")
+	assert Plane.readHeader("raw_test_single.raw")["DTYPE"]=="<f4"
+	assert os.path.getsize("raw_test_single.raw")==64*64*4
+	loaded = PotentialPlane.load("raw_test_single.raw",dtype=np.float32)
+	assert isinstance(loaded.data,np.memmap) and loaded.data.dtype==np.float32
+	assert (loaded.data==plane.data.astype(np.float32)).all()
+	assert (PotentialPlane.load("raw_test_single.raw").data==plane.data.astype(np.float32)).all()
+
+	#Lens packs too
+	pack = LensPackPlane.fromPotential(plane)
+	pack.save("raw_pack_test.raw",double_precision=True)
+	assert (LensPackPlane.load("raw_pack_test.raw").data==pack.data).all()
+
+	pack.save("raw_pack_test_single.raw")
+	loaded = LensPackPlane.load("raw_pack_test_single.raw",dtype=np.float32)
+	assert type(loaded)==LensPackPlane and isinstance(loaded.data,np.memmap) and loaded.data.shape==(5,64,64)
+	assert (loaded.data==pack.data.astype(np.float32)).all()
+
+
+def test_single_precision():
+
+	from ..simulations.raytracing import RayTracer
+	from astropy.cosmology import w0waCDM
+
+	#The same double precision planes are traced in double precision, in single precision and in single precision with double precision accumulators
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	tracers = [ RayTracer(cache=None),RayTracer(cache=None,dtype=np.float32),RayTracer(cache=None,dtype=np.float32,accumulator_dtype=np.float64) ]
+	for n,z in enumerate([0.2,0.4,0.6,0.8]):
+		plane = PotentialPlane(np.random.randn(64,64)*1.0e-7,angle=200.0*u.Mpc,redshift=z,cosmology=cosmo)
+		plane.save("single_test{0}.fits".format(n),double_precision=True)
+		for tracer in tracers:
+			tracer.addLens(("single_test{0}.fits".format(n),plane.comoving_distance,z))
+
+	assert PotentialPlane.load("single_test0.fits",dtype=np.float32).data.dtype==np.float32
+
+	#The rays are traced in the precision of the tracer, and the single precision results are close to the double precision ones
+	pos = np.random.rand(2,32,32)*u.deg
+	jacobians = list()
+	positions = list()
+	for tracer in tracers:
+		np.random.seed(1)
+		jacobians.append(tracer.shoot(pos,z=0.7,kind="jacobians"))
+		np.random.seed(1)
+		positions.append(tracer.shoot(pos,z=0.7))
+
+	assert [ j.dtype for j in jacobians ]==[np.float64,np.float32,np.float64]
+	assert [ p.dtype for p in positions ]==[np.float64,np.float32,np.float64]
+
+	convergence = [ 1.0 - 0.5*(j[0]+j[3]) for j in jacobians ]
+	errors = list()
+	for kappa,position in zip(convergence[1:],positions[1:]):
+		errors.append(np.abs(kappa-convergence[0]).max())
+		assert 0.0 < errors[-1] < 1.0e-4*convergence[0].std()
+		assert np.abs(position-positions[0]).max().to(u.arcsec).value < 1.0e-2
+
+	#Accumulating the jacobians in double precision reduces the error
+	assert errors[1] < errors[0]
+
+
+def test_forward_linear():
+
+	from ..simulations.raytracing import RayTracer
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	x,y = np.meshgrid(np.arange(128),np.arange(128))
+	tracer = RayTracer()
+	for n,z in enumerate([0.2,0.4,0.6,0.8]):
+		tracer.addLens(PotentialPlane(1.0e-6*np.sin(2*np.pi*(x+n*10)/128.)*np.cos(2*np.pi*y/64.),angle=200.0*u.Mpc,redshift=z,cosmology=cosmo))
+
+	#Trace the sources of known images, then find the images back with forward ray tracing
+	np.random.seed(0)
+	images = np.random.uniform(0.5,4.5,size=(2,500))*u.deg
+	sources = tracer.shoot(images,z=0.7)
+
+	nearest = tracer.shootForward(sources,z=0.7,grid_resolution=64)
+	linear = tracer.shootForward(sources,z=0.7,grid_resolution=64,interpolation="linear")
+
+	#The few sources that are deflected beyond the edges of the traced grid are not located
+	located = ~np.isnan(linear.value).any(0)
+	assert located.sum() >= 0.99*len(located)
+
+	nearest_error = np.abs(nearest-images).max().to(u.arcsec).value
+	linear_error = np.abs(linear-images)[:,located].max().to(u.arcsec).value
+	assert linear_error < 0.1*nearest_error
+
+	#The intermediate steps reuse the walk of the previous ones, and end with the same images
+	intermediate = tracer.shootForward(sources,z=0.7,grid_resolution=64,interpolation="linear",save_intermediate=True)
+	assert intermediate.shape[1:]==(2,500)
+	assert np.allclose(intermediate[-1].value,linear.value,equal_nan=True)
+
+	#Under strong shear the walk stops on traced vertices that do not belong to the triangles that contain the sources: the sources are located anyway, and the error is only the one of the linear interpolation
+	grid_axes = np.linspace(0.0,1.0,32),np.linspace(0.0,1.0,32)
+	x,y = np.meshgrid(*grid_axes)
+	images = np.random.uniform(0.1,0.9,size=(2,500))
+	sources = np.array([images[0]+12.0*images[1]**2,images[1]])
+	guess = np.array([ np.clip(np.round(sources[c]*31),0,31).astype(np.int64) for c in (1,0) ])
+	apparent,vertices = tracer._invertLinear(np.array([x+12.0*y**2,y]),grid_axes,sources,guess)
+	assert np.abs(apparent-images).max() < 12.0/31**2
+
+	#The sources outside of the traced grid are not extrapolated
+	apparent,vertices = tracer._invertLinear(np.array([x+12.0*y**2,y]),grid_axes,np.array([[-1.0],[0.5]]),np.zeros((2,1),dtype=np.int64))
+	assert np.isnan(apparent).all()
+
+
+class FakeComm(object):
+
+	#In-process stand-in for the communicator of an MPI pool: the tasks run in threads, one at a time in rank order, and each of them keeps its own random number generator state (as separate processes would)
+	def __init__(self,rank,shared):
+		self.rank = rank
+		self.shared = shared
+		self.round = 0
+		self.random_state = np.random.get_state()
+
+	def Get_rank(self):
+		return self.rank
+
+	def Get_size(self):
+		return self.shared["size"]
+
+	def _wait(self,condition):
+		assert self.shared["condition"].wait_for(condition,timeout=60.0),"Task {0} waited too long for the others!".format(self.rank)
+
+	def start(self):
+		with self.shared["condition"]:
+			self._wait(lambda:self.shared["turn"]==self.rank)
+		np.random.set_state(self.random_state)
+
+	def finish(self):
+		with self.shared["condition"]:
+			self.shared["turn"] = (self.rank+1) % self.shared["size"]
+			self.shared["condition"].notify_all()
+
+	#Hand over the value of this task, pass the turn and wait for the values of all the tasks
+	def _exchange(self,value):
+
+		self.random_state = np.random.get_state()
+		values = self.shared["rounds"].setdefault(self.round,[None]*self.shared["size"])
+		values[self.rank] = value
+		self.round += 1
+
+		with self.shared["condition"]:
+			self.shared["turn"] = (self.rank+1) % self.shared["size"]
+			self.shared["condition"].notify_all()
+			self._wait(lambda:(self.shared["turn"]==self.rank) and all([ v is not None for v in values ]))
+
+		np.random.set_state(self.random_state)
+		return values
+
+	def Alltoall(self,sendbuf,recvbuf):
+		values = self._exchange(np.array(sendbuf))
+		recvbuf[:] = [ v[self.rank] for v in values ]
+
+	def Alltoallv(self,sendspec,recvspec):
+		send,(counts,displs) = sendspec
+		values = self._exchange((send.reshape(-1).copy(),np.array(counts),np.array(displs)))
+		recv,(recv_counts,recv_displs) = recvspec
+		flat = recv.reshape(-1)
+		for t,(data,c,d) in enumerate(values):
+			flat[recv_displs[t]:recv_displs[t]+recv_counts[t]] = data[d[self.rank]:d[self.rank]+c[self.rank]]
+
+	def Gather(self,sendbuf,recvbuf,root=0):
+		values = self._exchange(np.array(sendbuf))
+		if self.rank==root:
+			recvbuf[:] = np.concatenate(values)
+
+	def Gatherv(self,sendbuf,recvspec,root=0):
+		values = self._exchange(sendbuf.reshape(-1).copy())
+		if self.rank==root:
+			recv,(counts,displs) = recvspec
+			flat = recv.reshape(-1)
+			for t,data in enumerate(values):
+				flat[displs[t]:displs[t]+counts[t]] = data
+
+
+class FakePool(object):
+
+	def __init__(self,comm):
+		self.comm = comm
+		self.rank = comm.Get_rank()
+		self.size = comm.Get_size()-1
+
+	def is_master(self):
+		return self.rank==0
+
+
+#Run function(pool) on num_tasks in-process tasks, return the results of all the tasks
+def runTasks(num_tasks,function):
+
+	import threading
+
+	shared = {"size":num_tasks,"turn":0,"rounds":dict(),"condition":threading.Condition()}
+	comms = [ FakeComm(rank,shared) for rank in range(num_tasks) ]
+	results = [None]*num_tasks
+	errors = list()
+
+	def task(comm):
+		comm.start()
+		try:
+			results[comm.rank] = function(FakePool(comm))
+		except Exception as e:
+			errors.append(e)
+		finally:
+			comm.finish()
+
+	threads = [ threading.Thread(target=task,args=(comm,)) for comm in comms ]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	if errors:
+		raise errors[0]
+
+	return results
+
+
+#Trace with the planes split among num_tasks tasks, and compare with shoot
+def distributedMatchesShoot(tracer,pos,interpolation,num_tasks):
+
+	from ..simulations.logs import PerformanceRecorder
+
+	for kind in ["positions","jacobians"]:
+
+		np.random.seed(7)
+		expected = tracer.shoot(pos,z=0.7,kind=kind)
+
+		np.random.seed(7)
+		with PerformanceRecorder() as recorder:
+			results = runTasks(num_tasks,lambda pool:tracer.shootDistributed(pos,z=0.7,kind=kind,pool=pool))
+
+		assert (results[0]==expected).all()
+		assert results[1:]==[None]*(num_tasks-1)
+
+		#Each task reports the bytes of its stripe, in the tracer precision
+		halo = 2 + {"nearest":0,"bicubic":2}[interpolation]
+		bounds = np.arange(num_tasks+1)*64//num_tasks
+		assert sorted([ event["bytes"] for event in recorder.events if event["phase"]=="load" ])==sorted([ (bounds[r+1]-bounds[r]+2*halo)*64*8 for r in range(num_tasks) ]*3)
+
+def test_distributed_raytracing():
+
+	import mmap
+	from astropy.io import fits
+	from ..simulations.raytracing import RayTracer,LensPackPlane,PlaneStripe
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	planes = [ PotentialPlane(np.random.randn(64,64)*1.0e-6,angle=200.0*u.Mpc,redshift=z,cosmology=cosmo) for z in [0.2,0.4,0.6,0.8] ]
+
+	b = np.linspace(0.0,3.0,32)
+	pos = np.array(np.meshgrid(b,b))*u.deg
+
+	#Without a pool each plane is a single stripe: the results are the same as with shoot
+	for lens_type,lenses in [(PotentialPlane,planes),(LensPackPlane,[ p.lensPack() for p in planes ])]:
+		for interpolation in ["nearest","bicubic"]:
+
+			tracer = RayTracer(lens_type=lens_type,interpolation=interpolation)
+			for lens in lenses:
+				tracer.addLens(lens)
+
+			assert (tracer.shootDistributed(pos,z=0.7)==tracer.shoot(pos,z=0.7)).all()
+			assert (tracer.shootDistributed(pos,z=0.7,kind="jacobians")==tracer.shoot(pos,z=0.7,kind="jacobians")).all()
+
+	#With the planes split among the tasks of a pool the results are the same too: the tasks read only their stripes of the (memory mapped, randomly rolled) planes, also when the precision on disk is not the tracer one
+	for extension,double_precision in [("raw",True),("raw",False),("fits",False)]:
+
+		files = list()
+		for n,plane in enumerate(planes):
+			files.append("distributed_plane{0}.{1}".format(n,extension))
+			plane.save(files[-1],double_precision=double_precision)
+
+		#The pixel values are mapped, not read
+		mapped = PotentialPlane.load(files[0],dtype=None)
+		assert mapped.data.dtype.itemsize==(8 if double_precision else 4)
+		assert isinstance(mapped.data,np.memmap) or isinstance(mapped.data.base,mmap.mmap)
+
+		for interpolation in ["nearest","bicubic"]:
+
+			tracer = RayTracer(cache=None,interpolation=interpolation)
+			for plane,filename in zip(planes,files):
+				tracer.addLens((filename,plane.comoving_distance,plane.redshift))
+
+			for num_tasks in [2,3]:
+				distributedMatchesShoot(tracer,pos,interpolation,num_tasks)
+
+	#The planes that cannot be mapped are not read whole
+	with fits.open("distributed_plane0.fits") as hdu:
+		hdu[0].scale("int16",option="minmax")
+		hdu.writeto("distributed_scaled.fits",overwrite=True)
+
+	tracer = RayTracer(cache=None)
+	tracer.addLens(("distributed_scaled.fits",planes[0].comoving_distance,planes[0].redshift))
+	tracer.addLens(("distributed_plane1.fits",planes[1].comoving_distance,planes[1].redshift))
+	try:
+		tracer.shootDistributed(pos,z=0.3)
+	except ValueError:
+		pass
+	else:
+		raise AssertionError("The scaled FITS plane should not be mapped!")
+
+	#Each stripe computes the lens quantities of the rays in its rows, using its halo
+	x,y = np.random.uniform(0.0,planes[0]._pixelAngle()*64,size=(2,1000))
+	for interpolation in ["nearest","bilinear","bicubic"]:
+
+		whole = PlaneStripe(planes[0],0,64,interpolation=interpolation)
+		for first,last in [(0,20),(20,41),(41,64)]:
+			
+			stripe = PlaneStripe(planes[0],first,last,interpolation=interpolation)
+			rays = (stripe.rows(x,y)>=first) & (stripe.rows(x,y)<last)
+			assert stripe.deflection_field.shape==(last-first+2*stripe.halo,64)
+			assert (stripe.deflections(x[rays],y[rays])==whole.deflections(x[rays],y[rays])).all()
+			assert (stripe.shearMatrices(x[rays],y[rays])==whole.shearMatrices(x[rays],y[rays])).all()
+
+
+def test_checkpoint():
+
+	from ..simulations.raytracing import RayTracer
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	tracer = RayTracer(cache=None)
+	for n,z in enumerate([0.2,0.4,0.6,0.8]):
+		PotentialPlane(np.random.randn(64,64)*1.0e-5,angle=200.0*u.Mpc,redshift=z,cosmology=cosmo).save("checkpoint_plane{0}.raw".format(n))
+		tracer.addLens(("checkpoint_plane{0}.raw".format(n),cosmo.comoving_distance(z),z))
+
+	b = np.linspace(0.0,3.0,32)
+	pos = np.array(np.meshgrid(b,b))*u.deg
+
+	np.random.seed(1)
+	jacobians = tracer.shoot(pos,z=0.7,kind="jacobians")
+
+	#Interrupt the ray tracing after the third lens
+	def interrupt(jacobian,tracer,k):
+		if k==2:
+			raise KeyboardInterrupt
+
+	np.random.seed(1)
+	try:
+		tracer.shoot(pos,z=0.7,kind="jacobians",callback=interrupt,checkpoint="checkpoint_test.npz")
+	except KeyboardInterrupt:
+		pass
+
+	#The resumed run restarts from the checkpoint, with the planes rolled in the same way
+	np.random.seed(2)
+	assert os.path.exists("checkpoint_test.npz")
+	assert (tracer.shoot(pos,z=0.7,kind="jacobians",checkpoint="checkpoint_test.npz")==jacobians).all()
+	assert not os.path.exists("checkpoint_test.npz")
+
+
+def test_multiple_outputs():
+
+	from ..simulations.raytracing import RayTracer
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	tracer = RayTracer()
+	for z in [0.2,0.4,0.6,0.8,1.0]:
+		tracer.addLens(PotentialPlane(np.random.randn(64,64)*1.0e-6,angle=200.0*u.Mpc,redshift=z,cosmology=cosmo))
+
+	b = np.linspace(0.0,3.0,32)
+	pos = np.array(np.meshgrid(b,b))*u.deg
+
+	#All the outputs at all the source redshifts come from a single pass, and match the single redshift ones
+	redshifts = [0.5,0.6,0.75,0.9]
+	outputs = tracer.shoot(pos,z=redshifts,outputs=set(["positions","jacobians","convergence","shear","omega"]),chunk_size=300)
+	assert outputs["convergence"].shape==(4,32,32) and outputs["shear"].shape==(4,2,32,32)
+	assert outputs["positions"].unit==u.deg
+
+	for n,z in enumerate(redshifts):
+		
+		jacobians = tracer.shoot(pos,z=z,kind="jacobians")
+		assert np.allclose(outputs["jacobians"][n],jacobians,rtol=0.0,atol=1.0e-14)
+		assert np.allclose(outputs["convergence"][n],tracer.shoot(pos,z=z,kind="convergence"),rtol=0.0,atol=1.0e-14)
+		assert np.allclose(outputs["shear"][n],tracer.shoot(pos,z=z,kind="shear"),rtol=0.0,atol=1.0e-14)
+		assert np.allclose(outputs["omega"][n],-0.5*(jacobians[2]-jacobians[1]),rtol=0.0,atol=1.0e-14)
+		assert np.allclose(outputs["positions"][n].value,tracer.shoot(pos,z=z).value,rtol=0.0,atol=1.0e-12)
+
+	#A single source redshift has no leading dimension
+	assert tracer.shoot(pos,z=0.6,outputs=["convergence"])["convergence"].shape==(32,32)
+
+	#The outputs can be handed to a callback as soon as each source redshift is reached, instead of being collected
+	emitted = list()
+	def collect(values,tracer,n,tag):
+		assert tag=="maps"
+		emitted.append((n,values))
+
+	assert tracer.shoot(pos,z=redshifts,outputs=set(["positions","convergence"]),output_callback=collect,tag="maps",chunk_size=300) is None
+	assert [ n for n,values in emitted ]==list(range(len(redshifts)))
+	for n,values in emitted:
+		assert np.allclose(values["convergence"],outputs["convergence"][n],rtol=0.0,atol=1.0e-14)
+		assert np.allclose(values["positions"].to(u.deg).value,outputs["positions"][n].value,rtol=0.0,atol=1.0e-12)
+
+
+def test_post_born_terms():
+
+	from ..simulations.raytracing import RayTracer
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	tracer = RayTracer()
+	for z in [0.2,0.4,0.6,0.8]:
+		tracer.addLens(PotentialPlane(np.random.randn(64,64)*1.0e-6,angle=200.0*u.Mpc,redshift=z,cosmology=cosmo))
+
+	pos = np.random.rand(2,32,32)*u.deg
+
+	#The first order term alone is the Born convergence
+	born = tracer.convergenceBorn(pos,z=0.7)
+	assert np.allclose(tracer.convergencePostBorn2(pos,z=0.7,include_first_order=True,include_ll=False,include_gp=False),born,rtol=0.0,atol=1.0e-14)
+
+	#The convergence is the sum of the contributions passed to the callback
+	contributions = dict()
+	def callback(values,tracer,k,contribution_type):
+		contributions[contribution_type] = contributions.get(contribution_type,0.0) + values
+
+	convergence = tracer.convergencePostBorn2(pos,z=0.7,include_first_order=True,callback=callback)
+	assert np.allclose(convergence,contributions["ll"]+contributions["gp"]+contributions["born"],rtol=0.0,atol=1.0e-14)
+	assert np.allclose(contributions["born"],born,rtol=0.0,atol=1.0e-14)
+
+	#Transposing the lenses leaves the loaded planes untouched
+	data = tracer.lens[0].data.copy()
+	tracer.convergencePostBorn2(pos,z=0.7,transpose_up_to=1)
+	assert (tracer.lens[0].data==data).all()
+
+
+def test_performance_recorder():
+
+	import json,csv
+	from ..simulations.raytracing import RayTracer
+	from ..simulations.logs import PerformanceRecorder
+	from astropy.cosmology import w0waCDM
+
+	cosmo = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74,w0=-1.0,wa=0.0)
+	tracer = RayTracer(cache=None)
+	files = [ "profile_plane{0}.{1}".format(n,("fits" if n%2 else "raw")) for n in range(4) ]
+	for n,z in enumerate([0.2,0.4,0.6,0.8]):
+		PotentialPlane(np.random.randn(64,64)*1.0e-5,angle=200.0*u.Mpc,redshift=z,cosmology=cosmo).save(files[n],double_precision=True)
+		tracer.addLens((files[n],cosmo.comoving_distance(z),z))
+
+	pos = np.random.rand(2,32,32)*u.deg
+
+	#Nothing is recorded outside of the with statement
+	with PerformanceRecorder(task=3) as recorder:
+		tracer.shoot(pos,z=0.7,kind="jacobians",callback=lambda jacobian,tracer,k: None)
+	tracer.shoot(pos,z=0.7)
+
+	#One event per crossed lens and per phase
+	for phase in ["load","roll","gradient","update","callback"]:
+		events = [ event for event in recorder.events if event["phase"]==phase ]
+		assert len(events)==3
+		assert all([ event["task"]==3 and event["wall_time"]>=0.0 and event["peak_memory"]>0.0 for event in events ])
+
+	#The events refer to the lenses by index, the memory mapped raw planes are not read from disk during the load
+	for phase in ["load","roll"]:
+		assert [ (event["lens"],event["file"]) for event in recorder.events if event["phase"]==phase ]==list(zip(range(3),files[:3]))
+	for phase in ["gradient","update","callback"]:
+		assert [ event["lens"] for event in recorder.events if event["phase"]==phase ]==list(range(3))
+
+	assert [ event["bytes"] for event in recorder.events if event["phase"]=="load" ]==[ 0,os.path.getsize(files[1]),0 ]
+	assert set(recorder.totals())==set(["load","roll","gradient","update","callback"])
+
+	#Dump to JSON and CSV
+	recorder.save("profile_test.json")
+	recorder.save("profile_test.csv")
+	
+	with open("profile_test.json","r") as fp:
+		assert json.load(fp)==recorder.events
+	with open("profile_test.csv","r") as fp:
+		assert len(list(csv.DictReader(fp)))==len(recorder.events)
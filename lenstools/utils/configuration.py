@@ -2,6 +2,7 @@ from ..pipeline.remote import LocalSystem
 from ..simulations import Nicaea
 from ..simulations.gadget2 import Gadget2SnapshotPipe
 from .fft import FFTEngine,NUMPYFFTPack
+from .. import extern as ext
 
 #Import all the modules that use FFT operations
 from ..image import convergence,shear,noise
@@ -53,6 +54,12 @@ class Configuration(object):
 
 		self.fftengine = NUMPYFFTPack
 
+		################################################
+		#Threads used in the particle gridding (0=auto)#
+		################################################
+
+		self.gridding_threads = 0
+
 	def __setattr__(self,a,v):
 		
 		super(Configuration,self).__setattr__(a,v)
@@ -64,6 +71,10 @@ class Configuration(object):
 			for module in modules_with_fft:
 				module.fftengine = fftengine
 
+		#Update the number of threads in the gridding C backend
+		if a=="gridding_threads":
+			ext._nbody.set_threads(int(v))
+
 
 #######################
 #Default configuration#
@@ -144,6 +144,49 @@ def check_nicaea(conf):
 	return nicaea_include,nicaea_lib
 
 
+#Check if the C compiler supports OpenMP, which is used to parallelize the particle gridding
+def check_openmp(conf):
+
+	if conf.has_option("openmp","enabled") and not(conf.getboolean("openmp","enabled")):
+		return None
+
+	if conf.has_option("openmp","flags"):
+		openmp_flags = conf.get("openmp","flags").split()
+	else:
+		openmp_flags = ["-fopenmp"]
+
+	import tempfile,shutil
+	from distutils.ccompiler import new_compiler
+	from distutils.sysconfig import customize_compiler
+
+	sys.stderr.write("Checking if the C compiler supports OpenMP with {0}... ".format(" ".join(openmp_flags)))
+
+	#Try to compile and link a minimal OpenMP program
+	tmp_dir = tempfile.mkdtemp()
+	
+	try:
+		
+		compiler = new_compiler()
+		customize_compiler(compiler)
+
+		source = os.path.join(tmp_dir,"check_openmp.c")
+		with open(source,"w") as fp:
+			fp.write("#include <omp.h>\nint main(void){\n#pragma omp parallel\n{}\nreturn omp_get_max_threads()<1;\n}\n")
+
+		objects = compiler.compile([source],output_dir=tmp_dir,extra_postargs=openmp_flags)
+		compiler.link_executable(objects,os.path.join(tmp_dir,"check_openmp"),extra_postargs=openmp_flags)
+	
+	except Exception:
+		sys.stderr.write(red("[FAIL]\n"))
+		return None
+	
+	finally:
+		shutil.rmtree(tmp_dir,ignore_errors=True)
+
+	sys.stderr.write(green("[OK]\n"))
+	return openmp_flags
+
+
 ############################################################
 #####################Execution##############################
 ############################################################
@@ -200,10 +243,11 @@ external_support = dict()
 lenstools_includes = list()
 
 #List external package sources here
-external_sources["_topology"] = ["_topology.c","differentials.c","peaks.c","minkowski.c","coordinates.c","azimuth.c"]
+external_sources["_topology"] = ["_topology.c","differentials.c","peaks.c","minkowski.c","coordinates.c","azimuth.c","interpolation.c"]
 external_sources["_gadget2"] = ["_gadget2.c","read_gadget_header.c","read_gadget_particles.c","write_gadget_particles.c"]
 external_sources["_nbody"] = ["_nbody.c","grid.c","coordinates.c"]
 external_sources["_pixelize"] = ["_pixelize.c","grid.c","coordinates.c"]
+external_sources["_raytracing"] = ["_raytracing.c","jacobian.c","deflection.c","postborn.c","coordinates.c","interpolation.c"]
 
 ######################################################################################################################################
 
@@ -243,6 +287,19 @@ if conf.getboolean("nicaea","install_python_bindings"):
 		print(red("[FAIL] NICAEA bindings will not be installed (either enable option or check GSL/FFTW3/NICAEA installations)"))
 
 
+######################################################################################################################################
+
+#Decide if the particle gridding can be multithreaded
+openmp_flags = check_openmp(conf)
+openmp_modules = ["_nbody","_pixelize"]
+
+if openmp_flags is not None:
+	print(green("[OK] Checked OpenMP support, the particle gridding will be multithreaded"))
+else:
+	print(yellow("[WARNING] OpenMP support not found, the particle gridding will run on a single thread"))
+	openmp_flags = list()
+
+
 #################################################################################################
 #############################Package data########################################################
 #################################################################################################
@@ -287,9 +344,16 @@ for ext_module in external_sources.keys():
 	if ext_module in external_support.keys():
 		sources += external_support[ext_module]
 
+	#Multithreaded modules
+	if ext_module in openmp_modules:
+		compile_flags = openmp_flags
+	else:
+		compile_flags = list()
+
 	ext.append(Extension(ext_module,
                              sources,
-                             extra_link_args=lenstools_link,
+                             extra_compile_args=compile_flags,
+                             extra_link_args=lenstools_link+compile_flags,
                              include_dirs=lenstools_includes))
 
 #################################################################################################